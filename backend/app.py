@@ -2,31 +2,133 @@
 import os
 import subprocess
 import sys
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context, g
 from flask_cors import CORS
-import google.generativeai as genai
 from google.generativeai.types import GenerationConfig
 from dotenv import load_dotenv
 import codecs
 import re
 import shlex
 import ctypes # Dùng cho việc kiểm tra quyền admin trên Windows
-import traceback # Để ghi log lỗi chi tiết
 import json
 import tempfile
 import stat # cho chmod
+import atexit
+import functools
+import logging
+import time
+import contextvars
+from contextlib import ExitStack, contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from streaming import sse_event, StreamingCodeBlockDetector
+from code_blocks import parse_fenced_blocks, select_code_block, find_pip_install, text_without_blocks
+from package_check import split_requirements, is_valid_requirement, partition_requirements
+from prompt_budget import compact_parts, compact_text, estimate_tokens
+from code_validation import CodeValidator
+from process_runner import StreamingProcess, run_process
+import resource_limits
+from resource_limits import LimitPolicy, LimitError
+from output_capture import OutputStore
+from history_store import HistoryStore
+from response_cache import ResponseCache
+from gemini_clients import GeminiClientPool
+from server import run_server
+from job_queue import JobQueue, QueueFullError
+from warm_pool import PythonWarmPool
+from session_envs import SessionEnvManager, SessionEnvError, is_valid_session_id
+from kernel_sessions import KernelManager, KernelError, KernelBusyError, KernelCapacityError
+from resilience import GeminiResilience, RateLimitedError, CircuitOpenError
+from fake_gemini import FakeGenerativeModel, fake_backend_enabled
+from model_router import ModelRouter
+from app_logging import setup_logging, log_payload, new_request_id, request_id_var, dropped_records
+import metrics
 
 # Tải biến môi trường từ file .env ở thư mục gốc
 load_dotenv(dotenv_path='../.env')
 
+# Log JSON có cấu trúc qua hàng đợi nền (xem app_logging.py)
+setup_logging()
+logger = logging.getLogger(__name__)
+
 app = Flask(__name__)
 # Cho phép CORS từ frontend (chạy trên cổng 5173)
-CORS(app, resources={r"/api/*": {"origins": "http://localhost:5173"}})
+CORS(app, resources={r"/api/*": {"origins": "http://localhost:5173"}}, expose_headers=["X-Request-ID"])
+
+# Gán correlation ID cho mỗi request (nhận X-Request-ID từ client nếu có), gắn vào mọi bản ghi log
+@app.before_request
+def _assign_request_id():
+    request_id_var.set(new_request_id(request.headers.get('X-Request-ID')))
+    g.request_started_at = time.monotonic()
+
+@app.after_request
+def _log_request(response):
+    response.headers['X-Request-ID'] = request_id_var.get() or ''
+    # Với response streaming, thời gian này chỉ tính tới lúc gửi header
+    started_at = g.get('request_started_at', time.monotonic())
+    duration_ms = round((time.monotonic() - started_at) * 1000, 2)
+    logger.info("Request hoàn tất", extra={"fields": {
+        "method": request.method, "path": request.path, "status": response.status_code, "duration_ms": duration_ms,
+    }})
+    # Metrics theo mẫu route (/api/jobs/<job_id>) thay vì path thật để số series không tăng theo id.
+    # Ghi khi response đóng nên với SSE là thời gian tới khi stream kết thúc.
+    method, route, status = request.method, request.url_rule.rule if request.url_rule else 'unmatched', str(response.status_code)
+    def observe_request():
+        metrics.http_requests_total.inc(method, route, status)
+        metrics.http_request_duration_seconds.observe(time.monotonic() - started_at, method, route)
+    response.call_on_close(observe_request)
+    return response
+
+# Xóa request_id khỏi thread sau khi request (kể cả phần streaming) kết thúc, tránh log sau đó bị gán nhầm
+@app.teardown_request
+def _clear_request_id(_error=None):
+    request_id_var.set(None)
 
 # --- Cấu hình Gemini ---
 # Lấy API key mặc định từ file .env nếu có set, không thì lấy API key dán vào api ui trong run settingsetting
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
+# GEMINI_FAKE_BACKEND=1: dùng model giả cục bộ (fake_gemini.py) thay cho Gemini thật, để test/benchmark
+GEMINI_FAKE_BACKEND = fake_backend_enabled()
+if GEMINI_FAKE_BACKEND:
+    logger.warning("GEMINI_FAKE_BACKEND đang bật: mọi phản hồi Gemini là dữ liệu giả.")
+    GOOGLE_API_KEY = GOOGLE_API_KEY or 'fake-api-key'
 # để hỗ trợ việc thay đổi key động từ giao diện người dùng.
+# Mỗi API key có client riêng trong pool (không dùng genai.configure global nữa)
+gemini_client_pool = GeminiClientPool(
+    idle_ttl_seconds=float(os.getenv('GEMINI_CLIENT_IDLE_TTL_SECONDS', '900')),
+    max_clients=int(os.getenv('GEMINI_CLIENT_POOL_SIZE', '32')),
+    # > 0: lưu system instruction tĩnh vào context cache của Gemini (giây); 0 = tắt (mặc định)
+    context_cache_ttl_seconds=int(os.getenv('GEMINI_CONTEXT_CACHE_TTL_SECONDS', '0')),
+    model_factory=FakeGenerativeModel if GEMINI_FAKE_BACKEND else None
+)
+
+# Retry + backoff có jitter, giới hạn tốc độ theo API key và circuit breaker quanh generate_content
+gemini_resilience = GeminiResilience(
+    max_attempts=int(os.getenv('GEMINI_RETRY_MAX_ATTEMPTS', '3')),
+    base_delay=float(os.getenv('GEMINI_RETRY_BASE_DELAY_SECONDS', '0.5')),
+    max_delay=float(os.getenv('GEMINI_RETRY_MAX_DELAY_SECONDS', '8')),
+    deadline_seconds=float(os.getenv('GEMINI_CALL_DEADLINE_SECONDS', '90')), # Tổng thời gian cho mọi lần thử
+    rate_limit_per_minute=float(os.getenv('GEMINI_RATE_LIMIT_PER_MINUTE', '0')), # 0 = không giới hạn phía client
+    rate_limit_burst=int(os.getenv('GEMINI_RATE_LIMIT_BURST', '10')),
+    breaker_failure_threshold=int(os.getenv('GEMINI_BREAKER_FAILURE_THRESHOLD', '5')), # Số request (đã hết lượt retry) lỗi liên tiếp để mở breaker
+    breaker_reset_seconds=float(os.getenv('GEMINI_BREAKER_RESET_SECONDS', '30'))
+)
+
+# --- Định tuyến model theo ngân sách độ trễ ---
+# GEMINI_ROUTING_MODE: 'off' (mặc định, chỉ dùng model_name), 'fallback' (model lỗi -> model kế tiếp)
+# hoặc 'hedge' (thêm: model chính chậm hơn hedge delay -> gửi song song tới model dự phòng).
+# Mỗi request có thể ghi đè bằng model_config.routing và model_config.fallback_models.
+GEMINI_ROUTING_MODE = os.getenv('GEMINI_ROUTING_MODE', 'off').lower()
+GEMINI_FALLBACK_MODELS = [name.strip() for name in os.getenv('GEMINI_FALLBACK_MODELS', 'gemini-1.5-flash-8b').split(',') if name.strip()]
+# Ngân sách độ trễ (giây) mỗi endpoint; ghi đè bằng GEMINI_LATENCY_BUDGET_<ENDPOINT>_SECONDS
+ENDPOINT_LATENCY_BUDGETS = {
+    endpoint: float(os.getenv(f'GEMINI_LATENCY_BUDGET_{endpoint.upper()}_SECONDS', default))
+    for endpoint, default in (('generate', '45'), ('review', '60'), ('debug', '60'), ('explain', '45'))
+}
+model_router = ModelRouter(
+    default_hedge_delay=float(os.getenv('GEMINI_HEDGE_DELAY_SECONDS', '2')), # Dùng khi model chưa đủ mẫu độ trễ
+    min_hedge_delay=float(os.getenv('GEMINI_HEDGE_MIN_DELAY_SECONDS', '0.3')),
+    min_samples=int(os.getenv('GEMINI_HEDGE_MIN_SAMPLES', '20'))
+)
 
 # --- Ánh xạ cài đặt an toàn (KHÔNG THAY ĐỔI) ---
 SAFETY_SETTINGS_MAP = {
@@ -56,6 +158,58 @@ SAFETY_SETTINGS_MAP = {
     ],
 }
 
+# --- Cache phản hồi Gemini ---
+# GEMINI_CACHE_MODE: 'auto' (chỉ cache khi temperature = 0, mặc định), 'always' hoặc 'off'
+# Mỗi request có thể ép bật/tắt cache bằng model_config.cache = true/false
+GEMINI_CACHE_MODE = os.getenv('GEMINI_CACHE_MODE', 'auto').lower()
+response_cache = ResponseCache(
+    max_entries=int(os.getenv('GEMINI_CACHE_MAX_ENTRIES', '256')),
+    ttl_seconds=float(os.getenv('GEMINI_CACHE_TTL_SECONDS', '3600')),
+    disk_path=os.getenv('GEMINI_CACHE_DISK_PATH') # Bỏ trống = chỉ cache trong bộ nhớ
+)
+
+# --- Lịch sử hội thoại (SQLite, xem history_store.py) ---
+# HISTORY_DB_PATH: file SQLite (mặc định history.sqlite3 cạnh app.py); đặt rỗng để tắt ghi lịch sử
+# Mỗi request gửi "conversation_id" trong body (hoặc header X-Conversation-Id) để gom tương tác theo hội thoại;
+# request không có conversation_id không được ghi lịch sử (không gom mọi client vào một hội thoại chung)
+HISTORY_DB_PATH = os.getenv('HISTORY_DB_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'history.sqlite3'))
+history_store = HistoryStore(
+    HISTORY_DB_PATH,
+    max_field_chars=int(os.getenv('HISTORY_MAX_FIELD_CHARS', '65536'))
+) if HISTORY_DB_PATH else None
+# Số mục tối đa mỗi trang lịch sử/tìm kiếm
+HISTORY_PAGE_MAX = 200
+
+# conversation_id của request (body hoặc header X-Conversation-Id), None nếu không có
+def _conversation_id(data):
+    conversation_id = data.get('conversation_id') or request.headers.get('X-Conversation-Id')
+    return str(conversation_id)[:128] if conversation_id else None
+
+# Ghi một tương tác vào lịch sử (không chặn; bỏ qua nếu tắt lịch sử)
+def _record_history(kind, conversation_id, status_code, **fields):
+    if history_store and conversation_id is not None:
+        history_store.append(conversation_id, kind, status=status_code, request_id=request_id_var.get(), **fields)
+
+# Trường lịch sử lấy từ kết quả của từng loại tương tác Gemini
+def _history_result_fields(kind, payload):
+    if kind == 'generate':
+        return {"code": payload.get("code")}
+    if kind == 'debug':
+        return {"output": payload.get("explanation"), "extra": {
+            key: payload.get(key) for key in ("corrected_code", "suggested_package") if payload.get(key)
+        }}
+    return {"output": payload.get("review") or payload.get("explanation")}
+
+# Bọc build_result của generate/review/debug/explain để ghi lịch sử khi có kết quả (cả stream và không stream);
+# request_fields: prompt/code/file_type lấy từ request
+def _with_history(kind, conversation_id, build_result, **request_fields):
+    def build(raw_response):
+        payload, status_code = build_result(raw_response)
+        result_fields = _history_result_fields(kind, payload)
+        _record_history(kind, conversation_id, status_code, error=payload.get("error"), **{**request_fields, **result_fields})
+        return payload, status_code
+    return build
+
 # clean tên HĐH 
 def get_os_name(platform_str):
     if platform_str == "win32": return "windows"
@@ -80,11 +234,14 @@ def get_language_name(file_ext):
     # Thêm các ngôn ngữ khác nếu cần
     return f'file .{ext_lower}' # Mặc định
 
-# Hàm tạo prompt để yêu cầu Gemini sinh code 
-def create_prompt(user_input, backend_os_name, target_os_name, file_type):
-    # Xác định file type description và extension
-    file_extension = ""
-    file_type_description = ""
+# --- Prompt ---
+# Mỗi hàm create_* trả về (system_instruction, user_prompt):
+#   system_instruction - phần hướng dẫn tĩnh, chỉ phụ thuộc HĐH/loại file/loại prompt -> được memoize
+#                        và gắn một lần vào model đã cache trong pool (tùy chọn lưu vào context cache của Gemini)
+#   user_prompt        - phần thay đổi theo từng request (yêu cầu, code, output...)
+
+# Mô tả file và tag code block cho prompt sinh code, từ tên file đầy đủ hoặc extension
+def _describe_file_type(file_type):
     # Xử lý file_type_input có thể là tên file đầy đủ hoặc chỉ extension
     if file_type and '.' in file_type:
         file_extension = file_type.split('.')[-1].lower() # Lấy phần sau dấu chấm cuối cùng
@@ -98,8 +255,12 @@ def create_prompt(user_input, backend_os_name, target_os_name, file_type):
 
     # Đảm bảo có file_extension hợp lệ để dùng làm tag code block
     code_block_tag = file_extension if file_extension and file_extension.isalnum() else 'code'
+    return file_type_description, code_block_tag
 
-    prompt = f"""
+@functools.lru_cache(maxsize=256)
+def _generate_system_instruction(backend_os_name, target_os_name, file_type):
+    file_type_description, code_block_tag = _describe_file_type(file_type)
+    return f"""
 Bạn là một trợ lý AI chuyên tạo mã nguồn để thực thi các tác vụ trên máy tính dựa trên yêu cầu của người dùng.
 **Môi trường Backend:** Máy chủ đang chạy {backend_os_name}.
 **Mục tiêu Người dùng:** Tạo mã phù hợp để lưu vào **{file_type_description}** và chạy trên hệ điều hành **{target_os_name}**.
@@ -177,44 +338,104 @@ exit 0
 ```
 
 **(Nhắc lại)** Chỉ cung cấp khối mã nguồn cuối cùng cho **{file_type_description}** trên **{target_os_name}** trong cặp dấu ```{code_block_tag} ... ```.
+"""
 
+# Hàm tạo prompt để yêu cầu Gemini sinh code 
+def create_prompt(user_input, backend_os_name, target_os_name, file_type):
+    system_instruction = _generate_system_instruction(backend_os_name, target_os_name, file_type)
+    user_prompt = f"""
 **Yêu cầu của người dùng:** "{user_input}"
 
 **Khối mã nguồn:**
 """
-    return prompt
+    return system_instruction, user_prompt
 
 
-# Hàm tạo prompt để yêu cầu Gemini đánh giá code 
-def create_review_prompt(code_to_review, language): # Nhận language là extension (py, sh, bat, v.v...)
+@functools.lru_cache(maxsize=64)
+def _review_system_instruction(language):
     language_name = get_language_name(language) # Lấy tên ngôn ngữ an toàn
     code_block_tag = language if language and language.isalnum() else 'code' # Tag cho khối mã
-
-    prompt = f"""
-Bạn là một chuyên gia đánh giá code **{language_name}**. Hãy phân tích đoạn mã **{language_name}** sau đây và đưa ra nhận xét về:
+    return f"""
+Bạn là một chuyên gia đánh giá code **{language_name}**. Hãy phân tích đoạn mã **{language_name}** người dùng gửi và đưa ra nhận xét về:
 1.  **Độ an toàn:** Liệu mã có chứa các lệnh nguy hiểm không? Rủi ro? (Đặc biệt chú ý với script hệ thống như Batch/Shell)
 2.  **Tính đúng đắn:** Mã có thực hiện đúng yêu cầu dự kiến không? Có lỗi cú pháp hoặc logic nào không?
 3.  **Tính hiệu quả/Tối ưu:** Có cách viết tốt hơn, ngắn gọn hơn hoặc hiệu quả hơn trong **{language_name}** không?
 4.  **Khả năng tương thích:** Chạy được trên các OS khác không (nếu có thể áp dụng)?
 5.  **Không cần đưa code cải tiến**
 
+**QUAN TRỌNG:** Chỉ trả về phần văn bản nhận xét/đánh giá bằng Markdown. Bắt đầu trực tiếp bằng nội dung đánh giá. Định dạng các khối mã ví dụ (nếu có) trong Markdown bằng ```{code_block_tag} ... ```. Kết thúc bằng dòng 'Mức độ an toàn: An toàn/Ổn/Nguy hiểm'.
+"""
+
+# Hàm tạo prompt để yêu cầu Gemini đánh giá code 
+def create_review_prompt(code_to_review, language): # Nhận language là extension (py, sh, bat, v.v...)
+    language_name = get_language_name(language)
+    code_block_tag = language if language and language.isalnum() else 'code'
+
+    user_prompt = f"""
 Đoạn mã **{language_name}** cần đánh giá:
 ```{code_block_tag}
 {code_to_review}
 ```
+"""
+    return _review_system_instruction(language), user_prompt
 
-**QUAN TRỌNG:** Chỉ trả về phần văn bản nhận xét/đánh giá bằng Markdown. Bắt đầu trực tiếp bằng nội dung đánh giá. Định dạng các khối mã ví dụ (nếu có) trong Markdown bằng ```{code_block_tag} ... ```. Kết thúc bằng dòng 'Mức độ an toàn: An toàn/Ổn/Nguy hiểm'.
+
+@functools.lru_cache(maxsize=64)
+def _debug_system_instruction(language):
+    language_name = get_language_name(language)
+    code_block_tag = language if language and language.isalnum() else 'code'
+    return f"""
+Bạn là một chuyên gia gỡ lỗi **{language_name}**. Người dùng đã cố gắng chạy một đoạn mã **{language_name}** dựa trên yêu cầu ban đầu của họ, nhưng đã gặp lỗi.
+Bạn sẽ nhận được: (1) yêu cầu ban đầu, (2) đoạn mã đã chạy, (3) stdout và (4) stderr khi chạy mã.
+
+**Nhiệm vụ của bạn:**
+a.  **Phân tích:** Xác định nguyên nhân chính xác gây ra lỗi dựa trên `stderr`, `stdout` và mã nguồn **{language_name}**.
+b.  **Giải thích:** Cung cấp một giải thích rõ ràng, ngắn gọn về lỗi cho người dùng bằng Markdown.
+c.  **Đề xuất Hành động / Cài đặt:**
+    *   **QUAN TRỌNG (CHỈ CHO PYTHON):** Nếu lỗi là `ModuleNotFoundError` (và ngôn ngữ là Python), hãy xác định tên module và đề xuất lệnh `pip install` trong khối ```bash ... ``` DUY NHẤT.
+    *   Nếu lỗi do nguyên nhân khác (thiếu file, quyền, cú pháp sai, lệnh không tồn tại trong Batch/Shell, cấu hình môi trường...) hoặc **ngôn ngữ không phải Python**, hãy đề xuất hành động người dùng cần làm thủ công. **KHÔNG đề xuất `pip install` cho ngôn ngữ không phải Python.**
+d.  **Sửa lỗi Code:** Nếu lỗi có thể sửa trực tiếp trong mã **{language_name}**, hãy cung cấp phiên bản mã đã sửa lỗi trong khối ```{code_block_tag} ... ``` CUỐI CÙNG. Nếu không thể sửa lỗi trong code, hãy giải thích tại sao.
+
+**QUAN TRỌNG:**
+*   Trả về phần giải thích và đề xuất hành động (bằng Markdown) trước.
+*   Nếu có lệnh cài đặt pip (chỉ cho Python), đặt nó trong khối ```bash ... ``` riêng.
+*   Sau đó, nếu có thể sửa code, cung cấp khối mã ```{code_block_tag} ... ``` CUỐI CÙNG chứa code đã sửa. Không thêm lời dẫn hay giải thích nào khác sau khối mã này.
+*   Nếu không sửa được code, chỉ cần giải thích và (nếu có) đề xuất hành động/cài đặt.
 """
-    return prompt
 
 # Hàm tạo prompt để yêu cầu Gemini gỡ lỗi code 
+# --- Ngân sách token cho phần dữ liệu người dùng trong prompt debug/explain (xem prompt_budget.py) ---
+# Output dài được gộp dòng lặp/frame traceback rồi cắt head + tail, luôn giữ exception cuối
+PROMPT_BUDGET_DEBUG_TOKENS = int(os.getenv('PROMPT_BUDGET_DEBUG_TOKENS', '12000'))
+PROMPT_BUDGET_EXPLAIN_TOKENS = int(os.getenv('PROMPT_BUDGET_EXPLAIN_TOKENS', '8000'))
+# Trọng số chia ngân sách debug: code cần cho bản sửa, stderr chứa lỗi, stdout ít quan trọng nhất
+_DEBUG_BUDGET_WEIGHTS = {"code": 3, "stderr": 2, "stdout": 1}
+
+def _observe_prompt_compaction(endpoint, reports):
+    if not reports:
+        return
+    elided = sum(report["elided_tokens"] for report in reports.values())
+    metrics.prompt_compactions_total.inc(endpoint)
+    metrics.prompt_tokens_elided_total.inc(endpoint, amount=elided)
+    logger.info(f"Rút gọn dữ liệu prompt {endpoint}: bỏ ~{elided} token", extra={"fields": {"parts": sorted(reports)}})
+
+# Gắn báo cáo rút gọn prompt (nếu có) vào kết quả (payload, status_code)
+def _with_prompt_compaction(result, compaction):
+    payload, status_code = result
+    return ({**payload, "prompt_compaction": compaction} if compaction else payload), status_code
+
+# Trả về (system_instruction, user_prompt, compaction); compaction = {phần: báo cáo} cho các phần bị rút gọn
 def create_debug_prompt(original_prompt, failed_code, stdout, stderr, language): # Nhận language là extension
     language_name = get_language_name(language)
     code_block_tag = language if language and language.isalnum() else 'code'
+    parts, compaction = compact_parts(
+        {"code": failed_code or "", "stdout": stdout or "", "stderr": stderr or ""},
+        PROMPT_BUDGET_DEBUG_TOKENS, _DEBUG_BUDGET_WEIGHTS, collapse={"code": False}
+    )
+    _observe_prompt_compaction('debug', compaction)
+    failed_code, stdout, stderr = parts["code"], parts["stdout"], parts["stderr"]
 
-    prompt = f"""
-Bạn là một chuyên gia gỡ lỗi **{language_name}**. Người dùng đã cố gắng chạy một đoạn mã **{language_name}** dựa trên yêu cầu ban đầu của họ, nhưng đã gặp lỗi.
-
+    user_prompt = f"""
 **1. Yêu cầu ban đầu của người dùng:**
 {original_prompt}
 
@@ -233,33 +454,54 @@ Bạn là một chuyên gia gỡ lỗi **{language_name}**. Người dùng đã
 {stderr if stderr else "(Không có lỗi stderr)"}
 ```
 
-**Nhiệm vụ của bạn:**
-a.  **Phân tích:** Xác định nguyên nhân chính xác gây ra lỗi dựa trên `stderr`, `stdout` và mã nguồn **{language_name}**.
-b.  **Giải thích:** Cung cấp một giải thích rõ ràng, ngắn gọn về lỗi cho người dùng bằng Markdown.
-c.  **Đề xuất Hành động / Cài đặt:**
-    *   **QUAN TRỌNG (CHỈ CHO PYTHON):** Nếu lỗi là `ModuleNotFoundError` (và ngôn ngữ là Python), hãy xác định tên module và đề xuất lệnh `pip install` trong khối ```bash ... ``` DUY NHẤT.
-    *   Nếu lỗi do nguyên nhân khác (thiếu file, quyền, cú pháp sai, lệnh không tồn tại trong Batch/Shell, cấu hình môi trường...) hoặc **ngôn ngữ không phải Python**, hãy đề xuất hành động người dùng cần làm thủ công. **KHÔNG đề xuất `pip install` cho ngôn ngữ không phải Python.**
-d.  **Sửa lỗi Code:** Nếu lỗi có thể sửa trực tiếp trong mã **{language_name}**, hãy cung cấp phiên bản mã đã sửa lỗi trong khối ```{code_block_tag} ... ``` CUỐI CÙNG. Nếu không thể sửa lỗi trong code, hãy giải thích tại sao.
-
-**QUAN TRỌNG:**
-*   Trả về phần giải thích và đề xuất hành động (bằng Markdown) trước.
-*   Nếu có lệnh cài đặt pip (chỉ cho Python), đặt nó trong khối ```bash ... ``` riêng.
-*   Sau đó, nếu có thể sửa code, cung cấp khối mã ```{code_block_tag} ... ``` CUỐI CÙNG chứa code đã sửa. Không thêm lời dẫn hay giải thích nào khác sau khối mã này.
-*   Nếu không sửa được code, chỉ cần giải thích và (nếu có) đề xuất hành động/cài đặt.
-
 **Phân tích và đề xuất:**
 """
-    return prompt
+    return _debug_system_instruction(language), user_prompt, compaction
 
 
-# Hàm tạo prompt để yêu cầu Gemini giải thích 
-def create_explain_prompt(content_to_explain, context, language=None): # Nhận language là extension (optional)
+# Phần hướng dẫn của prompt giải thích chỉ phụ thuộc ngữ cảnh và tên ngôn ngữ
+@functools.lru_cache(maxsize=64)
+def _explain_system_instruction(context, language_name):
     prompt_header = "Bạn là một trợ lý AI giỏi giải thích các khái niệm kỹ thuật một cách đơn giản, dễ hiểu cho người dùng không chuyên."
-    prompt_instruction = "\n\n**Yêu cầu:** Giải thích nội dung sau đây bằng tiếng Việt, sử dụng Markdown, tập trung vào ý nghĩa chính và những điều người dùng cần biết. Giữ cho giải thích ngắn gọn và rõ ràng. Bắt đầu trực tiếp bằng nội dung giải thích, không thêm lời dẫn."
+    if context == 'code': # Sử dụng context 'code' chung
+        prompt_instruction = f"\n\n**Yêu cầu:** Giải thích đoạn mã **{language_name}** này làm gì, mục đích chính của nó là gì, và tóm tắt các bước thực hiện chính (nếu có). Trả lời bằng tiếng Việt, sử dụng Markdown. Bắt đầu trực tiếp bằng nội dung giải thích."
+    elif context == 'execution_result':
+        prompt_instruction = "\n\n**Yêu cầu:** Phân tích kết quả thực thi này (stdout, stderr, mã trả về). Cho biết lệnh có vẻ đã thành công hay thất bại và giải thích ngắn gọn tại sao dựa trên kết quả. Lưu ý cả các cảnh báo (warning) nếu có. Trả lời bằng tiếng Việt, sử dụng Markdown. Bắt đầu trực tiếp bằng nội dung giải thích."
+    elif context == 'review_text':
+        prompt_instruction = "\n\n**Yêu cầu:** Tóm tắt và giải thích những điểm chính của bài đánh giá code này bằng ngôn ngữ đơn giản hơn. Trả lời bằng tiếng Việt, sử dụng Markdown. Bắt đầu trực tiếp bằng nội dung giải thích."
+    elif context == 'debug_result':
+        prompt_instruction = f"\n\n**Yêu cầu:** Giải thích kết quả gỡ lỗi này, bao gồm nguyên nhân lỗi được xác định, ý nghĩa của đề xuất cài đặt package (nếu có và chỉ cho Python), và mục đích của đoạn code {language_name} đã sửa (nếu có). Trả lời bằng tiếng Việt, sử dụng Markdown. Bắt đầu trực tiếp bằng nội dung giải thích."
+    elif context == 'error_message':
+        prompt_instruction = "\n\n**Yêu cầu:** Giải thích thông báo lỗi này có nghĩa là gì, nguyên nhân phổ biến có thể gây ra nó, và gợi ý hướng khắc phục (nếu có thể). Trả lời bằng tiếng Việt, sử dụng Markdown. Bắt đầu trực tiếp bằng nội dung giải thích."
+    elif context == 'installation_result':
+        prompt_instruction = "\n\n**Yêu cầu:** Phân tích kết quả cài đặt package này. Cho biết việc cài đặt thành công hay thất bại, và giải thích ngắn gọn output/error từ pip. Trả lời bằng tiếng Việt, sử dụng Markdown. Bắt đầu trực tiếp bằng nội dung giải thích."
+    else: # Ngữ cảnh mặc định hoặc không xác định
+        prompt_instruction = "\n\n**Yêu cầu:** Giải thích nội dung người dùng gửi bằng tiếng Việt, sử dụng Markdown, tập trung vào ý nghĩa chính và những điều người dùng cần biết. Giữ cho giải thích ngắn gọn và rõ ràng. Bắt đầu trực tiếp bằng nội dung giải thích, không thêm lời dẫn."
+    return f"{prompt_header}{prompt_instruction}"
+
+# Rút gọn nội dung cần giải thích trong ngân sách: JSON (kết quả thực thi/cài đặt/debug) thì rút gọn từng trường
+# chuỗi dài (stdout, stderr, output...), giữ cấu trúc JSON; còn lại rút gọn cả đoạn. Trả về (nội dung, compaction)
+def _compact_explain_content(content, parsed_json, context):
+    if isinstance(parsed_json, dict):
+        text_fields = {key: value for key, value in parsed_json.items() if isinstance(value, str)}
+        other_tokens = estimate_tokens(json.dumps({key: value for key, value in parsed_json.items() if key not in text_fields}, ensure_ascii=False))
+        compacted, compaction = compact_parts(
+            text_fields, max(1, PROMPT_BUDGET_EXPLAIN_TOKENS - other_tokens), {key: 1 for key in text_fields},
+            collapse={key: key not in ('code', 'corrected_code', 'codeThatFailed') for key in text_fields}
+        )
+        if not compaction:
+            return content, {}
+        return json.dumps({**parsed_json, **compacted}, ensure_ascii=False, indent=2), compaction
+    compacted, report = compact_text(content, PROMPT_BUDGET_EXPLAIN_TOKENS, collapse=context != 'code')
+    return compacted, ({"content": report.to_dict()} if report.changed else {})
+
+# Hàm tạo prompt để yêu cầu Gemini giải thích; trả về (system_instruction, prompt, compaction)
+def create_explain_prompt(content_to_explain, context, language=None): # Nhận language là extension (optional)
     context_description = ""
     language_name = get_language_name(language) if language else "nội dung"
     code_block_tag = language if language and language.isalnum() else 'code'
 
+    parsed_json = None
     try:
         if isinstance(content_to_explain, str) and content_to_explain.strip().startswith('{') and content_to_explain.strip().endswith('}'):
              parsed_json = json.loads(content_to_explain)
@@ -268,16 +510,15 @@ def create_explain_prompt(content_to_explain, context, language=None): # Nhận
              content_to_explain_formatted = str(content_to_explain)
     except json.JSONDecodeError:
          content_to_explain_formatted = str(content_to_explain)
+    content_to_explain_formatted, compaction = _compact_explain_content(content_to_explain_formatted, parsed_json, context)
+    _observe_prompt_compaction('explain', compaction)
 
     if context == 'code': # Sử dụng context 'code' chung
         context_description = f"Đây là một đoạn mã **{language_name}**:\n```{code_block_tag}\n{content_to_explain_formatted}\n```"
-        prompt_instruction = f"\n\n**Yêu cầu:** Giải thích đoạn mã **{language_name}** này làm gì, mục đích chính của nó là gì, và tóm tắt các bước thực hiện chính (nếu có). Trả lời bằng tiếng Việt, sử dụng Markdown. Bắt đầu trực tiếp bằng nội dung giải thích."
     elif context == 'execution_result':
         context_description = f"Đây là kết quả sau khi thực thi một đoạn mã:\n```json\n{content_to_explain_formatted}\n```"
-        prompt_instruction = "\n\n**Yêu cầu:** Phân tích kết quả thực thi này (stdout, stderr, mã trả về). Cho biết lệnh có vẻ đã thành công hay thất bại và giải thích ngắn gọn tại sao dựa trên kết quả. Lưu ý cả các cảnh báo (warning) nếu có. Trả lời bằng tiếng Việt, sử dụng Markdown. Bắt đầu trực tiếp bằng nội dung giải thích."
     elif context == 'review_text':
         context_description = f"Đây là một bài đánh giá code:\n```markdown\n{content_to_explain_formatted}\n```"
-        prompt_instruction = "\n\n**Yêu cầu:** Tóm tắt và giải thích những điểm chính của bài đánh giá code này bằng ngôn ngữ đơn giản hơn. Trả lời bằng tiếng Việt, sử dụng Markdown. Bắt đầu trực tiếp bằng nội dung giải thích."
     elif context == 'debug_result':
         # Cố gắng lấy language từ content nếu là object
         debug_language = language
@@ -292,171 +533,439 @@ def create_explain_prompt(content_to_explain, context, language=None): # Nhận
         language_name = get_language_name(debug_language) if debug_language else "code"
 
         context_description = f"Đây là kết quả từ việc gỡ lỗi một đoạn mã {language_name}:\n```json\n{content_to_explain_formatted}\n```"
-        prompt_instruction = f"\n\n**Yêu cầu:** Giải thích kết quả gỡ lỗi này, bao gồm nguyên nhân lỗi được xác định, ý nghĩa của đề xuất cài đặt package (nếu có và chỉ cho Python), và mục đích của đoạn code {language_name} đã sửa (nếu có). Trả lời bằng tiếng Việt, sử dụng Markdown. Bắt đầu trực tiếp bằng nội dung giải thích."
     elif context == 'error_message':
         context_description = f"Đây là một thông báo lỗi:\n```\n{content_to_explain_formatted}\n```"
-        prompt_instruction = "\n\n**Yêu cầu:** Giải thích thông báo lỗi này có nghĩa là gì, nguyên nhân phổ biến có thể gây ra nó, và gợi ý hướng khắc phục (nếu có thể). Trả lời bằng tiếng Việt, sử dụng Markdown. Bắt đầu trực tiếp bằng nội dung giải thích."
     elif context == 'installation_result':
         context_description = f"Đây là kết quả sau khi cài đặt một package Python:\n```json\n{content_to_explain_formatted}\n```"
-        prompt_instruction = "\n\n**Yêu cầu:** Phân tích kết quả cài đặt package này. Cho biết việc cài đặt thành công hay thất bại, và giải thích ngắn gọn output/error từ pip. Trả lời bằng tiếng Việt, sử dụng Markdown. Bắt đầu trực tiếp bằng nội dung giải thích."
     else: # Ngữ cảnh mặc định hoặc không xác định
          context_description = f"Nội dung cần giải thích:\n```\n{content_to_explain_formatted}\n```"
 
-    full_prompt = f"{prompt_header}{context_description}{prompt_instruction}"
-    return full_prompt
+    known_contexts = ('code', 'execution_result', 'review_text', 'debug_result', 'error_message', 'installation_result')
+    system_instruction = _explain_system_instruction(context if context in known_contexts else 'unknown', language_name)
+    return system_instruction, context_description, compaction
 
 
-# Hàm gọi Gemini API, xử lý việc chọn API Key và các tham số
-def generate_response_from_gemini(full_prompt, model_config, is_for_review_or_debug=False):
+# Chuẩn bị model + tham số cho một lần gọi Gemini (dùng chung cho cả chế độ thường và streaming)
+# Trả về (call, None) nếu thành công, hoặc (None, chuỗi lỗi) nếu cấu hình sai
+def _prepare_gemini_call(model_config, system_instruction=None):
     global GOOGLE_API_KEY # Dùng key mặc định từ .env
-    ui_api_key = None # Key người dùng nhập từ giao diện
 
-    try:
-        ui_api_key = model_config.pop('api_key', None)
-        if ui_api_key and not ui_api_key.strip():
-            ui_api_key = None
+    ui_api_key = model_config.pop('api_key', None) # Key người dùng nhập từ giao diện
+    if ui_api_key and not ui_api_key.strip():
+        ui_api_key = None
 
-        effective_api_key = ui_api_key if ui_api_key else GOOGLE_API_KEY
+    effective_api_key = ui_api_key if ui_api_key else GOOGLE_API_KEY
 
-        if not effective_api_key:
-            print("[LỖI] Không có API Key nào được cấu hình (cả .env và UI).")
-            return "Lỗi cấu hình: Thiếu API Key. Vui lòng đặt GOOGLE_API_KEY trong .env hoặc nhập vào Cài đặt."
+    if not effective_api_key:
+        logger.error("Không có API Key nào được cấu hình (cả .env và UI).")
+        return None, "Lỗi cấu hình: Thiếu API Key. Vui lòng đặt GOOGLE_API_KEY trong .env hoặc nhập vào Cài đặt."
 
-        try:
-            genai.configure(api_key=effective_api_key)
-            if ui_api_key:
-                 print("[INFO] Sử dụng API Key từ giao diện cho yêu cầu này.")
-        except Exception as config_e:
-             key_source = "giao diện" if ui_api_key else ".env"
-             print(f"[LỖI] Lỗi khi cấu hình Gemini với API Key từ {key_source}: {config_e}")
-             error_detail = str(config_e)
-             if "API key not valid" in error_detail:
-                  return f"Lỗi cấu hình: API key từ {key_source} không hợp lệ. Vui lòng kiểm tra lại."
-             else:
-                  return f"Lỗi cấu hình: Không thể cấu hình Gemini với API key từ {key_source} ({error_detail})."
-
-        model_name = model_config.get('model_name', 'gemini-1.5-flash')
-        if not model_name: model_name = 'gemini-1.5-flash'
-
-        temperature = model_config.get('temperature', 0.7)
-        top_p = model_config.get('top_p', 0.95)
-        top_k = model_config.get('top_k', 40)
-        safety_setting_key = model_config.get('safety_setting', 'BLOCK_MEDIUM_AND_ABOVE')
-        safety_settings = SAFETY_SETTINGS_MAP.get(safety_setting_key, SAFETY_SETTINGS_MAP['BLOCK_MEDIUM_AND_ABOVE'])
-
-        generation_config = GenerationConfig(
-            temperature=float(temperature),
-            top_p=float(top_p),
-            top_k=int(top_k)
-        )
+    model_name = model_config.get('model_name', 'gemini-1.5-flash')
+    if not model_name: model_name = 'gemini-1.5-flash'
 
-        print(f"Đang gọi model: {model_name} với cấu hình: T={temperature}, P={top_p}, K={top_k}, Safety={safety_setting_key}")
-        model = genai.GenerativeModel(model_name=model_name)
+    try:
+        model = gemini_client_pool.get_model(effective_api_key, model_name, system_instruction)
+        if ui_api_key:
+             logger.info("Sử dụng API Key từ giao diện cho yêu cầu này.")
+    except Exception as config_e:
+         key_source = "giao diện" if ui_api_key else ".env"
+         logger.error(f"Lỗi khi cấu hình Gemini với API Key từ {key_source}: {config_e}")
+         error_detail = str(config_e)
+         if "API key not valid" in error_detail:
+              return None, f"Lỗi cấu hình: API key từ {key_source} không hợp lệ. Vui lòng kiểm tra lại."
+         else:
+              return None, f"Lỗi cấu hình: Không thể cấu hình Gemini với API key từ {key_source} ({error_detail})."
+
+    temperature = model_config.get('temperature', 0.7)
+    top_p = model_config.get('top_p', 0.95)
+    top_k = model_config.get('top_k', 40)
+    safety_setting_key = model_config.get('safety_setting', 'BLOCK_MEDIUM_AND_ABOVE')
+    safety_settings = SAFETY_SETTINGS_MAP.get(safety_setting_key, SAFETY_SETTINGS_MAP['BLOCK_MEDIUM_AND_ABOVE'])
+
+    generation_config = GenerationConfig(
+        temperature=float(temperature),
+        top_p=float(top_p),
+        top_k=int(top_k)
+    )
 
-        response = model.generate_content(
-            full_prompt,
-            generation_config=generation_config,
-            safety_settings=safety_settings
-        )
+    logger.info(f"Đang gọi model: {model_name} với cấu hình: T={temperature}, P={top_p}, K={top_k}, Safety={safety_setting_key}")
+    call = {
+        "model": model,
+        "model_name": model_name,
+        "generation_config": generation_config,
+        "safety_settings": safety_settings,
+        "ui_api_key": ui_api_key,
+        "api_key": effective_api_key,
+    }
+    return call, None
+
+# Gọi generate_content qua lớp resilience (retry/backoff, rate limit theo key, circuit breaker)
+# deadline: mốc time.monotonic() phải xong (None = chỉ dùng GEMINI_CALL_DEADLINE_SECONDS)
+def _generate_content(call, contents, stream=False, deadline=None):
+    return gemini_resilience.call(
+        call["api_key"], call["model_name"],
+        lambda timeout: call["model"].generate_content(
+            contents,
+            generation_config=call["generation_config"],
+            safety_settings=call["safety_settings"],
+            stream=stream,
+            request_options={"timeout": timeout}
+        ),
+        deadline=deadline
+    )
+
+# Trả về thông báo lỗi nếu phản hồi bị chặn bởi cài đặt an toàn, ngược lại None
+def _blocked_response_message(response):
+    if not response.candidates and hasattr(response, 'prompt_feedback') and response.prompt_feedback.block_reason:
+        block_reason = response.prompt_feedback.block_reason.name
+        safety_ratings_str = str(getattr(response.prompt_feedback, 'safety_ratings', 'Không có'))
+        logger.warning(f"Phản hồi bị chặn vì lý do: {block_reason}. Ratings: {safety_ratings_str}")
+        return f"Lỗi: Phản hồi bị chặn bởi cài đặt an toàn (Lý do: {block_reason}). Hãy thử điều chỉnh Safety Settings hoặc prompt."
+    return None
+
+# Bỏ các dòng dẫn nhập ("Đây là đánh giá...", "Phân tích:"...) ở đầu phản hồi review/debug/explain
+def _clean_review_or_debug_text(raw_text):
+    lines = raw_text.splitlines()
+    cleaned_lines = []
+    prefixes_to_remove = (
+        "đây là đánh giá", "here is the review", "phân tích code",
+        "review:", "analysis:", "đây là phân tích", "here is the analysis",
+        "giải thích và đề xuất:", "phân tích và đề xuất:",
+        "đây là giải thích", "here is the explanation", "giải thích:", "explanation:",
+        "[thinking", "[processing", "```text"
+    )
+    first_meaningful_line = False
+    for line in lines:
+        stripped_line_lower = line.strip().lower()
+        if not first_meaningful_line and any(stripped_line_lower.startswith(p) for p in prefixes_to_remove):
+            continue
+        if line.strip():
+            first_meaningful_line = True
+        if first_meaningful_line:
+            cleaned_lines.append(line)
+    return "\n".join(cleaned_lines).strip()
+
+# Ánh xạ exception từ Gemini API sang thông báo lỗi tiếng Việt cho người dùng
+def _describe_gemini_error(e, model_name, ui_api_key):
+    error_message = str(e)
+    if isinstance(e, RateLimitedError):
+         logger.warning(f"Từ chối gọi Gemini ({model_name}): {error_message}")
+         return f"Lỗi giới hạn tốc độ: {error_message} Vui lòng thử lại sau."
+    if isinstance(e, CircuitOpenError):
+         logger.warning(f"Từ chối gọi Gemini ({model_name}): {error_message}")
+         return f"Lỗi tạm ngừng: {error_message}"
+    logger.error(f"Lỗi khi gọi Gemini API ({model_name}): {error_message}", exc_info=e)
+    if "API key not valid" in error_message:
+         key_source = "giao diện" if ui_api_key else ".env"
+         return f"Lỗi cấu hình: API key từ {key_source} không hợp lệ. Vui lòng kiểm tra."
+    elif "Could not find model" in error_message or "permission denied" in error_message.lower():
+         return f"Lỗi cấu hình: Không tìm thấy hoặc không có quyền truy cập model '{model_name}'."
+    elif "invalid" in error_message.lower() and any(p in error_message.lower() for p in ["temperature", "top_p", "top_k", "safety_settings"]):
+         return f"Lỗi cấu hình: Giá trị tham số (Temperature/TopP/TopK/Safety) không hợp lệ. ({error_message})"
+    elif "429" in error_message or "Resource has been exhausted" in error_message or "quota" in error_message.lower():
+         return f"Lỗi giới hạn tốc độ: Gemini API báo vượt quota/giới hạn tốc độ (429) cho model '{model_name}'. Vui lòng thử lại sau."
+    elif "Deadline Exceeded" in error_message or "timeout" in error_message.lower():
+         return f"Lỗi mạng: Yêu cầu tới Gemini API bị quá thời gian (timeout). Vui lòng thử lại."
+    elif "SAFETY" in error_message.upper():
+         details = re.search(r"Finish Reason: (\w+).+Safety Ratings: \[(.+?)]", error_message, re.DOTALL)
+         reason_detail = f" (Reason: {details.group(1)}, Ratings: {details.group(2)})" if details else ""
+         return f"Lỗi: Yêu cầu hoặc phản hồi có thể vi phạm chính sách an toàn của Gemini.{reason_detail} ({error_message[:100]}...)"
+    return f"Lỗi máy chủ khi gọi Gemini: {error_message}"
+
+# Xác định key cache cho một lần gọi Gemini, trả về None nếu request này không dùng cache.
+# Xóa cờ 'cache' khỏi model_config; phải gọi trước _prepare_gemini_call.
+def _response_cache_key(full_prompt, model_config, is_for_review_or_debug, system_instruction=None):
+    cache_flag = model_config.pop('cache', None)
+    temperature = float(model_config.get('temperature', 0.7))
+    if cache_flag is False or GEMINI_CACHE_MODE == 'off':
+        return None
+    if cache_flag is not True and GEMINI_CACHE_MODE != 'always' and temperature != 0:
+        return None # Chế độ auto: chỉ cache khi phản hồi gần như tất định
+    return ResponseCache.make_key(
+        full_prompt,
+        system_instruction=system_instruction,
+        model_name=model_config.get('model_name') or 'gemini-1.5-flash',
+        temperature=temperature,
+        top_p=float(model_config.get('top_p', 0.95)),
+        top_k=int(model_config.get('top_k', 40)),
+        safety_setting=model_config.get('safety_setting', 'BLOCK_MEDIUM_AND_ABOVE'),
+        is_for_review_or_debug=is_for_review_or_debug,
+    )
 
-        if not response.candidates and hasattr(response, 'prompt_feedback') and response.prompt_feedback.block_reason:
-            block_reason = response.prompt_feedback.block_reason.name
-            safety_ratings_str = str(getattr(response.prompt_feedback, 'safety_ratings', 'Không có'))
-            print(f"Cảnh báo: Phản hồi bị chặn vì lý do: {block_reason}. Ratings: {safety_ratings_str}")
-            return f"Lỗi: Phản hồi bị chặn bởi cài đặt an toàn (Lý do: {block_reason}). Hãy thử điều chỉnh Safety Settings hoặc prompt."
+# Hàm gọi Gemini API, xử lý việc chọn API Key và các tham số
+# Phản hồi hợp lệ (không rỗng, không phải chuỗi "Lỗi...") -> dùng được / cache được
+def _is_gemini_success(text):
+    return bool(text) and not text.startswith("Lỗi")
+
+# Xác định cách định tuyến cho request: trả về (mode, [model chính, dự phòng...], ngân sách giây) hoặc None.
+# Xóa các khóa routing/fallback_models khỏi model_config.
+def _routing_plan(model_config, endpoint):
+    mode = str(model_config.pop('routing', None) or GEMINI_ROUTING_MODE).lower()
+    fallback_models = model_config.pop('fallback_models', None) or GEMINI_FALLBACK_MODELS
+    if mode not in ('fallback', 'hedge'):
+        return None
+    primary = model_config.get('model_name') or 'gemini-1.5-flash'
+    models = [primary] + [name for name in fallback_models if name != primary]
+    if len(models) < 2:
+        return None
+    return mode, models, ENDPOINT_LATENCY_BUDGETS.get(endpoint, 60.0)
+
+# system_instruction: phần hướng dẫn tĩnh từ create_*, gắn vào model thay vì gửi chung với full_prompt
+# endpoint: tên endpoint ('generate', 'review'...) để lấy ngân sách độ trễ khi bật định tuyến model
+# deadline: mốc time.monotonic() mà lời gọi (kể cả retry, fallback/hedge) phải xong, vd: ngân sách thời gian của auto-fix
+def generate_response_from_gemini(full_prompt, model_config, is_for_review_or_debug=False, system_instruction=None, endpoint=None, deadline=None):
+    routing = _routing_plan(model_config, endpoint)
+    cache_key = _response_cache_key(full_prompt, model_config, is_for_review_or_debug, system_instruction)
+    if cache_key:
+        cached_text = response_cache.get(cache_key)
+        if cached_text is not None:
+            logger.info("Dùng phản hồi Gemini từ cache.")
+            return cached_text
+
+    if routing:
+        mode, models, budget = routing
+        if deadline is not None:
+            budget = max(0.0, min(budget, deadline - time.monotonic()))
+        call_model = lambda model_name: _call_gemini(full_prompt, {**model_config, 'model_name': model_name}, is_for_review_or_debug, system_instruction, deadline)
+        result_text, _model_name = model_router.call(models, budget, call_model, _is_gemini_success, mode=mode)
+        if result_text is None:
+            result_text = f"Lỗi mạng: Không model nào ({', '.join(models)}) trả lời trong ngân sách {budget:.0f} giây (timeout). Vui lòng thử lại."
+    else:
+        model_name = model_config.get('model_name') or 'gemini-1.5-flash'
+        result_text = model_router.timed_call(
+            model_name, lambda: _call_gemini(full_prompt, model_config, is_for_review_or_debug, system_instruction, deadline), _is_gemini_success
+        )
+    if cache_key and _is_gemini_success(result_text):
+        response_cache.set(cache_key, result_text)
+    return result_text
+
+def _call_gemini(full_prompt, model_config, is_for_review_or_debug, system_instruction, deadline=None):
+    call, error_text = _prepare_gemini_call(model_config, system_instruction)
+    if error_text:
+        return error_text
+    start_time = time.monotonic()
+    result_text = _call_prepared_gemini(call, full_prompt, is_for_review_or_debug, deadline)
+    _observe_gemini_call(call["model_name"], 'unary', start_time, result_text)
+    return result_text
+
+def _call_prepared_gemini(call, full_prompt, is_for_review_or_debug, deadline=None):
+    try:
+        response = _generate_content(call, full_prompt, deadline=deadline)
 
-        # 3 dòng print này để debug raw response / xóa comment r test check terminal
-        # print("--- RAW GEMINI RESPONSE ---")
-        # print(response.text)
-        # print("---------------------------")
+        blocked_message = _blocked_response_message(response)
+        if blocked_message:
+            return blocked_message
 
+        metrics.observe_token_usage(call["model_name"], getattr(response, 'usage_metadata', None))
         raw_text = response.text.strip()
 
         if is_for_review_or_debug and raw_text:
-             lines = raw_text.splitlines()
-             cleaned_lines = []
-             prefixes_to_remove = (
-                 "đây là đánh giá", "here is the review", "phân tích code",
-                 "review:", "analysis:", "đây là phân tích", "here is the analysis",
-                 "giải thích và đề xuất:", "phân tích và đề xuất:",
-                 "đây là giải thích", "here is the explanation", "giải thích:", "explanation:",
-                 "[thinking", "[processing", "```text"
-             )
-             first_meaningful_line = False
-             for line in lines:
-                 stripped_line_lower = line.strip().lower()
-                 if not first_meaningful_line and any(stripped_line_lower.startswith(p) for p in prefixes_to_remove):
-                     continue
-                 if line.strip():
-                     first_meaningful_line = True
-                 if first_meaningful_line:
-                     cleaned_lines.append(line)
-             final_text = "\n".join(cleaned_lines).strip()
-             # same
-             # print("--- CLEANED RESPONSE ---") # Debug cleaned text
-             # print(final_text)
-             # print("------------------------")
-             return final_text
+             return _clean_review_or_debug_text(raw_text)
 
         return raw_text
 
     except Exception as e:
-        error_message = str(e)
-        model_name = model_config.get('model_name', 'unknown_model') # Lấy tên model để báo lỗi
-        print(f"[LỖI API] Lỗi khi gọi Gemini API ({model_name}): {error_message}", file=sys.stderr)
-        traceback.print_exc(file=sys.stderr)
-        if "API key not valid" in error_message:
-             key_source = "giao diện" if ui_api_key else ".env"
-             return f"Lỗi cấu hình: API key từ {key_source} không hợp lệ. Vui lòng kiểm tra."
-        elif "Could not find model" in error_message or "permission denied" in error_message.lower():
-             return f"Lỗi cấu hình: Không tìm thấy hoặc không có quyền truy cập model '{model_name}'."
-        elif "invalid" in error_message.lower() and any(p in error_message.lower() for p in ["temperature", "top_p", "top_k", "safety_settings"]):
-             return f"Lỗi cấu hình: Giá trị tham số (Temperature/TopP/TopK/Safety) không hợp lệ. ({error_message})"
-        elif "Deadline Exceeded" in error_message or "timeout" in error_message.lower():
-             return f"Lỗi mạng: Yêu cầu tới Gemini API bị quá thời gian (timeout). Vui lòng thử lại."
-        elif "SAFETY" in error_message.upper():
-             details = re.search(r"Finish Reason: (\w+).+Safety Ratings: \[(.+?)]", error_message, re.DOTALL)
-             reason_detail = f" (Reason: {details.group(1)}, Ratings: {details.group(2)})" if details else ""
-             return f"Lỗi: Yêu cầu hoặc phản hồi có thể vi phạm chính sách an toàn của Gemini.{reason_detail} ({error_message[:100]}...)"
-        return f"Lỗi máy chủ khi gọi Gemini: {error_message}"
-
-    finally:
-        if ui_api_key and GOOGLE_API_KEY and GOOGLE_API_KEY != ui_api_key:
+        return _describe_gemini_error(e, call["model_name"], call["ui_api_key"])
+
+# Ghi metrics cho một lời gọi Gemini đã gửi đi (mode: 'unary' | 'stream')
+def _observe_gemini_call(model_name, mode, start_time, result_text):
+    metrics.gemini_calls_total.inc(model_name, mode, 'success' if _is_gemini_success(result_text) else 'error')
+    metrics.gemini_call_duration_seconds.observe(time.monotonic() - start_time, model_name, mode)
+
+# Phiên bản streaming của generate_response_from_gemini: gọi generate_content(stream=True)
+# và yield ('chunk', text) cho từng đoạn ngay khi Gemini trả về.
+# Sự kiện cuối luôn là ('done', full_text) — full_text giống hệt giá trị trả về của bản không streaming
+# (kể cả chuỗi "Lỗi..."), nên các endpoint dùng chung được phần xử lý kết quả.
+def stream_response_from_gemini(full_prompt, model_config, is_for_review_or_debug=False, system_instruction=None, endpoint=None):
+    routing = _routing_plan(model_config, endpoint)
+    cache_key = _response_cache_key(full_prompt, model_config, is_for_review_or_debug, system_instruction)
+    if cache_key:
+        cached_text = response_cache.get(cache_key)
+        if cached_text is not None:
+            logger.info("Dùng phản hồi Gemini từ cache (stream).")
+            yield ('chunk', cached_text)
+            yield ('done', cached_text)
+            return
+
+    # Stream không hedge được (chunk đã gửi cho client không rút lại được): chỉ fallback
+    # sang model kế tiếp khi model trước lỗi/bị chặn TRƯỚC khi gửi chunk nào.
+    models = routing[1] if routing else [model_config.get('model_name') or 'gemini-1.5-flash']
+    for attempt, model_name in enumerate(models):
+        attempt_config = {**model_config, 'model_name': model_name}
+        start_time = time.monotonic()
+        emitted_chunk = False
+        for event, value in _stream_gemini(full_prompt, attempt_config, is_for_review_or_debug, system_instruction):
+            if event == 'chunk':
+                emitted_chunk = True
+                yield (event, value)
+                continue
+            succeeded = _is_gemini_success(value)
+            model_router.stats.record(model_name, time.monotonic() - start_time, succeeded)
+            if not succeeded and not emitted_chunk and attempt + 1 < len(models):
+                model_router.note_fallback()
+                logger.warning(f"Model {model_name} thất bại (stream), chuyển sang {models[attempt + 1]}.")
+                break
+            if cache_key and succeeded:
+                response_cache.set(cache_key, value)
+            yield (event, value)
+            return
+
+def _stream_gemini(full_prompt, model_config, is_for_review_or_debug, system_instruction):
+    call, error_text = _prepare_gemini_call(model_config, system_instruction)
+    if error_text:
+        yield ('done', error_text)
+        return
+
+    model_name = call["model_name"]
+    start_time = time.monotonic()
+    parts = []
+    try:
+        # Với stream=True, SDK đọc chunk đầu ngay trong generate_content nên lỗi trước chunk đầu vẫn được retry
+        response = _generate_content(call, full_prompt, stream=True)
+        for chunk in response:
             try:
-                genai.configure(api_key=GOOGLE_API_KEY)
-            except Exception as reset_e:
-                print(f"[CẢNH BÁO] Không thể đặt lại API key global về key từ .env: {reset_e}")
-        elif ui_api_key and not GOOGLE_API_KEY:
-             pass
+                text = chunk.text
+            except ValueError: # Chunk không có part nào (bị chặn hoặc chỉ chứa finish_reason)
+                text = ""
+            if text:
+                if not parts:
+                    metrics.gemini_time_to_first_token_seconds.observe(time.monotonic() - start_time, model_name)
+                parts.append(text)
+                yield ('chunk', text)
+
+        if not parts:
+            blocked_message = _blocked_response_message(response)
+            if blocked_message:
+                _observe_gemini_call(model_name, 'stream', start_time, blocked_message)
+                yield ('done', blocked_message)
+                return
+
+        # Sau khi đọc hết stream, usage_metadata của response là tổng của cả lời gọi
+        metrics.observe_token_usage(model_name, getattr(response, 'usage_metadata', None))
+        raw_text = "".join(parts).strip()
+        if is_for_review_or_debug and raw_text:
+            raw_text = _clean_review_or_debug_text(raw_text)
+        _observe_gemini_call(model_name, 'stream', start_time, raw_text)
+        yield ('done', raw_text)
+
+    except Exception as e:
+        error_text = _describe_gemini_error(e, model_name, call["ui_api_key"])
+        _observe_gemini_call(model_name, 'stream', start_time, error_text)
+        yield ('done', error_text)
 
-# Hàm trích xuất khối mã Python từ phản hồi của Gemini 
+# Hàm trích xuất khối mã từ phản hồi của Gemini (một lượt quét, xem code_blocks.py)
 def extract_code_block(raw_text, requested_extension):
-    # Ưu tiên tìm khối mã với đúng extension hoặc các alias phổ biến
-    primary_tags = [requested_extension]
-    if requested_extension == 'py': primary_tags.append('python')
-    if requested_extension == 'sh': primary_tags.append('bash')
-    if requested_extension == 'bat': primary_tags.append('batch')
-    if requested_extension == 'ps1': primary_tags.append('powershell')
-    # Thêm các alias khác nếu cần
-
-    for tag in primary_tags:
-        pattern = r"```" + re.escape(tag) + r"\s*([\s\S]*?)\s*```"
-        matches = list(re.finditer(pattern, raw_text, re.IGNORECASE))
-        if matches:
-            print(f"[INFO] Found code block with tag: {tag}")
-            return matches[-1].group(1).strip()
-
-    # Nếu không có tag khớp, thử tìm khối ``` chung chung
-    matches_generic = list(re.finditer(r"```\s*([\s\S]*?)\s*```", raw_text))
-    if matches_generic:
-        last_block = matches_generic[-1].group(1).strip()
-        print(f"[WARN] Found generic code block ```...```. Assuming it's the correct type for .{requested_extension}")
-        return last_block
+    blocks = parse_fenced_blocks(raw_text)["blocks"]
+    # Ưu tiên khối mã với đúng extension hoặc các alias phổ biến, không có thì lấy khối ``` cuối cùng
+    block, tag_matched = select_code_block(blocks, requested_extension)
+    if block:
+        if tag_matched:
+            logger.info(f"Found code block with tag: {block.language}")
+        else:
+            logger.warning(f"Found generic code block ```...```. Assuming it's the correct type for .{requested_extension}")
+        return block.code.strip()
 
     # Trường hợp không tìm thấy khối mã nào rõ ràng
-    print(f"[WARN] Could not find specific code block for .{requested_extension} or generic block. Returning raw text as fallback.")
+    logger.warning(f"Could not find specific code block for .{requested_extension} or generic block. Returning raw text as fallback.")
     return raw_text.strip() 
 
+# Trả về mã HTTP phù hợp cho một chuỗi lỗi từ generate_response_from_gemini
+def _gemini_error_status(error_text):
+    if error_text.startswith("Lỗi giới hạn tốc độ"):
+        return 429
+    if error_text.startswith("Lỗi tạm ngừng"):
+        return 503
+    return 400 if ("Lỗi cấu hình" in error_text or "Lỗi: Phản hồi bị chặn" in error_text) else 500
+
+# Client yêu cầu streaming qua body {"stream": true}, query ?stream=1 hoặc header Accept: text/event-stream
+def _wants_stream(data):
+    if data.get('stream') is True:
+        return True
+    if request.args.get('stream') in ('1', 'true'):
+        return True
+    return 'text/event-stream' in request.headers.get('Accept', '')
+
+# Body streaming chạy sau khi view đã trả về: gán lại request_id cho log phát sinh trong lúc stream
+def _with_request_id(generator):
+    request_id = request_id_var.get()
+    def run():
+        request_id_var.set(request_id)
+        try:
+            yield from generator
+        finally:
+            request_id_var.set(None)
+    return run()
+
+# Bọc generator SSE thành Response, tắt cache/buffer của proxy để chunk đi thẳng tới client
+def _sse_response(generator):
+    return Response(
+        stream_with_context(_with_request_id(generator)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+# Generator SSE dùng chung cho generate/review/debug/explain:
+#   event: chunk  -> {"text": "..."} mỗi đoạn text từ Gemini
+#   event: code   -> {"block_index", "language", "delta", "closed"} khi phát hiện khối ``` (nếu detect_code)
+#   event: done   -> payload JSON giống hệt bản không streaming, kèm "status"
+#   event: error  -> {"error": "...", "status": ...} nếu thất bại
+def _stream_gemini_endpoint(full_prompt, model_config, is_for_review_or_debug, build_result, detect_code=False, system_instruction=None, endpoint=None):
+    detector = StreamingCodeBlockDetector() if detect_code else None
+    for event, value in stream_response_from_gemini(full_prompt, model_config, is_for_review_or_debug, system_instruction, endpoint):
+        if event == 'chunk':
+            yield sse_event('chunk', {"text": value})
+            if detector:
+                for code_event in detector.feed(value):
+                    yield sse_event('code', code_event)
+        elif event == 'done':
+            if detector:
+                for code_event in detector.finish(): # Dòng cuối không có "\n" / khối chưa đóng
+                    yield sse_event('code', code_event)
+            payload, status_code = build_result(value)
+            yield sse_event('done' if status_code < 400 else 'error', {**payload, "status": status_code})
+
+# Xử lý phản hồi của Gemini cho /api/generate, trả về (payload, status_code)
+def _build_generate_result(raw_response, file_extension):
+    log_payload(logger, logging.INFO, "Phản hồi thô từ Gemini (generate)", {"raw_response": raw_response})
+
+    if raw_response and not raw_response.startswith("Lỗi"):
+        generated_code = extract_code_block(raw_response, file_extension)
+
+        # Kiểm tra xem có phải trả về text thô không
+        # Điều chỉnh heuristic: chỉ coi là raw text nếu nó bằng raw_response VÀ KHÔNG bắt đầu bằng dấu ```
+        is_likely_raw_text = (generated_code == raw_response) and not generated_code.strip().startswith("```")
+
+        if not generated_code.strip() or is_likely_raw_text:
+             logger.error(f"AI không trả về khối mã hợp lệ. Phản hồi thô: {raw_response[:200]}...")
+             return {"error": f"AI không trả về khối mã hợp lệ. Phản hồi nhận được bắt đầu bằng: '{raw_response[:50]}...'"}, 500
+        else:
+            # Phân tích AST/lệnh shell thay cho dò từ khóa (kết quả cache, lần execute sau dùng lại)
+            validation = code_validator.validate(generated_code, file_extension)
+            if validation["risks"]:
+                logger.warning(
+                    f"Mã tạo ra có thao tác có thể nguy hiểm (mức {validation['max_severity']}).",
+                    extra={"fields": {"risks": [f"{risk['rule']}@{risk['line']}" for risk in validation["risks"]]}}
+                )
+            # Trả về code và cả file_extension đã dùng để sinh/trích xuất
+            return {"code": generated_code, "generated_for_type": file_extension, **_validation_fields(validation)}, 200
+    elif raw_response:
+        return {"error": raw_response}, _gemini_error_status(raw_response)
+    else:
+        return {"error": "Không thể tạo mã hoặc có lỗi không xác định xảy ra."}, 500
+
+# Dựng prompt sinh code; trả về (system_instruction, full_prompt, file_extension)
+def _prepare_generate_prompt(user_input, target_os_input, file_type_input):
+    backend_os_name = get_os_name(sys.platform)
+    target_os_name = backend_os_name if target_os_input == 'auto' else target_os_input
+
+    # Xác định extension từ file_type_input để dùng trong extract_code_block
+    file_extension = file_type_input.split('.')[-1].lower() if '.' in file_type_input else file_type_input.lower()
+    if not file_extension or not file_extension.isalnum():
+        file_extension = 'py' # Default nếu rỗng hoặc không hợp lệ
+
+    system_instruction, full_prompt = create_prompt(user_input, backend_os_name, target_os_name, file_type_input)
+    return system_instruction, full_prompt, file_extension
+
 # Endpoint để sinh code
 @app.route('/api/generate', methods=['POST'])
 def handle_generate():
@@ -469,45 +978,114 @@ def handle_generate():
     if not user_input:
         return jsonify({"error": "Vui lòng nhập yêu cầu."}), 400
 
-    backend_os_name = get_os_name(sys.platform)
-    target_os_name = backend_os_name if target_os_input == 'auto' else target_os_input
+    system_instruction, full_prompt, file_extension = _prepare_generate_prompt(user_input, target_os_input, file_type_input)
+    build_result = _with_history(
+        'generate', _conversation_id(data), lambda raw_response: _build_generate_result(raw_response, file_extension),
+        prompt=user_input, file_type=file_extension
+    )
 
-    # Xác định extension từ file_type_input để dùng trong extract_code_block
-    file_extension = file_type_input.split('.')[-1].lower() if '.' in file_type_input else file_type_input.lower()
-    if not file_extension or not file_extension.isalnum():
-        file_extension = 'py' # Default nếu rỗng hoặc không hợp lệ
+    if _wants_stream(data):
+        return _sse_response(_stream_gemini_endpoint(full_prompt, model_config.copy(), False, build_result, detect_code=True, system_instruction=system_instruction, endpoint='generate'))
 
-    full_prompt = create_prompt(user_input, backend_os_name, target_os_name, file_type_input)
-    raw_response = generate_response_from_gemini(full_prompt, model_config.copy(), is_for_review_or_debug=False)
+    raw_response = generate_response_from_gemini(full_prompt, model_config.copy(), is_for_review_or_debug=False, system_instruction=system_instruction, endpoint='generate')
+    payload, status_code = build_result(raw_response)
+    return jsonify(payload), status_code
 
-    print("-" * 20 + " RAW GEMINI RESPONSE (Generate) " + "-" * 20)
-    print(raw_response)
-    print("-" * 60)
 
-    if raw_response and not raw_response.startswith("Lỗi"):
-        generated_code = extract_code_block(raw_response, file_extension)
+# --- Sinh code theo lô ---
+# Số item gọi Gemini song song tối đa trong một batch, và số item tối đa mỗi batch
+BATCH_MAX_CONCURRENCY = int(os.getenv('BATCH_MAX_CONCURRENCY', '8'))
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', '20'))
 
-        # Kiểm tra xem có phải trả về text thô không
-        # Điều chỉnh heuristic: chỉ coi là raw text nếu nó bằng raw_response VÀ KHÔNG bắt đầu bằng dấu ```
-        is_likely_raw_text = (generated_code == raw_response) and not generated_code.strip().startswith("```")
-
-        if not generated_code.strip() or is_likely_raw_text:
-             print(f"[LỖI] AI không trả về khối mã hợp lệ. Phản hồi thô: {raw_response[:200]}...")
-             return jsonify({"error": f"AI không trả về khối mã hợp lệ. Phản hồi nhận được bắt đầu bằng: '{raw_response[:50]}...'"}), 500
-        else:
-            potentially_dangerous = ["rm ", "del ", "format ", "shutdown ", "reboot ", ":(){:|:&};:", "dd if=/dev/zero", "mkfs"]
-            code_lower = generated_code.lower()
-            detected_dangerous = [kw for kw in potentially_dangerous if kw in code_lower]
-            if detected_dangerous:
-                print(f"Cảnh báo: Mã tạo ra chứa từ khóa có thể nguy hiểm: {detected_dangerous}")
-            # Trả về code và cả file_extension đã dùng để sinh/trích xuất
-            return jsonify({"code": generated_code, "generated_for_type": file_extension})
-    elif raw_response:
-        status_code = 400 if ("Lỗi cấu hình" in raw_response or "Lỗi: Phản hồi bị chặn" in raw_response) else 500
-        return jsonify({"error": raw_response}), status_code
+# Sinh code cho một item của batch, trả về kết quả kèm index và thời gian xử lý
+def _generate_batch_item(index, item, model_config):
+    start_time = time.monotonic()
+    if not isinstance(item, dict) or not item.get('prompt'):
+        payload, status_code = {"error": "Vui lòng nhập yêu cầu."}, 400
     else:
-        return jsonify({"error": "Không thể tạo mã hoặc có lỗi không xác định xảy ra."}), 500
+        try:
+            system_instruction, full_prompt, file_extension = _prepare_generate_prompt(
+                item['prompt'], item.get('target_os', 'auto'), item.get('file_type', 'py')
+            )
+            # Mỗi item có thể ghi đè một phần model_config chung
+            item_config = {**model_config, **(item.get('model_config') or {})}
+            raw_response = generate_response_from_gemini(full_prompt, item_config, is_for_review_or_debug=False, system_instruction=system_instruction, endpoint='generate')
+            payload, status_code = _build_generate_result(raw_response, file_extension)
+        except Exception as e:
+            logger.error(f"Item {index} của batch gặp lỗi: {e}")
+            payload, status_code = {"error": f"Lỗi hệ thống khi sinh code: {e}"}, 500
+    return {"index": index, "status": status_code, "duration": round(time.monotonic() - start_time, 3), **payload}
+
+# Mỗi item chạy trong bản sao context hiện tại để log của item mang request_id của batch
+def _submit_batch_items(executor, items, model_config):
+    return [
+        executor.submit(contextvars.copy_context().run, _generate_batch_item, index, item, model_config)
+        for index, item in enumerate(items)
+    ]
+
+# Tóm tắt kết quả batch (dùng cho cả JSON và sự kiện done của SSE)
+def _batch_summary(results, start_time):
+    succeeded = sum(1 for result in results if result["status"] < 400)
+    return {
+        "total": len(results),
+        "succeeded": succeeded,
+        "failed": len(results) - succeeded,
+        "duration": round(time.monotonic() - start_time, 3),
+    }
+
+# SSE: mỗi item xong -> event item (thứ tự hoàn thành, không phải thứ tự gửi), cuối cùng -> event done
+def _stream_generate_batch(items, model_config, concurrency):
+    start_time = time.monotonic()
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="generate-batch")
+    results = []
+    try:
+        futures = _submit_batch_items(executor, items, model_config)
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            yield sse_event('item', result)
+        yield sse_event('done', _batch_summary(results, start_time))
+    finally:
+        # Client ngắt kết nối giữa chừng: bỏ các item chưa bắt đầu
+        executor.shutdown(wait=False, cancel_futures=True)
+
+# Endpoint sinh code cho nhiều yêu cầu cùng lúc: {"items": [{prompt, target_os, file_type}, ...], "model_config", "concurrency"}
+# Các item gọi Gemini song song (tối đa BATCH_MAX_CONCURRENCY), tổng thời gian xấp xỉ item chậm nhất
+@app.route('/api/generate_batch', methods=['POST'])
+def handle_generate_batch():
+    data = request.get_json()
+    items = data.get('items')
+    model_config = data.get('model_config', {})
+
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "Vui lòng gửi danh sách yêu cầu (items)."}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"Mỗi batch tối đa {BATCH_MAX_ITEMS} yêu cầu (nhận được {len(items)})."}), 400
+
+    try:
+        requested_concurrency = int(data.get('concurrency') or BATCH_MAX_CONCURRENCY)
+    except (TypeError, ValueError):
+        requested_concurrency = BATCH_MAX_CONCURRENCY
+    concurrency = max(1, min(requested_concurrency, BATCH_MAX_CONCURRENCY, len(items)))
+    logger.info(f"Batch sinh code: {len(items)} yêu cầu, song song {concurrency}.")
+
+    if _wants_stream(data):
+        return _sse_response(_stream_generate_batch(items, model_config, concurrency))
+
+    start_time = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="generate-batch") as executor:
+        results = [future.result() for future in _submit_batch_items(executor, items, model_config)]
+    return jsonify({"results": results, **_batch_summary(results, start_time)}), 200
+
 
+# Xử lý phản hồi của Gemini cho /api/review, trả về (payload, status_code)
+def _build_review_result(review_text):
+    if review_text and not review_text.startswith("Lỗi"):
+        return {"review": review_text}, 200
+    elif review_text:
+        return {"error": review_text}, _gemini_error_status(review_text)
+    else:
+        return {"error": "Không thể đánh giá mã hoặc có lỗi không xác định xảy ra."}, 500
 
 # Endpoint để đánh giá code 
 @app.route('/api/review', methods=['POST'])
@@ -524,16 +1102,499 @@ def handle_review():
     language_extension = file_type.split('.')[-1].lower() if '.' in file_type else file_type.lower()
     if not language_extension: language_extension = 'py' # Default
 
-    full_prompt = create_review_prompt(code_to_review, language_extension) # Truyền extension
-    review_text = generate_response_from_gemini(full_prompt, model_config.copy(), is_for_review_or_debug=True)
+    system_instruction, full_prompt = create_review_prompt(code_to_review, language_extension) # Truyền extension
+    build_result = _with_history('review', _conversation_id(data), _build_review_result, code=code_to_review, file_type=language_extension)
 
-    if review_text and not review_text.startswith("Lỗi"):
-        return jsonify({"review": review_text})
-    elif review_text:
-        status_code = 400 if ("Lỗi cấu hình" in review_text or "Lỗi: Phản hồi bị chặn" in review_text) else 500
-        return jsonify({"error": review_text}), status_code
+    if _wants_stream(data):
+        return _sse_response(_stream_gemini_endpoint(full_prompt, model_config.copy(), True, build_result, system_instruction=system_instruction, endpoint='review'))
+
+    review_text = generate_response_from_gemini(full_prompt, model_config.copy(), is_for_review_or_debug=True, system_instruction=system_instruction, endpoint='review')
+    payload, status_code = build_result(review_text)
+    return jsonify(payload), status_code
+
+# Thời gian tối đa (giây) cho một lần thực thi code
+EXECUTE_TIMEOUT_SECONDS = 60
+
+# --- Giới hạn tài nguyên khi thực thi (POSIX, rlimit) ---
+# EXECUTE_LIMIT_<TÊN>: mặc định cho mọi loại file; EXECUTE_LIMIT_<EXT>_<TÊN>: riêng một loại file (vd: EXECUTE_LIMIT_PY_MEMORY_MB)
+# EXECUTE_LIMIT_MAX_<TÊN>: mức tối đa request được đặt qua "limits" (không đặt = không được vượt mức mặc định)
+# TÊN: CPU_SECONDS, MEMORY_MB (bộ nhớ ảo), FILE_SIZE_MB, PROCESSES, OPEN_FILES; 0 = không giới hạn
+# PROCESSES là RLIMIT_NPROC: tính mọi tiến trình của user chạy backend (kể cả backend), root không bị giới hạn
+# MEMORY_MB là RLIMIT_AS (bộ nhớ ảo), mặc định tắt: JVM/node/Go (chạy từ .sh/.bat) và numpy/torch đặt trước vùng nhớ ảo
+# lớn hơn nhiều RSS thật nên hay lỗi mmap dưới giới hạn này; RSS thật vẫn có trong "resources" (peak_rss_bytes)
+_EXECUTE_LIMIT_DEFAULTS = {"cpu_seconds": '60', "memory_mb": '0', "file_size_mb": '1024', "processes": '0', "open_files": '0'}
+
+def _limits_from_env(prefix, defaults=None):
+    return {name: float(os.getenv(f'{prefix}{name.upper()}', (defaults or {}).get(name, '0')) or 0) for name in resource_limits.LIMITS}
+
+execution_limits = LimitPolicy(
+    defaults=_limits_from_env('EXECUTE_LIMIT_', _EXECUTE_LIMIT_DEFAULTS),
+    by_type={extension: _limits_from_env(f'EXECUTE_LIMIT_{extension.upper()}_') for extension in ('py', 'sh', 'bat', 'ps1')},
+    maxima=_limits_from_env('EXECUTE_LIMIT_MAX_')
+) if resource_limits.supported() else LimitPolicy()
+
+# Giới hạn cho một request execute từ "limits" trong body; trả về (limits, None) hoặc (None, (payload, status_code))
+def _request_limits(data, file_extension):
+    try:
+        return execution_limits.resolve(file_extension, data.get('limits')), None
+    except LimitError as e:
+        return None, ({"error": str(e)}, 400)
+
+# Báo cáo tài nguyên của một lần chạy: số đo + giới hạn đã áp dụng + giới hạn bị vượt (nếu đoán được)
+def _resource_report(usage, limits, file_extension, return_code, stderr_tail=""):
+    exceeded = resource_limits.exceeded_limit(return_code, limits, (usage["user_cpu_seconds"] or 0) + (usage["system_cpu_seconds"] or 0), stderr_tail)
+    if exceeded:
+        metrics.execute_limit_exceeded_total.inc(file_extension, exceeded)
+        logger.warning(f"Code .{file_extension} dừng do vượt giới hạn {exceeded}={limits[exceeded]:g}.")
+    if usage["written_bytes"] is not None:
+        metrics.execute_written_bytes.observe(usage["written_bytes"], file_extension)
+    return {**usage, "limits": limits, "limit_exceeded": exceeded}
+
+# --- Giới hạn output thực thi ---
+# Mỗi stream chỉ giữ EXECUTE_OUTPUT_HEAD_BYTES đầu + EXECUTE_OUTPUT_TAIL_BYTES cuối trong bộ nhớ/response;
+# phần vượt quá được ghi ra file tạm (tối đa EXECUTE_OUTPUT_SPILL_MAX_BYTES) và đọc lại qua /api/outputs/<id>/<stream>
+execution_outputs = OutputStore(
+    head_bytes=int(os.getenv('EXECUTE_OUTPUT_HEAD_BYTES', '65536')),
+    tail_bytes=int(os.getenv('EXECUTE_OUTPUT_TAIL_BYTES', '65536')),
+    spill_max_bytes=int(os.getenv('EXECUTE_OUTPUT_SPILL_MAX_BYTES', str(512 * 1024 * 1024))),
+    retention_seconds=float(os.getenv('EXECUTE_OUTPUT_RETENTION_SECONDS', '3600')),
+    max_entries=int(os.getenv('EXECUTE_OUTPUT_MAX_STORED', '64')),
+    spill_dir=os.getenv('EXECUTE_OUTPUT_SPILL_DIR') # Bỏ trống = thư mục tạm của hệ thống
+)
+# Số byte tối đa mỗi lần đọc output theo khoảng
+OUTPUT_RANGE_MAX_BYTES = 1024 * 1024
+
+# Chuẩn hóa file_type (tên file hoặc extension) thành extension dùng để thực thi
+def _execution_extension(file_type_requested):
+    if '.' in file_type_requested:
+         file_extension = file_type_requested.split('.')[-1].lower()
     else:
-        return jsonify({"error": "Không thể đánh giá mã hoặc có lỗi không xác định xảy ra."}), 500
+         file_extension = file_type_requested.lower()
+    if not file_extension or not file_extension.isalnum(): file_extension = 'py'
+    return file_extension
+
+# --- Kiểm tra code trước khi chạy ---
+# Python: compile() ngay trong backend, shell: `bash -n`. Code lỗi cú pháp được trả về sau vài ms thay vì spawn interpreter
+# (stderr giống interpreter in ra). Thao tác có thể nguy hiểm (AST cho Python, lệnh shell theo token) trả về trong "risks".
+# EXECUTE_VALIDATE=0 để bỏ bước kiểm tra trước khi execute; VALIDATION_CACHE_SIZE: số kết quả giữ lại theo hash của code
+EXECUTE_VALIDATE = os.getenv('EXECUTE_VALIDATE', '1').lower() in ('1', 'true', 'yes')
+code_validator = CodeValidator(
+    max_entries=int(os.getenv('VALIDATION_CACHE_SIZE', '1024')),
+    check_shell_syntax=sys.platform != 'win32'
+)
+
+# Các trường kiểm tra code đưa vào response (chỉ khi có điều cần báo)
+def _validation_fields(validation):
+    fields = {}
+    if validation is None:
+        return fields
+    if validation["risks"]:
+        fields["risks"] = validation["risks"]
+    if validation["syntax_ok"] is False:
+        fields["syntax_error"] = validation["syntax_error"]
+    return fields
+
+def _validation_outcome(validation):
+    if validation["syntax_ok"] is False:
+        return 'syntax_error'
+    return 'risky' if validation["risks"] else 'ok'
+
+# Kiểm tra trước khi chạy; None nếu đã tắt bằng EXECUTE_VALIDATE
+def _pre_execution_validation(code_to_execute, file_extension):
+    if not EXECUTE_VALIDATE:
+        return None
+    validation = code_validator.validate(code_to_execute, file_extension)
+    metrics.code_validations_total.inc(validation["language"] or 'other', _validation_outcome(validation))
+    if validation["syntax_ok"] is False:
+        logger.info(f"Code .{file_extension} lỗi cú pháp, bỏ qua bước thực thi: {validation['syntax_error']['message']}")
+    return validation
+
+# Kết quả execute khi code lỗi cú pháp: cùng dạng với lần chạy thất bại để client/auto-fix xử lý như cũ
+def _syntax_error_payload(validation, file_extension):
+    syntax_error = validation["syntax_error"]
+    metrics.observe_execution(file_extension, 'syntax_error')
+    return {
+        "message": "Code có lỗi cú pháp, không thực thi.", "output": "", "error": syntax_error["formatted"],
+        "return_code": syntax_error["return_code"], "executed_file_type": file_extension, "skipped_execution": True,
+        **_validation_fields(validation)
+    }
+
+# --- Chạy script không qua file tạm (Linux) ---
+# Code .py/.sh được ghi vào memfd (file ẩn danh trong RAM) và truyền cho interpreter dưới dạng /proc/self/fd/N,
+# bỏ được vòng tạo file tạm -> ghi -> stat -> chmod -> xóa trên đĩa mỗi lần chạy.
+# Không dùng stdin để truyền code: bash đọc script từ stdin theo từng dòng nên lệnh đọc stdin trong script sẽ ăn mất code.
+EXECUTE_IN_MEMORY = os.getenv('EXECUTE_IN_MEMORY', '1').lower() in ('1', 'true', 'yes') and hasattr(os, 'memfd_create')
+# Script tự tìm đường dẫn của chính nó (thư mục chứa script...) cần file thật
+_SCRIPT_PATH_MARKERS = {'py': ('__file__',), 'sh': ('$0', '${0', 'BASH_SOURCE')}
+
+# Trả về fd của memfd chứa code, hoặc None nếu phải dùng file tạm
+def _in_memory_script(code_to_execute, file_extension, run_as_admin):
+    if not EXECUTE_IN_MEMORY or run_as_admin: # sudo đóng các fd kế thừa (closefrom) nên /proc/self/fd/N không còn
+        return None
+    markers = _SCRIPT_PATH_MARKERS.get(file_extension)
+    if markers is None or any(marker in code_to_execute for marker in markers):
+        return None
+    try:
+        fd = os.memfd_create(f'snippet.{file_extension}') # MFD_CLOEXEC: chỉ tiến trình nhận qua pass_fds thấy fd
+        os.write(fd, code_to_execute.encode('utf-8'))
+        return fd
+    except OSError as e:
+        logger.warning(f"Không tạo được memfd ({e}), dùng file tạm.")
+        return None
+
+# Lưu code ra file tạm (hoặc memfd) và dựng lệnh chạy theo loại file/HĐH, xử lý yêu cầu Admin/Root.
+# Trả về (plan, None) với plan = {"command", "temp_file_path", "memfd", "admin_warning", ...},
+# hoặc (plan, (payload, status_code)) nếu không thể thực thi — plan vẫn được trả để dọn file tạm.
+# session_env: venv riêng của session (Python chạy bằng interpreter của venv đó, không dùng warm pool).
+def _prepare_execution(code_to_execute, file_extension, run_as_admin, session_env=None, limits=None):
+    backend_os = get_os_name(sys.platform)
+    plan = {"command": [], "temp_file_path": None, "memfd": None, "admin_warning": None, "warm_process": None, "stdin_data": None}
+    interpreter_path = session_env.python if session_env else sys.executable
+
+    # Python không cần quyền Admin/Root: thử lấy interpreter đã khởi động sẵn từ warm pool.
+    # Code dùng __file__ vẫn đi đường file tạm vì snippet chạy từ stdin không có file thật.
+    # Có giới hạn tài nguyên thì chỉ dùng warm pool khi đặt được giới hạn cho tiến trình đang chạy (prlimit, Linux).
+    if file_extension == 'py' and not run_as_admin and python_warm_pool and not session_env and '__file__' not in code_to_execute \
+            and (not limits or resource_limits.can_limit_running_process()):
+        warm_process = python_warm_pool.acquire()
+        if warm_process:
+            plan["warm_process"] = warm_process
+            plan["stdin_data"] = code_to_execute.encode('utf-8')
+            plan["command"] = warm_process.args
+            logger.info(f"Dùng interpreter Python khởi động sẵn từ warm pool (pid {warm_process.pid}).")
+            return plan, None
+
+    memfd = _in_memory_script(code_to_execute, file_extension, run_as_admin)
+    if memfd is not None:
+        plan["memfd"] = memfd
+        script_path = f"/proc/self/fd/{memfd}"
+        plan["command"] = [interpreter_path, script_path] if file_extension == 'py' else ['bash', script_path]
+        logger.info(f"Chạy code .{file_extension} từ memfd (không tạo file tạm).")
+        return plan, None
+
+    with tempfile.NamedTemporaryFile(mode='w', suffix=f'.{file_extension}', delete=False, encoding='utf-8', newline='') as temp_file:
+        plan["temp_file_path"] = temp_file_path = temp_file.name
+        temp_file.write(code_to_execute)
+    logger.info(f"Đã lưu code vào file tạm: {temp_file_path}")
+
+    if backend_os in ["linux", "macos"] and file_extension in ['sh', 'py']:
+        try:
+            current_stat = os.stat(temp_file_path).st_mode
+            os.chmod(temp_file_path, current_stat | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+            logger.info(f"Đã cấp quyền thực thi (chmod +x) cho: {temp_file_path}")
+        except Exception as chmod_e:
+            logger.error(f"Không thể cấp quyền thực thi cho file tạm: {chmod_e}")
+
+    if file_extension == 'py':
+        command = [interpreter_path, temp_file_path]
+    elif file_extension == 'bat' and backend_os == 'windows':
+        command = ['cmd', '/c', temp_file_path]
+    elif file_extension == 'ps1' and backend_os == 'windows':
+        command = ['powershell', '-NoProfile', '-ExecutionPolicy', 'Bypass', '-File', temp_file_path]
+    elif file_extension == 'sh' and backend_os in ['linux', 'macos']:
+         command = ['bash', temp_file_path]
+    elif backend_os == 'windows':
+        command = ['cmd', '/c', temp_file_path]
+        logger.warning(f"Loại file '.{file_extension}' không xác định rõ trên Windows, thử chạy bằng cmd /c.")
+    elif backend_os in ['linux', 'macos']:
+         command = ['bash', temp_file_path]
+         logger.warning(f"Loại file '.{file_extension}' không xác định rõ trên {backend_os}, thử chạy bằng bash.")
+    else:
+         return plan, ({"error": f"Không hỗ trợ thực thi file .{file_extension} trên hệ điều hành backend không xác định: {backend_os}"}, 501)
+
+    if run_as_admin:
+        if backend_os == "windows":
+            try:
+                is_admin = ctypes.windll.shell32.IsUserAnAdmin() != 0
+                if not is_admin:
+                    plan["admin_warning"] = "Đã yêu cầu chạy với quyền Admin, nhưng backend không có quyền này. Thực thi với quyền thường."
+                    logger.warning(f"{plan['admin_warning']}")
+            except Exception as admin_check_e:
+                plan["admin_warning"] = f"Không thể kiểm tra quyền admin ({admin_check_e}). Thực thi với quyền thường."
+                logger.error(f"{plan['admin_warning']}")
+        elif backend_os in ["linux", "darwin"]:
+            try:
+                subprocess.run(['which', 'sudo'], check=True, capture_output=True, text=True)
+                logger.info("Thêm 'sudo' vào đầu lệnh. Có thể cần nhập mật khẩu trong console backend.")
+                command.insert(0, 'sudo')
+            except (FileNotFoundError, subprocess.CalledProcessError):
+                 plan["admin_warning"] = "Đã yêu cầu chạy với quyền Root, nhưng không tìm thấy 'sudo' hoặc kiểm tra thất bại. Thực thi với quyền thường."
+                 logger.error(f"{plan['admin_warning']}")
+            except Exception as sudo_check_e:
+                 plan["admin_warning"] = f"Lỗi khi kiểm tra sudo ({sudo_check_e}). Thực thi với quyền thường."
+                 logger.error(f"{plan['admin_warning']}")
+        else:
+            plan["admin_warning"] = f"Yêu cầu 'Run as Admin/Root' không được hỗ trợ rõ ràng trên HĐH này ({backend_os}). Thực thi với quyền thường."
+            logger.warning(f"{plan['admin_warning']}")
+
+    plan["command"] = command
+    logger.info(f"Chuẩn bị chạy lệnh: {' '.join(shlex.quote(str(c)) for c in command)}")
+    return plan, None
+
+def _execution_env(session_env=None):
+    process_env = os.environ.copy()
+    process_env["PYTHONIOENCODING"] = "utf-8"
+    if session_env:
+        session_env.apply_env(process_env)
+    return process_env
+
+# --- Warm pool interpreter Python (opt-in) ---
+# PY_WARM_POOL_SIZE: số worker chờ sẵn (0 = tắt, mặc định)
+# PY_WARM_POOL_PRELOAD: các module import trước, cách nhau bởi dấu phẩy
+# PY_WARM_POOL_MAX_IDLE_SECONDS: worker chờ lâu hơn sẽ được thay bằng worker mới
+PY_WARM_POOL_SIZE = int(os.getenv('PY_WARM_POOL_SIZE', '0'))
+python_warm_pool = PythonWarmPool(
+    size=PY_WARM_POOL_SIZE,
+    preload_modules=[name.strip() for name in os.getenv('PY_WARM_POOL_PRELOAD', 'os,sys,json,pathlib,re,subprocess,shutil').split(',') if name.strip()],
+    max_idle_seconds=float(os.getenv('PY_WARM_POOL_MAX_IDLE_SECONDS', '300')),
+    env_factory=_execution_env
+) if PY_WARM_POOL_SIZE > 0 else None
+if python_warm_pool:
+    atexit.register(python_warm_pool.shutdown)
+
+# --- Venv riêng cho từng session (opt-in) ---
+# Request execute/install_package có "session_id" chạy/cài trong venv của session đó, clone từ venv mẫu dựng sẵn.
+# SESSION_ENVS=1 để bật; SESSION_ENV_ROOT: thư mục chứa venv mẫu (giữ qua các lần khởi động, dùng chung giữa các worker)
+# và venv của session (sessions/<pid>, riêng từng tiến trình)
+# SESSION_ENV_MAX / SESSION_ENV_MAX_DISK_MB: giới hạn số venv / tổng dung lượng (kể cả venv mẫu), vượt thì bỏ venv ít dùng nhất
+# SESSION_ENV_IDLE_SECONDS: venv không dùng lâu hơn sẽ bị bỏ
+# SESSION_ENV_CLONE_MODE: auto (reflink -> hardlink -> copy) | reflink | hardlink | copy
+# SESSION_ENV_BASE_PACKAGES: package cài sẵn trong venv mẫu, cách nhau bởi khoảng trắng
+# SESSION_ENV_SYSTEM_SITE_PACKAGES=1: venv thấy cả site-packages của interpreter gốc
+SESSION_ENVS_ENABLED = os.getenv('SESSION_ENVS', '').lower() in ('1', 'true', 'yes')
+session_envs = SessionEnvManager(
+    root_dir=os.getenv('SESSION_ENV_ROOT') or os.path.join(tempfile.gettempdir(), 'ai-agent-session-envs'),
+    max_envs=int(os.getenv('SESSION_ENV_MAX', '16')),
+    max_disk_bytes=int(float(os.getenv('SESSION_ENV_MAX_DISK_MB', '2048')) * 1024 * 1024),
+    idle_seconds=float(os.getenv('SESSION_ENV_IDLE_SECONDS', '3600')),
+    clone_mode=os.getenv('SESSION_ENV_CLONE_MODE', 'auto'),
+    base_packages=split_requirements(os.getenv('SESSION_ENV_BASE_PACKAGES', '')),
+    system_site_packages=os.getenv('SESSION_ENV_SYSTEM_SITE_PACKAGES', '').lower() in ('1', 'true', 'yes')
+) if SESSION_ENVS_ENABLED else None
+if session_envs:
+    atexit.register(session_envs.shutdown)
+
+# Kiểm tra "session_id" trong body; trả về None nếu hợp lệ (hoặc không có), ngược lại (payload, status_code)
+def _check_session_id(session_id):
+    if session_id is None:
+        return None
+    if not session_envs:
+        return {"error": "Venv riêng cho session chưa được bật trên backend (SESSION_ENVS=1)."}, 400
+    if not is_valid_session_id(session_id):
+        return {"error": "session_id chỉ gồm chữ, số, '_' hoặc '-' (tối đa 64 ký tự)."}, 400
+    return None
+
+# Context manager trả về venv của session (tạo nếu chưa có), hoặc None nếu request không có session_id
+def _session_env(session_id):
+    return session_envs.acquire(session_id) if session_id is not None else nullcontext(None)
+
+# --- Kernel Python giữ trạng thái theo hội thoại (opt-in, POSIX) ---
+# Request /api/execute có "kernel": true (chỉ .py) chạy trong kernel của hội thoại (conversation_id/X-Conversation-Id):
+# biến, module đã import, dữ liệu đã nạp được giữ giữa các lần chạy. Có "session_id" thì kernel dùng venv của session.
+# KERNEL_SESSIONS=1 để bật; KERNEL_MAX: số kernel tối đa (đủ thì tắt kernel rảnh lâu nhất; tất cả đang chạy -> 503)
+# KERNEL_IDLE_SECONDS: kernel không dùng lâu hơn bị tắt
+# KERNEL_MAX_RSS_MB: kernel có RSS vượt mức này sau một lần chạy bị tắt; KERNEL_MAX_TOTAL_RSS_MB: tổng RSS các kernel
+# vượt mức này thì tắt kernel rảnh lâu nhất (0 = không giới hạn)
+# KERNEL_PRELOAD: module import sẵn khi khởi động kernel, cách nhau bởi dấu phẩy
+# KERNEL_INTERRUPT_GRACE_SECONDS: quá EXECUTE_TIMEOUT_SECONDS thì gửi SIGINT (KeyboardInterrupt, kernel giữ trạng thái);
+# sau khoảng này vẫn chưa dừng thì kill kernel
+KERNEL_SESSIONS_ENABLED = os.getenv('KERNEL_SESSIONS', '').lower() in ('1', 'true', 'yes') and os.name == 'posix'
+KERNEL_INTERRUPT_GRACE_SECONDS = float(os.getenv('KERNEL_INTERRUPT_GRACE_SECONDS', '3'))
+kernel_manager = KernelManager(
+    max_kernels=int(os.getenv('KERNEL_MAX', '4')),
+    idle_seconds=float(os.getenv('KERNEL_IDLE_SECONDS', '1800')),
+    max_kernel_rss_bytes=int(float(os.getenv('KERNEL_MAX_RSS_MB', '2048')) * 1024 * 1024),
+    max_total_rss_bytes=int(float(os.getenv('KERNEL_MAX_TOTAL_RSS_MB', '4096')) * 1024 * 1024),
+    preload_modules=[name.strip() for name in os.getenv('KERNEL_PRELOAD', '').split(',') if name.strip()],
+    interrupt_grace_seconds=KERNEL_INTERRUPT_GRACE_SECONDS,
+    python_executable=sys.executable
+) if KERNEL_SESSIONS_ENABLED else None
+if kernel_manager:
+    atexit.register(kernel_manager.shutdown)
+
+# Kiểm tra request chạy trong kernel; trả về None nếu hợp lệ, ngược lại (payload, status_code).
+# Bắt buộc có conversation_id rõ ràng: kernel giữ biến, file, trạng thái của hội thoại, không dùng chung giữa các client.
+def _check_kernel_request(data, file_extension, run_as_admin):
+    if not kernel_manager:
+        return {"error": "Kernel giữ trạng thái chưa được bật trên backend (KERNEL_SESSIONS=1, chỉ Linux/macOS)."}, 400
+    if _conversation_id(data) is None:
+        return {"error": "Chế độ kernel cần conversation_id (trong body hoặc header X-Conversation-Id)."}, 400
+    if file_extension != 'py':
+        return {"error": "Chế độ kernel chỉ hỗ trợ code Python (.py)."}, 400
+    if run_as_admin:
+        return {"error": "Chế độ kernel không hỗ trợ chạy với quyền Admin/Root."}, 400
+    return None
+
+# Context manager giữ kernel của hội thoại (tạo nếu chưa có) trong suốt một lần chạy; trả về (kernel, created)
+@contextmanager
+def _conversation_kernel(conversation_id, session_id, limits):
+    with _session_env(session_id) as session_env:
+        python = session_env.python if session_env else sys.executable
+        with kernel_manager.acquire(conversation_id, python, _execution_env(session_env), limits) as acquired:
+            yield acquired
+
+def _kernel_error_status(error):
+    if isinstance(error, KernelBusyError):
+        return 409
+    if isinstance(error, KernelCapacityError):
+        return 503
+    return 500
+
+# Thông tin kernel trả kèm kết quả chạy
+def _kernel_fields(kernel, created, run):
+    fields = {
+        "id": kernel.key, "pid": kernel.pid, "runs": kernel.runs, "new": created, "run_status": run.status,
+        "rss_bytes": kernel.rss_bytes, "alive": not kernel.dead
+    }
+    if created and kernel.restarted_after:
+        fields["restarted_after"] = kernel.restarted_after # Kernel trước đó bị tắt (idle/memory/...): trạng thái cũ đã mất
+    if kernel_manager.exceeds_memory(kernel):
+        fields["recycled"] = "memory" # Vượt KERNEL_MAX_RSS_MB: kernel bị tắt sau lần chạy này
+    return fields
+
+# Payload kết quả (không gồm output) của một lần chạy trong kernel; cập nhật metrics
+def _kernel_result_payload(run, kernel, created, captured, limits, validation):
+    metrics.observe_execution('py', _execution_outcome(run.timed_out, run.return_code), run.duration, run.cpu_seconds, run.peak_rss_bytes)
+    if run.timed_out:
+        message = "Thực thi vượt quá thời gian cho phép." + (
+            " Đã ngắt bằng KeyboardInterrupt, kernel giữ nguyên trạng thái." if run.status == "interrupted" else " Kernel đã bị dừng."
+        )
+    elif run.return_code == 0:
+        message = "Thực thi trong kernel thành công."
+    else:
+        message = "Thực thi trong kernel hoàn tất (có thể có lỗi)."
+    logger.info(f"Kết quả thực thi trong kernel '{kernel.key}' (Mã trả về: {run.return_code}, {run.duration:.3f}s, lần chạy {kernel.runs})")
+    return {
+        "message": message, "return_code": -1 if run.timed_out else run.return_code,
+        "duration": round(run.duration, 4), "timed_out": run.timed_out, "executed_file_type": 'py',
+        "output_info": captured.info(),
+        "resources": _resource_report(run.usage(), limits, 'py', run.return_code, captured.text("stderr")[-4096:]),
+        "kernel": _kernel_fields(kernel, created, run),
+        **_validation_fields(validation),
+    }
+
+# Chạy code trong kernel của hội thoại (chế độ thường). Trả về (payload, status_code) cùng dạng với _run_code
+def _run_in_kernel(code_to_execute, conversation_id, session_id=None, limits=None, echo_code=False, timeout=EXECUTE_TIMEOUT_SECONDS):
+    limits = execution_limits.resolve('py') if limits is None else limits
+    code_echo = {"codeThatFailed": code_to_execute} if echo_code else {}
+    validation = _pre_execution_validation(code_to_execute, 'py')
+    if validation and validation["syntax_ok"] is False:
+        return {**_syntax_error_payload(validation, 'py'), **code_echo}, 200
+
+    captured = None
+    try:
+        with _conversation_kernel(conversation_id, session_id, limits) as (kernel, created):
+            run = kernel.run(code_to_execute, timeout, KERNEL_INTERRUPT_GRACE_SECONDS)
+            captured = execution_outputs.create()
+            for stream_name, text, _elapsed in run.iter_output():
+                captured.feed(stream_name, text)
+            execution_outputs.finish(captured)
+            payload = _kernel_result_payload(run, kernel, created, captured, limits, validation)
+        return {**payload, "output": captured.text("stdout"), "error": captured.text("stderr"), **code_echo}, 408 if run.timed_out else 200
+    except KernelError as e:
+        logger.warning(f"Không chạy được trong kernel '{conversation_id}': {e}")
+        return {"error": str(e), "output": "", "return_code": -1, **code_echo}, _kernel_error_status(e)
+    except FileNotFoundError as fnf_error:
+        err_msg = _missing_command_message(fnf_error, 'py', False)
+        logger.error(err_msg)
+        metrics.observe_execution('py', 'error')
+        return {"error": err_msg, "output": "", "return_code": -1, **code_echo}, 500
+    except Exception as e:
+        logger.exception(f"Lỗi nghiêm trọng khi thực thi trong kernel: {e}")
+        metrics.observe_execution('py', 'error')
+        return {"error": f"Lỗi hệ thống khi thực thi trong kernel: {e}", "output": "", "return_code": -1, **code_echo}, 500
+    finally:
+        if captured:
+            execution_outputs.finish(captured)
+
+# Generator SSE cho chạy trong kernel; cùng các event với _stream_execution, start/done có thêm "kernel".
+# Client ngắt giữa chừng: code bị ngắt bằng KeyboardInterrupt, kernel được giữ lại.
+def _stream_in_kernel(code_to_execute, conversation_id, session_id=None, limits=None):
+    limits = execution_limits.resolve('py') if limits is None else limits
+    captured = None
+    try:
+        validation = _pre_execution_validation(code_to_execute, 'py')
+        if validation and validation["syntax_ok"] is False:
+            payload = _syntax_error_payload(validation, 'py')
+            _record_execution_history(conversation_id, code_to_execute, 'py', payload, 200)
+            yield sse_event('output', {"stream": "stderr", "text": payload["error"], "t": 0})
+            yield sse_event('done', {
+                **{key: value for key, value in payload.items() if key not in ("output", "error")},
+                "duration": 0, "timed_out": False, "warning": None, "output_info": None, "tails": {}
+            })
+            return
+
+        with _conversation_kernel(conversation_id, session_id, limits) as (kernel, created):
+            run = kernel.run(code_to_execute, EXECUTE_TIMEOUT_SECONDS, KERNEL_INTERRUPT_GRACE_SECONDS)
+            captured = execution_outputs.create()
+            yield sse_event('start', {"executed_file_type": 'py', "warning": None, "kernel": {
+                "id": kernel.key, "pid": kernel.pid, "new": created, "restarted_after": kernel.restarted_after if created else None
+            }})
+            for stream_name, text, elapsed in run.iter_output():
+                stream_capture = captured.streams[stream_name]
+                was_truncated = stream_capture.truncated
+                stream_capture.feed(text)
+                if not was_truncated:
+                    yield sse_event('output', {"stream": stream_name, "text": text, "t": round(elapsed, 4)})
+                    if stream_capture.truncated:
+                        yield sse_event('output_truncated', {"stream": stream_name})
+            execution_outputs.finish(captured)
+            done_payload = {
+                **_kernel_result_payload(run, kernel, created, captured, limits, validation), "warning": None,
+                "tails": {name: stream.tail_text() for name, stream in captured.streams.items() if stream.truncated},
+            }
+        _record_execution_history(
+            conversation_id, code_to_execute, 'py',
+            {**done_payload, "output": captured.text("stdout"), "error": captured.text("stderr")}, 408 if run.timed_out else 200
+        )
+        yield sse_event('done', done_payload)
+
+    except KernelError as e:
+        status_code = _kernel_error_status(e)
+        _record_execution_history(conversation_id, code_to_execute, 'py', {"error": str(e), "return_code": -1}, status_code)
+        yield sse_event('error', {"error": str(e), "return_code": -1, "status": status_code})
+    except FileNotFoundError as fnf_error:
+        err_msg = _missing_command_message(fnf_error, 'py', False)
+        logger.error(err_msg)
+        metrics.observe_execution('py', 'error')
+        _record_execution_history(conversation_id, code_to_execute, 'py', {"error": err_msg, "return_code": -1}, 500)
+        yield sse_event('error', {"error": err_msg, "return_code": -1, "status": 500})
+    except Exception as e:
+        logger.exception(f"Lỗi nghiêm trọng khi thực thi trong kernel (stream): {e}")
+        metrics.observe_execution('py', 'error')
+        _record_execution_history(conversation_id, code_to_execute, 'py', {"error": f"Lỗi hệ thống khi thực thi trong kernel: {e}", "return_code": -1}, 500)
+        yield sse_event('error', {"error": f"Lỗi hệ thống khi thực thi trong kernel: {e}", "return_code": -1, "status": 500})
+    finally:
+        if captured:
+            execution_outputs.finish(captured)
+
+# Dọn tài nguyên của plan thực thi: đóng memfd, xóa file tạm
+def _cleanup_execution(plan):
+    if plan["memfd"] is not None:
+        os.close(plan["memfd"])
+    _cleanup_temp_file(plan["temp_file_path"])
+
+def _cleanup_temp_file(temp_file_path):
+    if temp_file_path and os.path.exists(temp_file_path):
+        try:
+            os.remove(temp_file_path)
+            logger.info(f"Đã xóa file tạm: {temp_file_path}")
+        except Exception as cleanup_e:
+            logger.error(f"Không thể xóa file tạm {temp_file_path}: {cleanup_e}")
+
+# Nhãn kết quả thực thi cho metrics
+def _execution_outcome(timed_out, return_code):
+    if timed_out:
+        return 'timeout'
+    return 'success' if return_code == 0 else 'failure'
+
+# Thông báo lỗi khi không tìm thấy interpreter/lệnh cần thiết
+def _missing_command_message(fnf_error, file_extension, run_as_admin):
+    missing_cmd = str(fnf_error)
+    err_msg = f"Lỗi hệ thống: Không tìm thấy lệnh cần thiết '{missing_cmd}' để chạy file .{file_extension}."
+    if 'sudo' in missing_cmd and run_as_admin and get_os_name(sys.platform) != "windows":
+         err_msg = "Lỗi hệ thống: Lệnh 'sudo' không được tìm thấy. Không thể chạy với quyền root."
+    return err_msg
 
 # Endpoint để thực thi code 
 @app.route('/api/execute', methods=['POST'])
@@ -542,267 +1603,964 @@ def handle_execute():
     code_to_execute = data.get('code')
     run_as_admin = data.get('run_as_admin', False)
     file_type_requested = data.get('file_type', 'py') # Nhận loại file được yêu cầu
+    echo_code = data.get('echo_code') is True # Trả lại code trong "codeThatFailed" (mặc định không)
+    session_id = data.get('session_id') # Chạy trong venv riêng của session (nếu bật SESSION_ENVS)
+    use_kernel = data.get('kernel') is True # Chạy trong kernel giữ trạng thái của hội thoại (nếu bật KERNEL_SESSIONS)
 
     if not code_to_execute:
         return jsonify({"error": "Không có mã nào để thực thi."}), 400
+    invalid = _check_session_id(session_id)
+    if invalid:
+        payload, status_code = invalid
+        return jsonify(payload), status_code
+
+    file_extension = _execution_extension(file_type_requested)
+    limits, invalid = _request_limits(data, file_extension) # "limits": {"memory_mb": 512, ...} trong mức tối đa của admin
+    if invalid:
+        payload, status_code = invalid
+        return jsonify(payload), status_code
+
+    conversation_id = _conversation_id(data)
+    if use_kernel:
+        invalid = _check_kernel_request(data, file_extension, run_as_admin)
+        if invalid:
+            payload, status_code = invalid
+            return jsonify(payload), status_code
+        if _wants_stream(data):
+            return _sse_response(_stream_in_kernel(code_to_execute, conversation_id, session_id=session_id, limits=limits))
+        payload, status_code = _run_in_kernel(code_to_execute, conversation_id, session_id=session_id, limits=limits, echo_code=echo_code)
+        _record_execution_history(conversation_id, code_to_execute, file_extension, payload, status_code)
+        return jsonify(payload), status_code
+
+    if _wants_stream(data):
+        return _sse_response(_stream_execution(
+            code_to_execute, file_extension, run_as_admin, session_id=session_id, conversation_id=conversation_id, limits=limits))
+
+    payload, status_code = _execute_code(
+        code_to_execute, file_extension, run_as_admin, echo_code=echo_code, session_id=session_id, conversation_id=conversation_id,
+        limits=limits)
+    return jsonify(payload), status_code
+
+# Kiểm tra cú pháp và các thao tác có thể nguy hiểm mà không chạy code
+@app.route('/api/validate', methods=['POST'])
+def handle_validate():
+    data = request.get_json()
+    code_to_validate = data.get('code')
+    if not code_to_validate:
+        return jsonify({"error": "Không có mã nào để kiểm tra."}), 400
+    file_extension = _execution_extension(data.get('file_type', 'py'))
+    return jsonify({"file_type": file_extension, **code_validator.validate(code_to_validate, file_extension)}), 200
+
+# Giới hạn tài nguyên mặc định theo loại file và mức tối đa request được đặt
+@app.route('/api/execute/limits', methods=['GET'])
+def handle_execute_limits():
+    return jsonify({"supported": resource_limits.supported(), "names": list(resource_limits.LIMITS), **execution_limits.snapshot()})
+
+# Chạy code ở chế độ thường (gom output có giới hạn), dùng chung cho /api/execute và job queue.
+# Trả về (payload, status_code); on_start(runner) nhận tiến trình vừa khởi chạy.
+# conversation_id: ghi kết quả vào lịch sử của hội thoại đó (None = không ghi)
+# limits: giới hạn tài nguyên đã kiểm tra (None = mặc định của loại file)
+def _execute_code(code_to_execute, file_extension, run_as_admin, on_start=None, echo_code=False, session_id=None, conversation_id=None,
+                  timeout=EXECUTE_TIMEOUT_SECONDS, limits=None):
+    payload, status_code = _run_code(code_to_execute, file_extension, run_as_admin, on_start, echo_code, session_id, timeout, limits)
+    _record_execution_history(conversation_id, code_to_execute, file_extension, payload, status_code)
+    return payload, status_code
+
+def _record_execution_history(conversation_id, code_to_execute, file_extension, payload, status_code):
+    output_info = payload.get("output_info") or {}
+    _record_history(
+        'execute', conversation_id, status_code, code=code_to_execute, file_type=file_extension,
+        output=payload.get("output"), error=payload.get("error"),
+        extra={"return_code": payload.get("return_code"), "output_id": output_info.get("id")}
+    )
 
-    backend_os = get_os_name(sys.platform)
+def _run_code(code_to_execute, file_extension, run_as_admin, on_start=None, echo_code=False, session_id=None, timeout=EXECUTE_TIMEOUT_SECONDS,
+              limits=None):
     admin_warning = None
-    temp_file_path = None
-    command = []
-
-    if '.' in file_type_requested:
-         file_extension = file_type_requested.split('.')[-1].lower()
-    else:
-         file_extension = file_type_requested.lower()
-    if not file_extension or not file_extension.isalnum(): file_extension = 'py'
+    limits = execution_limits.resolve(file_extension) if limits is None else limits
+    plan = None
+    session_stack = ExitStack()
+    code_echo = {"codeThatFailed": code_to_execute} if echo_code else {}
 
-    print(f"--- CẢNH BÁO: Chuẩn bị thực thi code dưới dạng file .{file_extension} (Yêu cầu Admin/Root: {run_as_admin}) ---")
+    logger.warning(f"Chuẩn bị thực thi code dưới dạng file .{file_extension} (Yêu cầu Admin/Root: {run_as_admin})")
+    validation = _pre_execution_validation(code_to_execute, file_extension)
+    if validation and validation["syntax_ok"] is False:
+        return {**_syntax_error_payload(validation, file_extension), **code_echo}, 200
 
     try:
-        with tempfile.NamedTemporaryFile(mode='w', suffix=f'.{file_extension}', delete=False, encoding='utf-8', newline='') as temp_file:
-            temp_file_path = temp_file.name
-            temp_file.write(code_to_execute)
-        print(f"[INFO] Đã lưu code vào file tạm: {temp_file_path}")
-
-        if backend_os in ["linux", "macos"] and file_extension in ['sh', 'py']:
-            try:
-                current_stat = os.stat(temp_file_path).st_mode
-                os.chmod(temp_file_path, current_stat | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
-                print(f"[INFO] Đã cấp quyền thực thi (chmod +x) cho: {temp_file_path}")
-            except Exception as chmod_e:
-                print(f"[LỖI] Không thể cấp quyền thực thi cho file tạm: {chmod_e}")
-
-        interpreter_path = sys.executable
-        if file_extension == 'py':
-            command = [interpreter_path, temp_file_path]
-        elif file_extension == 'bat' and backend_os == 'windows':
-            command = ['cmd', '/c', temp_file_path]
-        elif file_extension == 'ps1' and backend_os == 'windows':
-            command = ['powershell', '-NoProfile', '-ExecutionPolicy', 'Bypass', '-File', temp_file_path]
-        elif file_extension == 'sh' and backend_os in ['linux', 'macos']:
-             command = ['bash', temp_file_path]
-        elif backend_os == 'windows':
-            command = ['cmd', '/c', temp_file_path]
-            print(f"[WARN] Loại file '.{file_extension}' không xác định rõ trên Windows, thử chạy bằng cmd /c.")
-        elif backend_os in ['linux', 'macos']:
-             command = ['bash', temp_file_path]
-             print(f"[WARN] Loại file '.{file_extension}' không xác định rõ trên {backend_os}, thử chạy bằng bash.")
-        else:
-             return jsonify({"error": f"Không hỗ trợ thực thi file .{file_extension} trên hệ điều hành backend không xác định: {backend_os}"}), 501
-
-        if run_as_admin:
-            if backend_os == "windows":
-                try:
-                    is_admin = ctypes.windll.shell32.IsUserAnAdmin() != 0
-                    if not is_admin:
-                        admin_warning = "Đã yêu cầu chạy với quyền Admin, nhưng backend không có quyền này. Thực thi với quyền thường."
-                        print(f"[CẢNH BÁO] {admin_warning}")
-                except Exception as admin_check_e:
-                    admin_warning = f"Không thể kiểm tra quyền admin ({admin_check_e}). Thực thi với quyền thường."
-                    print(f"[LỖI] {admin_warning}")
-            elif backend_os in ["linux", "darwin"]:
-                try:
-                    subprocess.run(['which', 'sudo'], check=True, capture_output=True, text=True)
-                    print("[INFO] Thêm 'sudo' vào đầu lệnh. Có thể cần nhập mật khẩu trong console backend.")
-                    command.insert(0, 'sudo')
-                except (FileNotFoundError, subprocess.CalledProcessError):
-                     admin_warning = "Đã yêu cầu chạy với quyền Root, nhưng không tìm thấy 'sudo' hoặc kiểm tra thất bại. Thực thi với quyền thường."
-                     print(f"[LỖI] {admin_warning}")
-                except Exception as sudo_check_e:
-                     admin_warning = f"Lỗi khi kiểm tra sudo ({sudo_check_e}). Thực thi với quyền thường."
-                     print(f"[LỖI] {admin_warning}")
-            else:
-                admin_warning = f"Yêu cầu 'Run as Admin/Root' không được hỗ trợ rõ ràng trên HĐH này ({backend_os}). Thực thi với quyền thường."
-                print(f"[CẢNH BÁO] {admin_warning}")
-
-        print(f"[INFO] Chuẩn bị chạy lệnh: {' '.join(shlex.quote(str(c)) for c in command)}")
-        process_env = os.environ.copy()
-        process_env["PYTHONIOENCODING"] = "utf-8"
-
-        result = subprocess.run(
-            command, capture_output=True, encoding='utf-8', errors='replace',
-            timeout=60, check=False, env=process_env, text=True
+        session_env = session_stack.enter_context(_session_env(session_id))
+        plan, prepare_error = _prepare_execution(code_to_execute, file_extension, run_as_admin, session_env, limits)
+        admin_warning = plan["admin_warning"]
+        if prepare_error:
+            payload, status_code = prepare_error
+            return payload, status_code
+
+        captured = execution_outputs.create()
+        try:
+            result = run_process(
+                plan["command"], env=_execution_env(session_env), timeout=timeout, on_start=on_start,
+                stdin_data=plan["stdin_data"], process=plan["warm_process"], on_output=captured.feed,
+                pass_fds=() if plan["memfd"] is None else (plan["memfd"],), limits=limits
+            )
+        finally:
+            execution_outputs.finish(captured)
+        resources = _resource_report(result["usage"], limits, file_extension, result["return_code"], captured.text("stderr")[-4096:])
+        metrics.observe_execution(
+            file_extension, _execution_outcome(result["timed_out"], result["return_code"]),
+            result["duration"], result["cpu_seconds"], result["peak_rss_bytes"]
+        )
+        if result["timed_out"]:
+            logger.error(f"Thực thi file vượt quá thời gian cho phép ({timeout:g} giây).")
+            return {
+                "error": "Thực thi file vượt quá thời gian cho phép.", "output": captured.text("stdout"), "error": "Timeout", "return_code": -1,
+                "warning": admin_warning, "output_info": captured.info(), "resources": resources, **_validation_fields(validation), **code_echo
+            }, 408
+
+        output = captured.text("stdout")
+        error_output = captured.text("stderr")
+        return_code = result["return_code"]
+
+        log_payload(
+            logger, logging.INFO, f"Kết quả thực thi file (Mã trả về: {return_code})",
+            {"stdout": output or None, "stderr": error_output or None},
+            return_code=return_code, file_type=file_extension, duration=round(result["duration"], 4)
         )
-        output = result.stdout
-        error_output = result.stderr
-        return_code = result.returncode
-
-        print(f"--- Kết quả thực thi file (Mã trả về: {return_code}) ---")
-        if output: print(f"Output:\n{output}")
-        if error_output: print(f"Lỗi Output:\n{error_output}")
-        print(f"----------------------------------------------")
 
         message = "Thực thi file thành công." if return_code == 0 else "Thực thi file hoàn tất (có thể có lỗi)."
         response_data = {
             "message": message, "output": output, "error": error_output, "return_code": return_code,
             "executed_file_type": file_extension,
-            "codeThatFailed": code_to_execute
+            "output_info": captured.info(), # Tổng byte/dòng; id để đọc phần bị lược qua /api/outputs
+            "resources": resources, # Thời gian, CPU user/sys, RSS cao nhất, byte ghi; giới hạn đã áp dụng/bị vượt
+            **_validation_fields(validation),
+            **code_echo
         }
         if admin_warning:
             response_data["warning"] = admin_warning
-        return jsonify(response_data)
+        return response_data, 200
 
-    except subprocess.TimeoutExpired:
-        print("Lỗi: Thực thi file vượt quá thời gian cho phép (60 giây).")
-        return jsonify({"error": "Thực thi file vượt quá thời gian cho phép.", "output": "", "error": "Timeout", "return_code": -1, "warning": admin_warning, "codeThatFailed": code_to_execute}), 408
     except FileNotFoundError as fnf_error:
-        missing_cmd = str(fnf_error)
-        err_msg = f"Lỗi hệ thống: Không tìm thấy lệnh cần thiết '{missing_cmd}' để chạy file .{file_extension}."
-        if 'sudo' in missing_cmd and run_as_admin and backend_os != "windows":
-             err_msg = "Lỗi hệ thống: Lệnh 'sudo' không được tìm thấy. Không thể chạy với quyền root."
-        print(f"[LỖI] {err_msg}")
-        return jsonify({"error": err_msg, "output": "", "error": f"FileNotFoundError: {missing_cmd}", "return_code": -1, "warning": admin_warning, "codeThatFailed": code_to_execute}), 500
+        err_msg = _missing_command_message(fnf_error, file_extension, run_as_admin)
+        logger.error(err_msg)
+        metrics.observe_execution(file_extension, 'error')
+        return {"error": err_msg, "output": "", "error": f"FileNotFoundError: {fnf_error}", "return_code": -1, "warning": admin_warning, **code_echo}, 500
     except Exception as e:
-        print(f"Lỗi nghiêm trọng khi thực thi file tạm: {e}", file=sys.stderr)
-        traceback.print_exc(file=sys.stderr)
-        return jsonify({"error": f"Lỗi hệ thống khi thực thi file: {e}", "output": "", "error": str(e), "return_code": -1, "warning": admin_warning, "codeThatFailed": code_to_execute}), 500
+        logger.exception(f"Lỗi nghiêm trọng khi thực thi file tạm: {e}")
+        metrics.observe_execution(file_extension, 'error')
+        return {"error": f"Lỗi hệ thống khi thực thi file: {e}", "output": "", "error": str(e), "return_code": -1, "warning": admin_warning, **code_echo}, 500
     finally:
-        if temp_file_path and os.path.exists(temp_file_path):
-            try:
-                os.remove(temp_file_path)
-                print(f"[INFO] Đã xóa file tạm: {temp_file_path}")
-            except Exception as cleanup_e:
-                print(f"[LỖI] Không thể xóa file tạm {temp_file_path}: {cleanup_e}")
-
-
-# Endpoint để gỡ lỗi cod
-@app.route('/api/debug', methods=['POST'])
-def handle_debug():
-    data = request.get_json()
-    original_prompt = data.get('prompt', '(Không có prompt gốc)')
-    failed_code = data.get('code')
-    stdout = data.get('stdout', '')
-    stderr = data.get('stderr', '')
-    model_config = data.get('model_config', {})
-    # Nhận loại file gây lỗi từ frontend
-    file_type = data.get('file_type', 'py')
-
-    if not failed_code:
-        return jsonify({"error": "Thiếu mã lỗi để gỡ rối."}), 400
-
-    # Đảm bảo file_type chỉ là extension
-    language_extension = file_type.split('.')[-1].lower() if '.' in file_type else file_type.lower()
-    if not language_extension: language_extension = 'py'
-
-    full_prompt = create_debug_prompt(original_prompt, failed_code, stdout, stderr, language_extension)
-    raw_response = generate_response_from_gemini(full_prompt, model_config.copy(), is_for_review_or_debug=True)
+        if plan:
+            _cleanup_execution(plan)
+        session_stack.close()
+
+# Generator SSE cho /api/execute ở chế độ stream:
+#   event: start  -> {"command", "executed_file_type", "warning"}
+#   event: output -> {"stream": "stdout"|"stderr", "text", "t"} (t = giây kể từ lúc bắt đầu), đúng thứ tự xuất hiện
+#   event: output_truncated -> {"stream"} một lần khi stream vượt EXECUTE_OUTPUT_HEAD_BYTES; sau đó không gửi output
+#                     của stream đó nữa (phần cuối nằm trong done, toàn bộ đọc qua /api/outputs)
+#   event: done   -> {"message", "return_code", "duration", "timed_out", "executed_file_type", "warning", "output_info", "resources",
+#                     "tails": {stream: text cuối} cho các stream bị lược}
+#                     "risks" nếu code có thao tác có thể nguy hiểm
+#   event: error  -> {"error", "return_code": -1, "status"} nếu không thể chạy
+# Code lỗi cú pháp: không có start, chỉ một output (stderr) với thông báo lỗi rồi done kèm "skipped_execution", "syntax_error"
+def _stream_execution(code_to_execute, file_extension, run_as_admin, session_id=None, conversation_id=None, limits=None):
+    limits = execution_limits.resolve(file_extension) if limits is None else limits
+    plan = None
+    captured = None
+    session_stack = ExitStack()
+    logger.warning(f"Chuẩn bị thực thi (stream) code dưới dạng file .{file_extension} (Yêu cầu Admin/Root: {run_as_admin})")
+    try:
+        validation = _pre_execution_validation(code_to_execute, file_extension)
+        if validation and validation["syntax_ok"] is False:
+            payload = _syntax_error_payload(validation, file_extension)
+            _record_execution_history(conversation_id, code_to_execute, file_extension, payload, 200)
+            yield sse_event('output', {"stream": "stderr", "text": payload["error"], "t": 0})
+            yield sse_event('done', {
+                **{key: value for key, value in payload.items() if key not in ("output", "error")},
+                "duration": 0, "timed_out": False, "warning": None, "output_info": None, "tails": {}
+            })
+            return
+
+        session_env = session_stack.enter_context(_session_env(session_id))
+        plan, prepare_error = _prepare_execution(code_to_execute, file_extension, run_as_admin, session_env, limits)
+        if prepare_error:
+            payload, status_code = prepare_error
+            _record_execution_history(conversation_id, code_to_execute, file_extension, payload, status_code)
+            yield sse_event('error', {**payload, "return_code": -1, "status": status_code})
+            return
+
+        runner = StreamingProcess(
+            plan["command"], env=_execution_env(session_env), timeout=EXECUTE_TIMEOUT_SECONDS, stdin_data=plan["stdin_data"],
+            pass_fds=() if plan["memfd"] is None else (plan["memfd"],), limits=limits
+        )
+        runner.start(process=plan["warm_process"])
+        captured = execution_outputs.create()
+        yield sse_event('start', {"command": plan["command"], "executed_file_type": file_extension, "warning": plan["admin_warning"]})
+        for stream_name, text, elapsed in runner.iter_output():
+            stream_capture = captured.streams[stream_name]
+            was_truncated = stream_capture.truncated
+            stream_capture.feed(text)
+            if not was_truncated:
+                # Chunk vượt ngưỡng vẫn gửi trọn (tối đa READ_CHUNK_SIZE), sau đó dừng gửi stream này
+                yield sse_event('output', {"stream": stream_name, "text": text, "t": round(elapsed, 4)})
+                if stream_capture.truncated:
+                    yield sse_event('output_truncated', {"stream": stream_name})
+        execution_outputs.finish(captured)
+
+        if runner.timed_out:
+            message = "Thực thi file vượt quá thời gian cho phép."
+        elif runner.return_code == 0:
+            message = "Thực thi file thành công."
+        else:
+            message = "Thực thi file hoàn tất (có thể có lỗi)."
+        logger.info(f"Kết quả thực thi file (stream) (Mã trả về: {runner.return_code}, {runner.duration:.2f}s)")
+        metrics.observe_execution(
+            file_extension, _execution_outcome(runner.timed_out, runner.return_code),
+            runner.duration, runner.cpu_seconds, runner.peak_rss_bytes
+        )
+        done_payload = {
+            "message": message, "return_code": -1 if runner.timed_out else runner.return_code,
+            "duration": round(runner.duration, 4), "timed_out": runner.timed_out,
+            "executed_file_type": file_extension, "warning": plan["admin_warning"],
+            "output_info": captured.info(),
+            "tails": {name: stream.tail_text() for name, stream in captured.streams.items() if stream.truncated},
+            "resources": _resource_report(runner.usage(), limits, file_extension, runner.return_code, captured.text("stderr")[-4096:]),
+            **_validation_fields(validation),
+        }
+        _record_execution_history(
+            conversation_id, code_to_execute, file_extension,
+            {**done_payload, "output": captured.text("stdout"), "error": captured.text("stderr")}, 408 if runner.timed_out else 200
+        )
+        yield sse_event('done', done_payload)
 
+    except FileNotFoundError as fnf_error:
+        err_msg = _missing_command_message(fnf_error, file_extension, run_as_admin)
+        logger.error(err_msg)
+        metrics.observe_execution(file_extension, 'error')
+        _record_execution_history(conversation_id, code_to_execute, file_extension, {"error": err_msg, "return_code": -1}, 500)
+        yield sse_event('error', {"error": err_msg, "return_code": -1, "status": 500})
+    except Exception as e:
+        logger.exception(f"Lỗi nghiêm trọng khi thực thi file tạm (stream): {e}")
+        metrics.observe_execution(file_extension, 'error')
+        _record_execution_history(conversation_id, code_to_execute, file_extension, {"error": f"Lỗi hệ thống khi thực thi file: {e}", "return_code": -1}, 500)
+        yield sse_event('error', {"error": f"Lỗi hệ thống khi thực thi file: {e}", "return_code": -1, "status": 500})
+    finally:
+        if captured:
+            execution_outputs.finish(captured) # Client ngắt giữa chừng: vẫn đóng file spill
+        if plan:
+            _cleanup_execution(plan)
+        session_stack.close()
+
+
+def _output_expired(output_id):
+    return jsonify({"error": f"Không tìm thấy output '{output_id}' (có thể đã hết hạn)."}), 404
+
+# Đọc lại output đã bị lược của một lần thực thi:
+#   ?offset=<byte>&length=<byte>  -> khoảng byte (mặc định 0 .. 64 KiB)
+#   ?line=<dòng, từ 0>&lines=<n>  -> khoảng dòng
+# Tối đa OUTPUT_RANGE_MAX_BYTES mỗi lần; byte cắt giữa ký tự UTF-8 được thay bằng U+FFFD
+@app.route('/api/outputs/<output_id>/<stream_name>', methods=['GET'])
+def handle_output_range(output_id, stream_name):
+    captured = execution_outputs.get(output_id)
+    if captured is None:
+        return _output_expired(output_id)
+    if stream_name not in captured.streams:
+        return jsonify({"error": "Stream phải là 'stdout' hoặc 'stderr'."}), 400
+    stream = captured.streams[stream_name]
+    try:
+        if 'line' in request.args:
+            start_line = max(0, int(request.args['line']))
+            line_count = max(1, min(int(request.args.get('lines', '100')), 100000))
+            data = stream.read_lines(start_line, line_count, OUTPUT_RANGE_MAX_BYTES)
+            position = {"line": start_line, "lines": data.count(b'\n') + (0 if not data or data.endswith(b'\n') else 1)}
+        else:
+            offset = max(0, int(request.args.get('offset', '0')))
+            length = max(0, min(int(request.args.get('length', '65536')), OUTPUT_RANGE_MAX_BYTES))
+            data = stream.read_bytes(offset, length)
+            position = {"offset": offset, "length": len(data)}
+    except ValueError:
+        return jsonify({"error": "Tham số offset/length/line/lines phải là số nguyên."}), 400
+    except OSError: # File spill vừa bị xóa (hết hạn/bị đẩy ra) sau khi lấy output
+        return _output_expired(output_id)
+    return jsonify({
+        "id": output_id, "stream": stream_name, **position,
+        "text": data.decode('utf-8', errors='replace'), **stream.info(),
+    })
+
+
+# Xử lý phản hồi của Gemini cho /api/debug (tách giải thích, đề xuất pip, code đã sửa), trả về (payload, status_code)
+def _build_debug_result(raw_response, language_extension):
     if raw_response and not raw_response.startswith("Lỗi"):
-        explanation_part = raw_response
         corrected_code = None
         suggested_package = None
+        blocks = parse_fenced_blocks(raw_response)["blocks"]
+        excluded_blocks = []
 
         # Chỉ tìm đề xuất pip install NẾU ngôn ngữ là Python
         if language_extension == 'py':
-            install_match = re.search(r"```bash\s*pip install\s+([\w\-==\.]+)\s*```", explanation_part, re.IGNORECASE)
-            if install_match:
-                suggested_package = install_match.group(1).strip()
-                print(f"Debug (Python): Phát hiện đề xuất cài đặt package: {suggested_package}")
-                explanation_part = explanation_part[:install_match.start()].strip() + explanation_part[install_match.end():].strip()
-
-        # Tìm khối mã cuối cùng
-        last_code_block_match = None
-        code_block_tag = language_extension if language_extension.isalnum() else 'code'
-        patterns_to_try = [r"```" + re.escape(code_block_tag) + r"\s*([\s\S]*?)\s*```"]
-        # Thêm các alias phổ biến
-        if language_extension == 'py': patterns_to_try.append(r"```python\s*([\s\S]*?)\s*```")
-        if language_extension == 'sh': patterns_to_try.append(r"```bash\s*([\s\S]*?)\s*```")
-        if language_extension == 'bat': patterns_to_try.append(r"```batch\s*([\s\S]*?)\s*```")
-        if language_extension == 'ps1': patterns_to_try.append(r"```powershell\s*([\s\S]*?)\s*```")
-        patterns_to_try.append(r"```\s*([\s\S]*?)\s*```") # Fallback
-
-        for pattern in patterns_to_try:
-             matches = list(re.finditer(pattern, explanation_part, re.IGNORECASE | re.MULTILINE))
-             if matches:
-                 last_code_block_match = matches[-1]
-                 print(f"Debug: Found corrected code block using pattern: {pattern}")
-                 break
+            install_block, suggested_package = find_pip_install(blocks)
+            if install_block:
+                logger.info(f"Debug (Python): Phát hiện đề xuất cài đặt package: {suggested_package}")
+                excluded_blocks.append(install_block)
+
+        # Tìm khối mã cuối cùng (đúng tag/alias, không có thì khối ``` bất kỳ cuối cùng)
+        code_block, _tag_matched = select_code_block(blocks, language_extension, exclude=excluded_blocks)
 
-        if last_code_block_match:
-            start_index = last_code_block_match.start()
-            potential_explanation_before_code = explanation_part[:start_index].strip()
+        if code_block:
+            logger.debug(f"Debug: Found corrected code block #{code_block.index} (tag: {code_block.language or 'none'})")
+            potential_explanation_before_code = text_without_blocks(raw_response, excluded_blocks, end=code_block.start)
             if potential_explanation_before_code:
                  explanation_part = potential_explanation_before_code
             else:
                  explanation_part = f"(AI chỉ trả về code {get_language_name(language_extension)} đã sửa lỗi, không có giải thích)"
-            corrected_code = last_code_block_match.group(1).strip()
+            corrected_code = code_block.code.strip()
+        else:
+            explanation_part = text_without_blocks(raw_response, excluded_blocks)
 
         explanation_part = re.sub(r"^(Phân tích và đề xuất:|Giải thích và đề xuất:|Phân tích:|Giải thích:)\s*", "", explanation_part, flags=re.IGNORECASE | re.MULTILINE).strip()
 
-        return jsonify({
+        return {
             "explanation": explanation_part if explanation_part else "(Không có giải thích)",
             "corrected_code": corrected_code,
             "suggested_package": suggested_package,
             "original_language": language_extension # Trả về ngôn ngữ gốc để frontend biết
-        })
+        }, 200
     elif raw_response:
-        status_code = 400 if ("Lỗi cấu hình" in raw_response or "Lỗi: Phản hồi bị chặn" in raw_response) else 500
-        return jsonify({"error": raw_response}), status_code
+        return {"error": raw_response}, _gemini_error_status(raw_response)
     else:
-        return jsonify({"error": "Không thể thực hiện gỡ rối hoặc có lỗi không xác định xảy ra."}), 500
-
+        return {"error": "Không thể thực hiện gỡ rối hoặc có lỗi không xác định xảy ra."}, 500
 
-# Endpoint để cài đặt package Python bằng pip
-@app.route('/api/install_package', methods=['POST'])
-def handle_install_package():
+# Endpoint để gỡ lỗi cod
+@app.route('/api/debug', methods=['POST'])
+def handle_debug():
     data = request.get_json()
-    package_name = data.get('package_name')
-
-    if not package_name:
-        return jsonify({"error": "Thiếu tên package để cài đặt."}), 400
+    original_prompt = data.get('prompt', '(Không có prompt gốc)')
+    failed_code = data.get('code')
+    stdout = data.get('stdout', '')
+    stderr = data.get('stderr', '')
+    model_config = data.get('model_config', {})
+    # Nhận loại file gây lỗi từ frontend
+    file_type = data.get('file_type', 'py')
 
-    # Thêm kiểm tra tên package chặt chẽ hơn chút
-    if not re.fullmatch(r"^[a-zA-Z0-9\-_==\.\+]+$", package_name.replace('[','').replace(']','')): # Allow versions, extras
-        print(f"[CẢNH BÁO] Tên package không hợp lệ bị từ chối: {package_name}")
-        return jsonify({"success": False, "error": f"Tên package không hợp lệ: {package_name}"}), 400
+    if not failed_code:
+        return jsonify({"error": "Thiếu mã lỗi để gỡ rối."}), 400
 
-    print(f"--- Chuẩn bị cài đặt package: {package_name} ---")
-    # Sử dụng shlex.split để xử lý tên package có thể chứa dấu cách hoặc ký tự đặc biệt (ít gặp nhưng an toàn hơn)
-    try:
-        pip_command_parts = [sys.executable, '-m', 'pip', 'install'] + shlex.split(package_name)
-        # Loại bỏ các phần tử rỗng nếu có sau khi split
-        command = [part for part in pip_command_parts if part]
-    except Exception as parse_err:
-        print(f"[LỖI] Không thể phân tích tên package: {package_name} - {parse_err}")
-        return jsonify({"success": False, "error": f"Tên package không hợp lệ: {package_name}"}), 400
+    # Đảm bảo file_type chỉ là extension
+    language_extension = file_type.split('.')[-1].lower() if '.' in file_type else file_type.lower()
+    if not language_extension: language_extension = 'py'
 
+    system_instruction, full_prompt, compaction = create_debug_prompt(original_prompt, failed_code, stdout, stderr, language_extension)
+    build_result = _with_history(
+        'debug', _conversation_id(data),
+        lambda raw_response: _with_prompt_compaction(_build_debug_result(raw_response, language_extension), compaction),
+        prompt=original_prompt, code=failed_code, file_type=language_extension
+    )
 
+    if _wants_stream(data):
+        return _sse_response(_stream_gemini_endpoint(full_prompt, model_config.copy(), True, build_result, detect_code=True, system_instruction=system_instruction, endpoint='debug'))
+
+    raw_response = generate_response_from_gemini(full_prompt, model_config.copy(), is_for_review_or_debug=True, system_instruction=system_instruction, endpoint='debug')
+    payload, status_code = build_result(raw_response)
+    return jsonify(payload), status_code
+
+
+# Thời gian tối đa (giây) cho một lần cài package bằng pip
+INSTALL_TIMEOUT_SECONDS = 120
+# Số package tối đa trong một lần cài
+INSTALL_MAX_PACKAGES = 20
+# Thư mục wheel cục bộ (pip --find-links): cài lại nhanh, không cần tải; có thể tạo bằng
+# `pip download -d <dir> <package>` hoặc `pip wheel -w <dir> <package>`
+INSTALL_FIND_LINKS = os.getenv('INSTALL_FIND_LINKS')
+# INSTALL_OFFLINE=1: chỉ cài từ INSTALL_FIND_LINKS (pip --no-index), không truy cập PyPI
+INSTALL_OFFLINE = os.getenv('INSTALL_OFFLINE', '').lower() in ('1', 'true', 'yes')
+# INSTALL_INDEX_URL: index nội bộ/mirror thay cho PyPI
+INSTALL_INDEX_URL = os.getenv('INSTALL_INDEX_URL')
+
+# Lấy danh sách yêu cầu từ body: "packages": [...] hoặc "package_name": "a b==1 ..." (cách nhau bởi khoảng trắng).
+# Trả về (specs, None) hoặc (None, (payload, status_code))
+def _parse_package_request(data):
+    packages = data.get('packages')
+    if packages is None:
+        packages = split_requirements(str(data.get('package_name') or ''))
+    if not isinstance(packages, list) or not packages:
+        return None, ({"error": "Thiếu tên package để cài đặt."}, 400)
+    if len(packages) > INSTALL_MAX_PACKAGES:
+        return None, ({"success": False, "error": f"Mỗi lần cài tối đa {INSTALL_MAX_PACKAGES} package (nhận được {len(packages)})."}, 400)
+    for package_name in packages:
+        if not isinstance(package_name, str) or not is_valid_requirement(package_name):
+            logger.warning(f"Tên package không hợp lệ bị từ chối: {package_name}")
+            return None, ({"success": False, "error": f"Tên package không hợp lệ: {package_name}"}, 400)
+    return list(dict.fromkeys(packages)), None
+
+# Dựng lệnh pip cho các yêu cầu chưa thỏa (một lần gọi pip cho cả nhóm để pip resolve chung)
+def _build_pip_command(specs, python_executable=None):
+    command = [python_executable or sys.executable, '-m', 'pip', 'install', '--disable-pip-version-check', '--no-input']
+    if INSTALL_FIND_LINKS:
+        command += ['--find-links', INSTALL_FIND_LINKS]
+    if INSTALL_OFFLINE:
+        command.append('--no-index')
+    elif INSTALL_INDEX_URL:
+        command += ['--index-url', INSTALL_INDEX_URL]
+    return command + list(specs)
+
+# Cài các package, dùng chung cho /api/install_package và job queue. Trả về (payload, status_code).
+# Yêu cầu đã thỏa theo metadata đã cài được bỏ qua; tất cả đã thỏa -> trả về ngay, không chạy pip.
+# Có session_id: cài vào venv của session (pip của các session khác nhau chạy song song, cùng session thì tuần tự).
+# timeout: giới hạn thời gian chạy pip (giây), auto-fix truyền phần ngân sách còn lại
+def _install_package(specs, on_start=None, session_id=None, timeout=INSTALL_TIMEOUT_SECONDS):
+    try:
+        with _session_env(session_id) as session_env:
+            if session_env is None:
+                return _install_into_env(specs, on_start, timeout=timeout)
+            with session_env.install_lock:
+                payload, status_code = _install_into_env(specs, on_start, session_env, timeout)
+            session_envs.record_install(session_env)
+            return {**payload, "session_id": session_id}, status_code
+    except SessionEnvError as e:
+        logger.error(f"Không chuẩn bị được venv cho session '{session_id}': {e}")
+        return {"success": False, "error": str(e), "output": ""}, 500
+
+def _install_into_env(specs, on_start=None, session_env=None, timeout=INSTALL_TIMEOUT_SECONDS):
+    package_name = " ".join(specs)
+    satisfied, pending = partition_requirements(specs, session_env.site_paths() if session_env else None)
+    already_satisfied = [entry["requirement"] for entry in satisfied]
+    if not pending:
+        logger.info(f"Bỏ qua pip: '{package_name}' đã được cài đặt.")
+        return {
+            "success": True, "message": f"'{package_name}' đã được cài đặt, không cần cài lại.", "output": "", "error": "",
+            "already_satisfied": already_satisfied, "installed": [], "skipped_pip": True,
+        }, 200
+
+    to_install = [entry["requirement"] for entry in pending]
+    command = _build_pip_command(to_install, session_env.python if session_env else None)
+    logger.info(f"Chuẩn bị cài đặt package: {' '.join(to_install)}" + (f" (đã có: {' '.join(already_satisfied)})" if already_satisfied else ""))
     try:
-        process_env = os.environ.copy()
-        process_env["PYTHONIOENCODING"] = "utf-8"
-        result = subprocess.run(
-            command, capture_output=True, encoding='utf-8', errors='replace',
-            timeout=120, check=False, env=process_env, text=True
+        result = run_process(command, env=_execution_env(session_env), timeout=timeout, on_start=on_start)
+        if result["timed_out"]:
+            logger.error(f"Cài đặt package '{package_name}' vượt quá thời gian cho phép ({timeout:.0f} giây).")
+            return {"success": False, "error": f"Timeout khi cài đặt '{package_name}'.", "output": "", "error": "Timeout"}, 408
+
+        output = result["stdout"]
+        error_output = result["stderr"]
+        return_code = result["return_code"]
+
+        log_payload(
+            logger, logging.INFO, f"Kết quả cài đặt (Mã trả về: {return_code})",
+            {"stdout": output or None, "stderr": error_output or None},
+            return_code=return_code, package=package_name
         )
-        output = result.stdout
-        error_output = result.stderr
-        return_code = result.returncode
-
-        print(f"--- Kết quả cài đặt (Mã trả về: {return_code}) ---")
-        if output: print(f"Output:\n{output}")
-        if error_output: print(f"Lỗi Output:\n{error_output}")
-        print(f"----------------------------------------------")
 
         if return_code == 0:
             message = f"Cài đặt '{package_name}' thành công."
-            return jsonify({ "success": True, "message": message, "output": output, "error": error_output })
+            if python_warm_pool and not session_env:
+                python_warm_pool.recycle_all() # Worker cũ đã preload trước khi có package mới
+            return {
+                "success": True, "message": message, "output": output, "error": error_output,
+                "already_satisfied": already_satisfied, "installed": to_install, "skipped_pip": False,
+            }, 200
         else:
             message = f"Cài đặt '{package_name}' thất bại."
             # Cố gắng lấy dòng lỗi cuối cùng hoặc một phần lỗi chính
             detailed_error = error_output.strip().split('\n')[-1] if error_output.strip() else f"Lệnh Pip thất bại với mã trả về {return_code}."
-            return jsonify({ "success": False, "message": message, "output": output, "error": detailed_error }), 500 # Trả 500 khi pip lỗi
+            return { "success": False, "message": message, "output": output, "error": detailed_error }, 500 # Trả 500 khi pip lỗi
 
-    except subprocess.TimeoutExpired:
-        print(f"Lỗi: Cài đặt package '{package_name}' vượt quá thời gian cho phép (120 giây).")
-        return jsonify({"success": False, "error": f"Timeout khi cài đặt '{package_name}'.", "output": "", "error": "Timeout"}), 408
     except FileNotFoundError:
-         print(f"Lỗi: Không tìm thấy '{sys.executable}' hoặc pip.")
-         return jsonify({"success": False, "error": "Lỗi hệ thống: Không tìm thấy Python hoặc Pip.", "output": "", "error": "FileNotFoundError"}), 500
+         logger.error(f"Không tìm thấy '{sys.executable}' hoặc pip.")
+         return {"success": False, "error": "Lỗi hệ thống: Không tìm thấy Python hoặc Pip.", "output": "", "error": "FileNotFoundError"}, 500
     except Exception as e:
-        print(f"Lỗi nghiêm trọng khi cài đặt package '{package_name}': {e}", file=sys.stderr)
-        traceback.print_exc(file=sys.stderr)
-        return jsonify({"success": False, "error": f"Lỗi hệ thống khi cài đặt: {e}", "output": "", "error": str(e)}), 500
+        logger.exception(f"Lỗi nghiêm trọng khi cài đặt package '{package_name}': {e}")
+        return {"success": False, "error": f"Lỗi hệ thống khi cài đặt: {e}", "output": "", "error": str(e)}, 500
+
+# Endpoint để cài đặt package Python bằng pip
+# Body: {"package_name": "requests"} hoặc nhiều package {"packages": ["requests", "rich>=13"]}; "session_id" để cài vào venv của session
+@app.route('/api/install_package', methods=['POST'])
+def handle_install_package():
+    data = request.get_json()
+    specs, invalid = _parse_package_request(data)
+    invalid = invalid or _check_session_id(data.get('session_id'))
+    if invalid:
+        payload, status_code = invalid
+        return jsonify(payload), status_code
+
+    payload, status_code = _install_package(specs, session_id=data.get('session_id'))
+    return jsonify(payload), status_code
+
+
+# --- Tự sửa lỗi phía server: execute -> debug -> (cài package) -> execute lại ---
+# Mỗi vòng: chạy code; lỗi thì gọi Gemini với prompt debug (create_debug_prompt), lấy code đã sửa và package đề xuất
+# (_build_debug_result), cài package nếu có, rồi chạy lại. Dừng khi chạy thành công hoặc hết ngân sách vòng/thời gian.
+# Ngân sách thời gian là wall-clock: mọi bước (chạy code, gọi Gemini kể cả retry, pip) đều bị giới hạn bởi phần còn lại.
+AUTO_FIX_MAX_ITERATIONS = int(os.getenv('AUTO_FIX_MAX_ITERATIONS', '5'))
+AUTO_FIX_TIME_BUDGET_SECONDS = float(os.getenv('AUTO_FIX_TIME_BUDGET_SECONDS', '180'))
+# Thời gian tối thiểu còn lại để bắt đầu một bước mới (gọi Gemini/chạy code)
+AUTO_FIX_MIN_STEP_SECONDS = 1.0
+
+def _auto_fix_budget(value, default, maximum):
+    try:
+        return max(1, min(float(value), maximum)) if value is not None else default
+    except (TypeError, ValueError):
+        return default
+
+# Generator (event, payload) của vòng tự sửa:
+#   execute -> {"iteration", "return_code", "output", "error", "duration", "timed_out", "output_info"}
+#   debug   -> {"iteration", "explanation", "corrected_code", "suggested_package", "duration"}
+#   install -> {"iteration", "packages", "success", "message", "skipped_pip", "duration"}
+#   done    -> {"success", "reason", "iterations", "final_code", "duration", ...} (reason: fixed | iteration_budget |
+#              time_budget | execute_error | debug_failed | no_fix | install_failed)
+def _auto_fix_steps(code, original_prompt, file_extension, model_config, max_iterations, time_budget,
+                    auto_install=False, session_id=None, conversation_id=None):
+    start_time = time.monotonic()
+    deadline = start_time + time_budget
+    remaining = lambda: deadline - time.monotonic()
+    iteration = 0
+    last_result = {}
+
+    def finish(success, reason, **extra):
+        metrics.auto_fix_runs_total.inc(reason)
+        metrics.auto_fix_duration_seconds.observe(time.monotonic() - start_time)
+        metrics.auto_fix_iterations.observe(iteration)
+        logger.info(f"Auto-fix kết thúc: {reason} sau {iteration} lần chạy ({time.monotonic() - start_time:.1f}s).")
+        return 'done', {
+            "success": success, "reason": reason, "iterations": iteration, "final_code": code,
+            "return_code": last_result.get("return_code"), "output": last_result.get("output"), "error": last_result.get("error"),
+            "duration": round(time.monotonic() - start_time, 3), **extra
+        }
+
+    while True:
+        if remaining() < AUTO_FIX_MIN_STEP_SECONDS:
+            yield finish(False, 'time_budget')
+            return
+        iteration += 1
+        step_start = time.monotonic()
+        last_result, status_code = _execute_code(
+            code, file_extension, False, session_id=session_id, conversation_id=conversation_id, # Không bao giờ chạy code đã sửa bằng quyền admin
+            timeout=min(EXECUTE_TIMEOUT_SECONDS, remaining())
+        )
+        timed_out = status_code == 408
+        yield 'execute', {
+            "iteration": iteration, "return_code": last_result.get("return_code"), "output": last_result.get("output"),
+            "error": last_result.get("error"), "duration": round(time.monotonic() - step_start, 3), "timed_out": timed_out,
+            "output_info": last_result.get("output_info"),
+        }
+        if status_code == 200 and last_result.get("return_code") == 0:
+            yield finish(True, 'fixed')
+            return
+        if status_code not in (200, 408):
+            yield finish(False, 'execute_error') # Không chạy được (thiếu interpreter, lỗi hệ thống...), debug không giúp được
+            return
+        if iteration >= max_iterations:
+            yield finish(False, 'iteration_budget')
+            return
+        if remaining() < AUTO_FIX_MIN_STEP_SECONDS:
+            yield finish(False, 'time_budget')
+            return
+
+        step_start = time.monotonic()
+        stderr_text = last_result.get("error") or ""
+        if timed_out and not stderr_text.strip():
+            stderr_text = "Timeout: chương trình chạy quá thời gian cho phép."
+        system_instruction, full_prompt, compaction = create_debug_prompt(original_prompt, code, last_result.get("output") or "", stderr_text, file_extension)
+        build_result = _with_history(
+            'debug', conversation_id, lambda raw_response: _build_debug_result(raw_response, file_extension),
+            prompt=original_prompt, code=code, file_type=file_extension
+        )
+        raw_response = generate_response_from_gemini(
+            full_prompt, model_config.copy(), is_for_review_or_debug=True, system_instruction=system_instruction, endpoint='debug', deadline=deadline
+        )
+        debug_payload, debug_status = build_result(raw_response)
+        if debug_status >= 400:
+            reason = 'time_budget' if remaining() < AUTO_FIX_MIN_STEP_SECONDS else 'debug_failed' # Lời gọi bị cắt vì hết ngân sách
+            yield finish(False, reason, debug_error=debug_payload.get("error"))
+            return
+        corrected_code = debug_payload.get("corrected_code")
+        suggested_package = debug_payload.get("suggested_package")
+        yield 'debug', {
+            "iteration": iteration, "explanation": debug_payload.get("explanation"), "corrected_code": corrected_code,
+            "suggested_package": suggested_package, "duration": round(time.monotonic() - step_start, 3),
+            **({"prompt_compaction": compaction} if compaction else {}),
+        }
+
+        installed = False
+        if suggested_package and auto_install and remaining() >= AUTO_FIX_MIN_STEP_SECONDS:
+            step_start = time.monotonic()
+            specs = [spec for spec in split_requirements(suggested_package) if is_valid_requirement(spec)][:INSTALL_MAX_PACKAGES]
+            install_payload, install_status = _install_package(specs, session_id=session_id, timeout=min(INSTALL_TIMEOUT_SECONDS, remaining())) if specs else (
+                {"success": False, "message": f"Package đề xuất không hợp lệ: {suggested_package}"}, 400)
+            installed = install_status == 200 and not install_payload.get("skipped_pip")
+            yield 'install', {
+                "iteration": iteration, "packages": specs, "success": install_status == 200,
+                "message": install_payload.get("message") or install_payload.get("error"),
+                "skipped_pip": install_payload.get("skipped_pip", False), "duration": round(time.monotonic() - step_start, 3),
+            }
+            if install_status != 200 and remaining() < AUTO_FIX_MIN_STEP_SECONDS:
+                yield finish(False, 'time_budget')
+                return
+            if install_status != 200 and not corrected_code:
+                yield finish(False, 'install_failed')
+                return
+
+        if corrected_code and corrected_code.strip() != code.strip():
+            code = corrected_code
+        elif not installed:
+            yield finish(False, 'no_fix') # Gemini không đưa ra thay đổi nào mới -> chạy lại cũng vậy
+            return
+
+# Endpoint tự sửa lỗi: {"code", "prompt", "file_type", "model_config", "max_iterations", "time_budget_seconds",
+# "auto_install" (mặc định false, cần session_id), "session_id", "stream"}
+# Không stream: trả về kết quả cuối kèm "steps"; stream: mỗi bước là một event SSE (xem _auto_fix_steps)
+# Code do Gemini viết lại được chạy mà không ai xem trước: không bao giờ chạy với quyền admin, và chỉ cài package
+# Gemini đề xuất khi người dùng bật auto_install, vào venv riêng của session (không cài vào interpreter của server).
+@app.route('/api/auto_fix', methods=['POST'])
+def handle_auto_fix():
+    data = request.get_json()
+    code = data.get('code')
+    if not code:
+        return jsonify({"error": "Không có mã nào để sửa."}), 400
+    if data.get('run_as_admin'):
+        return jsonify({"error": "Auto-fix không hỗ trợ chạy với quyền admin: code đã sửa phải được người dùng xem lại trước khi chạy bằng quyền admin."}), 400
+    session_id = data.get('session_id')
+    invalid = _check_session_id(session_id)
+    if invalid:
+        payload, status_code = invalid
+        return jsonify(payload), status_code
+    auto_install = data.get('auto_install') is True
+    if auto_install and not session_id:
+        return jsonify({"error": "auto_install chỉ cài vào venv của session, cần session_id."}), 400
+
+    file_extension = _execution_extension(data.get('file_type', 'py'))
+    steps = _auto_fix_steps(
+        code, data.get('prompt') or '(Không có prompt gốc)', file_extension, data.get('model_config', {}),
+        max_iterations=int(_auto_fix_budget(data.get('max_iterations'), AUTO_FIX_MAX_ITERATIONS, AUTO_FIX_MAX_ITERATIONS)),
+        time_budget=_auto_fix_budget(data.get('time_budget_seconds'), AUTO_FIX_TIME_BUDGET_SECONDS, AUTO_FIX_TIME_BUDGET_SECONDS),
+        auto_install=auto_install and file_extension == 'py',
+        session_id=session_id, conversation_id=_conversation_id(data)
+    )
+    logger.info(f"Bắt đầu auto-fix cho code .{file_extension}.")
+
+    if _wants_stream(data):
+        return _sse_response(sse_event(event, payload) for event, payload in steps)
+
+    step_list = []
+    for event, payload in steps:
+        if event == 'done':
+            return jsonify({**payload, "steps": step_list}), 200
+        step_list.append({"event": event, **payload})
+
+
+# --- Job queue: chạy execute / install_package bất đồng bộ ---
+execution_jobs = JobQueue(
+    max_workers=int(os.getenv('JOB_MAX_WORKERS', '4')),
+    max_queue=int(os.getenv('JOB_MAX_QUEUE', '64')),
+    retention_seconds=float(os.getenv('JOB_RETENTION_SECONDS', '3600'))
+)
+
+def _submit_job(kind, fn):
+    try:
+        job = execution_jobs.submit(kind, fn)
+    except QueueFullError as e:
+        logger.warning(f"Từ chối job {kind}: {e}")
+        return jsonify({"error": f"Máy chủ đang bận: {e} Vui lòng thử lại sau."}), 503
+    logger.info(f"Đã nhận job {job.id} ({kind}).")
+    return jsonify(job.to_dict()), 202
+
+# Submit job thực thi code: body giống /api/execute, trả về job_id ngay (202)
+@app.route('/api/jobs/execute', methods=['POST'])
+def handle_submit_execute_job():
+    data = request.get_json()
+    code_to_execute = data.get('code')
+    run_as_admin = data.get('run_as_admin', False)
+    file_extension = _execution_extension(data.get('file_type', 'py'))
+    echo_code = data.get('echo_code') is True
+    session_id = data.get('session_id')
+    conversation_id = _conversation_id(data)
+
+    if not code_to_execute:
+        return jsonify({"error": "Không có mã nào để thực thi."}), 400
+    invalid = _check_session_id(session_id)
+    if invalid:
+        payload, status_code = invalid
+        return jsonify(payload), status_code
+    limits, invalid = _request_limits(data, file_extension)
+    if invalid:
+        payload, status_code = invalid
+        return jsonify(payload), status_code
+
+    return _submit_job('execute', lambda job: _execute_code(
+        code_to_execute, file_extension, run_as_admin, on_start=job.attach_process, echo_code=echo_code,
+        session_id=session_id, conversation_id=conversation_id, limits=limits))
+
+# Submit job cài package: body giống /api/install_package
+@app.route('/api/jobs/install_package', methods=['POST'])
+def handle_submit_install_job():
+    data = request.get_json()
+    specs, invalid = _parse_package_request(data)
+    invalid = invalid or _check_session_id(data.get('session_id'))
+    if invalid:
+        payload, status_code = invalid
+        return jsonify(payload), status_code
+
+    session_id = data.get('session_id')
+    return _submit_job('install_package', lambda job: _install_package(specs, on_start=job.attach_process, session_id=session_id))
+
+# Trạng thái job (kèm kết quả nếu đã xong)
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def handle_job_status(job_id):
+    job = execution_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Không tìm thấy job '{job_id}'."}), 404
+    return jsonify(job.to_dict(include_result=True))
+
+# Kết quả job: trả nguyên payload/status của /api/execute hoặc /api/install_package khi đã xong
+@app.route('/api/jobs/<job_id>/result', methods=['GET'])
+def handle_job_result(job_id):
+    job = execution_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Không tìm thấy job '{job_id}'."}), 404
+    if not job.finished_at:
+        return jsonify(job.to_dict()), 202
+    return jsonify(job.result), job.status_code
+
+# Hủy job: job đang chờ bị bỏ, job đang chạy bị kill cả cây tiến trình
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def handle_job_cancel(job_id):
+    job = execution_jobs.cancel(job_id)
+    if job is None:
+        return jsonify({"error": f"Không tìm thấy job '{job_id}'."}), 404
+    logger.info(f"Đã yêu cầu hủy job {job_id}.")
+    return jsonify(job.to_dict())
+
+# Thống kê hàng đợi (số job theo trạng thái, thời gian chờ/chạy trung bình) để định cỡ pool
+@app.route('/api/jobs', methods=['GET'])
+def handle_job_stats():
+    return jsonify(execution_jobs.stats())
+
+# Venv của các session: số lượng, dung lượng đĩa, số lần clone/evict
+@app.route('/api/sessions', methods=['GET'])
+def handle_session_envs():
+    if not session_envs:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **session_envs.stats()})
+
+# Xóa venv của một session (lần dùng sau sẽ clone lại từ venv mẫu)
+@app.route('/api/sessions/<session_id>', methods=['DELETE'])
+def handle_session_env_delete(session_id):
+    invalid = _check_session_id(session_id)
+    if invalid:
+        payload, status_code = invalid
+        return jsonify(payload), status_code
+    try:
+        removed = session_envs.remove(session_id)
+    except SessionEnvError as e:
+        return jsonify({"success": False, "error": str(e)}), 409
+    if not removed:
+        return jsonify({"success": False, "error": f"Session '{session_id}' không có venv."}), 404
+    return jsonify({"success": True, "message": f"Đã xóa venv của session '{session_id}'."})
+
+# Kernel giữ trạng thái đang chạy (mới dùng gần nhất trước) và thống kê
+@app.route('/api/kernels', methods=['GET'])
+def handle_kernels():
+    if not kernel_manager:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **kernel_manager.stats(), "items": kernel_manager.list()})
+
+def _kernel_not_found(conversation_id):
+    return jsonify({"success": False, "error": f"Hội thoại '{conversation_id}' không có kernel."}), 404
+
+# Khởi động lại kernel của hội thoại: bỏ toàn bộ trạng thái, kernel mới sẵn sàng ngay
+@app.route('/api/kernels/<conversation_id>/restart', methods=['POST'])
+def handle_kernel_restart(conversation_id):
+    if not kernel_manager:
+        return jsonify({"success": False, "error": "Kernel giữ trạng thái chưa được bật trên backend."}), 400
+    try:
+        info = kernel_manager.restart(conversation_id)
+    except KernelError as e:
+        return jsonify({"success": False, "error": str(e)}), _kernel_error_status(e)
+    if info is None:
+        return _kernel_not_found(conversation_id)
+    return jsonify({"success": True, "message": f"Đã khởi động lại kernel của hội thoại '{conversation_id}'.", "kernel": info})
+
+# Ngắt code đang chạy (KeyboardInterrupt), kernel giữ trạng thái
+@app.route('/api/kernels/<conversation_id>/interrupt', methods=['POST'])
+def handle_kernel_interrupt(conversation_id):
+    if not kernel_manager:
+        return jsonify({"success": False, "error": "Kernel giữ trạng thái chưa được bật trên backend."}), 400
+    if not kernel_manager.interrupt(conversation_id):
+        return _kernel_not_found(conversation_id)
+    return jsonify({"success": True, "message": f"Đã gửi tín hiệu ngắt tới kernel của hội thoại '{conversation_id}'."})
+
+# Tắt kernel của hội thoại (lần chạy sau bắt đầu với kernel mới)
+@app.route('/api/kernels/<conversation_id>', methods=['DELETE'])
+def handle_kernel_delete(conversation_id):
+    if not kernel_manager:
+        return jsonify({"success": False, "error": "Kernel giữ trạng thái chưa được bật trên backend."}), 400
+    if not kernel_manager.remove(conversation_id):
+        return _kernel_not_found(conversation_id)
+    return jsonify({"success": True, "message": f"Đã tắt kernel của hội thoại '{conversation_id}'."})
+
+
+# --- Lịch sử hội thoại ---
+def _history_int_arg(name, default=None, maximum=None):
+    value = request.args.get(name)
+    if value in (None, ''):
+        return default
+    number = int(value) # ValueError -> 400 ở caller
+    return min(number, maximum) if maximum else number
+
+def _history_disabled():
+    return jsonify({"error": "Lịch sử hội thoại đang tắt (HISTORY_DB_PATH rỗng)."}), 404
+
+# Danh sách hội thoại, mới cập nhật nhất trước: ?limit=&before=<updated_at của mục cuối trang trước>
+@app.route('/api/conversations', methods=['GET'])
+def handle_conversations():
+    if not history_store:
+        return _history_disabled()
+    try:
+        limit = max(1, _history_int_arg('limit', 50, HISTORY_PAGE_MAX))
+        before = float(request.args['before']) if request.args.get('before') else None
+    except ValueError:
+        return jsonify({"error": "limit/before phải là số."}), 400
+    return jsonify(history_store.list_conversations(limit, before))
+
+# Một trang tương tác của hội thoại: ?limit=&before=<id> (cũ hơn) hoặc ?after=<id> (mới hơn); mặc định trang mới nhất
+@app.route('/api/conversations/<conversation_id>/entries', methods=['GET'])
+def handle_conversation_entries(conversation_id):
+    if not history_store:
+        return _history_disabled()
+    try:
+        limit = max(1, _history_int_arg('limit', 50, HISTORY_PAGE_MAX))
+        before = _history_int_arg('before')
+        after = _history_int_arg('after')
+    except ValueError:
+        return jsonify({"error": "limit/before/after phải là số nguyên."}), 400
+    return jsonify(history_store.page(conversation_id, limit, before, after))
+
+# Tìm toàn văn trong prompt/code/output: ?q=&conversation_id=&limit=&before=<id>
+# Mặc định chỉ tìm trong hội thoại của người gọi (conversation_id hoặc header X-Conversation-Id);
+# ?scope=all để tìm trong mọi hội thoại
+@app.route('/api/conversations/search', methods=['GET'])
+def handle_conversation_search():
+    if not history_store:
+        return _history_disabled()
+    text = (request.args.get('q') or '').strip()
+    if not text:
+        return jsonify({"error": "Thiếu từ khóa tìm kiếm (q)."}), 400
+    conversation_id = _conversation_id(request.args)
+    if conversation_id is None and request.args.get('scope') != 'all':
+        return jsonify({"error": "Cần conversation_id (query hoặc header X-Conversation-Id), hoặc scope=all để tìm trong mọi hội thoại."}), 400
+    try:
+        limit = max(1, _history_int_arg('limit', 20, HISTORY_PAGE_MAX))
+        before = _history_int_arg('before')
+    except ValueError:
+        return jsonify({"error": "limit/before phải là số nguyên."}), 400
+    return jsonify(history_store.search(text, conversation_id, limit, before))
+
+# Một tương tác đầy đủ (vd: mở kết quả tìm kiếm)
+@app.route('/api/conversations/entries/<int:entry_id>', methods=['GET'])
+def handle_conversation_entry(entry_id):
+    if not history_store:
+        return _history_disabled()
+    entry = history_store.get_entry(entry_id)
+    if entry is None:
+        return jsonify({"error": f"Không tìm thấy mục lịch sử {entry_id}."}), 404
+    return jsonify(entry)
+
+@app.route('/api/conversations/<conversation_id>', methods=['DELETE'])
+def handle_conversation_delete(conversation_id):
+    if not history_store:
+        return _history_disabled()
+    deleted = history_store.delete_conversation(conversation_id)
+    return jsonify({"success": True, "deleted_entries": deleted})
+
+
+# Xử lý phản hồi của Gemini cho /api/explain, trả về (payload, status_code)
+def _build_explain_result(explanation_text):
+    if explanation_text and not explanation_text.startswith("Lỗi"):
+        return {"explanation": explanation_text}, 200
+    elif explanation_text:
+        return {"error": explanation_text}, _gemini_error_status(explanation_text)
+    else:
+        return {"error": "Không thể tạo giải thích hoặc có lỗi không xác định xảy ra."}, 500
+
+# Trạng thái lớp gọi Gemini: pool client, retry/rate limit, circuit breaker, định tuyến và độ trễ theo model
+@app.route('/api/gemini/status', methods=['GET'])
+def handle_gemini_status():
+    return jsonify({
+        "fake_backend": GEMINI_FAKE_BACKEND,
+        "client_pool": gemini_client_pool.stats(),
+        "resilience": gemini_resilience.stats(),
+        "routing_mode": GEMINI_ROUTING_MODE,
+        "fallback_models": GEMINI_FALLBACK_MODELS,
+        "latency_budgets": ENDPOINT_LATENCY_BUDGETS,
+        "router": model_router.snapshot(),
+    })
+
+# Thống kê cache phản hồi Gemini (số mục, hit/miss, tỉ lệ hit)
+@app.route('/api/cache', methods=['GET'])
+def handle_cache_stats():
+    return jsonify({"mode": GEMINI_CACHE_MODE, **response_cache.stats()})
+
+# Số liệu của các thành phần tự giữ thống kê, chỉ đọc lúc scrape /api/metrics
+def _collect_component_metrics():
+    cache_stats = response_cache.stats()
+    pool_stats = gemini_client_pool.stats()
+    validation_stats = code_validator.stats()
+    return [
+        ("gemini_response_cache_hits_total", "counter", "Số lần tìm thấy phản hồi trong cache.", [({}, cache_stats["hits"])]),
+        ("gemini_response_cache_misses_total", "counter", "Số lần không có phản hồi trong cache.", [({}, cache_stats["misses"])]),
+        ("gemini_response_cache_disk_hits_total", "counter", "Số lần hit từ cache trên đĩa.", [({}, cache_stats["disk_hits"])]),
+        ("gemini_response_cache_evictions_total", "counter", "Số mục bị loại khỏi cache do đầy.", [({}, cache_stats["evictions"])]),
+        ("gemini_response_cache_entries", "gauge", "Số mục đang có trong cache bộ nhớ.", [({}, cache_stats["entries"])]),
+        ("gemini_response_cache_hit_ratio", "gauge", "Tỉ lệ hit cache kể từ khi khởi động.", [({}, cache_stats["hit_rate"])]),
+        ("gemini_context_caches_created_total", "counter", "Số context cache Gemini đã tạo cho system instruction.", [({}, pool_stats["context_caches_created"])]),
+        ("gemini_context_cache_failures_total", "counter", "Số lần tạo context cache thất bại.", [({}, pool_stats["context_cache_failures"])]),
+        ("gemini_client_pool_clients", "gauge", "Số client Gemini (API key) đang giữ trong pool.", [({}, pool_stats["clients"])]),
+        ("log_records_dropped_total", "counter", "Số bản ghi log bị bỏ do hàng đợi log đầy.", [({}, dropped_records())]),
+        ("code_validation_cache_hits_total", "counter", "Số lần dùng lại kết quả kiểm tra code từ cache.", [({}, validation_stats["hits"])]),
+        ("code_validation_cache_entries", "gauge", "Số kết quả kiểm tra code đang giữ trong cache.", [({}, validation_stats["entries"])]),
+    ] + (_collect_session_env_metrics() if session_envs else []) + (_collect_history_metrics() if history_store else []) \
+      + (_collect_kernel_metrics() if kernel_manager else [])
+
+def _collect_kernel_metrics():
+    kernel_stats = kernel_manager.stats()
+    return [
+        ("kernels", "gauge", "Số kernel Python giữ trạng thái đang chạy.", [({}, kernel_stats["kernels"])]),
+        ("kernels_busy", "gauge", "Số kernel đang chạy code.", [({}, kernel_stats["busy"])]),
+        ("kernels_rss_bytes", "gauge", "Tổng RSS của các kernel (đo sau mỗi lần chạy).", [({}, kernel_stats["rss_bytes"])]),
+        ("kernel_starts_total", "counter", "Số kernel đã khởi động.", [({}, kernel_stats["started"])]),
+        ("kernel_evictions_total", "counter", "Số kernel bị tắt theo lý do (idle/memory/capacity/crashed/python_changed).",
+         [({"reason": reason}, count) for reason, count in kernel_stats["evictions"].items()]),
+    ]
+
+def _collect_history_metrics():
+    history_stats = history_store.stats()
+    return [
+        ("history_entries_written_total", "counter", "Số tương tác đã ghi vào lịch sử.", [({}, history_stats["written"])]),
+        ("history_entries_dropped_total", "counter", "Số tương tác bị bỏ do hàng đợi ghi lịch sử đầy.", [({}, history_stats["dropped"])]),
+        ("history_write_queue", "gauge", "Số tương tác đang chờ ghi lịch sử.", [({}, history_stats["queued"])]),
+    ]
+
+def _collect_session_env_metrics():
+    env_stats = session_envs.stats()
+    return [
+        ("session_envs", "gauge", "Số venv session đang giữ.", [({}, env_stats["envs"])]),
+        ("session_envs_disk_bytes", "gauge", "Dung lượng đĩa của venv mẫu và phần riêng của các venv session.", [({}, env_stats["disk_bytes"])]),
+        ("session_env_clones_total", "counter", "Số venv session đã clone từ venv mẫu.", [({}, env_stats["clones"])]),
+        ("session_env_evictions_total", "counter", "Số venv session bị bỏ (LRU/idle/dung lượng).", [({}, env_stats["evictions"])]),
+    ]
+
+metrics.registry.register_collector(_collect_component_metrics)
+
+# Metrics định dạng text của Prometheus. Mỗi process giữ số liệu riêng
+# (gunicorn nhiều worker: scrape từng worker hoặc chạy 1 worker nhiều thread).
+@app.route('/api/metrics', methods=['GET'])
+def handle_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+# Xóa toàn bộ cache phản hồi Gemini (cả bộ nhớ và đĩa)
+@app.route('/api/cache', methods=['DELETE'])
+def handle_cache_clear():
+    response_cache.clear()
+    return jsonify({"success": True, "message": "Đã xóa cache phản hồi Gemini."})
 
 
 # Endpoint để giải thích nội dung 
@@ -828,30 +2586,33 @@ def handle_explain():
     explain_context = 'code' if context == 'python_code' else context
     language_for_prompt = file_type if explain_context == 'code' else None
 
-    full_prompt = create_explain_prompt(content_to_explain, explain_context, language=language_for_prompt)
-    explanation_text = generate_response_from_gemini(full_prompt, model_config.copy(), is_for_review_or_debug=True)
+    system_instruction, full_prompt, compaction = create_explain_prompt(content_to_explain, explain_context, language=language_for_prompt)
+    build_result = _with_history(
+        'explain', _conversation_id(data),
+        lambda explanation_text: _with_prompt_compaction(_build_explain_result(explanation_text), compaction),
+        prompt=content_to_explain, file_type=language_for_prompt, extra={"context": explain_context}
+    )
 
-    if explanation_text and not explanation_text.startswith("Lỗi"):
-        return jsonify({"explanation": explanation_text})
-    elif explanation_text:
-        status_code = 400 if ("Lỗi cấu hình" in explanation_text or "Lỗi: Phản hồi bị chặn" in explanation_text) else 500
-        return jsonify({"error": explanation_text}), status_code
-    else:
-        return jsonify({"error": "Không thể tạo giải thích hoặc có lỗi không xác định xảy ra."}), 500
+    if _wants_stream(data):
+        return _sse_response(_stream_gemini_endpoint(full_prompt, model_config.copy(), True, build_result, system_instruction=system_instruction, endpoint='explain'))
+
+    explanation_text = generate_response_from_gemini(full_prompt, model_config.copy(), is_for_review_or_debug=True, system_instruction=system_instruction, endpoint='explain')
+    payload, status_code = build_result(explanation_text)
+    return jsonify(payload), status_code
 
 
 if __name__ == '__main__':
-    print("Backend đang chạy tại http://localhost:5001")
     if sys.platform == "win32":
         try:
             is_admin = ctypes.windll.shell32.IsUserAnAdmin() != 0
             if is_admin:
-                print("[INFO] Backend đang chạy với quyền Administrator.")
+                logger.info("Backend đang chạy với quyền Administrator.")
             else:
-                print("[INFO] Backend đang chạy với quyền User thông thường.")
+                logger.info("Backend đang chạy với quyền User thông thường.")
         except Exception:
-            print("[CẢNH BÁO] Không thể kiểm tra quyền admin khi khởi động.")
+            logger.warning("Không thể kiểm tra quyền admin khi khởi động.")
 
-    app.run(debug=True, port=5001)
+    # Chế độ server lấy từ SERVER_MODE (dev/threaded/waitress/gunicorn), xem server.py
+    run_server(app)
 
 # Đang thi công........
\ No newline at end of file
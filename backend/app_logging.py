@@ -0,0 +1,159 @@
+# backend/app_logging.py
+# Logging có cấu trúc cho backend:
+#   - mỗi bản ghi là một dòng JSON (hoặc text dễ đọc khi LOG_FORMAT=text), kèm request_id của request hiện tại
+#   - request thread chỉ đẩy bản ghi vào hàng đợi (QueueHandler); một thread nền ghi ra stdout/file.
+#     Hàng đợi đầy thì bỏ bản ghi (đếm lại) thay vì chặn request.
+#   - các trường payload lớn (phản hồi Gemini, stdout/stderr, output pip) được cắt ngắn và chỉ ghi đầy đủ
+#     cho một tỉ lệ request được lấy mẫu
+# Cấu hình qua biến môi trường:
+#   LOG_LEVEL (INFO), LOG_FORMAT (json | text), LOG_FILE (bỏ trống = stdout), LOG_QUEUE_SIZE (10000),
+#   LOG_PAYLOAD_MAX_CHARS (1000), LOG_PAYLOAD_SAMPLE_RATE (0.1)
+import atexit
+import contextvars
+import datetime
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import traceback
+import uuid
+
+# request_id của request đang xử lý; thread pool phải chạy task trong contextvars.copy_context() để mang theo
+request_id_var = contextvars.ContextVar('request_id', default=None)
+
+_REQUEST_ID_RE = re.compile(r"^[A-Za-z0-9._\-]{1,64}$")
+_queue_handler = None
+_listener = None
+
+
+# Dùng X-Request-ID của client nếu hợp lệ (để nối log giữa frontend/proxy/backend), không thì tạo mới
+def new_request_id(incoming=None):
+    if incoming and _REQUEST_ID_RE.match(incoming):
+        return incoming
+    return uuid.uuid4().hex[:16]
+
+
+class RequestContextFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "request_id": getattr(record, 'request_id', None),
+            **getattr(record, 'fields', {}),
+        }
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s")
+
+    def format(self, record):
+        text = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            text += " " + " ".join(f"{key}={json.dumps(value, ensure_ascii=False, default=str)}" for key, value in fields.items())
+        return text
+
+    def formatException(self, exc_info):
+        return "".join(traceback.format_exception(*exc_info)).rstrip()
+
+
+# QueueHandler không bao giờ chặn: hàng đợi đầy -> bỏ bản ghi và đếm
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    # Chỉ gộp message + traceback thành chuỗi (để bản ghi pickle/đi qua thread an toàn), giữ nguyên các trường cấu trúc
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = "".join(traceback.format_exception(*record.exc_info)).rstrip()
+            record.exc_info = None
+        return record
+
+
+def setup_logging():
+    global _queue_handler, _listener
+    if _listener is not None:
+        return
+
+    log_format = os.getenv('LOG_FORMAT', 'json').lower()
+    log_file = os.getenv('LOG_FILE')
+    output_handler = logging.FileHandler(log_file, encoding='utf-8') if log_file else logging.StreamHandler(sys.stdout)
+    output_handler.setFormatter(TextFormatter() if log_format == 'text' else JsonFormatter())
+
+    _queue_handler = DroppingQueueHandler(queue.Queue(maxsize=int(os.getenv('LOG_QUEUE_SIZE', '10000'))))
+    _queue_handler.addFilter(RequestContextFilter()) # Lấy request_id ngay trên thread của request
+    root = logging.getLogger()
+    root.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_queue_handler)
+
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, output_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop) # Ghi nốt các bản ghi còn trong hàng đợi khi tắt
+
+
+def dropped_records():
+    return _queue_handler.dropped if _queue_handler else 0
+
+
+# Request hiện tại có được lấy mẫu để ghi payload đầy đủ không.
+# Quyết định theo hash của request_id nên mọi payload trong cùng một request cùng được ghi hoặc cùng bị bỏ.
+def payload_sampled():
+    sample_rate = float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', '0.1'))
+    if sample_rate >= 1:
+        return True
+    if sample_rate <= 0:
+        return False
+    request_id = request_id_var.get()
+    if request_id is None:
+        return random.random() < sample_rate
+    bucket = int(hashlib.sha1(request_id.encode('utf-8')).hexdigest()[:8], 16) / 0xFFFFFFFF
+    return bucket < sample_rate
+
+
+def truncate_payload(value, max_chars=None):
+    text = value if isinstance(value, str) else str(value)
+    max_chars = int(os.getenv('LOG_PAYLOAD_MAX_CHARS', '1000')) if max_chars is None else max_chars
+    if len(text) <= max_chars:
+        return text
+    return f"{text[:max_chars]}...(cắt bớt {len(text) - max_chars} ký tự)"
+
+
+# Ghi bản ghi có payload lớn: request được lấy mẫu -> payload cắt ngắn, không -> chỉ ghi độ dài.
+# fields: các trường nhỏ (mã trả về, thời gian...) luôn được ghi.
+def log_payload(logger, level, message, payloads, **fields):
+    if not logger.isEnabledFor(level):
+        return
+    sampled = payload_sampled()
+    for name, value in payloads.items():
+        if value is None:
+            continue
+        fields[name] = truncate_payload(value) if sampled else f"<{len(str(value))} ký tự, không lấy mẫu>"
+    logger.log(level, message, extra={"fields": fields})
@@ -0,0 +1,82 @@
+# backend/benchmarks/bench_code_blocks.py
+# So sánh cách trích xuất khối mã cũ (mỗi tag alias một lần re.finditer với [\s\S]*?)
+# với tokenizer một lượt trong code_blocks.py, trên phản hồi tổng hợp cỡ lớn.
+#   cd backend && python benchmarks/bench_code_blocks.py --sizes 10,100,1000 --runs 5
+import argparse
+import json
+import os
+import re
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from code_blocks import parse_fenced_blocks, select_code_block
+
+
+# Bản sao logic extract_code_block trước đây, làm mốc so sánh
+def legacy_extract(raw_text, requested_extension):
+    primary_tags = [requested_extension]
+    if requested_extension == 'py': primary_tags.append('python')
+    for tag in primary_tags:
+        matches = list(re.finditer(r"```" + re.escape(tag) + r"\s*([\s\S]*?)\s*```", raw_text, re.IGNORECASE))
+        if matches:
+            return matches[-1].group(1).strip()
+    matches_generic = list(re.finditer(r"```\s*([\s\S]*?)\s*```", raw_text))
+    if matches_generic:
+        return matches_generic[-1].group(1).strip()
+    return raw_text.strip()
+
+
+def new_extract(raw_text, requested_extension):
+    block, _ = select_code_block(parse_fenced_blocks(raw_text)["blocks"], requested_extension)
+    return block.code.strip() if block else raw_text.strip()
+
+
+# Phản hồi gồm n_blocks đoạn giải thích + khối ```python (mỗi khối ~40 dòng)
+def make_response(n_blocks, unterminated=False):
+    code = "\n".join(f"    value_{i} = compute({i}) * 2  # dòng {i}" for i in range(40))
+    parts = []
+    for index in range(n_blocks):
+        parts.append(f"Bước {index}: giải thích ngắn gọn về đoạn mã bên dưới, có `inline code` và **markdown**.\n")
+        parts.append(f"```python\ndef step_{index}():\n{code}\n```\n")
+    if unterminated:
+        # Nhiều fence mở không đóng: trường hợp xấu nhất của pattern lười
+        parts.append("".join(f"```sh\necho {i}\n" for i in range(n_blocks)))
+    return "".join(parts)
+
+
+def time_it(fn, text, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn(text, 'py')
+        samples.append(time.perf_counter() - start)
+    return round(statistics.median(samples) * 1000, 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark trích xuất khối mã: regex cũ và tokenizer một lượt")
+    parser.add_argument('--sizes', default='10,100,1000', help="Số khối mã trong mỗi phản hồi tổng hợp")
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    results = []
+    for size in [int(value) for value in args.sizes.split(',') if value]:
+        for unterminated in (False, True):
+            text = make_response(size, unterminated)
+            # Cách cũ với tag 'py' khớp nhầm "```python" và trả về "thon\ndef ..."; cách mới lấy đúng khối
+            assert new_extract(text, 'py').startswith(f"def step_{size - 1}():")
+            results.append({
+                "blocks": size,
+                "unterminated_fences": unterminated,
+                "chars": len(text),
+                "legacy_ms": time_it(legacy_extract, text, args.runs),
+                "single_pass_ms": time_it(new_extract, text, args.runs),
+            })
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+# backend/benchmarks/bench_exec_paths.py
+# So sánh chi phí mỗi lần chạy script: đường file tạm cũ (tạo -> ghi -> stat -> chmod -> chạy -> xóa)
+# với đường memfd (/proc/self/fd/N, chỉ Linux).
+#   prepare: chỉ phần chuẩn bị + dọn dẹp, không spawn tiến trình (đo riêng chi phí syscall hệ thống file)
+#   run:     cả vòng chạy một script .sh/.py rất ngắn qua run_process
+#   cd backend && python benchmarks/bench_exec_paths.py --runs 200 --tmpdir /var/tmp
+import argparse
+import json
+import os
+import stat
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from process_runner import run_process
+
+SCRIPTS = {
+    "sh": "echo ok\n",
+    "py": "print('ok')\n",
+}
+
+
+def summarize(samples, unit=1000):
+    samples = sorted(samples)
+    return {
+        "runs": len(samples),
+        "p50": round(statistics.median(samples) * unit, 3),
+        "p95": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * unit, 3),
+        "mean": round(statistics.mean(samples) * unit, 3),
+    }
+
+
+# Giống _prepare_execution trước đây: NamedTemporaryFile + chmod +x, xóa sau khi chạy
+def temp_file_script(code, extension, tmpdir):
+    with tempfile.NamedTemporaryFile(mode='w', suffix=f'.{extension}', delete=False, encoding='utf-8', newline='', dir=tmpdir) as temp_file:
+        temp_file.write(code)
+    os.chmod(temp_file.name, os.stat(temp_file.name).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return temp_file.name, (), lambda: os.remove(temp_file.name)
+
+
+def memfd_script(code, extension, _tmpdir):
+    fd = os.memfd_create(f'snippet.{extension}')
+    os.write(fd, code.encode('utf-8'))
+    return f"/proc/self/fd/{fd}", (fd,), lambda: os.close(fd)
+
+
+def command_for(extension, path):
+    return [sys.executable, path] if extension == 'py' else ['bash', path]
+
+
+def bench_prepare(make_script, extension, runs, tmpdir):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        _path, _fds, cleanup = make_script(SCRIPTS[extension], extension, tmpdir)
+        cleanup()
+        samples.append(time.perf_counter() - start)
+    return summarize(samples, unit=1_000_000) # micro giây
+
+
+def bench_run(make_script, extension, runs, tmpdir):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        path, fds, cleanup = make_script(SCRIPTS[extension], extension, tmpdir)
+        try:
+            result = run_process(command_for(extension, path), timeout=30, pass_fds=fds)
+        finally:
+            cleanup()
+        samples.append(time.perf_counter() - start)
+        assert result["stdout"].strip() == "ok", result
+    return summarize(samples) # mili giây
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark chạy script qua file tạm và qua memfd")
+    parser.add_argument('--runs', type=int, default=200)
+    parser.add_argument('--prepare-runs', type=int, default=5000)
+    parser.add_argument('--types', default='sh,py')
+    parser.add_argument('--tmpdir', help="Thư mục cho file tạm (mặc định thư mục tạm của hệ thống)")
+    args = parser.parse_args()
+
+    if not hasattr(os, 'memfd_create'):
+        sys.exit("os.memfd_create không có trên nền tảng này (chỉ Linux).")
+
+    results = []
+    for extension in [value for value in args.types.split(',') if value]:
+        for name, make_script in (("temp_file", temp_file_script), ("memfd", memfd_script)):
+            results.append({
+                "type": extension,
+                "path": name,
+                "prepare_us": bench_prepare(make_script, extension, args.prepare_runs, args.tmpdir),
+                "run_ms": bench_run(make_script, extension, args.runs, args.tmpdir),
+            })
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
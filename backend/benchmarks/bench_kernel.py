@@ -0,0 +1,79 @@
+# backend/benchmarks/bench_kernel.py
+# Thời gian một lần chạy lặp lại (cùng phần import + nạp dữ liệu, rồi một bước tính mới):
+# spawn interpreter mới mỗi lần (phải import/nạp lại) so với chạy bước mới trong kernel giữ trạng thái.
+#   cd backend && python benchmarks/bench_kernel.py --runs 20 --rows 200000
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kernel_sessions import KernelManager
+from process_runner import run_process
+
+SETUP = """
+import asyncio, csv, decimal, email.mime.multipart, http.client, io, json, sqlite3, statistics, xml.etree.ElementTree
+rows = [{{"id": index, "group": index % 7, "value": (index * 7919) % 1000 / 10}} for index in range({rows})]
+"""
+STEP = """
+totals = {{}}
+for row in rows:
+    totals[row["group"]] = totals.get(row["group"], 0) + row["value"]
+print(round(totals[{step} % 7], 1))
+"""
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        "runs": len(samples),
+        "p50_ms": round(statistics.median(samples) * 1000, 3),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark chạy lặp lại trong kernel giữ trạng thái và spawn interpreter mới")
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--rows', type=int, default=200000, help="Số dòng dữ liệu nạp ở bước setup")
+    args = parser.parse_args()
+    setup = SETUP.format(rows=args.rows)
+
+    fresh = []
+    for step in range(args.runs):
+        start = time.perf_counter()
+        result = run_process([sys.executable, "-c", setup + STEP.format(step=step)], timeout=120)
+        fresh.append(time.perf_counter() - start)
+        assert result["return_code"] == 0, result
+
+    manager = KernelManager(max_kernels=1, python_executable=sys.executable)
+    kernel_runs = []
+    try:
+        with manager.acquire("bench") as (kernel, _created):
+            start = time.perf_counter()
+            setup_run = kernel.run(setup, 120)
+            list(setup_run.iter_output())
+            setup_seconds = time.perf_counter() - start
+            assert setup_run.return_code == 0, setup_run.status
+            for step in range(args.runs):
+                start = time.perf_counter()
+                run = kernel.run(STEP.format(step=step), 120)
+                list(run.iter_output())
+                kernel_runs.append(time.perf_counter() - start)
+                assert run.return_code == 0, run.status
+    finally:
+        manager.shutdown()
+
+    print(json.dumps({
+        "rows": args.rows,
+        "fresh_interpreter": summarize(fresh),
+        "kernel_first_setup_ms": round(setup_seconds * 1000, 3),
+        "kernel_repeat": summarize(kernel_runs),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# backend/benchmarks/bench_prompt_budget.py
+# Đo prompt_budget.compact_text trên log tổng hợp lớn: thời gian rút gọn, token trước/sau (ước lượng)
+# và kiểm tra exception cuối vẫn còn trong kết quả.
+#   cd backend && python benchmarks/bench_prompt_budget.py --sizes 100000,1000000,10000000 --budget 6000
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prompt_budget import compact_text
+
+FINAL_EXCEPTION = "ValueError: giá trị cuối cùng không hợp lệ"
+
+
+def _until_size(make_line, size):
+    lines, total, index = [], 0, 0
+    while total < size:
+        line = make_line(index)
+        lines.append(line)
+        total += len(line) + 1
+        index += 1
+    return lines
+
+
+def _traceback(depth):
+    frames = ['  File "app.py", line 12, in <module>\n    main()']
+    frames += ['  File "app.py", line 8, in walk\n    return walk(node.children[0])'] * depth
+    frames += ['  File "app.py", line 5, in check\n    raise ValueError(message)']
+    return "Traceback (most recent call last):\n" + "\n".join(frames) + "\n" + FINAL_EXCEPTION
+
+
+# Các kiểu log: tiến độ lặp (chỉ khác số), cảnh báo trùng, nhiễu ngẫu nhiên, một dòng JSON rất dài, đệ quy sâu
+def synthetic_logs(size, seed=0):
+    rng = random.Random(seed)
+    alphabet = "abcdefghijklmnopqrstuvwxyz      0123456789"
+    return {
+        "progress": "\n".join(_until_size(lambda i: f"[{i:08d}] Đang xử lý bản ghi {i} / ? - {i * 7 % 1000} ms", size)) + "\n" + _traceback(3),
+        "warnings": "\n".join(_until_size(lambda i: "DeprecationWarning: hàm cũ sẽ bị bỏ" if i % 5 else f"lô {i // 5} xong", size)) + "\n" + _traceback(3),
+        "noise": "\n".join(_until_size(lambda _i: "".join(rng.choice(alphabet) for _ in range(rng.randint(20, 120))), size)) + "\n" + _traceback(3),
+        "long_line": '{"data": "' + "x" * size + '"}\n' + _traceback(3),
+        "recursion": "\n".join(_until_size(lambda i: f"gọi walk({i})", size // 2)) + "\n" + _traceback(max(1, size // 120)),
+    }
+
+
+def bench(text, budget, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        compacted, report = compact_text(text, budget)
+        samples.append(time.perf_counter() - start)
+    return {
+        "bytes": len(text.encode("utf-8")),
+        "ms_median": round(statistics.median(samples) * 1000, 2),
+        "ms_max": round(max(samples) * 1000, 2),
+        **report.to_dict(),
+        "final_exception_kept": FINAL_EXCEPTION in compacted,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark rút gọn log theo ngân sách token")
+    parser.add_argument("--sizes", default="100000,1000000,10000000", help="Kích thước log (byte), cách nhau bởi dấu phẩy")
+    parser.add_argument("--budget", type=int, default=6000, help="Ngân sách token cho mỗi log")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--kinds", help="Chỉ chạy các kiểu log này (progress,warnings,noise,long_line,recursion)")
+    args = parser.parse_args()
+
+    kinds = set(args.kinds.split(",")) if args.kinds else None
+    results = []
+    for size in [int(value) for value in args.sizes.split(",") if value]:
+        for kind, text in synthetic_logs(size).items():
+            if kinds and kind not in kinds:
+                continue
+            results.append({"kind": kind, "size": size, **bench(text, args.budget, args.runs)})
+            print(f"{kind} {size}: {results[-1]['ms_median']} ms", file=sys.stderr)
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# backend/benchmarks/bench_validation.py
+# Thời gian phát hiện lỗi cú pháp: kiểm tra trước (compile()/`bash -n`, lần đầu và khi đã có trong cache)
+# so với spawn interpreter chạy thật rồi đọc lỗi từ stderr như trước đây.
+#   cd backend && python benchmarks/bench_validation.py --runs 50 --lines 20,200,2000
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from code_validation import CodeValidator, validate_code
+from process_runner import run_process
+
+
+def make_snippets(lines):
+    body_py = "".join(f"value_{index} = {index} * 2\nif value_{index} > 3:\n    print(value_{index})\n" for index in range(lines // 3))
+    body_sh = "".join(f"VALUE_{index}={index}\nif [ $VALUE_{index} -gt 3 ]; then\n  echo $VALUE_{index}\nfi\n" for index in range(lines // 4))
+    return {
+        "py": body_py + "def broken(:\n    pass\n",
+        "sh": body_sh + "if true; then\n  echo missing fi\n",
+    }
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        "runs": len(samples),
+        "p50_ms": round(statistics.median(samples) * 1000, 3),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000, 3),
+    }
+
+
+def bench(function, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def spawn(extension, code):
+    command = [sys.executable, "-c", code] if extension == "py" else ["bash", "-c", code]
+    result = run_process(command, timeout=30)
+    assert result["return_code"] != 0, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark phát hiện lỗi cú pháp trước khi chạy và khi spawn interpreter")
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--lines', default='20,200,2000', help="Số dòng code hợp lệ trước dòng lỗi, cách nhau bởi dấu phẩy")
+    args = parser.parse_args()
+
+    results = []
+    for lines in [int(value) for value in args.lines.split(',') if value]:
+        for extension, code in make_snippets(lines).items():
+            assert validate_code(code, extension)["syntax_ok"] is False
+            validator = CodeValidator()
+            validator.validate(code, extension)
+            results.append({
+                "type": extension,
+                "lines": lines,
+                "bytes": len(code.encode("utf-8")),
+                "validate_uncached": bench(lambda: validate_code(code, extension), args.runs),
+                "validate_cached": bench(lambda: validator.validate(code, extension), args.runs),
+                "spawn_interpreter": bench(lambda: spawn(extension, code), args.runs),
+            })
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# backend/benchmarks/bench_warm_pool.py
+# So sánh độ trễ chạy một snippet Python ngắn: interpreter nguội (file tạm + sys.executable)
+# với interpreter khởi động sẵn từ warm pool.
+#   cd backend && python benchmarks/bench_warm_pool.py --runs 30 --preload os,json,pathlib
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from process_runner import run_process
+from warm_pool import PythonWarmPool
+
+SNIPPET = "import os, json, pathlib\nprint(json.dumps({'cwd': os.getcwd(), 'home': str(pathlib.Path.home())}))\n"
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        "runs": len(samples),
+        "p50_ms": round(statistics.median(samples) * 1000, 2),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000, 2),
+        "mean_ms": round(statistics.mean(samples) * 1000, 2),
+    }
+
+
+def bench_cold(runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False, encoding='utf-8') as temp_file:
+            temp_file.write(SNIPPET)
+        try:
+            result = run_process([sys.executable, temp_file.name], timeout=60)
+        finally:
+            os.remove(temp_file.name)
+        samples.append(time.perf_counter() - start)
+        assert result["return_code"] == 0, result
+    return summarize(samples)
+
+
+def bench_warm(runs, preload):
+    pool = PythonWarmPool(size=2, preload_modules=preload)
+    samples = []
+    try:
+        for _ in range(runs):
+            while pool.stats()["ready"] == 0: # Đo độ trễ khi có worker sẵn, không đo thời gian refill
+                time.sleep(0.01)
+            time.sleep(0.05) # Cho worker kịp preload xong
+            start = time.perf_counter()
+            process = pool.acquire()
+            result = run_process(process.args, timeout=60, stdin_data=SNIPPET.encode('utf-8'), process=process)
+            samples.append(time.perf_counter() - start)
+            assert result["return_code"] == 0, result
+    finally:
+        pool.shutdown()
+    return summarize(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="So sánh interpreter nguội và warm pool")
+    parser.add_argument('--runs', type=int, default=30)
+    parser.add_argument('--preload', default='os,json,pathlib')
+    args = parser.parse_args()
+    preload = [name for name in args.preload.split(',') if name]
+    print(json.dumps({"cold": bench_cold(args.runs), "warm": bench_warm(args.runs, preload)}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
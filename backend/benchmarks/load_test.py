@@ -0,0 +1,268 @@
+# backend/benchmarks/load_test.py
+# Load test toàn bộ các route của backend mà không tốn quota Gemini:
+# khởi động app.py ở một cổng localhost với GEMINI_FAKE_BACKEND=1 (model giả trong fake_gemini.py,
+# độ trễ/độ dài phản hồi cấu hình được), bắn request song song vào từng route rồi ghi kết quả dạng JSON
+# (req/s, p50/p95/p99, lỗi, RSS của process backend) để so sánh trước/sau khi thay đổi.
+#   cd backend && python benchmarks/load_test.py --requests 200 --concurrency 16 --output before.json
+#   cd backend && python benchmarks/load_test.py --routes generate,execute --compare before.json
+import argparse
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SNIPPET = "import os\nfor name in sorted(os.listdir('.'))[:5]:\n    print(name)\n"
+
+# Body mẫu cho từng route (giống request frontend gửi)
+ROUTE_BODIES = {
+    "generate": ("/api/generate", {"prompt": "Liệt kê 5 file đầu tiên trong thư mục hiện tại", "file_type": "py"}),
+    "review": ("/api/review", {"code": SNIPPET, "file_type": "py"}),
+    "debug": ("/api/debug", {
+        "prompt": "Gọi API thời tiết", "code": "import requests\nprint(requests.get('https://example.com').status_code)\n",
+        "stdout": "", "stderr": "ModuleNotFoundError: No module named 'requests'", "file_type": "py",
+    }),
+    "explain": ("/api/explain", {"content": SNIPPET, "context": "code", "file_type": "py"}),
+    "execute": ("/api/execute", {"code": SNIPPET, "file_type": "py"}),
+    "install_package": ("/api/install_package", {"package_name": "flask"}),
+    "auto_fix": ("/api/auto_fix", {"code": "print(undefined_name)\n", "prompt": "In lời chào", "file_type": "py"}),
+}
+GEMINI_ROUTES = ("generate", "review", "debug", "explain", "auto_fix")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# RSS hiện tại của process (byte); Linux đọc /proc, nơi khác dùng ps
+def process_rss(pid):
+    try:
+        with open(f"/proc/{pid}/status", encoding="ascii") as status_file:
+            for line in status_file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except FileNotFoundError:
+        pass
+    try:
+        output = subprocess.run(["ps", "-o", "rss=", "-p", str(pid)], capture_output=True, text=True).stdout.strip()
+        return int(output) * 1024 if output else None
+    except (OSError, ValueError):
+        return None
+
+
+class RssSampler:
+    def __init__(self, pid, interval=0.1):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            rss = process_rss(self.pid)
+            if rss:
+                self.samples.append(rss)
+            self._stopped.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stopped.set()
+        self._thread.join()
+
+    def summary(self):
+        if not self.samples:
+            return {"rss_start_mb": None, "rss_peak_mb": None, "rss_end_mb": None}
+        to_mb = lambda value: round(value / (1024 * 1024), 1)
+        return {"rss_start_mb": to_mb(self.samples[0]), "rss_peak_mb": to_mb(max(self.samples)), "rss_end_mb": to_mb(self.samples[-1])}
+
+
+# Khởi động backend với Gemini giả; trả về Popen sau khi server nhận request
+def start_backend(port, args):
+    env = os.environ.copy()
+    env.update({
+        "GEMINI_FAKE_BACKEND": "1",
+        "GEMINI_FAKE_LATENCY_MS": str(args.latency_ms),
+        "GEMINI_FAKE_JITTER_MS": str(args.jitter_ms),
+        "GEMINI_FAKE_LATENCY_DIST": args.latency_dist,
+        "GEMINI_FAKE_RESPONSE_CHARS": args.response_chars,
+        "GEMINI_FAKE_FAILURE_RATE": str(args.failure_rate),
+        "GEMINI_CACHE_MODE": "always" if args.cache else "off",
+        "SERVER_MODE": args.server_mode,
+        "SERVER_HOST": "127.0.0.1",
+        "SERVER_PORT": str(port),
+        "SERVER_THREADS": str(args.server_threads),
+        "LOG_LEVEL": args.log_level,
+        "HISTORY_DB_PATH": "", # Không ghi lịch sử hội thoại vào thư mục backend khi đo
+    })
+    log_file = open(args.server_log, "w", encoding="utf-8") if args.server_log else subprocess.DEVNULL
+    process = subprocess.Popen([sys.executable, "app.py"], cwd=BACKEND_DIR, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + args.startup_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Backend thoát sớm với mã {process.returncode} (xem --server-log).")
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/api/cache", timeout=1).read()
+            return process
+        except (urllib.error.URLError, ConnectionError, socket.timeout):
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"Backend không sẵn sàng sau {args.startup_timeout} giây.")
+
+
+def send(url, body, timeout):
+    data = json.dumps(body).encode("utf-8")
+    request = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read() # Với SSE: đọc tới khi stream kết thúc
+            status = response.status
+    except urllib.error.HTTPError as e:
+        e.read()
+        status = e.code
+    except (urllib.error.URLError, ConnectionError, socket.timeout):
+        status = 0
+    return time.perf_counter() - start, status
+
+
+def percentile(sorted_samples, q):
+    return sorted_samples[min(len(sorted_samples) - 1, int(len(sorted_samples) * q))]
+
+
+def run_route(port, route, args, backend_pid):
+    path, body = ROUTE_BODIES[route]
+    if args.stream and route in GEMINI_ROUTES:
+        body = {**body, "stream": True}
+    url = f"http://127.0.0.1:{port}{path}"
+    requests_count = args.install_requests if route == "install_package" else args.requests
+
+    for _ in range(min(args.warmup, requests_count)):
+        send(url, body, args.timeout)
+
+    with RssSampler(backend_pid) as sampler, ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        start = time.perf_counter()
+        results = list(executor.map(lambda _index: send(url, body, args.timeout), range(requests_count)))
+        elapsed = time.perf_counter() - start
+
+    latencies = sorted(duration for duration, _status in results)
+    statuses = {}
+    for _duration, status in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    errors = sum(count for status, count in statuses.items() if not status.startswith("2"))
+    to_ms = lambda seconds: round(seconds * 1000, 2)
+    return {
+        "route": route,
+        "path": path,
+        "requests": requests_count,
+        "concurrency": args.concurrency,
+        "errors": errors,
+        "status_counts": statuses,
+        "duration_s": round(elapsed, 3),
+        "rps": round(requests_count / elapsed, 2),
+        "p50_ms": to_ms(percentile(latencies, 0.50)),
+        "p95_ms": to_ms(percentile(latencies, 0.95)),
+        "p99_ms": to_ms(percentile(latencies, 0.99)),
+        "mean_ms": to_ms(statistics.mean(latencies)),
+        "max_ms": to_ms(latencies[-1]),
+        **sampler.summary(),
+    }
+
+
+# In chênh lệch req/s và p95 so với một file kết quả trước đó
+def compare(results, baseline_path):
+    with open(baseline_path, encoding="utf-8") as baseline_file:
+        baseline = {entry["route"]: entry for entry in json.load(baseline_file)["routes"]}
+    rows = []
+    for entry in results["routes"]:
+        before = baseline.get(entry["route"])
+        if not before:
+            continue
+        change = lambda key: round((entry[key] - before[key]) / before[key] * 100, 1) if before[key] else None
+        rows.append({
+            "route": entry["route"],
+            "rps_before": before["rps"], "rps_after": entry["rps"], "rps_change_pct": change("rps"),
+            "p95_before_ms": before["p95_ms"], "p95_after_ms": entry["p95_ms"], "p95_change_pct": change("p95_ms"),
+            "rss_peak_before_mb": before.get("rss_peak_mb"), "rss_peak_after_mb": entry.get("rss_peak_mb"),
+        })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test các route backend với Gemini giả")
+    parser.add_argument("--routes", default=",".join(ROUTE_BODIES), help="Các route cần chạy, cách nhau bởi dấu phẩy")
+    parser.add_argument("--requests", type=int, default=100, help="Số request mỗi route")
+    parser.add_argument("--install-requests", type=int, default=10, help="Số request cho install_package (pip chậm)")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=3, help="Số request làm nóng (không tính) mỗi route")
+    parser.add_argument("--timeout", type=float, default=120, help="Timeout mỗi request (giây)")
+    parser.add_argument("--stream", action="store_true", help="Gọi các route Gemini ở chế độ SSE")
+    parser.add_argument("--cache", action="store_true", help="Bật cache phản hồi Gemini (mặc định tắt để đo đường gọi model)")
+    parser.add_argument("--latency-ms", type=float, default=200, help="Độ trễ cơ bản của Gemini giả")
+    parser.add_argument("--jitter-ms", type=float, default=50)
+    parser.add_argument("--latency-dist", choices=("uniform", "exponential"), default="uniform")
+    parser.add_argument("--response-chars", default="", help="Độ dài phản hồi giả: 'n' hoặc 'min-max'")
+    parser.add_argument("--failure-rate", type=float, default=0)
+    parser.add_argument("--server-mode", default="threaded", choices=("threaded", "waitress", "gunicorn"))
+    parser.add_argument("--server-threads", type=int, default=32)
+    parser.add_argument("--server-log", help="Ghi output của backend ra file này")
+    parser.add_argument("--log-level", default="WARNING", help="LOG_LEVEL của backend trong lúc đo")
+    parser.add_argument("--startup-timeout", type=float, default=30)
+    parser.add_argument("--output", help="Ghi kết quả JSON ra file (mặc định in ra stdout)")
+    parser.add_argument("--compare", help="File JSON kết quả trước đó để so sánh")
+    args = parser.parse_args()
+
+    routes = [route.strip() for route in args.routes.split(",") if route.strip()]
+    unknown = [route for route in routes if route not in ROUTE_BODIES]
+    if unknown:
+        parser.error(f"Route không hỗ trợ: {', '.join(unknown)}")
+
+    port = free_port()
+    backend = start_backend(port, args)
+    try:
+        route_results = []
+        for route in routes:
+            print(f"Đang chạy {route}...", file=sys.stderr)
+            route_results.append(run_route(port, route, args, backend.pid))
+    finally:
+        backend.terminate()
+        try:
+            backend.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            backend.kill()
+
+    results = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": sys.platform,
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "server_log")},
+        "routes": route_results,
+    }
+    if args.compare:
+        results["comparison"] = compare(results, args.compare)
+
+    output = json.dumps(results, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(output + "\n")
+        print(f"Đã ghi kết quả vào {args.output}", file=sys.stderr)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+# backend/code_blocks.py
+# Tách các khối mã ``` (hoặc ~~~) trong phản hồi Markdown của Gemini bằng MỘT lượt quét tuyến tính theo dòng.
+# Thay cho các vòng re.finditer với pattern lười [\s\S]*? (mỗi alias một lần quét, dễ chậm
+# bậc hai khi gặp fence không đóng). Dùng chung cho /api/generate và /api/debug.
+import re
+
+# Các tag ngôn ngữ được coi là cùng loại với một extension
+LANGUAGE_ALIASES = {
+    'py': ('py', 'python', 'python3'),
+    'sh': ('sh', 'bash', 'shell', 'zsh'),
+    'bat': ('bat', 'batch', 'cmd'),
+    'ps1': ('ps1', 'powershell', 'pwsh'),
+    'js': ('js', 'javascript', 'node'),
+    'ts': ('ts', 'typescript'),
+    'yaml': ('yaml', 'yml'),
+}
+
+# Ngôn ngữ của khối chứa lệnh cài đặt pip mà Gemini đề xuất
+SHELL_LANGUAGES = ('bash', 'sh', 'shell', 'console', 'zsh', 'cmd', 'powershell', '')
+
+_PIP_INSTALL_RE = re.compile(r"^\s*(?:\$\s*)?(?:python3?\s+-m\s+)?pip3?\s+install\s+([^\n#&|;]+)", re.IGNORECASE | re.MULTILINE)
+
+
+class FencedBlock:
+    __slots__ = ("index", "language", "info", "code", "start", "end", "code_start", "code_end", "closed")
+
+    def __init__(self, index, language, info, start, code_start):
+        self.index = index
+        self.language = language # Tag ngôn ngữ (chữ thường, '' nếu không có)
+        self.info = info # Toàn bộ info string sau fence mở
+        self.code = ""
+        self.start = start # Vị trí ký tự đầu fence mở trong text
+        self.end = None # Vị trí ngay sau fence đóng (hoặc cuối text nếu không đóng)
+        self.code_start = code_start
+        self.code_end = None
+        self.closed = False
+
+    def to_dict(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+
+# Trả về (fence_char, fence_len, phần còn lại sau fence) nếu dòng là fence, ngược lại None
+def _fence_of(line):
+    stripped = line.lstrip()
+    if not stripped or stripped[0] not in '`~':
+        return None
+    fence_char = stripped[0]
+    fence_len = len(stripped) - len(stripped.lstrip(fence_char))
+    if fence_len < 3:
+        return None
+    return fence_char, fence_len, stripped[fence_len:]
+
+
+# Dòng ngoài khối mã có phải fence mở không: trả về None, ("open", fence_char, fence_len, language) cho khối nhiều dòng,
+# hoặc ("inline", fence_char, fence_len, language, code) cho khối một dòng kiểu ```bash pip install x```.
+# Dùng chung cho parse_fenced_blocks và bộ phát hiện khối mã khi stream (streaming.py) để hai bên không lệch nhau.
+def opening_fence(line):
+    fence = _fence_of(line)
+    if not fence:
+        return None
+    fence_char, fence_len, info = fence
+    info = info.strip()
+    if fence_char == '`' and info.endswith(fence_char * fence_len) and len(info) > fence_len:
+        language, _, code = info[:-fence_len].strip().partition(' ')
+        return "inline", fence_char, fence_len, language.lower(), code.strip()
+    if fence_char == '~' or '`' not in info:
+        return "open", fence_char, fence_len, info.split()[0].lower() if info else ""
+    return None
+
+
+# Dòng có đóng khối mở bằng fence_char * fence_len không (cùng ký tự, dài ít nhất bằng, không có gì phía sau)
+def is_closing_fence(line, fence_char, fence_len):
+    fence = _fence_of(line)
+    return bool(fence) and fence[0] == fence_char and fence[1] >= fence_len and not fence[2].strip()
+
+
+# Quét text một lần, trả về {"blocks": [FencedBlock...], "prose": [(start, end, text)...]}.
+# Vị trí là chỉ số ký tự trong chuỗi text (dùng để cắt chuỗi trực tiếp).
+# Quy tắc fence theo CommonMark: fence đóng dùng cùng ký tự và dài ít nhất bằng fence mở,
+# nên khối ```` có thể chứa ``` bên trong. Fence không đóng kéo dài tới cuối text (closed=False).
+def parse_fenced_blocks(text):
+    blocks = []
+    prose = []
+    text = text or ""
+    length = len(text)
+    prose_start = 0
+    current = None # (block, fence_char, fence_len)
+    pos = 0
+    while pos < length:
+        newline = text.find("\n", pos)
+        line_end = length if newline == -1 else newline
+        next_pos = line_end + 1
+        line = text[pos:line_end].rstrip("\r")
+
+        if current is None:
+            opening = opening_fence(line)
+            if opening:
+                kind, fence_char, fence_len, language = opening[:4]
+                fence_start = pos + (len(line) - len(line.lstrip()))
+                block = FencedBlock(len(blocks), language, line.lstrip()[fence_len:].strip(), fence_start, min(next_pos, length))
+                if kind == "inline":
+                    # Khối một dòng kiểu ```bash pip install x```
+                    block.code = opening[4]
+                    block.code_start = fence_start + fence_len
+                    block.code_end = pos + len(line) - fence_len
+                    block.end = pos + len(line)
+                    block.closed = True
+                    blocks.append(block)
+                    if fence_start > prose_start:
+                        prose.append((prose_start, fence_start, text[prose_start:fence_start]))
+                    prose_start = block.end
+                else:
+                    if fence_start > prose_start:
+                        prose.append((prose_start, fence_start, text[prose_start:fence_start]))
+                    current = (block, fence_char, fence_len)
+        else:
+            block, fence_char, fence_len = current
+            if is_closing_fence(line, fence_char, fence_len):
+                block.code_end = pos
+                block.code = text[block.code_start:pos].rstrip("\r\n")
+                block.end = pos + len(line)
+                block.closed = True
+                blocks.append(block)
+                prose_start = block.end
+                current = None
+        pos = next_pos
+
+    if current is not None: # Fence không đóng: khối kéo dài tới cuối text
+        block = current[0]
+        body = text[block.code_start:]
+        stripped_body = body.rstrip()
+        # Gemini đôi khi đóng fence ngay cuối dòng code cuối cùng: "print(1)```"
+        if stripped_body.endswith(current[1] * current[2]):
+            body = stripped_body[:-current[2]]
+            block.closed = True
+        block.code = body.rstrip("\r\n")
+        block.code_end = block.code_start + len(body)
+        block.end = length
+        blocks.append(block)
+        prose_start = length
+
+    if prose_start < length:
+        prose.append((prose_start, length, text[prose_start:]))
+    return {"blocks": blocks, "prose": prose}
+
+
+def language_matches(block, extension):
+    return block.language in LANGUAGE_ALIASES.get(extension, (extension,))
+
+
+# Chọn khối mã cho extension: khối CUỐI CÙNG có tag khớp (kể cả alias),
+# nếu không có thì khối cuối cùng không nằm trong exclude (tương đương fallback ```...``` chung trước đây).
+def select_code_block(blocks, extension, exclude=()):
+    candidates = [block for block in blocks if block not in exclude]
+    for block in reversed(candidates):
+        if language_matches(block, extension):
+            return block, True
+    if candidates:
+        return candidates[-1], False
+    return None, False
+
+
+# Tìm khối đề xuất "pip install <package>"; trả về (block, package) hoặc (None, None)
+# Tùy chọn pip install có đối số đi kèm (đối số không phải tên package)
+_PIP_OPTIONS_WITH_VALUE = ('-r', '--requirement', '-c', '--constraint', '-e', '--editable', '-i', '--index-url',
+                           '--extra-index-url', '-f', '--find-links', '-t', '--target', '--prefix', '--root')
+
+
+# Lấy mọi package trên dòng lệnh pip install, bỏ các tùy chọn (-U, --user, -r file...)
+def _pip_install_packages(tokens):
+    packages = []
+    skip_next = False
+    for token in tokens:
+        if skip_next:
+            skip_next = False
+        elif token.startswith('-'):
+            skip_next = token in _PIP_OPTIONS_WITH_VALUE
+        else:
+            packages.append(token.strip("'\""))
+    return packages
+
+
+def find_pip_install(blocks):
+    for block in blocks:
+        if block.language not in SHELL_LANGUAGES:
+            continue
+        match = _PIP_INSTALL_RE.search(block.code)
+        if match:
+            packages = _pip_install_packages(match.group(1).split())
+            if packages:
+                return block, " ".join(packages)
+    return None, None
+
+
+# Ghép lại text nằm trong [start, end) sau khi bỏ các khối trong exclude
+def text_without_blocks(text, exclude, start=0, end=None):
+    end = len(text) if end is None else end
+    pieces = []
+    cursor = start
+    for block in sorted(exclude, key=lambda b: b.start):
+        if block.end <= start or block.start >= end:
+            continue
+        pieces.append(text[cursor:block.start])
+        cursor = max(cursor, block.end)
+    pieces.append(text[cursor:end])
+    return "".join(piece.strip("\n") + "\n" for piece in pieces if piece.strip()).strip()
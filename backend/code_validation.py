@@ -0,0 +1,464 @@
+# backend/code_validation.py
+# Kiểm tra code trước khi chạy, không cần spawn interpreter chạy thật:
+#   - cú pháp: compile() cho Python (trong tiến trình backend), `bash -n` cho shell
+#   - phân tích rủi ro: AST cho Python (theo dõi alias import, hằng chuỗi ghép/f-string truyền vào lệnh shell),
+#     tách lệnh theo token cho shell/batch/PowerShell (theo từ, không khớp chuỗi con như "format " trong văn bản)
+# Kết quả cache theo hash của (loại file, code): cùng một đoạn code chạy lại/sinh lại không phải phân tích lại.
+import ast
+import hashlib
+import re
+import shlex
+import subprocess
+import threading
+import time
+import traceback
+import warnings
+from collections import OrderedDict
+
+# Mức độ rủi ro, từ thấp tới cao
+SEVERITIES = ("low", "medium", "high")
+# Thời gian tối đa cho `bash -n`
+SHELL_CHECK_TIMEOUT_SECONDS = 5
+# Tên file hiển thị trong thông báo lỗi cú pháp Python
+PYTHON_FILENAME = "<snippet>"
+
+_LANGUAGES = {"py": "python", "sh": "shell", "bash": "shell", "bat": "batch", "cmd": "batch", "ps1": "powershell"}
+_SHELL_PLACEHOLDER = "$X" # Thay cho phần không xác định được tĩnh (biến trong f-string, ...)
+
+
+def language_for(file_extension):
+    return _LANGUAGES.get((file_extension or "").lower())
+
+
+def _risk(rule, severity, message, line=None, column=None):
+    return {"rule": rule, "severity": severity, "message": message, "line": line, "column": column}
+
+
+def max_severity(risks):
+    if not risks:
+        return None
+    return max((risk["severity"] for risk in risks), key=SEVERITIES.index)
+
+
+# --- Shell ---
+# Lệnh bọc lệnh khác: bỏ qua để lấy lệnh thật
+_COMMAND_PREFIXES = {"sudo", "doas", "env", "nohup", "exec", "command", "time", "nice", "xargs"}
+_CONTROL_TOKENS = {";", "&&", "||", "|", "&", "(", ")", ";;", "|&"}
+_SHELLS = {"sh", "bash", "zsh", "dash", "ksh", "python", "python3", "perl"}
+_DISK_COMMANDS = {"mkfs", "mke2fs", "mkswap", "wipefs", "fdisk", "sfdisk", "parted", "shred"}
+_POWER_COMMANDS = {"shutdown", "reboot", "halt", "poweroff"}
+_ROOT_TARGETS = {"/", "/*", "~", "~/", "~/*", "$HOME", "${HOME}", "*", ".", "..", "./*"}
+_SYSTEM_DIRS = ("/bin", "/boot", "/dev", "/etc", "/home", "/lib", "/opt", "/root", "/sbin", "/srv", "/usr", "/var")
+# Dòng không chứa lệnh nào trong các quy tắc thì không cần tách token (shlex chậm với script dài)
+_SHELL_INTEREST_RE = re.compile(
+    r"\b(rm|dd|init|systemctl|chmod|chown|chgrp|kill|pkill|killall|curl|wget|mkfs[\w.]*|"
+    + "|".join(sorted(_DISK_COMMANDS | _POWER_COMMANDS)) + r")\b|/dev/|:\s*\(")
+_FORK_BOMB_RE = re.compile(r":\s*\(\s*\)\s*\{\s*:\s*\|\s*:\s*&\s*\}\s*;\s*:")
+_BLOCK_DEVICE_RE = re.compile(r"^/dev/(sd[a-z]|nvme\d|hd[a-z]|vd[a-z]|xvd[a-z]|mmcblk\d|disk\d)")
+
+
+def _short_flags(words):
+    return "".join(word[1:] for word in words if word.startswith("-") and not word.startswith("--"))
+
+
+def _is_system_path(path):
+    path = path.rstrip("/") or "/"
+    return path in _ROOT_TARGETS or path in _SYSTEM_DIRS or path.rstrip("/*") in _SYSTEM_DIRS
+
+
+# Tách một dòng shell thành token; lỗi quote (chuỗi nhiều dòng, heredoc...) thì tách theo khoảng trắng
+def _shell_tokens(line):
+    lexer = shlex.shlex(line, posix=True, punctuation_chars=True)
+    lexer.whitespace_split = True
+    try:
+        return list(lexer)
+    except ValueError:
+        return line.split()
+
+
+# Chia token thành các lệnh đơn; trả về [(các từ của lệnh, lệnh có nhận stdin từ pipe, các đích chuyển hướng)]
+def _split_shell_commands(tokens):
+    commands, words, redirects = [], [], []
+    piped = False
+    index = 0
+    while index < len(tokens):
+        token = tokens[index]
+        if token in _CONTROL_TOKENS:
+            if words:
+                commands.append((words, piped, redirects))
+            words, redirects = [], []
+            piped = token in ("|", "|&")
+        elif token in (">", ">>", ">|", "&>") and index + 1 < len(tokens):
+            redirects.append(tokens[index + 1])
+            index += 1
+        else:
+            words.append(token)
+        index += 1
+    if words:
+        commands.append((words, piped, redirects))
+    return commands
+
+
+def _command_name(words):
+    index = 0
+    while index < len(words) and (words[index] in _COMMAND_PREFIXES or re.match(r"^[A-Za-z_]\w*=", words[index]) or (index and words[index].startswith("-") and words[index - 1] in _COMMAND_PREFIXES)):
+        index += 1
+    if index >= len(words):
+        return None, []
+    return words[index].rsplit("/", 1)[-1], words[index + 1:]
+
+
+def _shell_command_risks(name, args, line):
+    flags = _short_flags(args)
+    targets = [arg for arg in args if not arg.startswith("-")]
+    if name == "rm":
+        recursive = "r" in flags.lower() or "--recursive" in args
+        force = "f" in flags or "--force" in args
+        if "--no-preserve-root" in args or (recursive and any(_is_system_path(target) for target in targets)):
+            return [_risk("rm-root", "high", f"Xóa đệ quy thư mục hệ thống/thư mục gốc: {' '.join(targets)}", line)]
+        if recursive and force:
+            return [_risk("rm-rf", "high", f"Xóa đệ quy không hỏi lại (rm -rf {' '.join(targets)})", line)]
+        if recursive:
+            return [_risk("rm-r", "medium", f"Xóa đệ quy thư mục: {' '.join(targets)}", line)]
+        return [_risk("rm", "low", f"Xóa file: {' '.join(targets)}", line)]
+    if name in _DISK_COMMANDS or name.startswith("mkfs."):
+        return [_risk("disk-format", "high", f"Định dạng/phân vùng/ghi đè ổ đĩa ({name})", line)]
+    if name == "dd":
+        if any(arg.startswith("of=/dev/") and not arg.startswith("of=/dev/null") for arg in args):
+            return [_risk("dd-device", "high", "dd ghi trực tiếp lên thiết bị", line)]
+        return []
+    if name in _POWER_COMMANDS or (name == "init" and targets[:1] in (["0"], ["6"])) or (name == "systemctl" and set(targets) & {"poweroff", "reboot", "halt"}):
+        return [_risk("power", "high", f"Tắt/khởi động lại máy ({name})", line)]
+    if name in ("chmod", "chown", "chgrp") and ("R" in flags or "--recursive" in args) and any(_is_system_path(target) for target in targets):
+        return [_risk("permissions-root", "high", f"Đổi quyền đệ quy trên thư mục hệ thống ({name})", line)]
+    if name in ("kill", "pkill", "killall") and ("-1" in args or name == "killall"):
+        return [_risk("kill-all", "medium", f"Dừng hàng loạt tiến trình ({name} {' '.join(args)})", line)]
+    return []
+
+
+def analyze_shell(code, line_offset=0):
+    risks = []
+    for line_number, line in enumerate(code.splitlines(), start=1 + line_offset):
+        if not _SHELL_INTEREST_RE.search(line):
+            continue
+        if _FORK_BOMB_RE.search(line):
+            risks.append(_risk("fork-bomb", "high", "Fork bomb", line_number))
+            continue
+        previous_name = None
+        for words, piped, redirects in _split_shell_commands(_shell_tokens(line)):
+            if words[0].startswith("#"):
+                break
+            name, args = _command_name(words)
+            if name is None:
+                continue
+            risks.extend(_shell_command_risks(name, args, line_number))
+            if piped and name in _SHELLS and previous_name in ("curl", "wget"):
+                risks.append(_risk("pipe-to-shell", "medium", f"Tải script từ mạng và chạy ngay ({previous_name} | {name})", line_number))
+            for target in redirects:
+                if _BLOCK_DEVICE_RE.match(target):
+                    risks.append(_risk("write-device", "high", f"Ghi trực tiếp lên thiết bị {target}", line_number))
+            previous_name = name
+    return risks
+
+
+def check_shell(code):
+    try:
+        result = subprocess.run(
+            ["bash", "-n"], input=code.encode("utf-8"), capture_output=True, timeout=SHELL_CHECK_TIMEOUT_SECONDS)
+    except (OSError, subprocess.TimeoutExpired):
+        return None, None # Không có bash hoặc quá lâu: không kết luận được
+    if result.returncode == 0:
+        return True, None
+    message = result.stderr.decode("utf-8", errors="replace").strip()
+    match = re.search(r"line (\d+):", message)
+    return False, {
+        "message": message.splitlines()[-1] if message else "Lỗi cú pháp",
+        "line": int(match.group(1)) if match else None,
+        "column": None,
+        "text": None,
+        "formatted": message + "\n",
+        "return_code": result.returncode,
+    }
+
+
+# --- Batch / PowerShell (theo từ của từng dòng) ---
+def analyze_batch(code):
+    risks = []
+    for line_number, line in enumerate(code.splitlines(), start=1):
+        words = line.strip().lstrip("@").lower().split()
+        if not words or words[0] in ("rem", "::"):
+            continue
+        name, args = words[0], words[1:]
+        if name in ("rd", "rmdir") and "/s" in args:
+            risks.append(_risk("rmdir-s", "high", "Xóa đệ quy thư mục (rd /s)", line_number))
+        elif name in ("del", "erase") and ("/s" in args or any(arg.endswith("*") or arg.endswith("*.*") for arg in args)):
+            risks.append(_risk("del-s", "high" if "/s" in args else "medium", "Xóa hàng loạt file (del)", line_number))
+        elif name == "format" and any(re.fullmatch(r"[a-z]:", arg) for arg in args):
+            risks.append(_risk("disk-format", "high", f"Định dạng ổ đĩa ({line.strip()})", line_number))
+        elif name in ("diskpart", "bcdedit", "cipher") or (name == "vssadmin" and "delete" in args):
+            risks.append(_risk("system-tool", "high", f"Công cụ thay đổi ổ đĩa/khởi động hệ thống ({name})", line_number))
+        elif name == "shutdown":
+            risks.append(_risk("power", "high", "Tắt/khởi động lại máy (shutdown)", line_number))
+        elif name == "reg" and args[:1] == ["delete"]:
+            risks.append(_risk("registry-delete", "medium", "Xóa khóa registry", line_number))
+    return risks
+
+
+_POWERSHELL_RULES = (
+    (re.compile(r"\b(Remove-Item|rm|rmdir|del|ri)\b[^\n|;]*-Recurse", re.IGNORECASE), "remove-recurse", "high", "Xóa đệ quy (Remove-Item -Recurse)"),
+    (re.compile(r"\b(Format-Volume|Clear-Disk|Initialize-Disk|Remove-Partition)\b", re.IGNORECASE), "disk-format", "high", "Định dạng/xóa ổ đĩa"),
+    (re.compile(r"\b(Stop-Computer|Restart-Computer)\b|\bshutdown(\.exe)?\s+/", re.IGNORECASE), "power", "high", "Tắt/khởi động lại máy"),
+    (re.compile(r"\b(Invoke-Expression|iex)\b[^\n]*\b(DownloadString|Invoke-WebRequest|iwr|Invoke-RestMethod|irm)\b|\b(DownloadString|Invoke-WebRequest|iwr|Invoke-RestMethod|irm)\b[^\n]*\|\s*(Invoke-Expression|iex)\b", re.IGNORECASE),
+     "download-execute", "medium", "Tải script từ mạng và chạy ngay"),
+    (re.compile(r"\bRemove-ItemProperty\b|\bRemove-Item\b[^\n]*\bHK(LM|CU):", re.IGNORECASE), "registry-delete", "medium", "Xóa khóa/giá trị registry"),
+)
+
+
+def analyze_powershell(code):
+    risks = []
+    for line_number, line in enumerate(code.splitlines(), start=1):
+        if line.lstrip().startswith("#"):
+            continue
+        for pattern, rule, severity, message in _POWERSHELL_RULES:
+            if pattern.search(line):
+                risks.append(_risk(rule, severity, message, line_number))
+    return risks
+
+
+# --- Python ---
+# Biên dịch thẳng từ source (không dựng cây AST dạng object Python, nhanh hơn ast.parse vài lần);
+# bắt cả lỗi chỉ phát hiện khi sinh bytecode ('return' ngoài hàm, 'nonlocal' sai...)
+def check_python(code):
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore") # SyntaxWarning (escape sequence không hợp lệ...) không phải lỗi
+            compile(code, PYTHON_FILENAME, "exec", dont_inherit=True)
+        return True, None
+    except SyntaxError as e: # Gồm cả IndentationError/TabError
+        return False, {
+            "message": f"{type(e).__name__}: {e.msg}",
+            "line": e.lineno,
+            "column": e.offset,
+            "text": e.text.rstrip("\n") if e.text else None,
+            "formatted": "".join(traceback.format_exception_only(type(e), e)),
+            "return_code": 1,
+        }
+    except ValueError as e: # Ký tự NUL trong code
+        return False, {"message": f"SyntaxError: {e}", "line": None, "column": None, "text": None,
+                       "formatted": f"SyntaxError: {e}\n", "return_code": 1}
+    except (RecursionError, MemoryError):
+        return None, None # Code lồng quá sâu: để interpreter tự báo
+
+
+# Hàm nguy hiểm theo tên đầy đủ (sau khi giải alias import)
+_PYTHON_CALLS = {
+    "shutil.rmtree": ("high", "Xóa đệ quy cả cây thư mục"),
+    "os.removedirs": ("medium", "Xóa chuỗi thư mục"),
+    "os.remove": ("low", "Xóa file"),
+    "os.unlink": ("low", "Xóa file"),
+    "os.rmdir": ("low", "Xóa thư mục rỗng"),
+    "os.kill": ("medium", "Gửi tín hiệu tới tiến trình khác"),
+    "os.killpg": ("medium", "Gửi tín hiệu tới cả nhóm tiến trình"),
+    "os.fork": ("low", "Tạo tiến trình con bằng fork"),
+    "os.setuid": ("medium", "Đổi user của tiến trình"),
+    "ctypes.CDLL": ("low", "Nạp thư viện native"),
+}
+# Hàm chạy lệnh shell: phân tích thêm lệnh nếu xác định được tĩnh
+_SHELL_STRING_CALLS = {"os.system", "os.popen", "subprocess.getoutput", "subprocess.getstatusoutput", "pty.spawn"}
+_SUBPROCESS_CALLS = {"subprocess.run", "subprocess.call", "subprocess.check_call", "subprocess.check_output", "subprocess.Popen", "asyncio.create_subprocess_exec", "asyncio.create_subprocess_shell"}
+_EXEC_PREFIXES = ("os.exec", "os.spawn", "os.posix_spawn")
+_DYNAMIC_CODE_CALLS = {"eval", "exec", "compile", "__import__", "importlib.import_module"}
+_WRITE_MODES = ("w", "a", "x", "+")
+# Code không nhắc tới module/hàm nào trong các quy tắc thì bỏ qua phân tích AST
+# (alias import vẫn chứa tên module gốc trong dòng import)
+_PYTHON_INTEREST_RE = re.compile(r"\b(shutil|os|subprocess|pty|asyncio|ctypes|importlib|builtins|eval|exec|compile|__import__|getattr|open)\b")
+_SYSTEM_FILE_RE = re.compile(r"^(/(etc|boot|bin|sbin|usr|lib|dev/(sd|nvme|hd|vd|xvd|mmcblk))|[A-Za-z]:\\+Windows)", re.IGNORECASE)
+
+
+# Giá trị chuỗi (gần đúng) của một biểu thức hằng: chuỗi, f-string, phép cộng chuỗi, list/tuple các chuỗi.
+# Phần không xác định được thay bằng _SHELL_PLACEHOLDER; không phải chuỗi thì trả về None.
+def _literal_text(node):
+    if isinstance(node, ast.Constant):
+        return node.value if isinstance(node.value, str) else None
+    if isinstance(node, ast.JoinedStr):
+        return "".join(value.value if isinstance(value, ast.Constant) else _SHELL_PLACEHOLDER for value in node.values)
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        left, right = _literal_text(node.left), _literal_text(node.right)
+        if left is None and right is None:
+            return None
+        return (left if left is not None else _SHELL_PLACEHOLDER) + (right if right is not None else _SHELL_PLACEHOLDER)
+    if isinstance(node, (ast.List, ast.Tuple)):
+        parts = [_literal_text(element) for element in node.elts]
+        if not any(part is not None for part in parts):
+            return None
+        return shlex.join(part if part is not None else _SHELL_PLACEHOLDER for part in parts)
+    return None
+
+
+# Duyệt cây bằng ast.walk (nhanh hơn NodeVisitor): gom alias import trước, rồi xét từng lời gọi hàm
+class _PythonRiskAnalyzer:
+    def __init__(self):
+        self.aliases = {} # tên cục bộ -> tên đầy đủ (import os as o; from shutil import rmtree)
+        self.risks = []
+
+    def run(self, tree):
+        calls = []
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Call):
+                calls.append(node)
+            elif isinstance(node, ast.Import):
+                for alias in node.names:
+                    if alias.asname:
+                        self.aliases[alias.asname] = alias.name
+                    else:
+                        top = alias.name.split(".")[0]
+                        self.aliases[top] = top
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                for alias in node.names:
+                    if alias.name != "*":
+                        self.aliases[alias.asname or alias.name] = f"{node.module}.{alias.name}"
+        for node in sorted(calls, key=lambda call: (call.lineno, call.col_offset)):
+            name = self._qualified_name(node.func)
+            if name:
+                self._check_call(name, node)
+        return self.risks
+
+    def _qualified_name(self, node):
+        parts = []
+        while isinstance(node, ast.Attribute):
+            parts.append(node.attr)
+            node = node.value
+        if not isinstance(node, ast.Name):
+            return None
+        parts.append(self.aliases.get(node.id, node.id))
+        return ".".join(reversed(parts))
+
+    def _add(self, rule, severity, message, node):
+        self.risks.append(_risk(rule, severity, message, node.lineno, node.col_offset + 1))
+
+    # Phân tích lệnh shell truyền cho os.system/subprocess...; không xác định được tĩnh thì ghi nhận mức thấp hơn
+    def _check_command(self, name, command_node, node, shell):
+        command = _literal_text(command_node) if command_node is not None else None
+        if command is None:
+            severity = "medium" if shell else "low"
+            self._add(name, severity, f"Chạy lệnh không xác định được tĩnh qua {name}", node)
+            return
+        found = analyze_shell(command, line_offset=node.lineno - 1)
+        for risk in found:
+            risk.update(rule=f"{name}:{risk['rule']}", column=node.col_offset + 1, message=f"{risk['message']} qua {name}")
+        self.risks.extend(found)
+        if not found and shell and _SHELL_PLACEHOLDER in command:
+            self._add(name, "low", f"Lệnh shell ghép từ biến qua {name}: {command[:80]}", node)
+
+    def _check_call(self, name, node):
+        first_argument = node.args[0] if node.args else None
+        keywords = {keyword.arg: keyword.value for keyword in node.keywords if keyword.arg}
+        if name in _PYTHON_CALLS:
+            severity, message = _PYTHON_CALLS[name]
+            self._add(name, severity, message, node)
+        elif name in _SHELL_STRING_CALLS:
+            self._check_command(name, first_argument, node, shell=True)
+        elif name in _SUBPROCESS_CALLS:
+            shell_keyword = keywords.get("shell")
+            shell = name.endswith("_shell") or (isinstance(shell_keyword, ast.Constant) and shell_keyword.value is True)
+            self._check_command(name, first_argument if first_argument is not None else keywords.get("args"), node, shell)
+        elif name.startswith(_EXEC_PREFIXES):
+            command_args = node.args[1:] if len(node.args) > 1 else []
+            command = _literal_text(ast.List(elts=list(command_args))) if command_args else None
+            if command and analyze_shell(command):
+                self._check_command(name, ast.List(elts=list(command_args)), node, shell=False)
+            else:
+                self._add(name, "medium", f"Thay thế/sinh tiến trình bằng {name}", node)
+        elif name in _DYNAMIC_CODE_CALLS:
+            if first_argument is not None and not isinstance(first_argument, ast.Constant):
+                self._add(name, "medium", f"Chạy/nạp code tạo lúc chạy bằng {name} (không phân tích tĩnh được)", node)
+        elif name == "getattr" and len(node.args) >= 2:
+            target = self._qualified_name(node.args[0])
+            attribute = node.args[1].value if isinstance(node.args[1], ast.Constant) else None
+            if target in ("os", "subprocess", "shutil", "builtins"):
+                qualified = f"{target}.{attribute}"
+                if attribute is None:
+                    self._add("getattr", "medium", f"Lấy hàm của module {target} theo tên động", node)
+                elif qualified in _PYTHON_CALLS or qualified in _SHELL_STRING_CALLS or qualified in _SUBPROCESS_CALLS or qualified.startswith(_EXEC_PREFIXES):
+                    self._add("getattr", "medium", f"Lấy {qualified} qua getattr (che giấu lời gọi)", node)
+        elif name == "open" and first_argument is not None:
+            path = _literal_text(first_argument)
+            mode = keywords.get("mode", node.args[1] if len(node.args) > 1 else None)
+            mode_text = mode.value if isinstance(mode, ast.Constant) and isinstance(mode.value, str) else ""
+            if path and _SYSTEM_FILE_RE.match(path) and any(flag in mode_text for flag in _WRITE_MODES):
+                self._add("open-system-file", "high", f"Ghi vào file hệ thống {path}", node)
+
+
+def analyze_python(code):
+    if not _PYTHON_INTEREST_RE.search(code):
+        return []
+    try:
+        tree = ast.parse(code, filename=PYTHON_FILENAME)
+    except (SyntaxError, ValueError, RecursionError, MemoryError):
+        return []
+    return _PythonRiskAnalyzer().run(tree)
+
+
+# Kiểm tra một đoạn code (không cache). Trả về dict:
+#   language, syntax_ok (True/False/None = không kiểm tra được), syntax_error, risks, max_severity, duration_ms
+def validate_code(code, file_extension, check_shell_syntax=True):
+    start = time.perf_counter()
+    language = language_for(file_extension)
+    syntax_ok, syntax_error, risks = None, None, []
+    if language == "python":
+        syntax_ok, syntax_error = check_python(code)
+        if syntax_ok is not False:
+            risks = analyze_python(code)
+    elif language == "shell":
+        if check_shell_syntax:
+            syntax_ok, syntax_error = check_shell(code)
+        risks = analyze_shell(code)
+    elif language == "batch":
+        risks = analyze_batch(code)
+    elif language == "powershell":
+        risks = analyze_powershell(code)
+    return {
+        "language": language,
+        "syntax_ok": syntax_ok,
+        "syntax_error": syntax_error,
+        "risks": risks,
+        "max_severity": max_severity(risks),
+        "duration_ms": round((time.perf_counter() - start) * 1000, 3),
+    }
+
+
+# Cache LRU kết quả kiểm tra theo hash của (loại file, code)
+class CodeValidator:
+    def __init__(self, max_entries=1024, check_shell_syntax=True):
+        self.max_entries = max(1, int(max_entries))
+        self.check_shell_syntax = check_shell_syntax
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(code, file_extension):
+        return hashlib.sha256(f"{(file_extension or '').lower()}\0{code}".encode("utf-8", errors="surrogatepass")).hexdigest()
+
+    # Trả về bản sao kết quả kèm "cached" (True nếu lấy từ cache)
+    def validate(self, code, file_extension):
+        key = self.make_key(code, file_extension)
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return {**result, "cached": True}
+            self.misses += 1
+        result = validate_code(code, file_extension, self.check_shell_syntax)
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return {**result, "cached": False}
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
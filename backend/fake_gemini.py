@@ -0,0 +1,145 @@
+# backend/fake_gemini.py
+# Model Gemini giả chạy cục bộ, dùng để thử lớp resilience, benchmark và load test mà không gọi API thật.
+# Bật bằng GEMINI_FAKE_BACKEND=1. Các biến môi trường điều khiển hành vi:
+#   GEMINI_FAKE_LATENCY_MS     - độ trễ mỗi lời gọi (mặc định 200)
+#   GEMINI_FAKE_MODEL_LATENCY_MS - độ trễ riêng theo model, vd "gemini-1.5-flash=3000,gemini-1.5-flash-8b=150"
+#   GEMINI_FAKE_JITTER_MS      - dao động ngẫu nhiên thêm vào độ trễ (mặc định 0)
+#   GEMINI_FAKE_LATENCY_DIST   - phân phối của phần dao động: uniform (0..jitter, mặc định)
+#                                hoặc exponential (trung bình = jitter, có đuôi dài như API thật)
+#   GEMINI_FAKE_RESPONSE_CHARS - độ dài phản hồi: "n" cố định hoặc "min-max" ngẫu nhiên đều
+#                                (mặc định: phản hồi mẫu ~170 ký tự); phần thêm là đoạn giải thích trước khối mã
+#   GEMINI_FAKE_FAILURE_RATE   - xác suất lỗi mỗi lời gọi, 0..1 (mặc định 0)
+#   GEMINI_FAKE_FAIL_FIRST     - N lời gọi đầu tiên luôn lỗi (mặc định 0)
+#   GEMINI_FAKE_FAILURE_KIND   - rate_limit | unavailable | timeout | invalid_key (mặc định unavailable)
+#   GEMINI_FAKE_CHUNK_CHARS    - số ký tự mỗi chunk khi stream (mặc định 24)
+import itertools
+import os
+import random
+import threading
+import time
+
+from google.api_core import exceptions as google_exceptions
+
+DEFAULT_RESPONSE = """Phân tích: đây là phản hồi giả từ fake Gemini.
+```bash
+pip install requests
+```
+```python
+import sys
+print("Xin chao tu fake Gemini", sys.version_info[:2])
+```
+"""
+
+_FAILURES = {
+    'rate_limit': lambda: google_exceptions.ResourceExhausted("429 Resource has been exhausted (fake)"),
+    'unavailable': lambda: google_exceptions.ServiceUnavailable("503 The service is currently unavailable (fake)"),
+    'timeout': lambda: google_exceptions.DeadlineExceeded("504 Deadline Exceeded (fake)"),
+    'invalid_key': lambda: google_exceptions.InvalidArgument("400 API key not valid. Please pass a valid API key. (fake)"),
+}
+
+
+def fake_backend_enabled():
+    return os.getenv('GEMINI_FAKE_BACKEND', '').lower() in ('1', 'true', 'yes')
+
+
+class _UsageMetadata:
+    def __init__(self, prompt_token_count, candidates_token_count):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.total_token_count = prompt_token_count + candidates_token_count
+
+
+class _PromptFeedback:
+    block_reason = None
+
+
+class FakeResponse:
+    def __init__(self, text, chunks=None, usage_metadata=None):
+        self.text = text
+        self.candidates = [text] if text else []
+        self.prompt_feedback = _PromptFeedback()
+        self.usage_metadata = usage_metadata
+        self._chunks = chunks or []
+
+    def __iter__(self):
+        return iter(self._chunks)
+
+
+class _StreamingResponse(FakeResponse):
+    def __init__(self, text, chunk_chars, chunk_delay, usage_metadata):
+        super().__init__(text, usage_metadata=usage_metadata)
+        self._chunk_chars = chunk_chars
+        self._chunk_delay = chunk_delay
+
+    def __iter__(self):
+        for start in range(0, len(self.text), self._chunk_chars):
+            if start:
+                time.sleep(self._chunk_delay)
+            yield FakeResponse(self.text[start:start + self._chunk_chars], usage_metadata=self.usage_metadata)
+
+
+# Cùng giao diện generate_content như google.generativeai.GenerativeModel (phần backend dùng tới)
+class FakeGenerativeModel:
+    _call_counter = itertools.count(1)
+    _counter_lock = threading.Lock()
+
+    def __init__(self, model_name, system_instruction=None, response_text=None):
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+        self.response_text = response_text or DEFAULT_RESPONSE
+        self.latency = float(os.getenv('GEMINI_FAKE_LATENCY_MS', '200')) / 1000
+        for override in os.getenv('GEMINI_FAKE_MODEL_LATENCY_MS', '').split(','):
+            name, _, value = override.partition('=')
+            if name.strip() == model_name and value.strip():
+                self.latency = float(value) / 1000
+        self.jitter = float(os.getenv('GEMINI_FAKE_JITTER_MS', '0')) / 1000
+        self.latency_dist = os.getenv('GEMINI_FAKE_LATENCY_DIST', 'uniform').lower()
+        self.response_chars = _parse_range(os.getenv('GEMINI_FAKE_RESPONSE_CHARS', ''))
+        self.failure_rate = float(os.getenv('GEMINI_FAKE_FAILURE_RATE', '0'))
+        self.fail_first = int(os.getenv('GEMINI_FAKE_FAIL_FIRST', '0'))
+        self.failure_kind = os.getenv('GEMINI_FAKE_FAILURE_KIND', 'unavailable')
+        self.chunk_chars = max(1, int(os.getenv('GEMINI_FAKE_CHUNK_CHARS', '24')))
+
+    def generate_content(self, contents, generation_config=None, safety_settings=None, stream=False, request_options=None, **kwargs):
+        with self._counter_lock:
+            call_number = next(self._call_counter)
+        if self.latency_dist == 'exponential' and self.jitter > 0:
+            latency = self.latency + random.expovariate(1 / self.jitter)
+        else:
+            latency = self.latency + random.uniform(0, self.jitter)
+        timeout = (request_options or {}).get('timeout')
+        if timeout is not None and latency > timeout:
+            time.sleep(timeout)
+            raise _FAILURES['timeout']()
+        time.sleep(latency)
+        if call_number <= self.fail_first or random.random() < self.failure_rate:
+            raise _FAILURES.get(self.failure_kind, _FAILURES['unavailable'])()
+
+        response_text = self._response_text()
+        prompt_tokens = (len(str(contents)) + len(self.system_instruction or "")) // 4
+        usage_metadata = _UsageMetadata(prompt_tokens, len(response_text) // 4)
+        if stream:
+            chunk_count = max(1, len(response_text) // self.chunk_chars)
+            return _StreamingResponse(response_text, self.chunk_chars, latency / chunk_count, usage_metadata)
+        return FakeResponse(response_text, usage_metadata=usage_metadata)
+
+    # Nới phản hồi mẫu tới độ dài chọn theo GEMINI_FAKE_RESPONSE_CHARS, giữ nguyên các khối mã ở cuối
+    def _response_text(self):
+        if not self.response_chars:
+            return self.response_text
+        target = random.randint(*self.response_chars)
+        padding = target - len(self.response_text)
+        if padding <= 0:
+            return self.response_text
+        filler = "".join(f"Bước {index}: giải thích chi tiết cho phản hồi giả.\n" for index in range(padding // 40 + 1))
+        return filler[:padding] + "\n" + self.response_text
+
+
+# "n" -> (n, n), "min-max" -> (min, max), rỗng -> None
+def _parse_range(value):
+    value = value.strip()
+    if not value:
+        return None
+    low, _, high = value.partition('-')
+    low = int(low)
+    return (low, max(low, int(high))) if high else (low, low)
@@ -0,0 +1,144 @@
+# backend/gemini_clients.py
+# Pool client/model Gemini sống lâu, tách riêng theo API key.
+# Thay cho việc gọi genai.configure() (biến global của cả process) ở mỗi request:
+# các request dùng key khác nhau chạy song song an toàn và tái sử dụng kết nối gRPC.
+# Mỗi model được cache theo (model_name, system_instruction): phần hướng dẫn tĩnh gắn một lần vào model,
+# tùy chọn đẩy lên context cache phía Gemini để không phải gửi lại (và tính phí lại) ở mỗi request.
+import datetime
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import google.generativeai as genai
+from google.ai import generativelanguage as glm
+
+logger = logging.getLogger(__name__)
+
+
+class GeminiClientPool:
+    def __init__(self, idle_ttl_seconds=900, max_clients=32, max_models_per_client=64, context_cache_ttl_seconds=0, model_factory=None):
+        self.idle_ttl_seconds = float(idle_ttl_seconds)
+        self.max_clients = max(1, int(max_clients))
+        self.max_models_per_client = max(1, int(max_models_per_client))
+        # > 0: tạo context cache phía Gemini cho system instruction, sống trong số giây này (0 = tắt)
+        self.context_cache_ttl_seconds = int(context_cache_ttl_seconds)
+        # model_factory(model_name, system_instruction) thay cho model thật (vd: fake_gemini khi test/benchmark)
+        self.model_factory = model_factory
+        # key_id -> {"client", "cache_client", "models": OrderedDict[(model_name, system_instruction)] -> (model, expires_at), "last_used"}
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+        self.context_caches_created = 0
+        self.context_cache_failures = 0
+
+    # Không giữ API key thô làm khóa dict (tránh lộ key khi log/debug pool)
+    @staticmethod
+    def _key_id(api_key):
+        return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+    # Lấy GenerativeModel gắn với client của api_key (và system instruction nếu có), tạo mới nếu chưa có
+    def get_model(self, api_key, model_name, system_instruction=None):
+        key_id = self._key_id(api_key)
+        now = time.monotonic()
+        model_key = (model_name, system_instruction)
+        with self._lock:
+            self._sweep_idle(now)
+            entry = self._clients.get(key_id)
+            if entry is None:
+                entry = {"client": self._create_client(api_key), "cache_client": None, "models": OrderedDict(), "last_used": now}
+                self._clients[key_id] = entry
+                self._evict_lru()
+            entry["last_used"] = now
+            cached = entry["models"].get(model_key)
+            if cached is not None and (cached[1] is None or cached[1] > now):
+                entry["models"].move_to_end(model_key)
+                return cached[0]
+
+        # Tạo context cache là một lời gọi mạng -> làm ngoài lock
+        model, expires_at = self._create_model(entry, api_key, model_name, system_instruction)
+        with self._lock:
+            entry["models"][model_key] = (model, expires_at)
+            entry["models"].move_to_end(model_key)
+            while len(entry["models"]) > self.max_models_per_client:
+                entry["models"].popitem(last=False)
+        return model
+
+    def stats(self):
+        with self._lock:
+            return {
+                "clients": len(self._clients),
+                "models": sum(len(entry["models"]) for entry in self._clients.values()),
+                "max_clients": self.max_clients,
+                "idle_ttl_seconds": self.idle_ttl_seconds,
+                "context_cache_ttl_seconds": self.context_cache_ttl_seconds,
+                "context_caches_created": self.context_caches_created,
+                "context_cache_failures": self.context_cache_failures,
+            }
+
+    # Trả về (model, expires_at); expires_at = None nghĩa là model dùng được cho tới khi bị loại khỏi pool
+    def _create_model(self, entry, api_key, model_name, system_instruction):
+        if self.model_factory:
+            return self.model_factory(model_name, system_instruction), None
+        if system_instruction and self.context_cache_ttl_seconds > 0:
+            try:
+                if entry["cache_client"] is None:
+                    entry["cache_client"] = glm.CacheServiceClient(client_options={"api_key": api_key})
+                cached_content = entry["cache_client"].create_cached_content(
+                    cached_content=glm.CachedContent(
+                        model=model_name if model_name.startswith("models/") else f"models/{model_name}",
+                        system_instruction=glm.Content(parts=[glm.Part(text=system_instruction)]),
+                        ttl=datetime.timedelta(seconds=self.context_cache_ttl_seconds),
+                    )
+                )
+                model = genai.GenerativeModel(model_name=model_name)
+                model._client = entry["client"]
+                # Tương đương GenerativeModel.from_cached_content nhưng không cần client global
+                model._cached_content = cached_content.name
+                with self._lock:
+                    self.context_caches_created += 1
+                # Làm mới trước khi cache phía Gemini hết hạn
+                return model, time.monotonic() + self.context_cache_ttl_seconds * 0.9
+            except Exception as e:
+                # Model không hỗ trợ, prefix ngắn hơn số token tối thiểu, hết quota...:
+                # quay về gửi system instruction kèm mỗi request (kết quả này cũng được cache, không thử lại liên tục)
+                with self._lock:
+                    self.context_cache_failures += 1
+                logger.warning(f"Không tạo được context cache cho model {model_name}, dùng system instruction thường: {e}")
+
+        model = genai.GenerativeModel(model_name=model_name, system_instruction=system_instruction)
+        # SDK chỉ hỗ trợ client mặc định (global); gán client riêng của key này cho model
+        model._client = entry["client"]
+        return model, None
+
+    @staticmethod
+    def _create_client(api_key):
+        return glm.GenerativeServiceClient(client_options={"api_key": api_key})
+
+    # Phải gọi khi đang giữ self._lock
+    def _sweep_idle(self, now):
+        if now - self._last_sweep < min(self.idle_ttl_seconds, 60):
+            return
+        self._last_sweep = now
+        idle_keys = [key_id for key_id, entry in self._clients.items() if now - entry["last_used"] > self.idle_ttl_seconds]
+        for key_id in idle_keys:
+            self._close(self._clients.pop(key_id))
+
+    # Phải gọi khi đang giữ self._lock
+    def _evict_lru(self):
+        while len(self._clients) > self.max_clients:
+            lru_key = min(self._clients, key=lambda key_id: self._clients[key_id]["last_used"])
+            # Không đóng transport ở đây vì client có thể vẫn đang phục vụ request khác;
+            # bỏ tham chiếu để kênh gRPC tự đóng khi không còn ai dùng.
+            self._clients.pop(lru_key)
+
+    @staticmethod
+    def _close(entry):
+        for client in (entry["client"], entry["cache_client"]):
+            if client is None:
+                continue
+            try:
+                client.transport.close()
+            except Exception as e:
+                logger.warning(f"Không thể đóng client Gemini cũ: {e}")
@@ -0,0 +1,7 @@
+# backend/gunicorn.conf.py
+# Cấu hình gunicorn đọc từ cùng các biến môi trường SERVER_* như `python app.py`
+from server import gunicorn_options, load_server_config, warn_if_multi_worker
+
+_config = load_server_config()
+warn_if_multi_worker(_config)
+globals().update(gunicorn_options(_config))
@@ -0,0 +1,267 @@
+# backend/history_store.py
+# Lịch sử hội thoại phía server: mỗi tương tác generate/review/execute/debug/explain được ghi vào SQLite (WAL)
+# ngay khi có kết quả, để frontend chỉ tải phần đang hiển thị (phân trang theo id) và tìm kiếm toàn văn.
+# Ghi không chặn request: bản ghi vào hàng đợi, một thread ghi theo lô trong một transaction.
+# Đọc dùng kết nối riêng của từng thread (WAL cho phép đọc song song với thread ghi).
+# Tìm kiếm dùng FTS5 trên prompt/code/output/error; SQLite không có FTS5 thì quay về LIKE.
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Số bản ghi tối đa mỗi transaction của thread ghi
+WRITE_BATCH_SIZE = 200
+TEXT_FIELDS = ("prompt", "code", "output", "error")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    entry_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS conversations_updated ON conversations (updated_at);
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    conversation_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    request_id TEXT,
+    status INTEGER,
+    file_type TEXT,
+    prompt TEXT,
+    code TEXT,
+    output TEXT,
+    error TEXT,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS entries_conversation ON entries (conversation_id, id);
+"""
+
+# FTS5 dạng external content: chỉ lưu index, nội dung đọc từ bảng entries; trigger giữ index đồng bộ
+_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5(
+    prompt, code, output, error, content='entries', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS entries_fts_insert AFTER INSERT ON entries BEGIN
+    INSERT INTO entries_fts (rowid, prompt, code, output, error) VALUES (new.id, new.prompt, new.code, new.output, new.error);
+END;
+CREATE TRIGGER IF NOT EXISTS entries_fts_delete AFTER DELETE ON entries BEGIN
+    INSERT INTO entries_fts (entries_fts, rowid, prompt, code, output, error) VALUES ('delete', old.id, old.prompt, old.code, old.output, old.error);
+END;
+"""
+
+_ENTRY_COLUMNS = "id, conversation_id, kind, created_at, request_id, status, file_type, prompt, code, output, error, extra"
+
+
+# Chuyển chuỗi người dùng nhập thành truy vấn FTS5 an toàn: mỗi từ là một cụm trong ngoặc kép (AND),
+# từ cuối được tìm theo tiền tố để gõ dở vẫn ra kết quả
+def fts_query(text):
+    terms = [term.replace('"', '""') for term in text.split()]
+    if not terms:
+        return None
+    return " ".join(f'"{term}"' for term in terms[:-1]) + (" " if len(terms) > 1 else "") + f'"{terms[-1]}"*'
+
+
+def _row_to_entry(row):
+    entry = dict(zip(_ENTRY_COLUMNS.split(", "), row))
+    entry["extra"] = json.loads(entry["extra"]) if entry["extra"] else None
+    return entry
+
+
+class HistoryStore:
+    def __init__(self, path, max_field_chars=65536, max_queue=10000):
+        self.path = path
+        self.max_field_chars = max(1, int(max_field_chars))
+        self._queue = queue.Queue(maxsize=max(1, int(max_queue)))
+        self._local = threading.local()
+        self.written = 0
+        self.dropped = 0
+        self.write_errors = 0
+        self.fts_enabled = self._init_db()
+        threading.Thread(target=self._writer_loop, name="history-writer", daemon=True).start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL") # WAL + NORMAL: không fsync mỗi commit, vẫn không hỏng DB khi crash
+        conn.execute("PRAGMA foreign_keys=OFF")
+        return conn
+
+    # Kết nối đọc của thread hiện tại
+    def _reader(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def _init_db(self):
+        conn = self._connect()
+        try:
+            conn.executescript(_SCHEMA)
+            try:
+                conn.executescript(_FTS_SCHEMA)
+                return True
+            except sqlite3.OperationalError as e:
+                logger.warning(f"SQLite không hỗ trợ FTS5 ({e}), tìm kiếm lịch sử dùng LIKE.")
+                return False
+        finally:
+            conn.close()
+
+    # --- Ghi ---
+    # Đưa một tương tác vào hàng đợi ghi; không chặn (hàng đợi đầy thì bỏ và đếm)
+    def append(self, conversation_id, kind, status=None, request_id=None, file_type=None, extra=None, **fields):
+        record = {
+            "conversation_id": conversation_id, "kind": kind, "created_at": time.time(),
+            "request_id": request_id, "status": status, "file_type": file_type,
+            "extra": json.dumps(extra, ensure_ascii=False) if extra else None,
+        }
+        for name in TEXT_FIELDS:
+            value = fields.get(name)
+            record[name] = value[:self.max_field_chars] if isinstance(value, str) else value
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _writer_loop(self):
+        conn = self._connect()
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write_batch(conn, batch)
+                self.written += len(batch)
+            except sqlite3.Error as e:
+                self.write_errors += len(batch)
+                logger.error(f"Không ghi được {len(batch)} bản ghi lịch sử: {e}")
+            finally:
+                for _record in batch:
+                    self._queue.task_done()
+
+    def _write_batch(self, conn, batch):
+        with conn:
+            conn.executemany(
+                "INSERT INTO entries (conversation_id, kind, created_at, request_id, status, file_type, prompt, code, output, error, extra) "
+                "VALUES (:conversation_id, :kind, :created_at, :request_id, :status, :file_type, :prompt, :code, :output, :error, :extra)",
+                batch
+            )
+            counts = {}
+            for record in batch:
+                first, last, count = counts.get(record["conversation_id"], (record["created_at"], record["created_at"], 0))
+                counts[record["conversation_id"]] = (min(first, record["created_at"]), max(last, record["created_at"]), count + 1)
+            conn.executemany(
+                "INSERT INTO conversations (id, created_at, updated_at, entry_count) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET updated_at = excluded.updated_at, entry_count = entry_count + excluded.entry_count",
+                [(conversation_id, first, last, count) for conversation_id, (first, last, count) in counts.items()]
+            )
+
+    # Chờ các bản ghi đang xếp hàng được ghi xong (dùng khi cần đọc ngay sau khi ghi, vd: khi tắt)
+    def flush(self):
+        self._queue.join()
+
+    # --- Đọc ---
+    # Các hội thoại mới cập nhật nhất trước; before = updated_at của mục cuối trang trước
+    def list_conversations(self, limit=50, before=None):
+        sql = "SELECT id, created_at, updated_at, entry_count FROM conversations"
+        params = []
+        if before is not None:
+            sql += " WHERE updated_at < ?"
+            params.append(before)
+        sql += " ORDER BY updated_at DESC LIMIT ?"
+        params.append(limit + 1)
+        rows = self._reader().execute(sql, params).fetchall()
+        conversations = [dict(zip(("id", "created_at", "updated_at", "entry_count"), row)) for row in rows[:limit]]
+        return {"conversations": conversations, "next_before": conversations[-1]["updated_at"] if len(rows) > limit else None}
+
+    # Một trang tương tác của hội thoại theo id (keyset, không OFFSET):
+    #   before=<id>: các mục cũ hơn, mới nhất trước (cuộn ngược lên)
+    #   after=<id>:  các mục mới hơn, cũ nhất trước (đọc tiếp)
+    # Không có cả hai: trang mới nhất. Trong trang, mục luôn xếp theo thứ tự thời gian.
+    def page(self, conversation_id, limit=50, before=None, after=None):
+        sql = f"SELECT {_ENTRY_COLUMNS} FROM entries WHERE conversation_id = ?"
+        params = [conversation_id]
+        if after is not None:
+            sql += " AND id > ? ORDER BY id ASC LIMIT ?"
+            params += [after, limit + 1]
+        else:
+            if before is not None:
+                sql += " AND id < ?"
+                params.append(before)
+            sql += " ORDER BY id DESC LIMIT ?"
+            params.append(limit + 1)
+        rows = self._reader().execute(sql, params).fetchall()
+        has_more = len(rows) > limit
+        entries = [_row_to_entry(row) for row in rows[:limit]]
+        if after is None:
+            entries.reverse()
+        return {
+            "conversation_id": conversation_id,
+            "entries": entries,
+            "has_more": has_more, # Còn mục theo hướng đang đọc
+            "first_id": entries[0]["id"] if entries else None,
+            "last_id": entries[-1]["id"] if entries else None,
+        }
+
+    # Tìm toàn văn trong prompt/code/output/error, mới nhất trước; before=<id> để lấy trang tiếp
+    def search(self, text, conversation_id=None, limit=20, before=None):
+        columns = ", ".join(f"e.{column}" for column in ("id", "conversation_id", "kind", "created_at", "status", "file_type"))
+        params = []
+        if self.fts_enabled:
+            match = fts_query(text)
+            if match is None:
+                return {"results": [], "next_before": None}
+            sql = (f"SELECT {columns}, snippet(entries_fts, -1, '[', ']', '…', 16) FROM entries_fts "
+                   "JOIN entries e ON e.id = entries_fts.rowid WHERE entries_fts MATCH ?")
+            params.append(match)
+        else:
+            pattern = f"%{text.strip()}%"
+            sql = (f"SELECT {columns}, substr(coalesce(e.prompt, e.code, e.output, e.error, ''), 1, 200) FROM entries e "
+                   "WHERE (e.prompt LIKE ? OR e.code LIKE ? OR e.output LIKE ? OR e.error LIKE ?)")
+            params += [pattern] * 4
+        if conversation_id is not None:
+            sql += " AND e.conversation_id = ?"
+            params.append(conversation_id)
+        if before is not None:
+            sql += " AND e.id < ?"
+            params.append(before)
+        sql += " ORDER BY e.id DESC LIMIT ?"
+        params.append(limit + 1)
+        rows = self._reader().execute(sql, params).fetchall()
+        names = ("id", "conversation_id", "kind", "created_at", "status", "file_type", "snippet")
+        results = [dict(zip(names, row)) for row in rows[:limit]]
+        return {"results": results, "next_before": results[-1]["id"] if len(rows) > limit else None}
+
+    def get_entry(self, entry_id):
+        row = self._reader().execute(f"SELECT {_ENTRY_COLUMNS} FROM entries WHERE id = ?", (entry_id,)).fetchone()
+        return _row_to_entry(row) if row else None
+
+    # Xóa hội thoại (đợi các bản ghi đang xếp hàng để không sót mục ghi sau khi xóa)
+    def delete_conversation(self, conversation_id):
+        self.flush()
+        conn = self._connect()
+        try:
+            with conn:
+                deleted = conn.execute("DELETE FROM entries WHERE conversation_id = ?", (conversation_id,)).rowcount
+                conn.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+            return deleted
+        finally:
+            conn.close()
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "fts_enabled": self.fts_enabled,
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "write_errors": self.write_errors,
+        }
@@ -0,0 +1,185 @@
+# backend/job_queue.py
+# Hàng đợi job bất đồng bộ: submit trả về job ID ngay, một nhóm worker giới hạn chạy job,
+# client poll trạng thái / lấy kết quả / hủy. Ghi lại thời gian chờ và thời gian chạy mỗi job.
+import contextvars
+import logging
+import queue
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, kind, fn):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.fn = fn # fn(job) -> (payload, status_code)
+        self.status = "queued" # queued | running | succeeded | failed | cancelled
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.status_code = None
+        self.cancel_event = threading.Event()
+        self.context = contextvars.copy_context() # Giữ request_id của request submit để log của job nối được với request
+        self._process = None # Đối tượng có .kill() (StreamingProcess) của tiến trình đang chạy
+        self._lock = threading.Lock()
+
+    # Được gọi khi tiến trình con của job bắt đầu, để có thể kill khi hủy
+    def attach_process(self, process):
+        with self._lock:
+            self._process = process
+            cancelled = self.cancel_event.is_set()
+        if cancelled:
+            process.kill()
+
+    def request_cancel(self):
+        self.cancel_event.set()
+        with self._lock:
+            process = self._process
+        if process:
+            process.kill()
+
+    def timings(self):
+        now = time.time()
+        if self.started_at:
+            queue_wait = self.started_at - self.submitted_at
+        elif self.status == "queued":
+            queue_wait = now - self.submitted_at
+        else: # Bị hủy trước khi chạy
+            queue_wait = None
+        run_time = (self.finished_at or now) - self.started_at if self.started_at else None
+        return {
+            "queue_wait_seconds": round(queue_wait, 4) if queue_wait is not None else None,
+            "run_seconds": round(run_time, 4) if run_time is not None else None,
+        }
+
+    def to_dict(self, include_result=False):
+        data = {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            **self.timings(),
+        }
+        if include_result and self.finished_at:
+            data["result"] = self.result
+            data["result_status"] = self.status_code
+        return data
+
+
+class JobQueue:
+    def __init__(self, max_workers=4, max_queue=64, retention_seconds=3600):
+        self.max_workers = max(1, int(max_workers))
+        self.max_queue = max(1, int(max_queue))
+        self.retention_seconds = float(retention_seconds)
+        self._queue = queue.Queue(maxsize=self.max_queue)
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._workers = []
+        self._running = 0
+        # Thống kê tích lũy để định cỡ pool
+        self._completed = 0
+        self._total_queue_wait = 0.0
+        self._total_run_time = 0.0
+        self._max_queue_wait = 0.0
+        for index in range(self.max_workers):
+            worker = threading.Thread(target=self._worker_loop, name=f"job-worker-{index}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, kind, fn):
+        job = Job(kind, fn)
+        with self._lock:
+            self._prune_finished()
+            self._jobs[job.id] = job
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self._jobs.pop(job.id, None)
+            raise QueueFullError(f"Hàng đợi đã đầy ({self.max_queue} job).")
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    # Hủy job: job đang chờ bị bỏ qua khi tới lượt, job đang chạy bị kill cả cây tiến trình
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is None:
+            return None
+        with self._lock:
+            if job.status == "queued":
+                job.status = "cancelled"
+                job.finished_at = time.time()
+                job.result = {"error": "Job đã bị hủy trước khi chạy."}
+                job.status_code = 499
+        job.request_cancel()
+        return job
+
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "queued": self._queue.qsize(),
+                "running": self._running,
+                "jobs_by_status": counts,
+                "completed": self._completed,
+                "avg_queue_wait_seconds": round(self._total_queue_wait / self._completed, 4) if self._completed else 0.0,
+                "max_queue_wait_seconds": round(self._max_queue_wait, 4),
+                "avg_run_seconds": round(self._total_run_time / self._completed, 4) if self._completed else 0.0,
+            }
+
+    def _worker_loop(self):
+        while True:
+            job = self._queue.get()
+            try:
+                with self._lock:
+                    if job.status == "cancelled":
+                        continue
+                    job.status = "running"
+                    job.started_at = time.time()
+                    self._running += 1
+                try:
+                    payload, status_code = job.context.run(job.fn, job)
+                except Exception as e:
+                    logger.error(f"Job {job.id} ({job.kind}) gặp lỗi: {e}")
+                    payload, status_code = {"error": f"Lỗi hệ thống khi chạy job: {e}"}, 500
+                with self._lock:
+                    self._running -= 1
+                    job.finished_at = time.time()
+                    job.result = payload
+                    job.status_code = status_code
+                    if job.cancel_event.is_set():
+                        job.status = "cancelled"
+                    else:
+                        job.status = "succeeded" if status_code < 400 else "failed"
+                    queue_wait = job.started_at - job.submitted_at
+                    self._completed += 1
+                    self._total_queue_wait += queue_wait
+                    self._total_run_time += job.finished_at - job.started_at
+                    self._max_queue_wait = max(self._max_queue_wait, queue_wait)
+                job.context.run(logger.info, f"Job {job.id} ({job.kind}) kết thúc: {job.status} (chờ {queue_wait:.2f}s, chạy {job.finished_at - job.started_at:.2f}s)")
+            finally:
+                self._queue.task_done()
+
+    # Phải gọi khi đang giữ self._lock
+    def _prune_finished(self):
+        cutoff = time.time() - self.retention_seconds
+        expired = [job_id for job_id, job in self._jobs.items() if job.finished_at and job.finished_at < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
@@ -0,0 +1,628 @@
+# backend/kernel_sessions.py
+# Kernel Python giữ trạng thái theo hội thoại (chỉ POSIX): mỗi kernel là một tiến trình Python sống lâu,
+# mỗi lần chạy exec code trong cùng một namespace -> module đã import, dữ liệu đã nạp, biến được giữ giữa các lần chạy,
+# lần chạy sau chỉ tốn thời gian của code mới.
+#   - Điều khiển: lệnh (JSON mỗi dòng) qua stdin của kernel; stdin của code người dùng là /dev/null.
+#     Kết quả mỗi lần chạy qua một pipe riêng; stdout/stderr của kernel là output của code.
+#     Kernel flush stdout/stderr trước khi gửi kết quả, nên khi nhận kết quả chỉ cần đọc nốt phần còn trong pipe.
+#   - Timeout: gửi SIGINT (KeyboardInterrupt trong code, giữ nguyên namespace); sau interrupt_grace_seconds vẫn chưa
+#     dừng thì kill kernel (lần sau bắt đầu lại từ đầu).
+#   - Giới hạn: số kernel, thời gian rảnh, RSS của từng kernel và tổng RSS; khởi động lại theo yêu cầu.
+import codecs
+import io
+import json
+import logging
+import os
+import select
+import signal
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from resource_limits import apply_to_pid, read_process_io, wrap_command
+
+logger = logging.getLogger(__name__)
+
+READ_CHUNK_SIZE = 65536
+# Thời gian tối đa chờ kernel khởi động xong (kể cả import các module preload)
+STARTUP_TIMEOUT_SECONDS = 60
+# Số lý do tắt kernel gần nhất được nhớ theo key (để báo cho lần chạy sau biết trạng thái đã mất)
+_EVICTION_MEMORY = 256
+
+# Script chạy trong kernel. Biến của kernel nằm trong globals của script, code người dùng chạy trong _namespace riêng.
+KERNEL_BOOTSTRAP = r"""
+import importlib, json, linecache, os, resource, signal, sys, traceback
+_control = os.fdopen(os.dup(0), 'rb')
+_null = os.open(os.devnull, os.O_RDONLY)
+os.dup2(_null, 0)
+os.close(_null)
+_result = os.fdopen(int(sys.argv[1]), 'wb', buffering=0)
+os.set_inheritable(_result.fileno(), False)
+for _name in sys.argv[2:]:
+    try:
+        __import__(_name)
+    except Exception:
+        pass
+sys.argv = ['<kernel>']
+_namespace = {'__name__': '__main__', '__builtins__': __builtins__}
+_rss_unit = 1 if sys.platform == 'darwin' else 1024
+
+def _rss_bytes():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+def _send(message):
+    _result.write(json.dumps(message).encode('utf-8') + b'\n')
+
+# SIGINT chỉ thành KeyboardInterrupt khi đang chạy code (handler C: không thêm frame vào traceback)
+signal.signal(signal.SIGINT, signal.SIG_IGN)
+_send({'ready': True, 'rss_bytes': _rss_bytes()})
+_cell = 0
+while True:
+    _line = _control.readline()
+    if not _line:
+        break
+    _request = json.loads(_line)
+    _cell += 1
+    _filename = f'<cell-{_cell}>'
+    _source = _request['code']
+    linecache.cache[_filename] = (len(_source), None, _source.splitlines(True), _filename)
+    importlib.invalidate_caches() # Package vừa cài giữa hai lần chạy
+    _self_before = resource.getrusage(resource.RUSAGE_SELF)
+    _children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    _status, _code = 'ok', 0
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    try:
+        exec(compile(_source, _filename, 'exec'), _namespace)
+    except SystemExit as _exit:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        _status = 'exit'
+        if _exit.code is None or isinstance(_exit.code, int):
+            _code = _exit.code or 0
+        else:
+            print(_exit.code, file=sys.stderr)
+            _code = 1
+    except KeyboardInterrupt:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        _status, _code = 'interrupted', -int(signal.SIGINT)
+        _type, _value, _tb = sys.exc_info()
+        traceback.print_exception(_type, _value, _tb.tb_next)
+    except BaseException:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        _status, _code = 'error', 1
+        _type, _value, _tb = sys.exc_info()
+        traceback.print_exception(_type, _value, _tb.tb_next)
+    finally:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for _stream in (sys.stdout, sys.stderr, sys.__stdout__, sys.__stderr__):
+        try:
+            _stream.flush()
+        except Exception:
+            pass
+    _self_after = resource.getrusage(resource.RUSAGE_SELF)
+    _children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    _send({
+        'id': _request['id'], 'status': _status, 'return_code': _code,
+        'user_cpu_seconds': _self_after.ru_utime - _self_before.ru_utime + _children_after.ru_utime - _children_before.ru_utime,
+        'system_cpu_seconds': _self_after.ru_stime - _self_before.ru_stime + _children_after.ru_stime - _children_before.ru_stime,
+        'cpu_total_seconds': _self_after.ru_utime + _self_after.ru_stime,
+        'peak_rss_bytes': _self_after.ru_maxrss * _rss_unit,
+        'rss_bytes': _rss_bytes(),
+    })
+"""
+
+
+class KernelError(Exception):
+    pass
+
+
+class KernelBusyError(KernelError):
+    pass
+
+
+class KernelCapacityError(KernelError):
+    pass
+
+
+def _decoder():
+    return io.IncrementalNewlineDecoder(codecs.getincrementaldecoder('utf-8')(errors='replace'), translate=True)
+
+
+class Kernel:
+    def __init__(self, key, python, env=None, preload_modules=(), limits=None):
+        self.key = key
+        self.python = python
+        self.env = env
+        self.preload_modules = list(preload_modules)
+        self.limits = dict(limits or {})
+        self.process = None
+        self.lock = threading.Lock() # Giữ trong suốt một lần chạy
+        self.created_at = self.last_used = time.time()
+        self.runs = 0
+        self.rss_bytes = None
+        self.peak_rss_bytes = None
+        self.cpu_total_seconds = 0.0
+        self.dead = False
+        self.retired = False # Đã bị bỏ khỏi manager (restart/xóa) trong lúc chạy: thread đang chạy tự kill khi xong
+        self.restarted_after = None # Lý do kernel trước đó của key này bị tắt (trạng thái cũ đã mất)
+        self._result_fd = None
+        self._result_buffer = b""
+        self._decoders = {}
+        self._abandoned_id = None # Lần chạy bị bỏ dở (client ngắt kết nối) còn chờ kết quả
+
+    # Spawn tiến trình kernel và chờ nó sẵn sàng; có thể ném FileNotFoundError/KernelError
+    def start(self):
+        result_read, result_write = os.pipe()
+        # CPU là tổng của cả đời kernel: đặt lại trước mỗi lần chạy (xem run), không đặt lúc spawn
+        spawn_limits = {name: value for name, value in self.limits.items() if name != "cpu_seconds"}
+        command, preexec_fn = wrap_command([self.python, '-c', KERNEL_BOOTSTRAP, str(result_write), *self.preload_modules], spawn_limits)
+        try:
+            self.process = subprocess.Popen(
+                command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=self.env,
+                pass_fds=(result_write,), start_new_session=True, preexec_fn=preexec_fn
+            )
+        except BaseException:
+            os.close(result_read)
+            raise
+        finally:
+            os.close(result_write)
+        self._result_fd = result_read
+        self._decoders = {self.process.stdout.fileno(): _decoder(), self.process.stderr.fileno(): _decoder()}
+        ready = self._wait_result(STARTUP_TIMEOUT_SECONDS)
+        if not ready or not ready.get("ready"):
+            stderr = self._drain_text().get("stderr", "")
+            self.kill()
+            raise KernelError(f"Kernel Python không khởi động được. {stderr.strip()[-500:]}")
+        self.rss_bytes = ready.get("rss_bytes")
+        logger.info(f"Đã khởi động kernel '{self.key}' (pid {self.process.pid}).")
+        return self
+
+    @property
+    def pid(self):
+        return self.process.pid if self.process else None
+
+    @property
+    def busy(self):
+        return self.lock.locked()
+
+    # Đọc một dòng kết quả; None nếu hết thời gian hoặc kernel đã đóng pipe (khi đó dead = True)
+    def _read_result_line(self):
+        data = os.read(self._result_fd, READ_CHUNK_SIZE)
+        if not data:
+            self.dead = True
+            return None
+        self._result_buffer += data
+        if b"\n" not in self._result_buffer:
+            return None
+        line, self._result_buffer = self._result_buffer.split(b"\n", 1)
+        return json.loads(line)
+
+    def _wait_result(self, timeout):
+        deadline = time.monotonic() + timeout
+        while not self.dead:
+            if b"\n" in self._result_buffer:
+                line, self._result_buffer = self._result_buffer.split(b"\n", 1)
+                return json.loads(line)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([self._result_fd], [], [], remaining)[0]:
+                return None
+            message = self._read_result_line()
+            if message is not None:
+                return message
+        return None
+
+    def _read_stream(self, fd):
+        data = os.read(fd, READ_CHUNK_SIZE)
+        if not data:
+            return None
+        return self._decoders[fd].decode(data)
+
+    # Đọc hết phần output đang nằm trong pipe (không chờ)
+    def _drain(self):
+        fds = [self.process.stdout.fileno(), self.process.stderr.fileno()]
+        while fds:
+            ready = select.select(fds, [], [], 0)[0]
+            if not ready:
+                break
+            for fd in ready:
+                text = self._read_stream(fd)
+                if text is None:
+                    fds.remove(fd)
+                elif text:
+                    yield self._stream_name(fd), text
+        for fd, decoder in self._decoders.items():
+            tail = decoder.decode(b"", final=True)
+            decoder.reset()
+            if tail:
+                yield self._stream_name(fd), tail
+
+    def _drain_text(self):
+        collected = {}
+        for stream_name, text in self._drain():
+            collected[stream_name] = collected.get(stream_name, "") + text
+        return collected
+
+    def _stream_name(self, fd):
+        return "stdout" if fd == self.process.stdout.fileno() else "stderr"
+
+    # Lần chạy trước bị bỏ dở: chờ kết quả của nó (bỏ output) trong grace giây, không xong thì kill
+    def _settle(self, grace):
+        if self._abandoned_id is None or self.dead:
+            return
+        deadline = time.monotonic() + grace
+        while not self.dead and time.monotonic() < deadline:
+            message = self._wait_result(max(deadline - time.monotonic(), 0))
+            self._drain_text()
+            if message is None:
+                break
+            if message.get("id") == self._abandoned_id:
+                self._abandoned_id = None
+                self._apply_result(message)
+                return
+        self.kill()
+
+    def _apply_result(self, message):
+        self.rss_bytes = message.get("rss_bytes")
+        self.peak_rss_bytes = message.get("peak_rss_bytes")
+        self.cpu_total_seconds = message.get("cpu_total_seconds") or self.cpu_total_seconds
+
+    def interrupt(self):
+        if self.process and not self.dead and self.process.poll() is None:
+            try:
+                os.kill(self.process.pid, signal.SIGINT)
+            except ProcessLookupError:
+                pass
+
+    def _kill_group(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL) # Cả tiến trình con chạy nền của code, kể cả khi kernel đã thoát
+        except (ProcessLookupError, PermissionError, OSError):
+            if self.process.poll() is None:
+                self.process.kill()
+
+    # Kill và đóng pipe/fd; chỉ gọi từ thread đang giữ lock (hoặc khi chắc chắn không ai đang chạy kernel)
+    def kill(self):
+        self.dead = True
+        if self.process is None:
+            return
+        self._kill_group()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            pass
+        for pipe in (self.process.stdin, self.process.stdout, self.process.stderr):
+            try:
+                pipe.close()
+            except OSError:
+                pass
+        if self._result_fd is not None:
+            os.close(self._result_fd)
+            self._result_fd = None
+
+    # Tắt kernel từ thread khác (restart/xóa/shutdown). Đang chạy: ngắt code, chờ lần chạy trả lock tối đa grace giây;
+    # vẫn chưa xong thì chỉ kill process group (không đóng fd mà thread kia đang select/đọc), thread đó thấy kernel
+    # chết và tự dọn
+    def terminate(self, grace):
+        self.retired = True
+        if not self.lock.acquire(blocking=False):
+            self.interrupt()
+            if not self.lock.acquire(timeout=grace):
+                if self.process is not None:
+                    self._kill_group()
+                return
+        try:
+            self.kill()
+        finally:
+            self.lock.release()
+
+    def run(self, code, timeout, interrupt_grace_seconds=3):
+        return KernelRun(self, code, timeout, interrupt_grace_seconds)
+
+    def info(self):
+        return {
+            "id": self.key,
+            "pid": self.pid,
+            "python": self.python,
+            "runs": self.runs,
+            "busy": self.busy,
+            "alive": not self.dead,
+            "created_at": self.created_at,
+            "last_used": self.last_used,
+            "rss_bytes": self.rss_bytes,
+            "peak_rss_bytes": self.peak_rss_bytes,
+            "cpu_total_seconds": round(self.cpu_total_seconds, 4),
+        }
+
+
+# Một lần chạy code trong kernel; giao diện giống StreamingProcess (iter_output, return_code, timed_out, usage())
+class KernelRun:
+    def __init__(self, kernel, code, timeout, interrupt_grace_seconds):
+        self.kernel = kernel
+        self.code = code
+        self.timeout = timeout
+        self.interrupt_grace_seconds = interrupt_grace_seconds
+        self.return_code = None
+        self.status = None # ok | error | exit | interrupted | crashed | killed
+        self.timed_out = False
+        self.started_at = None
+        self.duration = None
+        self.user_cpu_seconds = None
+        self.system_cpu_seconds = None
+        self.cpu_seconds = None
+        self.peak_rss_bytes = None
+        self.io = None
+
+    def _elapsed(self):
+        return time.monotonic() - self.started_at
+
+    # Yield (stream_name, text, elapsed_seconds) theo thứ tự output đến, kết thúc khi kernel gửi kết quả
+    # (hoặc chết / bị kill do quá thời gian). Consumer dừng giữa chừng: interrupt code, kernel giữ lại cho lần sau.
+    def iter_output(self):
+        kernel = self.kernel
+        kernel._settle(self.interrupt_grace_seconds)
+        self.started_at = time.monotonic()
+        if kernel.dead:
+            self.status, self.return_code, self.duration = "crashed", -1, 0.0
+            return
+        # Output còn sót từ lần trước (vd: thread chạy nền) tính cho lần này
+        for stream_name, text in kernel._drain():
+            yield stream_name, text, 0.0
+
+        kernel.runs += 1
+        run_id = kernel.runs
+        io_before = read_process_io(kernel.pid)
+        if kernel.limits:
+            # Giới hạn của request này; RLIMIT_CPU tính trên tổng CPU của kernel nên cộng thêm phần đã dùng
+            limits = dict(kernel.limits)
+            if limits.get("cpu_seconds"):
+                limits["cpu_seconds"] += int(kernel.cpu_total_seconds) + 1
+            apply_to_pid(kernel.pid, limits)
+        try:
+            kernel.process.stdin.write(json.dumps({"id": run_id, "code": self.code}).encode('utf-8') + b"\n")
+            kernel.process.stdin.flush()
+        except (BrokenPipeError, OSError):
+            kernel.dead = True
+
+        streams = [kernel.process.stdout.fileno(), kernel.process.stderr.fileno()]
+        deadline = self.started_at + self.timeout if self.timeout else None
+        result = None
+        try:
+            while result is None and not kernel.dead:
+                wait = None if deadline is None else max(deadline - time.monotonic(), 0)
+                ready = select.select(streams + [kernel._result_fd], [], [], wait)[0]
+                if not ready:
+                    if not self.timed_out:
+                        self.timed_out = True
+                        kernel.interrupt()
+                        deadline = time.monotonic() + self.interrupt_grace_seconds
+                    else:
+                        logger.warning(f"Kernel '{kernel.key}' không dừng sau SIGINT, kill kernel.")
+                        self.status = "killed"
+                        kernel.kill()
+                    continue
+                for fd in ready:
+                    if fd == kernel._result_fd:
+                        message = kernel._read_result_line()
+                        if message is not None and message.get("id") == run_id:
+                            result = message
+                        continue
+                    text = kernel._read_stream(fd)
+                    if text is None:
+                        streams.remove(fd)
+                    elif text:
+                        yield kernel._stream_name(fd), text, self._elapsed()
+            if kernel._result_fd is not None:
+                for stream_name, text in kernel._drain():
+                    yield stream_name, text, self._elapsed()
+        except GeneratorExit:
+            kernel._abandoned_id = run_id
+            kernel.interrupt()
+            raise
+
+        self.duration = self._elapsed()
+        if result is not None:
+            kernel._apply_result(result)
+            self.status = result["status"]
+            self.return_code = result["return_code"]
+            self.user_cpu_seconds = result.get("user_cpu_seconds")
+            self.system_cpu_seconds = result.get("system_cpu_seconds")
+            self.cpu_seconds = (self.user_cpu_seconds or 0) + (self.system_cpu_seconds or 0)
+            self.peak_rss_bytes = result.get("peak_rss_bytes")
+            io_after = read_process_io(kernel.pid)
+            if io_before and io_after:
+                self.io = {name: io_after[name] - io_before[name] for name in io_after}
+            return
+        # Kernel chết giữa chừng (os._exit, segfault, vượt giới hạn) hoặc bị kill
+        io_after = read_process_io(kernel.pid)
+        if io_before and io_after:
+            self.io = {name: io_after[name] - io_before[name] for name in io_after}
+        kernel.kill()
+        self.status = self.status or "crashed"
+        self.return_code = kernel.process.returncode if kernel.process.returncode is not None else -1
+
+    def usage(self):
+        io = self.io or {}
+        return {
+            "wall_seconds": None if self.duration is None else round(self.duration, 4),
+            "user_cpu_seconds": self.user_cpu_seconds,
+            "system_cpu_seconds": self.system_cpu_seconds,
+            "peak_rss_bytes": self.peak_rss_bytes, # RSS cao nhất của kernel từ lúc khởi động
+            "written_bytes": io.get("written_bytes"),
+            "disk_write_bytes": io.get("disk_write_bytes"),
+            "read_bytes": io.get("read_bytes"),
+        }
+
+
+class KernelManager:
+    def __init__(self, max_kernels=4, idle_seconds=900, max_kernel_rss_bytes=0, max_total_rss_bytes=0, preload_modules=(),
+                 interrupt_grace_seconds=3, python_executable=None, env_factory=None):
+        self.max_kernels = max(1, int(max_kernels))
+        self.idle_seconds = float(idle_seconds)
+        self.max_kernel_rss_bytes = int(max_kernel_rss_bytes)
+        self.max_total_rss_bytes = int(max_total_rss_bytes)
+        self.preload_modules = list(preload_modules)
+        self.interrupt_grace_seconds = float(interrupt_grace_seconds)
+        self.python_executable = python_executable
+        self.env_factory = env_factory
+        self._kernels = {} # key -> Kernel
+        self._evicted = OrderedDict() # key -> lý do kernel gần nhất bị tắt
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self.started = 0
+        self.evictions = {}
+        threading.Thread(target=self._janitor_loop, name="kernel-janitor", daemon=True).start()
+
+    def _record_eviction(self, key, reason):
+        self.evictions[reason] = self.evictions.get(reason, 0) + 1
+        self._evicted[key] = reason
+        self._evicted.move_to_end(key)
+        while len(self._evicted) > _EVICTION_MEMORY:
+            self._evicted.popitem(last=False)
+
+    # Bỏ kernel khỏi danh sách (gọi khi giữ _lock); trả về kernel để kill ngoài lock
+    def _detach(self, key, reason):
+        kernel = self._kernels.pop(key, None)
+        if kernel is not None:
+            self._record_eviction(key, reason)
+            logger.info(f"Tắt kernel '{key}' ({reason}).")
+        return kernel
+
+    # Giữ kernel của key trong suốt khối with (tạo mới nếu chưa có). Trả về (kernel, created).
+    # python/env: interpreter và môi trường (vd: venv của session); đổi interpreter thì kernel cũ bị thay.
+    # limits: giới hạn tài nguyên (resource_limits), cpu_seconds tính cho từng lần chạy.
+    @contextmanager
+    def acquire(self, key, python=None, env=None, limits=None):
+        python = python or self.python_executable
+        stale = []
+        with self._lock:
+            kernel = self._kernels.get(key)
+            if kernel is not None and not kernel.busy and (kernel.dead or kernel.python != python):
+                stale.append(self._detach(key, "crashed" if kernel.dead else "python_changed"))
+                kernel = None
+            created = kernel is None
+            if created:
+                while len(self._kernels) >= self.max_kernels:
+                    idle = [candidate for candidate in self._kernels.values() if not candidate.busy]
+                    if not idle:
+                        raise KernelCapacityError(f"Đã đủ {self.max_kernels} kernel và tất cả đang chạy.")
+                    stale.append(self._detach(min(idle, key=lambda candidate: candidate.last_used).key, "capacity"))
+                kernel = Kernel(key, python, env if env is not None else (self.env_factory() if self.env_factory else None),
+                                self.preload_modules, limits)
+                kernel.restarted_after = self._evicted.pop(key, None)
+                self._kernels[key] = kernel
+            if not kernel.lock.acquire(blocking=False):
+                raise KernelBusyError(f"Kernel '{key}' đang chạy một lệnh khác.")
+        for old in stale:
+            old.terminate(0)
+        try:
+            if created:
+                try:
+                    kernel.start()
+                    self.started += 1
+                except BaseException:
+                    with self._lock:
+                        if self._kernels.get(key) is kernel:
+                            del self._kernels[key]
+                    kernel.kill()
+                    raise
+            elif limits is not None:
+                kernel.limits = dict(limits)
+            yield kernel, created
+        finally:
+            kernel.last_used = time.time()
+            if kernel.retired:
+                kernel.kill() # Bị restart/xóa trong lúc chạy: thread đang giữ kernel dọn nốt
+            kernel.lock.release()
+            self._enforce_memory()
+
+    # Kernel sẽ bị tắt sau lần chạy này vì vượt RSS cho phép
+    def exceeds_memory(self, kernel):
+        return bool(self.max_kernel_rss_bytes) and (kernel.rss_bytes or 0) > self.max_kernel_rss_bytes
+
+    # Tắt kernel vượt RSS riêng, rồi kernel rảnh lâu nhất cho tới khi tổng RSS dưới mức cho phép
+    def _enforce_memory(self):
+        stale = []
+        with self._lock:
+            for kernel in list(self._kernels.values()):
+                if kernel.dead and not kernel.busy:
+                    stale.append(self._detach(kernel.key, "crashed"))
+                elif self.exceeds_memory(kernel) and not kernel.busy:
+                    stale.append(self._detach(kernel.key, "memory"))
+            if self.max_total_rss_bytes:
+                idle = sorted((kernel for kernel in self._kernels.values() if not kernel.busy), key=lambda kernel: kernel.last_used)
+                total = sum(kernel.rss_bytes or 0 for kernel in self._kernels.values())
+                while total > self.max_total_rss_bytes and idle:
+                    kernel = idle.pop(0)
+                    total -= kernel.rss_bytes or 0
+                    stale.append(self._detach(kernel.key, "memory"))
+        for kernel in stale:
+            kernel.terminate(0)
+
+    def _janitor_loop(self):
+        interval = max(1.0, min(self.idle_seconds / 4, 30.0))
+        while not self._stopped.wait(interval):
+            now = time.time()
+            stale = []
+            with self._lock:
+                for kernel in list(self._kernels.values()):
+                    if not kernel.busy and now - kernel.last_used > self.idle_seconds:
+                        stale.append(self._detach(kernel.key, "idle"))
+            for kernel in stale:
+                kernel.terminate(0)
+
+    # Khởi động lại kernel: tắt kernel hiện tại (kể cả đang chạy) và dựng kernel mới cùng cấu hình ngay
+    def restart(self, key):
+        with self._lock:
+            kernel = self._kernels.pop(key, None)
+        if kernel is None:
+            return None
+        kernel.terminate(self.interrupt_grace_seconds)
+        with self.acquire(key, kernel.python, kernel.env, kernel.limits) as (new_kernel, _created):
+            self._evicted.pop(key, None)
+            new_kernel.restarted_after = "restart"
+        return new_kernel.info()
+
+    def interrupt(self, key):
+        with self._lock:
+            kernel = self._kernels.get(key)
+        if kernel is None:
+            return False
+        kernel.interrupt()
+        return True
+
+    def remove(self, key):
+        with self._lock:
+            kernel = self._kernels.pop(key, None)
+        if kernel is None:
+            return False
+        kernel.terminate(self.interrupt_grace_seconds)
+        return True
+
+    def list(self):
+        with self._lock:
+            kernels = list(self._kernels.values())
+        return [kernel.info() for kernel in sorted(kernels, key=lambda kernel: kernel.last_used, reverse=True)]
+
+    def stats(self):
+        with self._lock:
+            kernels = list(self._kernels.values())
+        return {
+            "kernels": len(kernels),
+            "busy": sum(1 for kernel in kernels if kernel.busy),
+            "max_kernels": self.max_kernels,
+            "rss_bytes": sum(kernel.rss_bytes or 0 for kernel in kernels),
+            "started": self.started,
+            "evictions": dict(self.evictions),
+        }
+
+    def shutdown(self):
+        self._stopped.set()
+        with self._lock:
+            kernels, self._kernels = list(self._kernels.values()), {}
+        for kernel in kernels:
+            kernel.terminate(0)
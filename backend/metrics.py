@@ -0,0 +1,206 @@
+# backend/metrics.py
+# Bộ đếm/histogram trong bộ nhớ, xuất ra định dạng text của Prometheus cho /api/metrics.
+# Chi phí mỗi lần ghi: một bisect (ngoài lock) + vài phép cộng trong một critical section rất ngắn,
+# không cấp phát gì sau lần đầu gặp bộ label -> đủ rẻ để bật thường trực.
+# Giá trị lấy từ các thành phần có sẵn thống kê riêng (cache, logging...) đăng ký bằng register_collector,
+# chỉ được đọc lúc scrape.
+import bisect
+import threading
+
+# Giây: từ lời gọi nhanh nhất (cache, script nhỏ) tới lời gọi Gemini/pip chậm nhất
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+# Byte: 8 MiB .. 4 GiB
+MEMORY_BUCKETS = tuple(2 ** power for power in range(23, 33))
+# Số token mỗi lời gọi
+TOKEN_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {} # tuple(label values) -> số
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in sorted(values)]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {} # tuple(label values) -> [count từng bucket (không cộng dồn)..., +Inf, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value) # Ngoài lock
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        with self._lock:
+            snapshot = [(key, list(series)) for key, series in self._series.items()]
+        lines = []
+        for key, series in sorted(snapshot):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series[:-1]):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(float(series[-1]))}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def _register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    # collect() trả về list (name, kind, documentation, [(dict labels, giá trị)...]); gọi mỗi lần scrape
+    def register_collector(self, collect):
+        with self._lock:
+            self._collectors.append(collect)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = list(self._collectors)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        for collect in collectors:
+            for name, kind, documentation, samples in collect():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(labels.keys(), labels.values())} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+# --- HTTP ---
+http_requests_total = registry.counter(
+    "http_requests_total", "Số request HTTP theo route, method và mã trạng thái.", ("method", "route", "status"))
+http_request_duration_seconds = registry.histogram(
+    "http_request_duration_seconds", "Thời gian xử lý request HTTP (với SSE: tới khi stream kết thúc).", ("method", "route"))
+
+# --- Gemini ---
+gemini_calls_total = registry.counter(
+    "gemini_calls_total", "Số lời gọi Gemini theo model, chế độ và kết quả.", ("model", "mode", "outcome"))
+gemini_call_duration_seconds = registry.histogram(
+    "gemini_call_duration_seconds", "Tổng thời gian một lời gọi Gemini (kể cả retry).", ("model", "mode"))
+gemini_time_to_first_token_seconds = registry.histogram(
+    "gemini_time_to_first_token_seconds", "Thời gian tới chunk đầu tiên khi stream.", ("model",))
+gemini_tokens_total = registry.counter(
+    "gemini_tokens_total", "Tổng số token theo usage_metadata của phản hồi.", ("model", "kind"))
+gemini_tokens_per_call = registry.histogram(
+    "gemini_tokens_per_call", "Số token mỗi lời gọi theo usage_metadata.", ("model", "kind"), buckets=TOKEN_BUCKETS)
+
+# --- Thực thi code ---
+execute_runs_total = registry.counter(
+    "execute_runs_total", "Số lần thực thi code theo loại file và kết quả.", ("file_type", "outcome"))
+execute_wall_seconds = registry.histogram(
+    "execute_wall_seconds", "Thời gian thực (wall) của tiến trình thực thi.", ("file_type",))
+execute_cpu_seconds = registry.histogram(
+    "execute_cpu_seconds", "Thời gian CPU (user + sys) của tiến trình thực thi và các tiến trình con.", ("file_type",))
+execute_peak_rss_bytes = registry.histogram(
+    "execute_peak_rss_bytes", "RSS cao nhất của tiến trình thực thi (chỉ ghi khi vượt RSS cao nhất của backend, xem process_runner).", ("file_type",), buckets=MEMORY_BUCKETS)
+execute_limit_exceeded_total = registry.counter(
+    "execute_limit_exceeded_total", "Số lần thực thi dừng do vượt giới hạn tài nguyên (rlimit).", ("file_type", "limit"))
+execute_written_bytes = registry.histogram(
+    "execute_written_bytes", "Số byte tiến trình thực thi đã ghi (mọi lệnh write, theo /proc/<pid>/io).", ("file_type",), buckets=MEMORY_BUCKETS)
+code_validations_total = registry.counter(
+    "code_validations_total", "Số lần kiểm tra code trước khi thực thi theo ngôn ngữ và kết quả (ok, syntax_error, risky).", ("language", "outcome"))
+
+# --- Ngân sách prompt ---
+prompt_compactions_total = registry.counter(
+    "prompt_compactions_total", "Số prompt có dữ liệu người dùng bị rút gọn để vừa ngân sách token.", ("endpoint",))
+prompt_tokens_elided_total = registry.counter(
+    "prompt_tokens_elided_total", "Số token (ước lượng) đã lược khỏi prompt.", ("endpoint",))
+
+# --- Tự sửa lỗi ---
+auto_fix_runs_total = registry.counter(
+    "auto_fix_runs_total", "Số lần chạy /api/auto_fix theo lý do kết thúc.", ("reason",))
+auto_fix_duration_seconds = registry.histogram(
+    "auto_fix_duration_seconds", "Tổng thời gian một lần auto-fix (tới khi chạy được hoặc hết ngân sách).")
+auto_fix_iterations = registry.histogram(
+    "auto_fix_iterations", "Số lần chạy code trong một lần auto-fix.", buckets=(1, 2, 3, 4, 5, 7, 10))
+
+
+# Ghi token từ usage_metadata của phản hồi Gemini (bỏ qua nếu phản hồi không có)
+def observe_token_usage(model_name, usage_metadata):
+    if usage_metadata is None:
+        return
+    for kind, attribute in (("prompt", "prompt_token_count"), ("response", "candidates_token_count")):
+        count = getattr(usage_metadata, attribute, None)
+        if count:
+            gemini_tokens_total.inc(model_name, kind, amount=count)
+            gemini_tokens_per_call.observe(count, model_name, kind)
+
+
+def observe_execution(file_type, outcome, wall_seconds=None, cpu_seconds=None, peak_rss_bytes=None):
+    execute_runs_total.inc(file_type, outcome)
+    if wall_seconds is not None:
+        execute_wall_seconds.observe(wall_seconds, file_type)
+    if cpu_seconds is not None:
+        execute_cpu_seconds.observe(cpu_seconds, file_type)
+    if peak_rss_bytes is not None:
+        execute_peak_rss_bytes.observe(peak_rss_bytes, file_type)
+
+
+def render():
+    return registry.render()
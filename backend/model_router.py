@@ -0,0 +1,152 @@
+# backend/model_router.py
+# Định tuyến lời gọi Gemini giữa nhiều model theo ngân sách độ trễ của từng endpoint:
+#   - hedge: nếu model chính chưa trả lời sau "hedge delay", gửi thêm request tới model dự phòng,
+#            lấy kết quả nào về trước
+#   - fallback: model lỗi hoặc bị chặn -> chuyển ngay sang model kế tiếp
+# Hedge delay lấy từ thống kê độ trễ thực tế (p95) của từng model thay vì một hằng số.
+import contextvars
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger(__name__)
+
+
+class ModelLatencyStats:
+    def __init__(self, window=200):
+        self.window = max(10, int(window))
+        self._samples = {} # model_name -> deque[giây] (chỉ các lần thành công)
+        self._counts = {} # model_name -> {"success", "failure"}
+        self._lock = threading.Lock()
+
+    def record(self, model_name, seconds, success):
+        with self._lock:
+            counts = self._counts.setdefault(model_name, {"success": 0, "failure": 0})
+            counts["success" if success else "failure"] += 1
+            if success:
+                self._samples.setdefault(model_name, deque(maxlen=self.window)).append(seconds)
+
+    # Trả về phân vị q (0..1) độ trễ của model, None nếu chưa đủ min_samples mẫu
+    def percentile(self, model_name, q, min_samples=1):
+        with self._lock:
+            samples = sorted(self._samples.get(model_name, ()))
+        if len(samples) < max(1, min_samples):
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+    def snapshot(self):
+        with self._lock:
+            models = set(self._counts)
+            counts = {name: dict(self._counts[name]) for name in models}
+        result = {}
+        for name in sorted(models):
+            result[name] = {
+                **counts[name],
+                "p50_seconds": self._rounded(self.percentile(name, 0.50)),
+                "p95_seconds": self._rounded(self.percentile(name, 0.95)),
+                "p99_seconds": self._rounded(self.percentile(name, 0.99)),
+            }
+        return result
+
+    @staticmethod
+    def _rounded(value):
+        return round(value, 3) if value is not None else None
+
+
+class ModelRouter:
+    def __init__(self, default_hedge_delay=2.0, min_hedge_delay=0.3, min_samples=20, max_workers=32):
+        self.stats = ModelLatencyStats()
+        self.default_hedge_delay = float(default_hedge_delay)
+        self.min_hedge_delay = float(min_hedge_delay)
+        self.min_samples = int(min_samples)
+        self._executor = ThreadPoolExecutor(max_workers=max(2, int(max_workers)), thread_name_prefix="gemini-router")
+        self._lock = threading.Lock()
+        self.hedges_sent = 0
+        self.secondary_wins = 0 # Số lần kết quả cuối cùng đến từ model dự phòng (hedge hoặc fallback)
+        self.fallbacks = 0
+
+    # Chờ tới p95 độ trễ của model rồi mới hedge (đủ mẫu), không quá nửa ngân sách còn lại
+    def hedge_delay(self, model_name, budget):
+        p95 = self.stats.percentile(model_name, 0.95, self.min_samples)
+        delay = p95 if p95 is not None else self.default_hedge_delay
+        return max(self.min_hedge_delay, min(delay, budget / 2))
+
+    # Gọi fn() và ghi lại độ trễ cho model_name; is_success(result) quyết định thành công hay lỗi
+    def timed_call(self, model_name, fn, is_success):
+        start_time = time.monotonic()
+        result = fn()
+        self.stats.record(model_name, time.monotonic() - start_time, is_success(result))
+        return result
+
+    # models: [model chính, model dự phòng...]; call_fn(model_name) -> result (không raise).
+    # mode 'fallback': lần lượt từng model khi lỗi; 'hedge': thêm hedge theo thời gian.
+    # Trả về (result, model_name thắng) hoặc (result lỗi đầu tiên / None, None) nếu tất cả thất bại/hết ngân sách.
+    def call(self, models, budget, call_fn, is_success, mode='hedge'):
+        start_time = time.monotonic()
+        deadline = start_time + budget
+        remaining_models = list(models)
+        pending = {}
+        first_error = None
+        next_hedge_at = None
+
+        def launch():
+            nonlocal next_hedge_at
+            model_name = remaining_models.pop(0)
+            # Chạy trong bản sao context để log của lời gọi mang request_id của request gốc
+            future = self._executor.submit(contextvars.copy_context().run, self.timed_call, model_name, lambda: call_fn(model_name), is_success)
+            pending[future] = model_name
+            if mode == 'hedge' and remaining_models:
+                next_hedge_at = time.monotonic() + self.hedge_delay(model_name, deadline - time.monotonic())
+            else:
+                next_hedge_at = None
+            return model_name
+
+        primary = launch()
+        while pending:
+            now = time.monotonic()
+            wake_at = min(deadline, next_hedge_at) if next_hedge_at else deadline
+            done, _ = wait(list(pending), timeout=max(0.0, wake_at - now), return_when=FIRST_COMPLETED)
+            for future in done:
+                model_name = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = None
+                    logger.error(f"Lời gọi model {model_name} gặp ngoại lệ: {e}")
+                if result is not None and is_success(result):
+                    if model_name != primary:
+                        with self._lock:
+                            self.secondary_wins += 1
+                        logger.info(f"Dùng kết quả từ model dự phòng {model_name} (model chính: {primary}).")
+                    return result, model_name
+                if first_error is None:
+                    first_error = result
+                if remaining_models and not pending:
+                    # Model lỗi/bị chặn và không còn request nào đang chạy: chuyển ngay sang model kế tiếp
+                    self.note_fallback()
+                    logger.warning(f"Model {model_name} thất bại, chuyển sang {remaining_models[0]}.")
+                    launch()
+            if done:
+                continue
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            if next_hedge_at and now >= next_hedge_at and remaining_models:
+                with self._lock:
+                    self.hedges_sent += 1
+                hedge_model = launch()
+                logger.info(f"Model {primary} chưa trả lời sau {now - start_time:.2f}s, gửi hedge tới {hedge_model}.")
+        # Các request còn chạy tiếp ở nền; kết quả của chúng chỉ dùng để cập nhật thống kê độ trễ
+        return first_error, None
+
+    # Đếm một lần chuyển sang model dự phòng do lỗi (dùng cả cho đường streaming)
+    def note_fallback(self):
+        with self._lock:
+            self.fallbacks += 1
+
+    def snapshot(self):
+        with self._lock:
+            counters = {"hedges_sent": self.hedges_sent, "secondary_wins": self.secondary_wins, "fallbacks": self.fallbacks}
+        return {**counters, "default_hedge_delay": self.default_hedge_delay, "models": self.stats.snapshot()}
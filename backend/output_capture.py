@@ -0,0 +1,242 @@
+# backend/output_capture.py
+# Gom stdout/stderr của lần thực thi với bộ nhớ có giới hạn:
+#   - giữ head_bytes đầu và tail_bytes cuối của mỗi stream trong bộ nhớ (đủ để hiển thị tóm tắt)
+#   - khi output vượt head_bytes, toàn bộ stream (từ byte 0) được ghi ra file tạm, tối đa spill_max_bytes
+#   - đếm tổng byte/dòng kể cả phần không còn giữ
+# Output đã spill được giữ trong OutputStore một thời gian để client lấy theo khoảng byte hoặc dòng.
+import atexit
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+# Cứ mỗi LINE_INDEX_STEP dòng ghi lại offset byte bắt đầu dòng, để đọc theo dòng không phải quét từ đầu file
+LINE_INDEX_STEP = 1000
+
+
+class StreamCapture:
+    def __init__(self, stream_name, head_bytes, tail_bytes, spill_max_bytes, spill_dir=None):
+        self.stream_name = stream_name
+        self.head_bytes = max(0, int(head_bytes))
+        self.tail_bytes = max(0, int(tail_bytes))
+        self.spill_max_bytes = max(0, int(spill_max_bytes))
+        self.spill_dir = spill_dir
+        self.total_bytes = 0
+        self.newlines = 0
+        self.ends_with_newline = True
+        self.spill_path = None
+        self.spilled_bytes = 0
+        self.line_offsets = [] # line_offsets[k] = offset byte bắt đầu dòng (k + 1) * LINE_INDEX_STEP (đếm từ 0)
+        self._head = bytearray()
+        self._tail = deque()
+        self._tail_size = 0
+        self._spill_file = None
+
+    @property
+    def truncated(self):
+        return self.total_bytes > self.head_bytes
+
+    @property
+    def total_lines(self):
+        return self.newlines + (0 if self.ends_with_newline else 1)
+
+    def feed(self, text):
+        data = text.encode('utf-8')
+        if not data:
+            return
+        offset = self.total_bytes
+        if len(self._head) < self.head_bytes:
+            self._head += data[:self.head_bytes - len(self._head)]
+        if offset + len(data) > self.head_bytes:
+            self._spill(data, offset)
+            self._push_tail(data[max(0, self.head_bytes - offset):]) # Tail không chồng lên head
+        self._index_lines(data, offset)
+        self.total_bytes += len(data)
+        self.ends_with_newline = data.endswith(b'\n')
+
+    def _push_tail(self, data):
+        if not self.tail_bytes:
+            return
+        self._tail.append(data)
+        self._tail_size += len(data)
+        while self._tail_size - len(self._tail[0]) >= self.tail_bytes:
+            self._tail_size -= len(self._tail.popleft())
+
+    def _spill(self, data, offset):
+        if self._spill_file is None:
+            if self.spill_path is not None or not self.spill_max_bytes:
+                return # Đã đóng, hoặc tắt spill
+            fd, self.spill_path = tempfile.mkstemp(prefix=f'exec-{self.stream_name}-', suffix='.log', dir=self.spill_dir)
+            self._spill_file = os.fdopen(fd, 'wb')
+            # File chứa toàn bộ stream từ byte 0: head đã giữ + phần còn lại của chunk hiện tại
+            data = bytes(self._head) + data[self.head_bytes - offset:] if offset <= self.head_bytes else data
+        room = self.spill_max_bytes - self.spilled_bytes
+        if room <= 0:
+            return
+        chunk = data[:room]
+        self._spill_file.write(chunk)
+        self.spilled_bytes += len(chunk)
+
+    def _index_lines(self, data, offset):
+        newlines = data.count(b'\n')
+        next_mark = (self.newlines // LINE_INDEX_STEP + 1) * LINE_INDEX_STEP
+        if self.newlines + newlines >= next_mark:
+            line, position = self.newlines, -1
+            while True:
+                position = data.find(b'\n', position + 1)
+                if position < 0:
+                    break
+                line += 1
+                if line % LINE_INDEX_STEP == 0:
+                    self.line_offsets.append(offset + position + 1)
+        self.newlines += newlines
+
+    def close(self):
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+
+    def delete(self):
+        self.close()
+        if self.spill_path and os.path.exists(self.spill_path):
+            os.remove(self.spill_path)
+
+    def _tail_data(self):
+        return b"".join(self._tail)[-self.tail_bytes:] if self.tail_bytes else b""
+
+    # Phần cuối của output sau head (rỗng nếu không bị lược)
+    def tail_text(self):
+        return self._tail_data().decode('utf-8', errors='ignore')
+
+    # Text trả về trong response: toàn bộ nếu không vượt head, ngược lại head + dòng đánh dấu + tail
+    def summary_text(self):
+        head = bytes(self._head).decode('utf-8', errors='ignore')
+        if not self.truncated:
+            return head
+        omitted = self.total_bytes - len(self._head) - len(self._tail_data())
+        marker = f"\n... [đã lược bỏ {omitted} byte, tổng {self.total_bytes} byte / {self.total_lines} dòng] ...\n"
+        return head + marker + self.tail_text()
+
+    def info(self):
+        return {
+            "total_bytes": self.total_bytes,
+            "total_lines": self.total_lines,
+            "truncated": self.truncated,
+            "spilled_bytes": self.spilled_bytes, # Số byte lấy lại được qua endpoint đọc theo khoảng
+            "spill_truncated": self.total_bytes > self.spilled_bytes and self.truncated,
+        }
+
+    # Đọc tối đa length byte từ offset (trong head nếu chưa spill, ngược lại trong file spill)
+    def read_bytes(self, offset, length):
+        if self.spill_path is None:
+            return bytes(self._head[offset:offset + length])
+        with open(self.spill_path, 'rb') as spill_file:
+            spill_file.seek(offset)
+            return spill_file.read(min(length, max(0, self.spilled_bytes - offset)))
+
+    # Đọc tối đa count dòng bắt đầu từ dòng start (đếm từ 0), không quá max_bytes
+    def read_lines(self, start, count, max_bytes):
+        if self.spill_path is None:
+            lines = bytes(self._head).splitlines(keepends=True)[start:start + count]
+            return b"".join(lines)[:max_bytes]
+        index = min(start // LINE_INDEX_STEP, len(self.line_offsets))
+        offset, line = (self.line_offsets[index - 1], index * LINE_INDEX_STEP) if index else (0, 0)
+        result = bytearray()
+        with open(self.spill_path, 'rb') as spill_file:
+            spill_file.seek(offset)
+            for raw_line in spill_file:
+                if line >= start:
+                    if len(result) + len(raw_line) > max_bytes:
+                        result += raw_line[:max_bytes - len(result)]
+                        break
+                    result += raw_line
+                    if line + 1 >= start + count:
+                        break
+                line += 1
+        return bytes(result)
+
+
+class ExecutionOutput:
+    def __init__(self, head_bytes, tail_bytes, spill_max_bytes, spill_dir=None):
+        self.id = uuid.uuid4().hex
+        self.created_at = time.time()
+        self.finished = False
+        self.streams = {
+            name: StreamCapture(name, head_bytes, tail_bytes, spill_max_bytes, spill_dir)
+            for name in ("stdout", "stderr")
+        }
+
+    def feed(self, stream_name, text):
+        self.streams[stream_name].feed(text)
+
+    def text(self, stream_name):
+        return self.streams[stream_name].summary_text()
+
+    @property
+    def spilled(self):
+        return any(stream.spill_path for stream in self.streams.values())
+
+    # Thông tin kèm response; id chỉ có khi output được giữ lại để đọc theo khoảng
+    def info(self):
+        return {"id": self.id if self.spilled else None, **{name: stream.info() for name, stream in self.streams.items()}}
+
+    def close(self):
+        for stream in self.streams.values():
+            stream.close()
+
+    def delete(self):
+        for stream in self.streams.values():
+            stream.delete()
+
+
+class OutputStore:
+    def __init__(self, head_bytes=65536, tail_bytes=65536, spill_max_bytes=512 * 1024 * 1024,
+                 retention_seconds=3600, max_entries=64, spill_dir=None):
+        self.head_bytes = head_bytes
+        self.tail_bytes = tail_bytes
+        self.spill_max_bytes = spill_max_bytes
+        self.retention_seconds = float(retention_seconds)
+        self.max_entries = max(1, int(max_entries))
+        self.spill_dir = spill_dir or None
+        self._entries = OrderedDict() # id -> ExecutionOutput đã spill
+        self._lock = threading.Lock()
+        atexit.register(self.clear)
+
+    def create(self):
+        return ExecutionOutput(self.head_bytes, self.tail_bytes, self.spill_max_bytes, self.spill_dir)
+
+    # Gọi khi tiến trình đã xong: output có spill được giữ lại, không thì bỏ ngay
+    def finish(self, output):
+        if output.finished:
+            return
+        output.finished = True
+        output.close()
+        if not output.spilled:
+            return
+        expired = []
+        with self._lock:
+            self._entries[output.id] = output
+            cutoff = time.time() - self.retention_seconds
+            while self._entries:
+                oldest = next(iter(self._entries.values()))
+                if len(self._entries) <= self.max_entries and oldest.created_at >= cutoff:
+                    break
+                expired.append(self._entries.popitem(last=False)[1])
+        for old_output in expired:
+            old_output.delete()
+
+    def get(self, output_id):
+        with self._lock:
+            output = self._entries.get(output_id)
+        if output and output.created_at < time.time() - self.retention_seconds:
+            return None
+        return output
+
+    def clear(self):
+        with self._lock:
+            outputs = list(self._entries.values())
+            self._entries.clear()
+        for output in outputs:
+            output.delete()
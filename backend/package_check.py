@@ -0,0 +1,96 @@
+# backend/package_check.py
+# Kiểm tra yêu cầu cài package (PEP 508: tên, extras, version specifier, marker) với metadata của các
+# distribution đã cài trong interpreter hiện tại (importlib.metadata), để bỏ qua pip khi đã thỏa mãn.
+# Cần `packaging` (bản cài riêng hoặc bản vendored trong pip); không có thì mọi yêu cầu coi như chưa biết -> chạy pip.
+import importlib.metadata
+import re
+
+try:
+    from packaging.requirements import Requirement, InvalidRequirement
+    from packaging.utils import canonicalize_name
+except ImportError:
+    try:
+        from pip._vendor.packaging.requirements import Requirement, InvalidRequirement
+        from pip._vendor.packaging.utils import canonicalize_name
+    except ImportError:
+        Requirement = None
+
+# Một yêu cầu cài đặt hợp lệ: tên + extras + specifier, không khoảng trắng, không bắt đầu bằng '-' (tùy chọn pip)
+_REQUIREMENT_RE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._\-]*(\[[A-Za-z0-9._,\-]+\])?([<>=!~]=?[A-Za-z0-9.*+!_\-]+(,[<>=!~]=?[A-Za-z0-9.*+!_\-]+)*)?$")
+
+
+def is_valid_requirement(spec):
+    return bool(_REQUIREMENT_RE.match(spec))
+
+
+# Tách chuỗi "a b==1 c[x]>=2" (cách nhau bởi khoảng trắng) thành danh sách yêu cầu
+def split_requirements(text):
+    return [part for part in re.split(r"\s+", text.strip()) if part]
+
+
+# path: danh sách thư mục site-packages cần tìm (vd: venv của session); None = sys.path của backend
+def _distribution(name, path=None):
+    if path is None:
+        try:
+            return importlib.metadata.distribution(name)
+        except importlib.metadata.PackageNotFoundError:
+            return None
+    return next(iter(importlib.metadata.distributions(name=name, path=list(path))), None)
+
+
+def _installed_version(name, path=None):
+    distribution = _distribution(name, path)
+    return distribution.version if distribution else None
+
+
+# Trả về (satisfied, installed_version, reason) cho một yêu cầu.
+# satisfied = None nghĩa là không xác định được (không có packaging, yêu cầu dạng URL...) -> để pip quyết định.
+def check_requirement(spec, path=None, _seen=None):
+    if Requirement is None:
+        return None, None, "thiếu thư viện packaging"
+    try:
+        requirement = Requirement(spec)
+    except InvalidRequirement as e:
+        return None, None, f"không phân tích được ({e})"
+    if requirement.url:
+        return None, None, "yêu cầu dạng URL"
+    if requirement.marker is not None and not requirement.marker.evaluate():
+        return True, None, "marker không áp dụng cho môi trường này"
+
+    installed_version = _installed_version(requirement.name, path)
+    if installed_version is None:
+        return False, None, "chưa cài"
+    if requirement.specifier and not requirement.specifier.contains(installed_version, prereleases=True):
+        return False, installed_version, f"phiên bản {installed_version} không thỏa {requirement.specifier}"
+
+    # Extras: các dependency khai báo cho extra đó cũng phải đã thỏa
+    seen = _seen if _seen is not None else set()
+    seen.add(canonicalize_name(requirement.name))
+    for extra in requirement.extras:
+        for dependency_spec in _distribution(requirement.name, path).requires or []:
+            try:
+                dependency = Requirement(dependency_spec)
+            except InvalidRequirement:
+                continue
+            if dependency.marker is None or not dependency.marker.evaluate({"extra": extra}):
+                continue
+            if canonicalize_name(dependency.name) in seen:
+                continue
+            dependency.marker = None
+            satisfied, _version, reason = check_requirement(str(dependency), path, seen)
+            if not satisfied:
+                return satisfied, installed_version, f"extra [{extra}] thiếu {dependency.name} ({reason})"
+    return True, installed_version, None
+
+
+# Chia danh sách yêu cầu thành (đã thỏa, cần cài); mỗi phần tử là dict mô tả để trả về cho client
+def partition_requirements(specs, path=None):
+    satisfied, pending = [], []
+    for spec in specs:
+        ok, installed_version, reason = check_requirement(spec, path)
+        entry = {"requirement": spec, "installed_version": installed_version}
+        if ok:
+            satisfied.append(entry)
+        else:
+            pending.append({**entry, "reason": reason})
+    return satisfied, pending
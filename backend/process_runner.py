@@ -0,0 +1,274 @@
+# backend/process_runner.py
+# Chạy tiến trình con bằng Popen và đọc stdout/stderr không chặn (mỗi pipe một thread),
+# để có thể stream output ngay khi được sinh ra thay vì chờ tiến trình kết thúc.
+import codecs
+import io
+import os
+import queue
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from resource_limits import read_process_io, wrap_command, apply_to_pid
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+READ_CHUNK_SIZE = 65536
+# Sau khi kill (timeout/hủy), chờ tối đa chừng này để đọc nốt output và các pipe đóng
+KILL_GRACE_SECONDS = 5
+
+
+class StreamingProcess:
+    def __init__(self, command, env=None, timeout=60, cwd=None, stdin_data=None, pass_fds=(), limits=None):
+        self.command = command
+        self.env = env
+        self.pass_fds = tuple(pass_fds) # fd giữ nguyên số trong tiến trình con (vd: memfd chứa script)
+        self.timeout = timeout
+        self.cwd = cwd
+        self.stdin_data = stdin_data # bytes gửi vào stdin rồi đóng (None = không có stdin)
+        self.limits = limits or {} # Giới hạn tài nguyên, xem resource_limits.LIMITS (chỉ POSIX)
+        self.process = None
+        self.return_code = None
+        self.timed_out = False
+        self.started_at = None
+        self.duration = None
+        self.cpu_seconds = None # user + sys của tiến trình và các tiến trình con đã được reap (chỉ POSIX)
+        self.user_cpu_seconds = None
+        self.system_cpu_seconds = None
+        self.io = None # Byte đọc/ghi theo /proc/<pid>/io (chỉ Linux)
+        self.peak_rss_bytes = None
+        self._rss_floor_bytes = None
+        self._events = queue.Queue()
+        self._readers = []
+        self._process_group = None # pgid riêng của tiến trình (đã tách session) để kill cả cây kể cả khi tiến trình chính đã thoát
+
+    # Khởi chạy tiến trình; có thể ném FileNotFoundError nếu không tìm thấy interpreter.
+    # Nếu truyền process (Popen đã spawn sẵn, vd: từ warm pool) thì chỉ gắn reader vào nó.
+    def start(self, process=None):
+        if resource is not None:
+            self._rss_floor_bytes = _maxrss_bytes(resource.getrusage(resource.RUSAGE_SELF))
+        if process is not None:
+            # Tiến trình đang chờ code ở stdin nên đặt giới hạn lúc này vẫn có hiệu lực trước khi code chạy
+            if self.limits and not apply_to_pid(process.pid, self.limits):
+                raise OSError(f"Không đặt được giới hạn tài nguyên cho tiến trình {process.pid}")
+            self.started_at = time.monotonic()
+            self.process = process
+            if sys.platform != "win32":
+                try:
+                    self._process_group = process.pid if os.getpgid(process.pid) == process.pid else None
+                except ProcessLookupError:
+                    pass
+        else:
+            self._spawn()
+        if self.stdin_data is not None:
+            threading.Thread(target=self._write_stdin, daemon=True).start()
+        for stream_name, pipe in (("stdout", self.process.stdout), ("stderr", self.process.stderr)):
+            reader = threading.Thread(target=self._read_pipe, args=(stream_name, pipe), daemon=True)
+            reader.start()
+            self._readers.append(reader)
+        return self
+
+    def _spawn(self):
+        popen_kwargs = {}
+        if sys.platform == "win32":
+            popen_kwargs["creationflags"] = subprocess.CREATE_NEW_PROCESS_GROUP
+        elif self.command and self.command[0] != 'sudo':
+            # Tách process group riêng để khi timeout có thể kill cả cây tiến trình con.
+            # Không áp dụng cho sudo vì sudo cần terminal của backend để hỏi mật khẩu.
+            popen_kwargs["start_new_session"] = True
+        command = self.command
+        if self.limits and sys.platform != "win32":
+            command, preexec_fn = wrap_command(self.command, self.limits)
+            if preexec_fn:
+                popen_kwargs["preexec_fn"] = preexec_fn
+
+        # sudo giữ stdin của backend (nếu cần hỏi mật khẩu), còn script thường không được đọc stdin
+        if self.stdin_data is not None:
+            stdin = subprocess.PIPE
+        else:
+            stdin = None if self.command and self.command[0] == 'sudo' else subprocess.DEVNULL
+        self.started_at = time.monotonic()
+        self.process = subprocess.Popen(
+            command, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            env=self.env, cwd=self.cwd, pass_fds=self.pass_fds, **popen_kwargs
+        )
+        if popen_kwargs.get("start_new_session"):
+            self._process_group = self.process.pid
+
+    # Ghi stdin trong thread riêng để không bị kẹt khi tiến trình chưa đọc mà pipe output đã đầy
+    def _write_stdin(self):
+        try:
+            self.process.stdin.write(self.stdin_data)
+        except (BrokenPipeError, OSError):
+            pass # Tiến trình đã thoát trước khi đọc hết stdin
+        finally:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+
+    def _read_pipe(self, stream_name, pipe):
+        # Giải mã UTF-8 theo từng chunk và chuẩn hóa \r\n như text mode của subprocess.run
+        decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder('utf-8')(errors='replace'), translate=True)
+        try:
+            while True:
+                data = pipe.read1(READ_CHUNK_SIZE)
+                if not data:
+                    break
+                text = decoder.decode(data)
+                if text:
+                    self._events.put((stream_name, text, time.monotonic() - self.started_at))
+            tail = decoder.decode(b'', final=True)
+            if tail:
+                self._events.put((stream_name, tail, time.monotonic() - self.started_at))
+        finally:
+            pipe.close()
+            self._events.put((stream_name, None, None)) # Đánh dấu pipe đã đóng
+
+    # Kill tiến trình và toàn bộ tiến trình con của nó. Với process group riêng luôn kill cả group, kể cả khi
+    # tiến trình chính đã thoát: tiến trình con chạy nền (`cmd &`, disown) vẫn giữ pipe output và tiếp tục chạy.
+    def kill(self):
+        if not self.process:
+            return
+        if self._process_group is not None:
+            try:
+                os.killpg(self._process_group, signal.SIGKILL)
+                return
+            except ProcessLookupError: # Cả group đã thoát
+                return
+            except (PermissionError, OSError):
+                pass
+        if self.process.poll() is not None:
+            return
+        try:
+            if sys.platform == "win32":
+                subprocess.run(['taskkill', '/F', '/T', '/PID', str(self.process.pid)], capture_output=True)
+            else:
+                self.process.kill()
+        except (ProcessLookupError, PermissionError, OSError):
+            self.process.kill()
+
+    # Yield (stream_name, text, elapsed_seconds) theo đúng thứ tự output đến.
+    # Kết thúc khi cả hai pipe đóng và tiến trình đã thoát (hoặc bị kill do timeout).
+    # Nếu consumer dừng giữa chừng (client ngắt kết nối SSE), tiến trình bị kill.
+    def iter_output(self):
+        open_pipes = 2
+        deadline = self.started_at + self.timeout if self.timeout else None
+        killed = False
+        try:
+            while open_pipes:
+                wait = None if deadline is None else max(deadline - time.monotonic(), 0)
+                try:
+                    stream_name, text, elapsed = self._events.get(timeout=wait)
+                except queue.Empty:
+                    if killed:
+                        # Pipe vẫn mở sau khi kill (tiến trình con đã tự tách khỏi process group): không chờ thêm
+                        break
+                    self.timed_out = True
+                    self.kill()
+                    killed = True
+                    deadline = time.monotonic() + KILL_GRACE_SECONDS # Đọc nốt output trong pipe sau khi kill
+                    continue
+                if text is None:
+                    open_pipes -= 1
+                    continue
+                yield stream_name, text, elapsed
+        except GeneratorExit:
+            self.kill()
+            raise
+
+        remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+        try:
+            self.return_code = self._wait(remaining)
+        except subprocess.TimeoutExpired:
+            self.timed_out = True
+            self.kill()
+            self.return_code = self._wait(None)
+        self.duration = time.monotonic() - self.started_at
+
+    # Chờ tiến trình thoát. Trên POSIX reap bằng os.wait4 để lấy rusage riêng của tiến trình này
+    # (getrusage(RUSAGE_CHILDREN) cộng dồn mọi tiến trình con nên sai khi nhiều lần chạy song song).
+    # Trước khi reap, waitid(WNOWAIT) báo tiến trình đã thoát để còn đọc được /proc/<pid>/io của nó.
+    def _wait(self, timeout):
+        if not hasattr(os, 'wait4') or self.process.returncode is not None:
+            return self.process.wait(timeout=timeout)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = 0.0005
+        while True:
+            try:
+                exited = True
+                if _HAS_WAITID:
+                    exited = os.waitid(os.P_PID, self.process.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None
+                    if exited:
+                        self.io = read_process_io(self.process.pid)
+                pid, status, rusage = os.wait4(self.process.pid, os.WNOHANG) if exited else (0, None, None)
+            except ChildProcessError: # Popen.poll() (vd: trong kill) đã reap trước
+                return self.process.wait(timeout=timeout)
+            if pid:
+                self.process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+                self.user_cpu_seconds = rusage.ru_utime
+                self.system_cpu_seconds = rusage.ru_stime
+                self.cpu_seconds = rusage.ru_utime + rusage.ru_stime
+                # Trên Linux ru_maxrss của tiến trình con không nhỏ hơn RSS cao nhất của backend lúc fork/exec
+                # (kernel giữ hiwater của mm cũ). Không vượt mức đó thì không biết RSS thật -> để None.
+                peak_rss_bytes = _maxrss_bytes(rusage)
+                if self._rss_floor_bytes is None or peak_rss_bytes > self._rss_floor_bytes:
+                    self.peak_rss_bytes = peak_rss_bytes
+                return self.process.returncode
+            if deadline is not None and time.monotonic() >= deadline:
+                raise subprocess.TimeoutExpired(self.command, timeout)
+            # Pipe đã đóng nên tiến trình thường thoát ngay; tăng dần khoảng chờ cho trường hợp hiếm còn chạy
+            time.sleep(delay if deadline is None else min(delay, max(deadline - time.monotonic(), 0)))
+            delay = min(delay * 2, 0.05)
+
+    # Tài nguyên đã dùng của lần chạy (None với số liệu không đo được trên nền tảng này)
+    def usage(self):
+        io = self.io or {}
+        return {
+            "wall_seconds": None if self.duration is None else round(self.duration, 4),
+            "user_cpu_seconds": self.user_cpu_seconds,
+            "system_cpu_seconds": self.system_cpu_seconds,
+            "peak_rss_bytes": self.peak_rss_bytes,
+            "written_bytes": io.get("written_bytes"),
+            "disk_write_bytes": io.get("disk_write_bytes"),
+            "read_bytes": io.get("read_bytes"),
+        }
+
+
+_HAS_WAITID = hasattr(os, 'waitid') and hasattr(os, 'WNOWAIT')
+
+
+# ru_maxrss: KiB trên Linux, byte trên macOS
+def _maxrss_bytes(rusage):
+    return rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024
+
+
+# Chạy lệnh và gom toàn bộ output (chế độ không streaming).
+# on_start(runner) được gọi ngay sau khi tiến trình khởi chạy (vd: để job queue có thể kill khi hủy).
+# on_output(stream_name, text): nhận output thay vì gom vào bộ nhớ (khi đó stdout/stderr trả về rỗng).
+# limits: giới hạn tài nguyên cho tiến trình (xem resource_limits.LIMITS)
+def run_process(command, env=None, timeout=60, cwd=None, on_start=None, stdin_data=None, process=None, on_output=None, pass_fds=(), limits=None):
+    runner = StreamingProcess(command, env=env, timeout=timeout, cwd=cwd, stdin_data=stdin_data, pass_fds=pass_fds, limits=limits).start(process=process)
+    if on_start:
+        on_start(runner)
+    stdout_parts, stderr_parts = [], []
+    for stream_name, text, _elapsed in runner.iter_output():
+        if on_output:
+            on_output(stream_name, text)
+        else:
+            (stdout_parts if stream_name == "stdout" else stderr_parts).append(text)
+    return {
+        "stdout": "".join(stdout_parts),
+        "stderr": "".join(stderr_parts),
+        "return_code": runner.return_code,
+        "timed_out": runner.timed_out,
+        "duration": runner.duration,
+        "cpu_seconds": runner.cpu_seconds,
+        "peak_rss_bytes": runner.peak_rss_bytes,
+        "usage": runner.usage(),
+    }
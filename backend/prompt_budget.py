@@ -0,0 +1,265 @@
+# backend/prompt_budget.py
+# Giữ phần stdout/stderr/code đưa vào prompt debug/explain trong ngân sách token:
+#   - ước lượng token tại chỗ (không gọi API count_tokens)
+#   - gộp các dòng lặp lại liên tiếp (kể cả dòng chỉ khác nhau ở con số, vd: log tiến độ)
+#   - rút gọn traceback dài: giữ các frame đầu/cuối, gộp frame lặp (đệ quy)
+#   - luôn giữ exception cuối cùng (từ dòng "Traceback" cuối tới hết)
+#   - vẫn vượt ngân sách thì giữ head + tail, phần giữa thay bằng một dòng đánh dấu
+# Mỗi lần rút gọn trả về báo cáo (token trước/sau, số dòng bị lược/gộp) để đưa vào response và metrics.
+import math
+import re
+
+# Gemini: trung bình ~4 ký tự/token với văn bản tiếng Anh; code/log nhiều ký hiệu và tiếng Việt (nhiều byte/ký tự)
+# tốn token hơn -> ước lượng theo byte UTF-8 với hệ số thận trọng hơn
+BYTES_PER_TOKEN = 3.5
+# Dòng dài hơn mức này bị cắt giữa dòng (vd: JSON/base64 một dòng vài MB)
+MAX_LINE_CHARS = 2000
+# Số dòng lặp liên tiếp tối thiểu để gộp
+MIN_REPEAT_RUN = 3
+# Traceback dài hơn số frame này thì chỉ giữ TRACEBACK_HEAD_FRAMES frame đầu + TRACEBACK_TAIL_FRAMES frame cuối
+TRACEBACK_HEAD_FRAMES = 3
+TRACEBACK_TAIL_FRAMES = 6
+# Khi phải cắt head/tail: phần ngân sách dành cho head (còn lại cho tail, nơi thường có lỗi)
+HEAD_SHARE = 0.35
+# Chừa chỗ cho dòng đánh dấu phần bị lược
+_MARKER_TOKENS = 16
+
+# Log lớn hơn mức này: chỉ xử lý theo dòng phần đầu và phần cuối (mỗi phần một nửa), phần giữa bỏ ngay
+MAX_SCAN_BYTES = 4 * 1024 * 1024
+
+_NUMBER_RE = re.compile(r"0x[0-9a-fA-F]+|\d+")
+# Frame của traceback Python ("  File ..., line N, in f"), Java/JS ("    at ...")
+_FRAME_RE = re.compile(r'^\s+(File ".*", line \d+|at .+)')
+_TRACEBACK_HEADER = "Traceback (most recent call last):"
+_EXCEPTION_LINE_RE = re.compile(r"^[A-Za-z_][\w.]*(Error|Exception|Interrupt|Exit|Warning)\b.*$")
+
+
+def estimate_tokens(text):
+    if not text:
+        return 0
+    return math.ceil(len(text.encode('utf-8')) / BYTES_PER_TOKEN)
+
+
+# Token của một dòng kể cả ký tự xuống dòng (không làm tròn, để cộng dồn nhiều dòng ngắn không bị ước lượng dư)
+def _line_tokens(line):
+    return (len(line.encode('utf-8')) + 1) / BYTES_PER_TOKEN
+
+
+class CompactionReport:
+    __slots__ = ("original_tokens", "kept_tokens", "original_lines", "collapsed_lines", "elided_lines", "cut_lines")
+
+    def __init__(self, original_tokens=0, original_lines=0):
+        self.original_tokens = original_tokens
+        self.kept_tokens = original_tokens
+        self.original_lines = original_lines
+        self.collapsed_lines = 0 # Dòng được gộp (lặp lại, frame traceback)
+        self.elided_lines = 0 # Dòng bị bỏ khi cắt head/tail
+        self.cut_lines = 0 # Dòng quá dài bị cắt giữa
+
+    @property
+    def changed(self):
+        return bool(self.collapsed_lines or self.elided_lines or self.cut_lines)
+
+    def to_dict(self):
+        return {
+            "original_tokens": self.original_tokens,
+            "kept_tokens": self.kept_tokens,
+            "elided_tokens": max(0, self.original_tokens - self.kept_tokens),
+            "original_lines": self.original_lines,
+            "collapsed_lines": self.collapsed_lines,
+            "elided_lines": self.elided_lines,
+            "cut_lines": self.cut_lines,
+        }
+
+
+def _cut_long_line(line, report):
+    if len(line) <= MAX_LINE_CHARS:
+        return line
+    report.cut_lines += 1
+    half = MAX_LINE_CHARS // 2
+    return f"{line[:half]} … [đã lược {len(line) - 2 * half} ký tự] … {line[-half:]}"
+
+
+def _shape(line):
+    return _NUMBER_RE.sub("#", line)
+
+
+# Gộp các dòng giống hệt nhau (hoặc chỉ khác số) liên tiếp: giữ dòng đầu và dòng cuối của mỗi đợt
+def collapse_repeats(lines, report):
+    result = []
+    index = 0
+    total = len(lines)
+    shapes = [_shape(line) for line in lines]
+    while index < total:
+        shape = shapes[index]
+        end = index + 1
+        while end < total and shapes[end] == shape:
+            end += 1
+        run = end - index
+        if run >= MIN_REPEAT_RUN:
+            identical = all(line == lines[index] for line in lines[index + 1:end])
+            if identical:
+                result.append(lines[index])
+                result.append(f"    [... dòng trên lặp lại thêm {run - 1} lần]")
+                report.collapsed_lines += run - 1
+            else:
+                result.append(lines[index])
+                result.append(f"    [... {run - 2} dòng tương tự]")
+                result.append(lines[end - 1])
+                report.collapsed_lines += run - 2
+        else:
+            result.extend(lines[index:end])
+        index = end
+    return result
+
+
+# Gom frame traceback: mỗi frame = dòng "File ..."/"at ..." + các dòng thụt lề theo sau (dòng code, con trỏ ^^^)
+def _split_frames(lines, start):
+    frames = []
+    index = start
+    while index < len(lines) and _FRAME_RE.match(lines[index]):
+        end = index + 1
+        while end < len(lines) and lines[end].startswith("    ") and not _FRAME_RE.match(lines[end]):
+            end += 1
+        frames.append(lines[index:end])
+        index = end
+    return frames, index
+
+
+# Rút gọn các đoạn frame dài: gộp frame lặp liên tiếp (đệ quy), rồi chỉ giữ các frame đầu/cuối
+def collapse_tracebacks(lines, report):
+    result = []
+    index = 0
+    while index < len(lines):
+        line = lines[index]
+        if line[:1] not in (' ', '\t') or not _FRAME_RE.match(line):
+            result.append(line)
+            index += 1
+            continue
+        frames, index = _split_frames(lines, index)
+        deduplicated = []
+        for frame in frames:
+            if deduplicated and deduplicated[-1][0] == frame:
+                deduplicated[-1][1] += 1
+            else:
+                deduplicated.append([frame, 1])
+        kept = deduplicated
+        if len(deduplicated) > TRACEBACK_HEAD_FRAMES + TRACEBACK_TAIL_FRAMES:
+            kept = deduplicated[:TRACEBACK_HEAD_FRAMES] + [None] + deduplicated[-TRACEBACK_TAIL_FRAMES:]
+        for entry in kept:
+            if entry is None:
+                skipped = deduplicated[TRACEBACK_HEAD_FRAMES:-TRACEBACK_TAIL_FRAMES]
+                skipped_lines = sum(len(frame) * count for frame, count in skipped)
+                report.collapsed_lines += skipped_lines
+                result.append(f"  [... đã lược {sum(count for _frame, count in skipped)} frame]")
+                continue
+            frame, count = entry
+            result.extend(frame)
+            if count > 1:
+                report.collapsed_lines += len(frame) * (count - 1)
+                result.append(f"  [Frame trên lặp lại thêm {count - 1} lần]")
+    return result
+
+
+# Vị trí bắt đầu phần lỗi cuối cùng cần giữ nguyên: dòng "Traceback" cuối, không có thì dòng exception cuối
+def _final_error_start(lines):
+    for index in range(len(lines) - 1, -1, -1):
+        if lines[index].startswith(_TRACEBACK_HEADER):
+            return index
+    for index in range(len(lines) - 1, max(-1, len(lines) - 50), -1):
+        if _EXCEPTION_LINE_RE.match(lines[index]):
+            return index
+    return len(lines)
+
+
+def _take_within(lines, budget, from_end=False):
+    taken, used = [], 0
+    for line in (reversed(lines) if from_end else lines):
+        cost = _line_tokens(line)
+        if used + cost > budget:
+            break
+        taken.append(line)
+        used += cost
+    return (taken[::-1] if from_end else taken), used
+
+
+# Giữ head + tail trong ngân sách; phần lỗi cuối (lines[protected_start:]) luôn được giữ nếu không quá lớn
+def _head_tail(lines, budget, protected_start, report):
+    protected = lines[protected_start:]
+    protected_tokens = sum(_line_tokens(line) for line in protected)
+    if protected_tokens > budget * 0.8: # Phần lỗi cuối quá dài: cắt như phần còn lại
+        protected, protected_start, protected_tokens = [], len(lines), 0
+    rest = lines[:protected_start]
+    remaining = budget - protected_tokens - _MARKER_TOKENS
+    head, head_tokens = _take_within(rest, remaining * HEAD_SHARE)
+    tail, _ = _take_within(rest[len(head):], remaining - head_tokens, from_end=True)
+    elided = len(rest) - len(head) - len(tail)
+    if elided <= 0:
+        return lines
+    elided_tokens = estimate_tokens("\n".join(rest[len(head):len(rest) - len(tail)]))
+    report.elided_lines += elided
+    return head + [f"... [đã lược bỏ {elided} dòng, ~{elided_tokens} token] ..."] + tail + protected
+
+
+# Cắt sẵn phần giữa của log rất lớn (theo ranh giới dòng) để phần xử lý theo dòng có chi phí giới hạn
+def _pre_cut(text, report):
+    half = MAX_SCAN_BYTES // 2
+    head_end = text.rfind("\n", 0, half) + 1 or half
+    tail_start = text.find("\n", len(text) - half) + 1 or len(text) - half
+    middle = text[head_end:tail_start]
+    elided = middle.count("\n")
+    report.elided_lines += elided
+    return f"{text[:head_end]}... [đã lược bỏ {elided} dòng, ~{estimate_tokens(middle)} token] ...\n{text[tail_start:]}"
+
+
+# Rút gọn một đoạn text (stdout/stderr/code) về tối đa budget token. Trả về (text, CompactionReport)
+def compact_text(text, budget, collapse=True):
+    text = text or ""
+    report = CompactionReport(estimate_tokens(text), text.count("\n") + (1 if text and not text.endswith("\n") else 0))
+    if report.original_tokens <= budget:
+        return text, report
+    if len(text) > MAX_SCAN_BYTES:
+        text = _pre_cut(text, report)
+    lines = [_cut_long_line(line, report) for line in text.splitlines()]
+    if collapse:
+        lines = collapse_tracebacks(lines, report)
+        lines = collapse_repeats(lines, report)
+    if estimate_tokens("\n".join(lines)) > budget:
+        lines = _head_tail(lines, max(1, budget), _final_error_start(lines), report)
+    compacted = "\n".join(lines)
+    report.kept_tokens = estimate_tokens(compacted)
+    return compacted, report
+
+
+# Chia ngân sách cho nhiều phần theo trọng số; phần cần ít hơn phần được chia thì phần dư chuyển cho phần khác
+def allocate(budget, needs, weights):
+    allocation = {name: 0 for name in needs}
+    pending = {name for name, need in needs.items() if need > 0}
+    remaining = budget
+    while pending and remaining > 0:
+        total_weight = sum(weights[name] for name in pending)
+        satisfied = {name for name in pending if needs[name] - allocation[name] <= remaining * weights[name] / total_weight}
+        if not satisfied:
+            for name in pending:
+                allocation[name] += int(remaining * weights[name] / total_weight)
+            break
+        for name in satisfied:
+            remaining -= needs[name] - allocation[name]
+            allocation[name] = needs[name]
+        pending -= satisfied
+    return allocation
+
+
+# Rút gọn nhiều phần cùng một prompt trong tổng ngân sách. parts: {tên: text}; weights: {tên: trọng số}
+# Trả về ({tên: text đã rút gọn}, {tên: báo cáo dạng dict} chỉ với các phần bị thay đổi)
+def compact_parts(parts, budget, weights, collapse=None):
+    needs = {name: estimate_tokens(text) for name, text in parts.items()}
+    if sum(needs.values()) <= budget:
+        return dict(parts), {}
+    allocation = allocate(budget, needs, weights)
+    compacted, reports = {}, {}
+    for name, text in parts.items():
+        compacted[name], report = compact_text(text, allocation[name], collapse=(collapse or {}).get(name, True))
+        if report.changed:
+            reports[name] = report.to_dict()
+    return compacted, reports
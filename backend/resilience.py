@@ -0,0 +1,259 @@
+# backend/resilience.py
+# Lớp chống chịu lỗi quanh lời gọi generate_content:
+#   - phân loại lỗi có thể thử lại (429, 5xx, Deadline Exceeded)
+#   - thử lại với exponential backoff + jitter, giới hạn bởi tổng deadline
+#   - token bucket phía client cho từng API key để không vượt quota
+#   - circuit breaker theo model: lỗi liên tiếp -> ngừng gọi một thời gian (fail fast). Breaker đếm theo lời gọi,
+#     không theo lần thử: một lời gọi chỉ tính là một lỗi khi đã hết lượt retry mà upstream vẫn lỗi (5xx/timeout),
+#     nên failure_threshold là số request thất bại liên tiếp. 429 (quota của từng API key) và lỗi phía request
+#     (key sai, tham số sai) là trung lập: không tính là lỗi, cũng không reset bộ đếm
+import hashlib
+import logging
+import random
+import threading
+import time
+
+try:
+    from google.api_core import exceptions as google_exceptions
+except ImportError: # google-api-core luôn đi kèm google-generativeai, phòng trường hợp thiếu
+    google_exceptions = None
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitedError(Exception):
+    pass
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+# Trả về loại lỗi có thể thử lại ('rate_limited' | 'unavailable' | 'timeout'), hoặc None nếu không nên thử lại
+# (API key sai, tham số sai, bị chặn an toàn... thử lại cũng không khác).
+def classify_error(error):
+    if google_exceptions is not None:
+        if isinstance(error, (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)):
+            return 'rate_limited'
+        if isinstance(error, (google_exceptions.DeadlineExceeded, google_exceptions.GatewayTimeout)):
+            return 'timeout'
+        if isinstance(error, (google_exceptions.ServiceUnavailable, google_exceptions.InternalServerError,
+                              google_exceptions.BadGateway, google_exceptions.Aborted, google_exceptions.Unknown)):
+            return 'unavailable'
+        if isinstance(error, google_exceptions.GoogleAPICallError):
+            return None
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return 'timeout' if isinstance(error, TimeoutError) else 'unavailable'
+    message = str(error).lower()
+    if "429" in message or "resource exhausted" in message or "quota" in message:
+        return 'rate_limited'
+    if "deadline exceeded" in message or "timed out" in message:
+        return 'timeout'
+    if any(code in message for code in ("500", "502", "503", "504")) or "unavailable" in message:
+        return 'unavailable'
+    return None
+
+
+# Token bucket: rate_per_second token được nạp mỗi giây, chứa tối đa capacity token (cho phép burst)
+class TokenBucket:
+    def __init__(self, rate_per_second, capacity):
+        self.rate_per_second = float(rate_per_second)
+        self.capacity = max(1.0, float(capacity))
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    # Chờ tới khi lấy được 1 token; trả về False nếu không thể có token trước timeout (giây)
+    def acquire(self, timeout):
+        deadline = time.monotonic() + max(0.0, timeout)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate_per_second)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait_time = (1 - self._tokens) / self.rate_per_second
+            if now + wait_time > deadline:
+                return False
+            time.sleep(wait_time)
+
+    def available(self):
+        with self._lock:
+            elapsed = time.monotonic() - self._updated_at
+            return min(self.capacity, self._tokens + elapsed * self.rate_per_second)
+
+
+# Circuit breaker: closed -> (failure_threshold lỗi liên tiếp) -> open -> (sau reset_timeout) -> half_open
+# half_open cho đúng một request thử; thành công thì closed, thất bại thì open lại.
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.reset_timeout = float(reset_timeout)
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                self._probe_in_flight = False
+            if self.state == "half_open" and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.consecutive_failures = 0
+            self._probe_in_flight = False
+
+    # Lần gọi đã được allow() nhưng kết thúc mà không có kết quả về sức khỏe upstream (vd: 429 quota của key,
+    # lỗi ngoài lời gọi): trả lại lượt thử của half_open để request sau được thử
+    def release_probe(self):
+        with self._lock:
+            if self.state == "half_open":
+                self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+                if self.state != "open":
+                    logger.warning(f"Circuit breaker mở sau {self.consecutive_failures} lỗi liên tiếp, ngừng gọi trong {self.reset_timeout:.0f} giây.")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self._probe_in_flight = False
+
+    # Số giây còn lại trước khi cho request thử (0 nếu không ở trạng thái open)
+    def retry_after(self):
+        with self._lock:
+            if self.state != "open":
+                return 0.0
+            return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    # Thông báo cho request bị từ chối: thời gian chờ khi open, hoặc đang chờ request thử khi half_open
+    def rejection_message(self, model_name):
+        with self._lock:
+            state = self.state
+        if state == "half_open":
+            return f"Gemini API ({model_name}) đang gặp sự cố, đang chờ kết quả của một request thử, vui lòng thử lại sau giây lát."
+        return f"Gemini API ({model_name}) đang gặp sự cố, tạm ngừng gọi thêm {max(1.0, self.retry_after()):.0f} giây."
+
+    def stats(self):
+        with self._lock:
+            return {"state": self.state, "consecutive_failures": self.consecutive_failures}
+
+
+class GeminiResilience:
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=8.0, deadline_seconds=60,
+                 rate_limit_per_minute=0, rate_limit_burst=10, breaker_failure_threshold=5, breaker_reset_seconds=30):
+        self.max_attempts = max(1, int(max_attempts))
+        self.base_delay = float(base_delay)
+        self.max_delay = float(max_delay)
+        self.deadline_seconds = float(deadline_seconds)
+        self.rate_limit_per_minute = float(rate_limit_per_minute) # 0 = không giới hạn
+        self.rate_limit_burst = rate_limit_burst
+        self.breaker_failure_threshold = breaker_failure_threshold
+        self.breaker_reset_seconds = breaker_reset_seconds
+        self._buckets = {} # sha256(api_key) -> TokenBucket
+        self._breakers = {} # model_name -> CircuitBreaker
+        self._lock = threading.Lock()
+        self.retries = 0
+        self.rate_limited = 0
+        self.short_circuited = 0
+
+    # Full jitter: chờ ngẫu nhiên trong [0, min(max_delay, base * 2^attempt)]
+    def backoff_delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def _bucket(self, api_key):
+        if self.rate_limit_per_minute <= 0:
+            return None
+        key_id = hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+        with self._lock:
+            bucket = self._buckets.get(key_id)
+            if bucket is None:
+                bucket = self._buckets[key_id] = TokenBucket(self.rate_limit_per_minute / 60.0, self.rate_limit_burst)
+            return bucket
+
+    def _breaker(self, model_name):
+        with self._lock:
+            breaker = self._breakers.get(model_name)
+            if breaker is None:
+                breaker = self._breakers[model_name] = CircuitBreaker(self.breaker_failure_threshold, self.breaker_reset_seconds)
+            return breaker
+
+    # Gọi fn(timeout) với retry/backoff/rate limit/circuit breaker.
+    # timeout truyền cho fn là số giây còn lại của deadline (dùng làm request_options timeout cho từng lần thử).
+    # deadline: thời điểm (time.monotonic()) người gọi phải có kết quả (vd: ngân sách của auto-fix); lấy mốc sớm hơn
+    # giữa nó và deadline_seconds, kể cả thời gian chờ token và backoff.
+    def call(self, api_key, model_name, fn, deadline=None):
+        call_deadline = time.monotonic() + self.deadline_seconds
+        deadline = call_deadline if deadline is None else min(deadline, call_deadline)
+        bucket = self._bucket(api_key)
+        breaker = self._breaker(model_name)
+        # Lấy token trước khi hỏi breaker: bị rate limit sau khi allow() sẽ giữ lượt thử half_open mãi
+        self._take_token(bucket, deadline)
+        if not breaker.allow():
+            with self._lock:
+                self.short_circuited += 1
+            raise CircuitOpenError(breaker.rejection_message(model_name))
+        # Breaker chỉ được hỏi một lần cho cả lời gọi (các lần retry, kể cả khi đây là lượt thử của half_open)
+        # và chỉ được báo kết quả một lần khi lời gọi kết thúc
+        settled = False
+        attempt = 0
+        try:
+            while True:
+                try:
+                    result = fn(max(1.0, deadline - time.monotonic()))
+                except Exception as e:
+                    error_kind = classify_error(e)
+                    attempt += 1
+                    delay = self.backoff_delay(attempt)
+                    if error_kind is None or attempt >= self.max_attempts or time.monotonic() + delay >= deadline:
+                        if error_kind in ('unavailable', 'timeout'):
+                            breaker.record_failure() # Hết lượt retry mà upstream vẫn lỗi: một lỗi cho cả lời gọi
+                            settled = True
+                        raise
+                    with self._lock:
+                        self.retries += 1
+                    logger.warning(f"Gemini ({model_name}) lỗi {error_kind}, thử lại lần {attempt} sau {delay:.2f} giây: {e}")
+                    time.sleep(delay)
+                    self._take_token(bucket, deadline)
+                    continue
+                breaker.record_success()
+                settled = True
+                return result
+        finally:
+            if not settled:
+                # Lỗi phía request (key sai, tham số sai...), 429 quota của key, hết token khi retry hoặc bị ngắt giữa chừng:
+                # không nói gì về sức khỏe upstream -> không đổi bộ đếm, chỉ trả lại lượt thử half_open
+                breaker.release_probe()
+
+    def _take_token(self, bucket, deadline):
+        if bucket and not bucket.acquire(timeout=deadline - time.monotonic()):
+            with self._lock:
+                self.rate_limited += 1
+            raise RateLimitedError(f"Vượt giới hạn {self.rate_limit_per_minute:.0f} yêu cầu/phút cho API key này.")
+
+    def stats(self):
+        with self._lock:
+            breakers = {name: breaker.stats() for name, breaker in self._breakers.items()}
+            return {
+                "max_attempts": self.max_attempts,
+                "deadline_seconds": self.deadline_seconds,
+                "rate_limit_per_minute": self.rate_limit_per_minute,
+                "retries": self.retries,
+                "rate_limited": self.rate_limited,
+                "short_circuited": self.short_circuited,
+                "rate_limited_keys": len(self._buckets),
+                "breakers": breakers,
+            }
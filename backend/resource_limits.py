@@ -0,0 +1,184 @@
+# backend/resource_limits.py
+# Giới hạn tài nguyên (rlimit) cho code được thực thi và đo tài nguyên mỗi lần chạy (POSIX).
+#   - Giới hạn: CPU, bộ nhớ ảo (RLIMIT_AS), kích thước file ghi ra, số tiến trình, số file mở.
+#     Đặt trước khi interpreter chạy bằng cách bọc lệnh qua `prlimit` (util-linux); không có prlimit thì dùng
+#     preexec_fn (chậm hơn nhiều khi backend lớn: subprocess phải fork thay vì vfork). Interpreter đã spawn sẵn
+#     (warm pool, đang chờ code ở stdin) được đặt giới hạn bằng resource.prlimit(pid) trước khi nhận code.
+#   - Đo: /proc/<pid>/io đọc lúc tiến trình đã thoát nhưng chưa được reap (gồm cả các tiến trình con đã reap).
+import shutil
+import signal
+import sys
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+# Tên giới hạn trong API -> (tên RLIMIT, số đơn vị kernel mỗi đơn vị API, giá trị nhỏ nhất cho phép, cờ của prlimit)
+LIMITS = {
+    "cpu_seconds": ("RLIMIT_CPU", 1, 1, "--cpu"),
+    "memory_mb": ("RLIMIT_AS", 1024 * 1024, 64, "--as"), # Python cần vài chục MB bộ nhớ ảo chỉ để khởi động
+    "file_size_mb": ("RLIMIT_FSIZE", 1024 * 1024, 1, "--fsize"),
+    "processes": ("RLIMIT_NPROC", 1, 1, "--nproc"),
+    "open_files": ("RLIMIT_NOFILE", 1, 16, "--nofile"),
+}
+# Tín hiệu kernel gửi khi vượt giới hạn mềm -> tên giới hạn
+_LIMIT_SIGNALS = {"SIGXCPU": "cpu_seconds", "SIGXFSZ": "file_size_mb"}
+# Dấu hiệu trong stderr khi lời gọi hệ thống bị giới hạn chặn (Python bỏ qua SIGXFSZ nên nhận lỗi EFBIG thay vì bị kill)
+_STDERR_MARKERS = {
+    "memory_mb": ("MemoryError", "Cannot allocate memory", "std::bad_alloc", "out of memory"),
+    "file_size_mb": ("File too large", "File size limit exceeded"),
+    "open_files": ("Too many open files",),
+    "processes": ("Resource temporarily unavailable", "fork: retry"),
+}
+
+_PRLIMIT_PATH = shutil.which("prlimit") if sys.platform.startswith("linux") else None
+
+
+class LimitError(ValueError):
+    pass
+
+
+def supported():
+    return resource is not None
+
+
+# Có đặt được giới hạn cho tiến trình đang chạy (warm pool) không
+def can_limit_running_process():
+    return resource is not None and hasattr(resource, "prlimit")
+
+
+def _number(name, value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value != value:
+        raise LimitError(f"Giới hạn '{name}' phải là số.")
+    return value
+
+
+# Giới hạn áp dụng cho từng lần chạy: mặc định theo loại file, ghi đè theo request (chỉ trong mức tối đa của admin)
+class LimitPolicy:
+    # defaults: {tên: giá trị} cho mọi loại file; by_type: {extension: {tên: giá trị}}; maxima: {tên: giá trị}
+    # Giá trị 0/None = không giới hạn. Không khai báo mức tối đa thì mức mặc định cũng là mức tối đa
+    # (request chỉ được siết chặt hơn), trừ khi mặc định là không giới hạn.
+    def __init__(self, defaults=None, by_type=None, maxima=None):
+        self.defaults = {name: value for name, value in (defaults or {}).items() if value}
+        self.by_type = {extension: {name: value for name, value in limits.items() if value} for extension, limits in (by_type or {}).items()}
+        self.maxima = {name: value for name, value in (maxima or {}).items() if value}
+
+    def defaults_for(self, file_extension):
+        return {**self.defaults, **self.by_type.get(file_extension, {})}
+
+    def maximum(self, name, file_extension):
+        return self.maxima.get(name) or self.defaults_for(file_extension).get(name)
+
+    # Trả về {tên: giá trị} đã áp dụng; request không hợp lệ hoặc vượt mức tối đa -> LimitError
+    def resolve(self, file_extension, requested=None):
+        limits = self.defaults_for(file_extension)
+        if requested is None:
+            return limits
+        if not isinstance(requested, dict):
+            raise LimitError("'limits' phải là object, vd: {\"memory_mb\": 512, \"cpu_seconds\": 10}.")
+        for name, value in requested.items():
+            if name not in LIMITS:
+                raise LimitError(f"Không hỗ trợ giới hạn '{name}' (hỗ trợ: {', '.join(LIMITS)}).")
+            value = _number(name, value)
+            minimum = LIMITS[name][2]
+            if value < minimum:
+                raise LimitError(f"Giới hạn '{name}' phải từ {minimum} trở lên.")
+            maximum = self.maximum(name, file_extension)
+            if maximum and value > maximum:
+                raise LimitError(f"Giới hạn '{name}' vượt mức tối đa cho phép ({maximum}).")
+            limits[name] = value
+        return limits
+
+    def snapshot(self):
+        return {"defaults": self.defaults, "by_type": self.by_type, "maxima": self.maxima}
+
+
+# [(tên, hằng RLIMIT, mềm, cứng)] cho các giới hạn; không vượt giới hạn cứng hiện có của backend
+# (tiến trình thường không tự nâng được giới hạn cứng)
+def rlimits(limits):
+    if resource is None:
+        return []
+    result = []
+    for name, value in limits.items():
+        constant_name, unit, _minimum, _flag = LIMITS[name]
+        constant = getattr(resource, constant_name, None)
+        if constant is None:
+            continue
+        soft = int(value * unit)
+        _current_soft, current_hard = resource.getrlimit(constant)
+        if current_hard != resource.RLIM_INFINITY:
+            soft = min(soft, current_hard)
+        # CPU: vượt giới hạn mềm nhận SIGXCPU (có thể in thông báo), vượt cứng (1 giây sau) bị SIGKILL
+        hard = soft + 1 if name == "cpu_seconds" and (current_hard == resource.RLIM_INFINITY or soft < current_hard) else soft
+        result.append((name, constant, soft, hard))
+    return result
+
+
+# Lệnh thật để spawn và preexec_fn (nếu cần) cho các giới hạn
+def wrap_command(command, limits):
+    pairs = rlimits(limits)
+    if not pairs:
+        return command, None
+    if _PRLIMIT_PATH:
+        # prlimit tự báo lỗi khi không tìm thấy lệnh: kiểm tra trước để vẫn ném FileNotFoundError như khi spawn trực tiếp
+        executable = command[1] if command[0] == 'sudo' and len(command) > 1 else command[0]
+        if shutil.which(executable) is None:
+            raise FileNotFoundError(2, "No such file or directory", executable)
+        flags = [f"{LIMITS[name][3]}={soft}:{hard}" for name, _constant, soft, hard in pairs]
+        # sudo giữ vị trí đầu (để kill/hỏi mật khẩu như cũ); prlimit chạy dưới sudo
+        if command[0] == 'sudo':
+            return ['sudo', _PRLIMIT_PATH, *flags, '--', *command[1:]], None
+        return [_PRLIMIT_PATH, *flags, '--', *command], None
+
+    def apply_limits():
+        for _name, constant, soft, hard in pairs:
+            resource.setrlimit(constant, (soft, hard))
+    return command, apply_limits
+
+
+# Đặt giới hạn cho tiến trình đang chạy (Linux); trả về False nếu không làm được
+def apply_to_pid(pid, limits):
+    if not can_limit_running_process():
+        return False
+    try:
+        for _name, constant, soft, hard in rlimits(limits):
+            resource.prlimit(pid, constant, (soft, hard))
+        return True
+    except (OSError, ValueError):
+        return False
+
+
+# Số liệu I/O của tiến trình (Linux); gọi khi tiến trình đã thoát nhưng chưa reap để có tổng cuối cùng
+def read_process_io(pid):
+    try:
+        with open(f"/proc/{pid}/io", encoding="ascii") as io_file:
+            fields = dict(line.split(":", 1) for line in io_file if ":" in line)
+    except OSError:
+        return None
+    return {
+        "written_bytes": int(fields["wchar"]), # Mọi lệnh write (kể cả stdout/stderr, pipe)
+        "disk_write_bytes": int(fields["write_bytes"]), # Phần thực sự ghi xuống thiết bị lưu trữ
+        "read_bytes": int(fields["rchar"]),
+    }
+
+
+# Đoán giới hạn nào đã làm tiến trình dừng (None nếu không có dấu hiệu)
+def exceeded_limit(return_code, limits, cpu_seconds=None, stderr_tail=""):
+    if return_code is None or not limits:
+        return None
+    if return_code < 0:
+        try:
+            name = _LIMIT_SIGNALS.get(signal.Signals(-return_code).name)
+        except ValueError:
+            name = None
+        if name in limits:
+            return name
+        # Vượt giới hạn CPU cứng: SIGKILL
+        if return_code == -signal.SIGKILL and "cpu_seconds" in limits and cpu_seconds is not None and cpu_seconds >= limits["cpu_seconds"]:
+            return "cpu_seconds"
+    if return_code != 0:
+        for name, markers in _STDERR_MARKERS.items():
+            if name in limits and any(marker in stderr_tail for marker in markers):
+                return name
+    return None
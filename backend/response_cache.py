@@ -0,0 +1,123 @@
+# backend/response_cache.py
+# Cache khớp chính xác cho phản hồi Gemini: LRU giới hạn số mục, TTL cho từng mục,
+# tùy chọn lưu xuống SQLite để giữ lại cache qua các lần khởi động lại backend.
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    def __init__(self, max_entries=256, ttl_seconds=3600, disk_path=None):
+        self.max_entries = max(1, int(max_entries))
+        self.ttl_seconds = float(ttl_seconds)
+        self.disk_path = disk_path or None
+        self._entries = OrderedDict() # key -> (value, expires_at)
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+        self._disk_writes = 0
+        if self.disk_path:
+            self._init_disk()
+
+    # Tạo key từ prompt đầy đủ và mọi tham số ảnh hưởng tới phản hồi
+    @staticmethod
+    def make_key(full_prompt, **params):
+        raw = json.dumps({"prompt": full_prompt, **params}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+        value = self._disk_get(key, now) if self.disk_path else None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            value, expires_at = value
+            self.hits += 1
+            self.disk_hits += 1
+            self._store_in_memory(key, value, expires_at)
+            return value
+
+    def set(self, key, value):
+        expires_at = time.time() + self.ttl_seconds
+        with self._lock:
+            self._store_in_memory(key, value, expires_at)
+        if self.disk_path:
+            self._disk_set(key, value, expires_at)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.disk_path:
+            with self._disk_lock, self._connect() as conn:
+                conn.execute("DELETE FROM response_cache")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "disk_hits": self.disk_hits,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "disk_path": self.disk_path,
+            }
+
+    # Phải gọi khi đang giữ self._lock
+    def _store_in_memory(self, key, value, expires_at):
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    # --- Lưu trữ trên đĩa (SQLite) ---
+    def _connect(self):
+        return sqlite3.connect(self.disk_path, timeout=5)
+
+    def _init_disk(self):
+        with self._disk_lock, self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS response_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)")
+            conn.execute("DELETE FROM response_cache WHERE expires_at <= ?", (time.time(),))
+
+    def _disk_get(self, key, now):
+        try:
+            with self._disk_lock, self._connect() as conn:
+                row = conn.execute("SELECT value, expires_at FROM response_cache WHERE key = ? AND expires_at > ?", (key, now)).fetchone()
+            return row
+        except sqlite3.Error as e:
+            logger.warning(f"Không đọc được cache trên đĩa: {e}")
+            return None
+
+    def _disk_set(self, key, value, expires_at):
+        try:
+            with self._disk_lock, self._connect() as conn:
+                conn.execute("INSERT OR REPLACE INTO response_cache (key, value, expires_at) VALUES (?, ?, ?)", (key, value, expires_at))
+                self._disk_writes += 1
+                if self._disk_writes % 100 == 0: # Thỉnh thoảng dọn các mục đã hết hạn
+                    conn.execute("DELETE FROM response_cache WHERE expires_at <= ?", (time.time(),))
+        except sqlite3.Error as e:
+            logger.warning(f"Không ghi được cache xuống đĩa: {e}")
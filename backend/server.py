@@ -0,0 +1,130 @@
+# backend/server.py
+# Chọn cách phục vụ app Flask theo cấu hình (biến môi trường SERVER_MODE):
+#   dev      - Werkzeug dev server + reloader + debugger (mặc định, như trước đây)
+#   threaded - Werkzeug đa luồng, tắt reloader/debugger (không cần cài thêm gì)
+#   waitress - WSGI server đa luồng, chạy được trên cả Windows (pip install waitress)
+#   gunicorn - nhiều worker process x nhiều thread (gthread), chỉ Linux/macOS (pip install gunicorn)
+import logging
+import os
+import sys
+
+logger = logging.getLogger(__name__)
+
+
+def _env_int(name, default):
+    try:
+        return int(os.getenv(name, default))
+    except ValueError:
+        logger.warning(f"Giá trị {name} không hợp lệ, dùng mặc định {default}.")
+        return int(default)
+
+
+def _env_flag(name):
+    return os.getenv(name, '').lower() in ('1', 'true', 'yes')
+
+
+# Trạng thái chỉ nằm trong bộ nhớ/thư mục của process đã tạo ra nó: gunicorn chia request cho các worker,
+# nên ID do worker này cấp không dùng được ở worker khác
+def per_process_features():
+    features = ["job (/api/jobs/<id>: poll, lấy kết quả, hủy)", "output bị lược (/api/outputs/<id>)"]
+    if _env_flag('KERNEL_SESSIONS'):
+        features.append("kernel (/api/kernels/<conversation_id>: biến của lần chạy trước)")
+    if _env_flag('SESSION_ENVS'):
+        features.append("venv của session (package đã cài)")
+    return features
+
+
+def warn_if_multi_worker(config):
+    if config["workers"] <= 1:
+        return
+    logger.warning(
+        f"SERVER_WORKERS={config['workers']}: các trạng thái sau chỉ có ở worker đã tạo ra chúng, request tiếp theo rơi vào "
+        f"worker khác sẽ nhận 404 hoặc trạng thái trống: {'; '.join(per_process_features())}. "
+        "Dùng SERVER_WORKERS=1 (tăng SERVER_THREADS) nếu cần các tính năng này."
+    )
+
+
+# Đọc cấu hình server từ biến môi trường
+def load_server_config():
+    return {
+        "mode": os.getenv('SERVER_MODE', 'dev').lower(),
+        "host": os.getenv('SERVER_HOST', '127.0.0.1'),
+        "port": _env_int('SERVER_PORT', '5001'),
+        "workers": _env_int('SERVER_WORKERS', '1'), # Số process (chỉ gunicorn)
+        "threads": _env_int('SERVER_THREADS', '32'), # Số thread mỗi process
+        "keepalive": _env_int('SERVER_KEEPALIVE_SECONDS', '5'),
+        # Thời gian chờ các request đang chạy hoàn tất khi tắt server
+        "graceful_timeout": _env_int('SERVER_GRACEFUL_TIMEOUT_SECONDS', '30'),
+        # Phải lớn hơn thời gian chạy lâu nhất (cài package: 120 giây)
+        "timeout": _env_int('SERVER_WORKER_TIMEOUT_SECONDS', '180'),
+    }
+
+
+def run_server(app, config=None):
+    config = config or load_server_config()
+    mode = config["mode"]
+    logger.info(f"Backend đang chạy tại http://{config['host']}:{config['port']} (chế độ: {mode})")
+
+    if mode == 'dev':
+        app.run(debug=True, host=config["host"], port=config["port"])
+    elif mode == 'threaded':
+        app.run(debug=False, use_reloader=False, threaded=True, host=config["host"], port=config["port"])
+    elif mode == 'waitress':
+        _run_waitress(app, config)
+    elif mode == 'gunicorn':
+        _run_gunicorn(app, config)
+    else:
+        logger.error(f"SERVER_MODE không hợp lệ: '{mode}'. Chọn một trong: dev, threaded, waitress, gunicorn.")
+        sys.exit(1)
+
+
+def _run_waitress(app, config):
+    try:
+        from waitress import serve
+    except ImportError:
+        logger.error("Chưa cài waitress. Chạy: pip install waitress")
+        sys.exit(1)
+    if config["workers"] > 1:
+        logger.warning("waitress chỉ chạy một process; SERVER_WORKERS bị bỏ qua, dùng SERVER_THREADS.")
+    # waitress tự xử lý SIGINT/SIGTERM: ngừng nhận kết nối mới rồi thoát
+    serve(
+        app, host=config["host"], port=config["port"], threads=config["threads"],
+        channel_timeout=max(config["timeout"], config["keepalive"]),
+        ident="gemini-ui-executor"
+    )
+
+
+def _run_gunicorn(app, config):
+    if sys.platform == "win32":
+        logger.error("gunicorn không hỗ trợ Windows. Dùng SERVER_MODE=waitress.")
+        sys.exit(1)
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        logger.error("Chưa cài gunicorn. Chạy: pip install gunicorn")
+        sys.exit(1)
+
+    warn_if_multi_worker(config)
+
+    class _GunicornApp(BaseApplication):
+        def load_config(self):
+            for key, value in gunicorn_options(config).items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    _GunicornApp().run()
+
+
+# Tùy chọn gunicorn tương ứng với cấu hình (dùng chung với gunicorn.conf.py)
+def gunicorn_options(config):
+    return {
+        "bind": f"{config['host']}:{config['port']}",
+        "workers": config["workers"],
+        "threads": config["threads"],
+        "worker_class": "gthread",
+        "keepalive": config["keepalive"],
+        "graceful_timeout": config["graceful_timeout"],
+        "timeout": config["timeout"],
+    }
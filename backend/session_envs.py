@@ -0,0 +1,408 @@
+# backend/session_envs.py
+# Môi trường Python riêng cho từng session: mỗi session có một venv clone từ venv mẫu (base) dựng sẵn một lần,
+# nên pip install của session này không ảnh hưởng backend hay session khác, và các session cài song song được.
+# Clone rẻ: file của base được reflink (copy-on-write, nếu filesystem hỗ trợ) hoặc hardlink thay vì copy;
+# chỉ file chứa đường dẫn tuyệt đối của base (pyvenv.cfg, script trong bin/) được ghi lại.
+# Hardlink an toàn với pip (pip xóa file cũ trước khi ghi file mới, Python ghi .pyc bằng rename), nhưng code
+# người dùng sửa trực tiếp file trong site-packages sẽ sửa luôn base -> dùng reflink/copy nếu cần cách ly tuyệt đối.
+# Env không dùng được bỏ theo LRU khi vượt số lượng/dung lượng, hoặc khi idle quá lâu.
+# Nhiều worker (gunicorn) dùng chung root_dir: venv mẫu dựng một lần dưới file lock, còn env của session nằm trong
+# sessions/<pid> riêng của từng tiến trình; khi khởi động chỉ dọn thư mục của tiến trình đã chết.
+import logging
+import os
+import re
+import shutil
+import site
+import subprocess
+import sys
+import threading
+import time
+import venv
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+_SESSION_ID_RE = re.compile(r"^[A-Za-z0-9_\-]{1,64}$")
+# ioctl FICLONE của Linux (btrfs, xfs, bcachefs...): file đích dùng chung extent với file nguồn tới khi bị ghi
+_FICLONE = 0x40049409
+CLONE_MODES = ('auto', 'reflink', 'hardlink', 'copy')
+_BIN_DIR = 'Scripts' if os.name == 'nt' else 'bin'
+
+
+class SessionEnvError(Exception):
+    pass
+
+
+def is_valid_session_id(session_id):
+    return isinstance(session_id, str) and bool(_SESSION_ID_RE.match(session_id))
+
+
+# Tiến trình pid còn sống không (thư mục sessions/<pid> của nó còn được dùng)
+def _process_alive(pid):
+    if os.name == 'nt':
+        import ctypes
+        handle = ctypes.windll.kernel32.OpenProcess(0x1000, False, pid) # PROCESS_QUERY_LIMITED_INFORMATION
+        if handle:
+            ctypes.windll.kernel32.CloseHandle(handle)
+            return True
+        return ctypes.windll.kernel32.GetLastError() == 5 # ERROR_ACCESS_DENIED: tiến trình tồn tại nhưng của user khác
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _reflink(source, target):
+    with open(source, 'rb') as source_file, open(target, 'wb') as target_file:
+        fcntl.ioctl(target_file.fileno(), _FICLONE, source_file.fileno())
+    shutil.copystat(source, target)
+
+
+# Tổng dung lượng của thư mục: (apparent, owned); owned không tính file hardlink dùng chung với nơi khác
+def disk_usage(path):
+    apparent = owned = 0
+    for dirpath, _dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                file_stat = os.lstat(os.path.join(dirpath, filename))
+            except OSError:
+                continue
+            apparent += file_stat.st_size
+            if file_stat.st_nlink <= 1:
+                owned += file_stat.st_size
+    return apparent, owned
+
+
+class SessionEnv:
+    def __init__(self, session_id, path, system_site_packages=False):
+        self.session_id = session_id
+        self.path = path
+        self.system_site_packages = system_site_packages
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self.in_use = 0
+        self.disk_bytes = 0 # Dung lượng riêng của env (không tính phần dùng chung với base)
+        self.install_lock = threading.Lock() # pip của cùng một session chạy tuần tự
+
+    @property
+    def python(self):
+        return os.path.join(self.path, _BIN_DIR, 'python.exe' if os.name == 'nt' else 'python')
+
+    @property
+    def bin_dir(self):
+        return os.path.join(self.path, _BIN_DIR)
+
+    # Biến môi trường để lệnh `python`/`pip` trong script bash cũng trỏ vào env của session
+    def apply_env(self, process_env):
+        process_env["VIRTUAL_ENV"] = self.path
+        process_env["PATH"] = self.bin_dir + os.pathsep + process_env.get("PATH", "")
+        process_env.pop("PYTHONHOME", None)
+        return process_env
+
+    # Thư mục site-packages để kiểm tra package đã cài (package_check)
+    def site_paths(self):
+        lib_dir = os.path.join(self.path, 'Lib' if os.name == 'nt' else 'lib')
+        paths = []
+        for dirpath, dirnames, _filenames in os.walk(lib_dir):
+            if os.path.basename(dirpath) == 'site-packages':
+                paths.append(dirpath)
+                dirnames.clear()
+        if self.system_site_packages:
+            paths.extend(site.getsitepackages([sys.base_prefix]))
+        return paths
+
+    def refresh_disk_usage(self):
+        self.disk_bytes = disk_usage(self.path)[1]
+
+    def info(self):
+        return {
+            "session_id": self.session_id,
+            "created_at": self.created_at,
+            "last_used": self.last_used,
+            "in_use": self.in_use,
+            "disk_bytes": self.disk_bytes,
+        }
+
+
+class SessionEnvManager:
+    def __init__(self, root_dir, max_envs=16, max_disk_bytes=2 * 1024 ** 3, idle_seconds=3600, clone_mode='auto',
+                 base_packages=None, system_site_packages=False, pip_timeout=600):
+        if clone_mode not in CLONE_MODES:
+            raise ValueError(f"clone_mode phải là một trong {CLONE_MODES}")
+        self.root_dir = os.path.abspath(root_dir)
+        self.base_dir = os.path.join(self.root_dir, 'base')
+        self.sessions_root = os.path.join(self.root_dir, 'sessions')
+        self.sessions_dir = os.path.join(self.sessions_root, str(os.getpid()))
+        self.max_envs = max(1, int(max_envs))
+        self.max_disk_bytes = int(max_disk_bytes)
+        self.idle_seconds = float(idle_seconds)
+        self.clone_mode = clone_mode
+        self.base_packages = list(base_packages or [])
+        self.system_site_packages = system_site_packages
+        self.pip_timeout = pip_timeout
+        self.base_disk_bytes = 0
+        self._envs = OrderedDict() # session_id -> SessionEnv, cũ nhất (ít dùng gần đây nhất) ở đầu
+        self._creating = {} # session_id -> threading.Event khi đang clone
+        self._lock = threading.Lock()
+        self._base_lock = threading.Lock()
+        self._base_ready = False
+        self.clones = 0
+        self.evictions = 0
+        self.clone_seconds = 0.0
+        self.link_fallbacks = 0 # Số file phải copy vì không reflink/hardlink được
+        self._remove_stale_sessions()
+        os.makedirs(self.sessions_dir, exist_ok=True)
+
+    # Bỏ env của các tiến trình đã chết (lần chạy trước, worker bị respawn) và thư mục cũ trùng pid của tiến trình này;
+    # env của worker khác đang chạy được giữ nguyên
+    def _remove_stale_sessions(self):
+        try:
+            names = os.listdir(self.sessions_root)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if name.isdigit() and int(name) != os.getpid() and _process_alive(int(name)):
+                continue
+            shutil.rmtree(os.path.join(self.sessions_root, name), ignore_errors=True)
+
+    # --- Base ---
+    def _base_marker(self):
+        return os.path.join(self.base_dir, '.base-ready')
+
+    # Khóa giữa các tiến trình dùng chung root_dir khi kiểm tra/dựng venv mẫu (fcntl.flock; Windows chỉ có khóa trong tiến trình)
+    @contextmanager
+    def _base_file_lock(self):
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(self.root_dir, exist_ok=True)
+        with open(os.path.join(self.root_dir, '.base.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    # Dựng venv mẫu một lần (giữ lại qua các lần khởi động; xóa thư mục base để dựng lại)
+    def ensure_base(self):
+        if self._base_ready:
+            return
+        with self._base_lock, self._base_file_lock():
+            if self._base_ready:
+                return
+            if not os.path.exists(self._base_marker()):
+                start_time = time.monotonic()
+                logger.info(f"Đang dựng venv mẫu cho session tại {self.base_dir}...")
+                shutil.rmtree(self.base_dir, ignore_errors=True)
+                builder = venv.EnvBuilder(with_pip=True, symlinks=os.name != 'nt', system_site_packages=self.system_site_packages)
+                builder.create(self.base_dir)
+                base_python = SessionEnv('base', self.base_dir).python
+                if self.base_packages:
+                    result = subprocess.run(
+                        [base_python, '-m', 'pip', 'install', '--disable-pip-version-check', '--no-input', *self.base_packages],
+                        capture_output=True, text=True, timeout=self.pip_timeout
+                    )
+                    if result.returncode != 0:
+                        raise SessionEnvError(f"Cài package cho venv mẫu thất bại: {result.stderr.strip()[-500:]}")
+                with open(self._base_marker(), 'w', encoding='utf-8') as marker_file:
+                    marker_file.write(str(time.time()))
+                logger.info(f"Đã dựng venv mẫu ({time.monotonic() - start_time:.1f}s).")
+            self.base_disk_bytes = disk_usage(self.base_dir)[0]
+            self._base_ready = True
+
+    # --- Clone ---
+    def _copy_file(self, source, target):
+        mode = self.clone_mode
+        if mode in ('auto', 'reflink') and fcntl is not None:
+            try:
+                _reflink(source, target)
+                return
+            except OSError:
+                if os.path.exists(target):
+                    os.remove(target)
+                if mode == 'reflink':
+                    mode = 'copy'
+        if mode in ('auto', 'hardlink'):
+            try:
+                os.link(source, target)
+                return
+            except OSError:
+                pass
+        if mode != 'copy':
+            self.link_fallbacks += 1
+        shutil.copy2(source, target)
+
+    # File văn bản chứa đường dẫn base (pyvenv.cfg, shebang của script trong bin/): ghi bản riêng với đường dẫn mới
+    def _rewrite_paths(self, source, target, env_dir):
+        try:
+            with open(source, 'rb') as source_file:
+                content = source_file.read()
+        except OSError:
+            return False
+        base_path = self.base_dir.encode()
+        if base_path not in content or b'\0' in content:
+            return False
+        with open(target, 'wb') as target_file:
+            target_file.write(content.replace(base_path, env_dir.encode()))
+        shutil.copystat(source, target)
+        return True
+
+    def _clone_base(self, env_dir):
+        for dirpath, dirnames, filenames in os.walk(self.base_dir):
+            relative = os.path.relpath(dirpath, self.base_dir)
+            target_dir = os.path.normpath(os.path.join(env_dir, relative))
+            os.makedirs(target_dir, exist_ok=True)
+            in_bin = relative.split(os.sep)[0] == _BIN_DIR
+            for name in dirnames:
+                source = os.path.join(dirpath, name)
+                if os.path.islink(source): # lib64 -> lib
+                    os.symlink(os.readlink(source), os.path.join(target_dir, name))
+            dirnames[:] = [name for name in dirnames if not os.path.islink(os.path.join(dirpath, name))]
+            for name in filenames:
+                source = os.path.join(dirpath, name)
+                target = os.path.join(target_dir, name)
+                if source == self._base_marker():
+                    continue
+                if os.path.islink(source): # bin/python -> interpreter hệ thống
+                    os.symlink(os.readlink(source), target)
+                elif (in_bin or name == 'pyvenv.cfg') and self._rewrite_paths(source, target, env_dir):
+                    continue
+                else:
+                    self._copy_file(source, target)
+
+    # --- Vòng đời env ---
+    # Dùng env của session (tạo nếu chưa có) trong khối with; env đang dùng không bị evict
+    @contextmanager
+    def acquire(self, session_id):
+        env = self._get_or_create(session_id)
+        try:
+            yield env
+        finally:
+            with self._lock:
+                env.in_use -= 1
+                env.last_used = time.time()
+            self.evict()
+
+    def _get_or_create(self, session_id):
+        if not is_valid_session_id(session_id):
+            raise SessionEnvError("session_id chỉ gồm chữ, số, '_' hoặc '-' (tối đa 64 ký tự).")
+        while True:
+            with self._lock:
+                env = self._envs.get(session_id)
+                if env is not None:
+                    env.in_use += 1
+                    env.last_used = time.time()
+                    self._envs.move_to_end(session_id)
+                    return env
+                pending = self._creating.get(session_id)
+                if pending is None:
+                    self._creating[session_id] = threading.Event()
+                    break
+            pending.wait() # Request khác đang clone cùng session
+        try:
+            env = self._create(session_id)
+        finally:
+            with self._lock:
+                self._creating.pop(session_id).set()
+        self.evict()
+        return env
+
+    def _create(self, session_id):
+        self.ensure_base()
+        env_dir = os.path.join(self.sessions_dir, session_id)
+        start_time = time.monotonic()
+        shutil.rmtree(env_dir, ignore_errors=True)
+        try:
+            self._clone_base(env_dir)
+        except OSError as e:
+            shutil.rmtree(env_dir, ignore_errors=True)
+            raise SessionEnvError(f"Không clone được venv cho session '{session_id}': {e}")
+        elapsed = time.monotonic() - start_time
+        env = SessionEnv(session_id, env_dir, self.system_site_packages)
+        env.refresh_disk_usage()
+        env.in_use = 1
+        with self._lock:
+            self._envs[session_id] = env
+            self.clones += 1
+            self.clone_seconds += elapsed
+        logger.info(f"Đã clone venv cho session '{session_id}' trong {elapsed * 1000:.1f} ms ({env.disk_bytes} byte riêng).")
+        return env
+
+    # Gọi sau khi pip cài vào env: cập nhật dung lượng và evict nếu vượt giới hạn
+    def record_install(self, env):
+        env.refresh_disk_usage()
+        self.evict()
+
+    def total_disk_bytes(self):
+        with self._lock:
+            return self.base_disk_bytes + sum(env.disk_bytes for env in self._envs.values())
+
+    # Bỏ env idle quá idle_seconds, rồi bỏ env ít dùng gần đây nhất tới khi trong giới hạn số lượng/dung lượng
+    def evict(self):
+        removed = []
+        with self._lock:
+            cutoff = time.time() - self.idle_seconds
+            disk_bytes = self.base_disk_bytes + sum(env.disk_bytes for env in self._envs.values())
+            for session_id, env in list(self._envs.items()):
+                if env.in_use:
+                    continue
+                over_limit = len(self._envs) > self.max_envs or disk_bytes > self.max_disk_bytes
+                if not over_limit and env.last_used >= cutoff:
+                    continue
+                del self._envs[session_id]
+                disk_bytes -= env.disk_bytes
+                removed.append(env)
+            self.evictions += len(removed)
+        for env in removed:
+            logger.info(f"Bỏ venv của session '{env.session_id}' (LRU/idle).")
+            shutil.rmtree(env.path, ignore_errors=True)
+
+    def remove(self, session_id):
+        with self._lock:
+            env = self._envs.get(session_id)
+            if env is None:
+                return False
+            if env.in_use:
+                raise SessionEnvError(f"Session '{session_id}' đang chạy, không thể xóa.")
+            del self._envs[session_id]
+        shutil.rmtree(env.path, ignore_errors=True)
+        return True
+
+    def get_info(self, session_id):
+        with self._lock:
+            env = self._envs.get(session_id)
+            return env.info() if env else None
+
+    def stats(self):
+        with self._lock:
+            envs = [env.info() for env in self._envs.values()]
+            return {
+                "root_dir": self.root_dir,
+                "sessions_dir": self.sessions_dir,
+                "clone_mode": self.clone_mode,
+                "base_ready": self._base_ready,
+                "base_disk_bytes": self.base_disk_bytes,
+                "envs": len(envs),
+                "max_envs": self.max_envs,
+                "disk_bytes": self.base_disk_bytes + sum(env["disk_bytes"] for env in envs),
+                "max_disk_bytes": self.max_disk_bytes,
+                "clones": self.clones,
+                "evictions": self.evictions,
+                "link_fallbacks": self.link_fallbacks,
+                "avg_clone_ms": round(self.clone_seconds / self.clones * 1000, 2) if self.clones else None,
+                "sessions": envs,
+            }
+
+    def shutdown(self):
+        with self._lock:
+            self._envs.clear()
+        shutil.rmtree(self.sessions_dir, ignore_errors=True)
@@ -0,0 +1,146 @@
+# backend/streaming.py
+# Tiện ích cho các endpoint streaming (Server-Sent Events)
+import json
+
+from code_blocks import is_closing_fence, opening_fence
+
+CODE_WHITESPACE = " \t\r\n"
+
+
+# Định dạng một sự kiện SSE: "event: <tên>\ndata: <json>\n\n"
+def sse_event(event, data):
+    payload = json.dumps(data, ensure_ascii=False)
+    return f"event: {event}\ndata: {payload}\n\n"
+
+
+# Độ dài phần đuôi chưa được gửi của code: khoảng trắng/dòng trống cuối (bị rstrip khi khối kết thúc)
+# và dãy ký tự fence ngay trước đó (fence đóng dính cuối dòng cuối, vd "print(1)```")
+def _held_suffix_length(text, fence_char):
+    end = len(text)
+    while end and text[end - 1] in CODE_WHITESPACE:
+        end -= 1
+    while end and text[end - 1] == fence_char:
+        end -= 1
+    return len(text) - end
+
+
+# Phát hiện các khối mã ngay trong lúc text đang được stream về, để frontend hiển thị code sớm
+# thay vì chờ toàn bộ phản hồi. Xử lý theo từng dòng với cùng luật fence của code_blocks.parse_fenced_blocks:
+# nối các delta của một khối luôn ra đúng block.code mà parse_fenced_blocks trả về cho toàn bộ text.
+# Chỉ giữ phần chưa gửi (dòng hiện tại chưa rõ có phải fence không, khoảng trắng cuối) nên mỗi ký tự chỉ được xử lý một lần.
+class StreamingCodeBlockDetector:
+    def __init__(self):
+        self.block_index = -1
+        self.language = None
+        self._fence = None # (fence_char, fence_len) của khối đang mở; None = đang ở ngoài khối
+        self._line = "" # Phần chưa xử lý của dòng hiện tại
+        self._line_is_code = False # Dòng hiện tại (trong khối) chắc chắn không phải fence đóng, đã được gửi dần
+        self._skip_line = False # Dòng hiện tại (ngoài khối) chắc chắn không phải fence mở
+        self._held = "" # Code chưa gửi, chỉ gửi khi có nội dung tiếp theo (xem _held_suffix_length)
+
+    # Nhận thêm text, trả về danh sách sự kiện code:
+    # {"block_index", "language", "delta", "closed"}
+    def feed(self, text):
+        events = []
+        pos = 0
+        while True:
+            newline = text.find("\n", pos)
+            if newline == -1:
+                self._feed_partial(text[pos:], events)
+                return events
+            self._feed_partial(text[pos:newline], events)
+            self._end_line(events)
+            pos = newline + 1
+
+    # Gọi khi stream kết thúc: xử lý dòng cuối không có "\n" và khối chưa đóng
+    # (cùng cách parse_fenced_blocks xử lý cuối text)
+    def finish(self):
+        events = []
+        line, self._line = self._line, ""
+        if self._fence is None:
+            if not self._skip_line and line:
+                self._open_block(line.rstrip("\r"), events)
+            self._skip_line = False
+            if self._fence is None:
+                return events
+            line = ""
+
+        if not self._line_is_code and is_closing_fence(line.rstrip("\r"), *self._fence):
+            self._close(events)
+            return events
+        rest = self._held + line
+        fence_char, fence_len = self._fence
+        closed = rest.rstrip().endswith(fence_char * fence_len) # Fence đóng dính cuối dòng cuối, vd "print(1)```"
+        if closed:
+            rest = rest.rstrip()[:-fence_len]
+        self._emit(rest.rstrip("\r\n"), closed, events)
+        self._reset()
+        return events
+
+    def _emit(self, delta, closed, events):
+        events.append({"block_index": self.block_index, "language": self.language, "delta": delta, "closed": closed})
+
+    def _reset(self):
+        self._fence = None
+        self._line_is_code = False
+        self._held = ""
+
+    def _feed_partial(self, text, events):
+        if not text:
+            return
+        if self._fence is None:
+            if self._skip_line:
+                return
+            self._line += text
+            stripped = self._line.lstrip()
+            if stripped and stripped[0] not in "`~":
+                self._skip_line = True
+                self._line = ""
+            return
+        if self._line_is_code:
+            self._send_code(text, events)
+            return
+        self._line += text
+        stripped = self._line.lstrip()
+        if stripped and stripped[0] != self._fence[0]:
+            self._line_is_code = True
+            line, self._line = self._line, ""
+            self._send_code(line, events)
+
+    def _end_line(self, events):
+        line, self._line = self._line, ""
+        if self._fence is None:
+            if not self._skip_line:
+                self._open_block(line.rstrip("\r"), events)
+            self._skip_line = False
+        elif self._line_is_code:
+            self._line_is_code = False
+            self._send_code("\n", events)
+        elif is_closing_fence(line.rstrip("\r"), *self._fence):
+            self._close(events)
+        else:
+            self._send_code(line + "\n", events)
+
+    def _open_block(self, line, events):
+        opening = opening_fence(line)
+        if not opening:
+            return
+        kind, fence_char, fence_len, language = opening[:4]
+        self.block_index += 1
+        self.language = language or None
+        if kind == "inline":
+            self._emit(opening[4], True, events)
+        else:
+            self._fence = (fence_char, fence_len)
+
+    # Gửi code mới, giữ lại phần đuôi có thể bị bỏ khi khối kết thúc
+    def _send_code(self, text, events):
+        body = self._held + text
+        held = _held_suffix_length(body, self._fence[0])
+        self._held = body[len(body) - held:] if held else ""
+        if len(body) > held:
+            self._emit(body[:len(body) - held], False, events)
+
+    def _close(self, events):
+        self._emit(self._held.rstrip("\r\n"), True, events)
+        self._reset()
@@ -0,0 +1,67 @@
+# backend/tests/test_job_queue.py
+#   cd backend && python -m unittest discover -s tests
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from job_queue import JobQueue
+from process_runner import run_process
+
+
+def _process_gone(pid):
+    try:
+        with open(f"/proc/{pid}/stat", encoding="ascii") as stat_file:
+            return stat_file.read().rsplit(")", 1)[1].split()[0] in ("Z", "X") # Zombie chờ init reap coi như đã chết
+    except FileNotFoundError:
+        return True
+
+
+def _wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return condition()
+
+
+@unittest.skipUnless(sys.platform.startswith("linux") and shutil.which("bash"), "cần Linux và bash")
+class CancelKillsProcessTreeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.pid_file = os.path.join(self.tmp_dir, "grandchild.pid")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    # Tiến trình chính đã thoát, tiến trình cháu chạy nền (disown) vẫn giữ pipe output: hủy job phải kill nó
+    def test_cancel_after_leader_exit_kills_disowned_grandchild(self):
+        jobs = JobQueue(max_workers=1)
+        runners = []
+        script = f"sleep 30 & echo $! > {self.pid_file}; disown; echo started; exit 0"
+
+        def execute(job):
+            result = run_process(['bash', '-c', script], timeout=60, on_start=lambda runner: (runners.append(runner), job.attach_process(runner)))
+            return result, 200
+
+        job = jobs.submit("execute", execute)
+        self.assertTrue(_wait_for(lambda: os.path.exists(self.pid_file) and os.path.getsize(self.pid_file) > 0, 10))
+        self.assertTrue(_wait_for(lambda: runners and runners[0].process.poll() is not None, 10)) # bash đã thoát
+        with open(self.pid_file, encoding="ascii") as pid_file:
+            grandchild = int(pid_file.read())
+        self.assertFalse(_process_gone(grandchild))
+
+        jobs.cancel(job.id)
+
+        self.assertTrue(_wait_for(lambda: job.finished_at is not None, 10), "job không kết thúc sau khi hủy")
+        self.assertEqual(job.status, "cancelled")
+        self.assertTrue(_wait_for(lambda: _process_gone(grandchild), 5), "tiến trình cháu vẫn chạy sau khi hủy")
+
+
+if __name__ == '__main__':
+    unittest.main()
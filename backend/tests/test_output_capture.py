@@ -0,0 +1,48 @@
+# backend/tests/test_output_capture.py
+#   cd backend && python -m unittest discover -s tests
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from output_capture import StreamCapture
+
+HEAD_BYTES = 65536
+
+
+class SpillBoundaryTest(unittest.TestCase):
+    def setUp(self):
+        self.spill_dir = tempfile.mkdtemp()
+        self.capture = StreamCapture("stdout", HEAD_BYTES, 1024, 1024 * 1024, spill_dir=self.spill_dir)
+
+    def tearDown(self):
+        self.capture.delete()
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    # Chunk đầu kết thúc đúng tại head_bytes (trường hợp thường gặp: bằng READ_CHUNK_SIZE và dung lượng pipe):
+    # file spill vẫn phải chứa head, offset byte/dòng không bị lệch
+    def test_spill_keeps_head_when_chunk_ends_exactly_at_head_bytes(self):
+        head = "A" * (HEAD_BYTES - 1) + "\n"
+        self.capture.feed(head)
+        self.capture.feed("tail\n")
+        self.capture.close()
+
+        self.assertEqual(self.capture.spilled_bytes, HEAD_BYTES + 5)
+        self.assertEqual(self.capture.read_bytes(0, 4), b"AAAA")
+        self.assertEqual(self.capture.read_bytes(HEAD_BYTES, 64), b"tail\n")
+        self.assertEqual(self.capture.read_lines(1, 1, 64), b"tail\n")
+
+    def test_spill_keeps_head_when_chunk_crosses_head_bytes(self):
+        self.capture.feed("B" * (HEAD_BYTES - 2))
+        self.capture.feed("CCCC\n")
+        self.capture.close()
+
+        self.assertEqual(self.capture.spilled_bytes, HEAD_BYTES + 3)
+        self.assertEqual(self.capture.read_bytes(HEAD_BYTES - 4, 64), b"BBCCCC\n")
+
+
+if __name__ == '__main__':
+    unittest.main()
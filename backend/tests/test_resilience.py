@@ -0,0 +1,87 @@
+# backend/tests/test_resilience.py
+#   cd backend && python -m unittest discover -s tests
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from google.api_core import exceptions as google_exceptions
+
+from fake_gemini import FakeGenerativeModel
+from resilience import CircuitOpenError, GeminiResilience
+
+MODEL_NAME = "gemini-1.5-flash"
+
+
+def _fake_model(failure_kind=None):
+    model = FakeGenerativeModel(MODEL_NAME)
+    model.latency = 0
+    model.jitter = 0
+    model.fail_first = 0
+    model.failure_rate = 1 if failure_kind else 0
+    model.failure_kind = failure_kind or 'unavailable'
+    return model
+
+
+def _call(resilience, model, api_key="key"):
+    return resilience.call(api_key, MODEL_NAME, lambda timeout: model.generate_content("x", request_options={"timeout": timeout}))
+
+
+class BreakerAccountingTest(unittest.TestCase):
+    def _resilience(self, max_attempts, threshold, reset_seconds=60):
+        return GeminiResilience(max_attempts=max_attempts, base_delay=0, max_delay=0, deadline_seconds=30,
+                                breaker_failure_threshold=threshold, breaker_reset_seconds=reset_seconds)
+
+    # Lỗi phía request (API key sai) xen giữa các lỗi 503 không được reset bộ đếm của breaker
+    def test_request_side_errors_do_not_reset_failures(self):
+        resilience = self._resilience(max_attempts=1, threshold=3)
+        down, bad_key = _fake_model('unavailable'), _fake_model('invalid_key')
+        for _ in range(2):
+            with self.assertRaises(google_exceptions.ServiceUnavailable):
+                _call(resilience, down)
+            with self.assertRaises(google_exceptions.InvalidArgument):
+                _call(resilience, bad_key, api_key="bad")
+        with self.assertRaises(google_exceptions.ServiceUnavailable):
+            _call(resilience, down)
+
+        self.assertEqual(resilience.stats()["breakers"][MODEL_NAME]["state"], "open")
+        with self.assertRaises(CircuitOpenError):
+            _call(resilience, _fake_model())
+
+    # Mỗi lời gọi chỉ tính một lỗi dù đã thử lại nhiều lần, và lần retry cuối không bị đổi thành CircuitOpenError
+    def test_failure_counted_once_per_call_after_retries(self):
+        resilience = self._resilience(max_attempts=3, threshold=2)
+        down = _fake_model('unavailable')
+
+        with self.assertRaises(google_exceptions.ServiceUnavailable):
+            _call(resilience, down)
+        self.assertEqual(resilience.stats()["breakers"][MODEL_NAME], {"state": "closed", "consecutive_failures": 1})
+
+        with self.assertRaises(google_exceptions.ServiceUnavailable):
+            _call(resilience, down)
+        self.assertEqual(resilience.stats()["breakers"][MODEL_NAME]["state"], "open")
+        self.assertEqual(resilience.stats()["retries"], 4)
+
+    # Lượt thử của half_open được retry trong cùng lời gọi; thành công thì breaker đóng lại
+    def test_half_open_probe_keeps_its_retries(self):
+        resilience = self._resilience(max_attempts=3, threshold=1, reset_seconds=0)
+        model = _fake_model('unavailable')
+        with self.assertRaises(google_exceptions.ServiceUnavailable):
+            _call(resilience, model)
+        self.assertEqual(resilience.stats()["breakers"][MODEL_NAME]["state"], "open")
+
+        attempts = []
+
+        def recovering(timeout):
+            attempts.append(timeout)
+            model.failure_rate = 0 if len(attempts) > 1 else 1
+            return model.generate_content("x", request_options={"timeout": timeout})
+
+        resilience.call("key", MODEL_NAME, recovering)
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(resilience.stats()["breakers"][MODEL_NAME], {"state": "closed", "consecutive_failures": 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
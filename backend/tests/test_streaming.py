@@ -0,0 +1,68 @@
+# backend/tests/test_streaming.py
+#   cd backend && python -m unittest discover -s tests
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from code_blocks import parse_fenced_blocks
+from streaming import StreamingCodeBlockDetector
+
+SAMPLES = [
+    "Chạy thử:\n```python\nprint(1)\n\nprint(2)\n```\nXong.",
+    "```bash pip install requests```\n```js\nconsole.log(1)\n```",
+    "````md\n```python\nx = 1\n```\n````\n~~~\nplain\n~~~~\n",
+    "Cắt giữa chừng:\n```python\nfor i in range(3):\n    print(i)  \n\n",
+    "```python\nprint(1)```",
+    "```python\nx = `a`\ns = '``'\n```",
+    "```python\r\nprint(1)\r\n\r\n```\r\n",
+    "```\n```",
+    "text ``` not a fence\n```python",
+    "```py\ncode\n  ```  \nafter\n```sh\nls\n",
+]
+
+
+def _stream(text, sizes):
+    detector = StreamingCodeBlockDetector()
+    events = []
+    pos = 0
+    for size in sizes:
+        events.extend(detector.feed(text[pos:pos + size]))
+        pos += size
+    events.extend(detector.feed(text[pos:]))
+    events.extend(detector.finish())
+    return events
+
+
+def _blocks_from_events(events):
+    blocks = {}
+    for event in events:
+        block = blocks.setdefault(event["block_index"], {"language": event["language"], "code": "", "closed": False})
+        block["code"] += event["delta"]
+        block["closed"] = event["closed"]
+    return [blocks[index] for index in sorted(blocks)]
+
+
+class StreamingMatchesParseTest(unittest.TestCase):
+    # Dù text bị cắt thành chunk thế nào, nối các delta phải ra đúng kết quả của parse_fenced_blocks
+    def test_deltas_match_parse_fenced_blocks_for_any_chunking(self):
+        rng = random.Random(0)
+        for text in SAMPLES:
+            expected = [{"language": block.language or None, "code": block.code, "closed": block.closed}
+                        for block in parse_fenced_blocks(text)["blocks"]]
+            chunkings = [[len(text)], [1] * len(text)] + [[rng.randint(1, 8) for _ in range(len(text))] for _ in range(30)]
+            for sizes in chunkings:
+                with self.subTest(text=text, sizes=sizes[:10]):
+                    self.assertEqual(_blocks_from_events(_stream(text, sizes)), expected)
+
+    def test_code_is_sent_before_block_closes(self):
+        detector = StreamingCodeBlockDetector()
+        events = detector.feed("```python\nprint(1)\nprint(2")
+        self.assertEqual("".join(event["delta"] for event in events), "print(1)\nprint(2")
+        self.assertFalse(any(event["closed"] for event in events))
+
+
+if __name__ == '__main__':
+    unittest.main()
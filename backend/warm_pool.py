@@ -0,0 +1,135 @@
+# backend/warm_pool.py
+# Pool các interpreter Python đã khởi động sẵn (đã qua bước startup, import site và các module preload).
+# Mỗi worker nhận đúng một snippet qua stdin, chạy trong namespace mới rồi thoát,
+# pool spawn worker thay thế ở nền -> giữ được cách ly giữa các lần chạy mà giảm độ trễ khởi động.
+import logging
+import subprocess
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Script chạy trong worker: preload module, chờ code trên stdin, exec như __main__
+BOOTSTRAP = r"""
+import sys, traceback as _traceback
+for _name in sys.argv[1:]:
+    try:
+        __import__(_name)
+    except Exception:
+        pass
+_code = sys.stdin.buffer.read().decode('utf-8')
+_filename = '<snippet>'
+sys.argv = [_filename]
+_globals = {'__name__': '__main__', '__builtins__': __builtins__}
+try:
+    exec(compile(_code, _filename, 'exec'), _globals)
+except SystemExit:
+    raise
+except BaseException:
+    _type, _value, _tb = sys.exc_info()
+    _traceback.print_exception(_type, _value, _tb.tb_next)
+    sys.exit(1)
+"""
+
+
+class PythonWarmPool:
+    def __init__(self, size=2, preload_modules=None, max_idle_seconds=300, python_executable=None, env_factory=None):
+        self.size = max(0, int(size))
+        self.preload_modules = list(preload_modules or [])
+        self.max_idle_seconds = float(max_idle_seconds)
+        self.python_executable = python_executable or sys.executable
+        self.env_factory = env_factory # Hàm trả về env cho worker mới
+        self._ready = [] # [(spawned_at, Popen)]
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self.hits = 0
+        self.misses = 0
+        self.spawned = 0
+        if self.size:
+            threading.Thread(target=self._maintain_loop, name="python-warm-pool", daemon=True).start()
+
+    # Lấy một worker sẵn sàng; trả về None nếu pool rỗng (caller dùng đường chạy nguội)
+    def acquire(self):
+        with self._lock:
+            while self._ready:
+                spawned_at, process = self._ready.pop(0)
+                if process.poll() is None:
+                    self.hits += 1
+                    self._wakeup.set()
+                    return process
+            self.misses += 1
+        self._wakeup.set()
+        return None
+
+    # Bỏ toàn bộ worker đang chờ (vd: sau khi cài package mới) để worker mới thấy môi trường mới
+    def recycle_all(self):
+        with self._lock:
+            stale, self._ready = self._ready, []
+        for _spawned_at, process in stale:
+            self._terminate(process)
+        self._wakeup.set()
+
+    def shutdown(self):
+        self._stopped = True
+        self.recycle_all()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "ready": len(self._ready),
+                "hits": self.hits,
+                "misses": self.misses,
+                "spawned": self.spawned,
+                "preload_modules": self.preload_modules,
+                "max_idle_seconds": self.max_idle_seconds,
+            }
+
+    def _spawn(self):
+        popen_kwargs = {}
+        if sys.platform == "win32":
+            popen_kwargs["creationflags"] = subprocess.CREATE_NEW_PROCESS_GROUP
+        else:
+            popen_kwargs["start_new_session"] = True # Để có thể kill cả cây tiến trình như đường chạy thường
+        return subprocess.Popen(
+            [self.python_executable, '-c', BOOTSTRAP, *self.preload_modules],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            env=self.env_factory() if self.env_factory else None, **popen_kwargs
+        )
+
+    @staticmethod
+    def _terminate(process):
+        try:
+            process.kill()
+            process.wait(timeout=5)
+        except Exception:
+            pass
+        for pipe in (process.stdin, process.stdout, process.stderr):
+            try:
+                pipe.close()
+            except Exception:
+                pass
+
+    # Giữ đủ số worker sẵn sàng, thay các worker đã chết hoặc chờ quá lâu
+    def _maintain_loop(self):
+        while not self._stopped:
+            self._wakeup.clear()
+            now = time.monotonic()
+            with self._lock:
+                expired = [entry for entry in self._ready if entry[1].poll() is not None or now - entry[0] > self.max_idle_seconds]
+                self._ready = [entry for entry in self._ready if entry not in expired]
+                missing = self.size - len(self._ready)
+            for _spawned_at, process in expired:
+                self._terminate(process)
+            for _ in range(missing):
+                try:
+                    process = self._spawn()
+                except Exception as e:
+                    logger.error(f"Không thể khởi động worker Python cho warm pool: {e}")
+                    break
+                with self._lock:
+                    self._ready.append((time.monotonic(), process))
+                    self.spawned += 1
+            self._wakeup.wait(timeout=min(self.max_idle_seconds, 30))
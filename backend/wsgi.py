@@ -0,0 +1,7 @@
+# backend/wsgi.py
+# Điểm vào WSGI cho server bên ngoài, ví dụ:
+#   cd backend && gunicorn -c gunicorn.conf.py wsgi:app
+#   cd backend && waitress-serve --port=5001 --threads=16 wsgi:app
+from app import app
+
+__all__ = ["app"]
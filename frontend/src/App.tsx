@@ -96,6 +96,8 @@ function App() {
   const [targetOs, setTargetOs] = useState<TargetOS>('auto');
   const [fileType, setFileType] = useState<string>('py'); // Mặc định là python
   const [customFileName, setCustomFileName] = useState<string>('');
+  // Id hội thoại gửi kèm mỗi request để backend ghi lịch sử (xem /api/conversations)
+  const [conversationId] = useState<string>(() => crypto.randomUUID?.() ?? `${Date.now()}-${Math.random().toString(36).slice(2)}`);
   // ------------------------------------
 
   // --- Tải tên model đã lưu ---
@@ -191,7 +193,7 @@ function App() {
     try {
         const response = await fetch(`http://localhost:5001/api/${endpoint}`, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: { 'Content-Type': 'application/json', 'X-Conversation-Id': conversationId },
             body: JSON.stringify({
                 ...body,
                 model_config: effectiveModelConfig,
@@ -213,7 +215,7 @@ function App() {
          if (error.name === 'AbortError') { throw new Error(`Yêu cầu tới /${endpoint} bị quá thời gian (60s).`); }
          throw error;
     }
-  }, [modelConfig, useUiApiKey, uiApiKey, targetOs, fileType, customFileName]);
+  }, [modelConfig, useUiApiKey, uiApiKey, targetOs, fileType, customFileName, conversationId]);
   // ----------------------------------------------
 
   // --- Hàm đóng/mở khối user và output ---
@@ -323,7 +325,7 @@ function App() {
 
             const response = await fetch('http://localhost:5001/api/execute', {
                 method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
+                headers: { 'Content-Type': 'application/json', 'X-Conversation-Id': conversationId },
                 body: JSON.stringify({ code: codeToExecute, run_as_admin: runAsAdmin, file_type: fileTypeForExecution }),
                 signal: controller.signal
             });
@@ -352,7 +354,7 @@ function App() {
                  else { setConversation(prev => [...prev, blockToAdd]); }
             }
         }
-      }, [runAsAdmin, conversation, fileType, customFileName]);
+      }, [runAsAdmin, conversation, fileType, customFileName, conversationId]);
 
       const handleDebug = useCallback(async (codeToDebug: string | null, lastExecutionResult: ExecutionResult | null, blockId: string) => {
            const hasErrorSignal = (execResult: ExecutionResult | null): boolean => {